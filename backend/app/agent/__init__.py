@@ -8,6 +8,7 @@ from .llm_caller import LLMCaller, OpenAILLMCaller
 from .tool_invoker import ToolInvoker
 from .event_logger import EventLogger, LogEntry
 from .ai_assistant import AIAssistant
+from .container import AgentServices, agent_services
 
 __all__ = [
     'ContextBuilder',
@@ -16,5 +17,7 @@ __all__ = [
     'ToolInvoker',
     'EventLogger',
     'LogEntry',
-    'AIAssistant'
+    'AIAssistant',
+    'AgentServices',
+    'agent_services'
 ]
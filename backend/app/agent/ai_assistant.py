@@ -3,13 +3,13 @@ AI助手主控制器
 整合上下文构建、LLM调用、工具调度和事件日志等模块，实现完整的对话处理流程
 """
 
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, List, Optional, AsyncIterator
+import asyncio
 import uuid
 import logging
 import json
 import os
 import time
-from typing import Dict, Any, List, Optional
 from datetime import datetime
 
 # 导入Tavily客户端
@@ -24,14 +24,111 @@ from .tool_invoker import ToolInvoker, get_weather, generate_ai_id, generate_fre
 from .event_logger import EventLogger
 from app.services.chat_memory_integration import ChatMemoryIntegration
 
+# 保存用户消息和AI回复的后台任务，保留引用避免任务被回收
+_background_tasks = set()
+
+def _run_in_background(coro):
+    task = asyncio.ensure_future(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+async def _timed_stage(timings: Dict[str, float], name: str, coro):
+    """等待一个处理阶段完成，把耗时（毫秒）记录到 timings[name]"""
+    stage_start = time.perf_counter()
+    try:
+        return await coro
+    finally:
+        timings[name] = round((time.perf_counter() - stage_start) * 1000, 1)
+
+async def _await_persistence(persistence):
+    """等待保存用户消息和更新会话的阶段完成，保证AI回复写在用户消息之后"""
+    if persistence is None:
+        return
+    for result in await persistence:
+        if isinstance(result, Exception):
+            logging.error(f"保存用户消息或更新会话失败: {str(result)}")
+
+def register_default_tools(tool_invoker: ToolInvoker):
+    """注册AI助手的默认工具"""
+    # 天气工具
+    tool_invoker.register_tool(
+        name="get_weather",
+        func=get_weather,
+        description="获取指定城市和日期的天气信息",
+        parameters={
+            "city": {
+                "type": "string",
+                "description": "城市名称，如北京、上海、新加坡等"
+            },
+            "date": {
+                "type": "string",
+                "description": "日期，如今天、明天、后天等",
+                "optional": True
+            }
+        }
+    )
+    
+    # AI-ID生成工具
+    tool_invoker.register_tool(
+        name="generate_ai_id",
+        func=generate_ai_id,
+        description="生成唯一的AI-ID标识符",
+        parameters={
+            "name": {
+                "type": "string",
+                "description": "AI的名称（可选）",
+                "optional": True
+            }
+        }
+    )
+    
+    # 频率编号生成工具
+    tool_invoker.register_tool(
+        name="generate_frequency",
+        func=generate_frequency,
+        description="基于AI-ID生成频率编号",
+        parameters={
+            "ai_id": {
+                "type": "string",
+                "description": "AI-ID标识符"
+            },
+            "personality_type": {
+                "type": "string",
+                "description": "人格类型代码，默认为P",
+                "optional": True
+            },
+            "ai_type": {
+                "type": "string",
+                "description": "AI类型代码，默认为A",
+                "optional": True
+            }
+        }
+    )
+
 class AIAssistant:
     """主AI助手控制器，整合所有模块"""
     
-    def __init__(self, model_name: str = "gpt-4o"):
+    def __init__(self, model_name: str = "gpt-4o", services=None):
+        """
+        Args:
+            model_name: 模型名称
+            services: 应用级共享服务（app.agent.container.AgentServices）。为空时自行创建全部依赖，
+                      关闭时一起释放；路由中通过 agent_services.session() 获取实例，
+                      只新建本次请求的上下文和事件日志，其余依赖由应用关闭时释放
+        """
         self.context_builder = ContextBuilder()
+        self.event_logger = EventLogger()
+        self._owns_resources = services is None
+        if services is not None:
+            self.llm_caller = services.llm_caller(model_name)
+            self.tool_invoker = services.tool_invoker
+            self.chat_service = services.chat_service
+            self.chat_memory_integration = services.chat_memory_integration
+            return
+        
         self.llm_caller = OpenAILLMCaller(model_name)
         self.tool_invoker = ToolInvoker()
-        self.event_logger = EventLogger()
         
         # 导入聊天服务
         from app.services.chat_service import ChatService
@@ -41,14 +138,15 @@ class AIAssistant:
         self.chat_memory_integration = ChatMemoryIntegration()
         
         # 注册默认工具
-        self._register_default_tools()
+        register_default_tools(self.tool_invoker)
         
     async def close(self):
         """关闭所有资源"""
         try:
-            # 关闭LLM调用器
+            # 关闭LLM调用器（共享的调用器由应用关闭时释放）
             if hasattr(self, 'llm_caller'):
-                await self.llm_caller.close()
+                if self._owns_resources and self.llm_caller is not None:
+                    await self.llm_caller.close()
                 self.llm_caller = None
             
             # 关闭其他可能持有资源的对象
@@ -80,63 +178,6 @@ class AIAssistant:
     async def __aexit__(self, exc_type, exc_val, exc_tb):
         await self.close()
         
-    def _register_default_tools(self):
-        """注册默认工具"""
-        # 天气工具
-        self.tool_invoker.register_tool(
-            name="get_weather",
-            func=get_weather,
-            description="获取指定城市和日期的天气信息",
-            parameters={
-                "city": {
-                    "type": "string",
-                    "description": "城市名称，如北京、上海、新加坡等"
-                },
-                "date": {
-                    "type": "string",
-                    "description": "日期，如今天、明天、后天等",
-                    "optional": True
-                }
-            }
-        )
-        
-        # AI-ID生成工具
-        self.tool_invoker.register_tool(
-            name="generate_ai_id",
-            func=generate_ai_id,
-            description="生成唯一的AI-ID标识符",
-            parameters={
-                "name": {
-                    "type": "string",
-                    "description": "AI的名称（可选）",
-                    "optional": True
-                }
-            }
-        )
-        
-        # 频率编号生成工具
-        self.tool_invoker.register_tool(
-            name="generate_frequency",
-            func=generate_frequency,
-            description="基于AI-ID生成频率编号",
-            parameters={
-                "ai_id": {
-                    "type": "string",
-                    "description": "AI-ID标识符"
-                },
-                "personality_type": {
-                    "type": "string",
-                    "description": "人格类型代码，默认为P",
-                    "optional": True
-                },
-                "ai_type": {
-                    "type": "string",
-                    "description": "AI类型代码，默认为A",
-                    "optional": True
-                }
-            }
-        )
-    
     async def process_query(self, user_input: str, session_id: str = None, user_id: str = None, ai_id: str = None, image_data: str = None, file_data: Dict[str, Any] = None) -> Dict[str, Any]:
         """处理用户查询的完整流程
         
@@ -175,26 +216,186 @@ class AIAssistant:
                 "tool_results": [],
                 "error": str(e)
             }
+    
+    async def process_query_stream(self, user_input: str, session_id: str = None, user_id: str = None, ai_id: str = None, image_data: str = None, file_data: Dict[str, Any] = None) -> AsyncIterator[Dict[str, Any]]:
+        """流式处理用户查询，参数与 process_query 相同
+        
+        LLM 生成的文本逐段返回，AI回复在流结束后由后台任务保存到数据库，
+        客户端断开连接不会影响保存。
+        
+        Yields:
+            {"type": "start", "session_id": 会话ID}
+            {"type": "token", "content": 文本片段}
+            {"type": "reset"}：之前的文本作废（AI不确定时使用搜索结果重新回答）
+            {"type": "tool_call", "name": 工具名称, "arguments": 参数}
+            {"type": "tool_result", "name": 工具名称, "result": 工具结果}
+            {"type": "done", ...}：其余字段与 process_query 的返回值相同
+            {"type": "error", "error": 错误信息, "response": 提示文本}
+        """
+        try:
+            context = await self._prepare_query(user_input, session_id, user_id, ai_id, image_data, file_data)
+            session_id = context["session_id"]
+            yield {"type": "start", "session_id": session_id}
+            async for event in self._stream_turn(context, user_input):
+                yield event
+        except Exception as e:
+            logging.error(f"流式处理查询失败: {str(e)}")
+            yield {
+                "type": "error",
+                "response": f"处理您的请求时出错: {str(e)}",
+                "session_id": session_id,
+                "error": str(e)
+            }
+    
+    async def stream_messages(self, messages: List[Dict[str, Any]], session_id: str = None) -> AsyncIterator[Dict[str, Any]]:
+        """流式回答调用方已经构建好的完整消息列表（如 /chat 请求中的对话）
+        
+        工具调用、不确定时搜索和事件格式都与 process_query_stream 相同，但不读取会话历史，
+        也不保存消息和AI回复（按匿名用户处理）。
+        """
+        session_id = session_id or str(uuid.uuid4())
+        try:
+            user_input = next((msg.get("content") or "" for msg in reversed(messages) if msg.get("role") == "user"), "")
+            self.context_builder.session_id = session_id
+            self.context_builder.user_id = "anonymous"
+            self.context_builder.messages = list(messages)
+            context = {
+                "session_id": session_id,
+                "user_id": "anonymous",
+                "ai_id": self.context_builder.ai_id,
+                "messages": self.context_builder.messages,
+                "start_time": time.time(),
+                "persistence": None,
+                "timings": {}
+            }
+            yield {"type": "start", "session_id": session_id}
+            async for event in self._stream_turn(context, user_input):
+                yield event
+        except Exception as e:
+            logging.error(f"流式处理消息失败: {str(e)}")
+            yield {
+                "type": "error",
+                "response": f"处理您的请求时出错: {str(e)}",
+                "session_id": session_id,
+                "error": str(e)
+            }
+    
+    async def _stream_turn(self, context: Dict[str, Any], user_input: str) -> AsyncIterator[Dict[str, Any]]:
+        """流式执行一轮对话：带工具定义的LLM调用、工具调用和第二次LLM调用，最后返回 done 事件"""
+        # 第一次LLM调用（带工具定义）
+        messages = context["messages"]
+        first_response = None
+        async for event in self._stream_llm(context, messages, self.tool_invoker.get_tool_definitions(), 1):
+            if event["type"] == "done":
+                first_response = event
+            else:
+                yield event
+        
+        # AI表示不确定时使用搜索结果重新回答
+        if not first_response.get("tool_calls") and await self._search_when_uncertain(messages, user_input, first_response.get("content", "")):
+            yield {"type": "reset"}
+            async for event in self._stream_llm(context, messages, None, "search_enhanced"):
+                if event["type"] == "done":
+                    first_response = event
+                else:
+                    yield event
+        
+        if first_response.get("tool_calls"):
+            for tool_call in first_response["tool_calls"]:
+                yield {"type": "tool_call", "name": tool_call["name"], "arguments": tool_call["arguments"]}
+            tool_results = await self._invoke_tool_calls(context, first_response["tool_calls"])
+            for tool_call, tool_result in zip(first_response["tool_calls"], tool_results):
+                yield {"type": "tool_result", "name": tool_call["name"], "result": tool_result}
+            
+            # 第二次LLM调用（不带工具定义）
+            final_response = None
+            async for event in self._stream_llm(context, self.context_builder.get_conversation_history(), None, 2):
+                if event["type"] == "done":
+                    final_response = event
+                else:
+                    yield event
+            result = self._finish_query(context, final_response["content"], True)
+        else:
+            result = self._finish_query(context, first_response["content"], False)
+        
+        yield dict(result, type="done")
             
     async def _process_query_internal(self, user_input: str, session_id: str = None, user_id: str = None, ai_id: str = None, image_data: str = None, file_data: Dict[str, Any] = None) -> Dict[str, Any]:
         """处理用户查询的内部实现方法"""
-        import time
+        context = await self._prepare_query(user_input, session_id, user_id, ai_id, image_data, file_data)
+        session_id, user_id, ai_id = context["session_id"], context["user_id"], context["ai_id"]
+        messages = context["messages"]
+        
+        # 4. 第一次LLM调用（带工具定义）
+        tool_definitions = self.tool_invoker.get_tool_definitions()
+        logging.info(f"开始第一次LLM调用: session_id={session_id}, 消息数={len(messages)}")
+        llm_start_time = time.time()
+        first_response = await self.llm_caller.invoke(messages, tools=tool_definitions)
+        llm_duration = time.time() - llm_start_time
+        context["timings"]["llm_1"] = round(llm_duration * 1000, 1)
+        logging.info(f"完成第一次LLM调用: session_id={session_id}, 耗时={llm_duration:.2f}秒")
+        self.event_logger.log_llm_call(session_id, user_id, ai_id, messages, first_response, 1)
+        
+        # 检查AI回答是否表示不确定或无法回答，如果是则使用搜索结果重新调用LLM
+        if not first_response.get("tool_calls") and await self._search_when_uncertain(messages, user_input, first_response.get("content", "")):
+            logging.info("使用搜索结果重新调用LLM获取回答")
+            llm_start_time = time.time()
+            first_response = await self.llm_caller.invoke(messages)
+            llm_duration = time.time() - llm_start_time
+            context["timings"]["llm_search_enhanced"] = round(llm_duration * 1000, 1)
+            logging.info(f"完成搜索后的LLM调用: session_id={session_id}, 耗时={llm_duration:.2f}秒")
+            self.event_logger.log_llm_call(session_id, user_id, ai_id, messages, first_response, "search_enhanced")
+        
+        # 5. 检查是否有工具调用
+        if first_response.get("tool_calls"):
+            # 处理所有工具调用（6. 并发执行工具调用，7. 更新上下文）
+            await self._invoke_tool_calls(context, first_response["tool_calls"])
+            
+            # 8. 第二次LLM调用（不带工具定义）
+            updated_messages = self.context_builder.get_conversation_history()
+            logging.info(f"开始第二次LLM调用: session_id={session_id}, 消息数={len(updated_messages)}")
+            llm_start_time = time.time()
+            final_response = await self.llm_caller.invoke(updated_messages)
+            llm_duration = time.time() - llm_start_time
+            context["timings"]["llm_2"] = round(llm_duration * 1000, 1)
+            logging.info(f"完成第二次LLM调用: session_id={session_id}, 耗时={llm_duration:.2f}秒")
+            self.event_logger.log_llm_call(session_id, user_id, ai_id, updated_messages, final_response, 2)
+            
+            return self._finish_query(context, final_response["content"], True)
+        
+        # 如果没有工具调用，直接使用第一次响应
+        return self._finish_query(context, first_response["content"], False)
+    
+    async def _prepare_query(self, user_input: str, session_id: str = None, user_id: str = None, ai_id: str = None, image_data: str = None, file_data: Dict[str, Any] = None) -> Dict[str, Any]:
+        """第一次LLM调用之前的步骤：记录输入、构建上下文、保存用户消息、更新会话和记忆增强
+        
+        阶段之间的依赖：
+        - 构建上下文：同步执行，记忆增强会修改其中的系统消息
+        - 保存用户消息、更新会话：互不依赖，也不影响提示词，用 asyncio.gather 在后台并发执行，
+          保存AI回复之前等待完成（见 _await_persistence）
+        - 记忆增强：与上面两个阶段并发执行，只有它会阻塞提示词的构建
+        
+        各阶段的耗时（毫秒）记录在 context["timings"] 中，并随结果返回。
+        
+        Returns:
+            处理上下文：session_id、user_id、ai_id、messages（发送给LLM的消息）、start_time、
+            persistence（保存阶段的 Future，匿名用户为 None）和 timings
+        """
         start_time = time.time()
+        timings = {}
         logging.info(f"开始处理查询: session_id={session_id}, user_id={user_id}, 输入长度={len(user_input)}字符")
         
         # 生成会话 ID 和其他标识符（如果未提供）
         session_id = session_id or str(uuid.uuid4())
         user_id = user_id or "user_" + str(uuid.uuid4())[:8]
         ai_id = ai_id or "ai_" + str(uuid.uuid4())[:8]
+        anonymous = user_id == "anonymous" or user_id.startswith("anonymous")
         
         # 设置上下文构建器的会话信息
         self.context_builder.session_id = session_id
         self.context_builder.user_id = user_id
         self.context_builder.ai_id = ai_id
         
-        # 初始化结果变量
-        result = None
-        
         # 1. 记录用户输入和文件信息
         file_type = file_data.get('type') if file_data else None
         file_info = file_data.get('info') if file_data else None
@@ -204,36 +405,6 @@ class AIAssistant:
             file_type=file_type, file_info=file_info
         )
         
-        # 保存用户输入到数据库（仅对非匿名用户）
-        
-        # 检查是否为匿名用户
-        if user_id == "anonymous" or user_id.startswith("anonymous"):
-            logging.info(f"匿名用户，跳过数据库保存用户消息: session_id={session_id}")
-        else:
-            logging.info(f"Saving user message for session {session_id}")
-            # 使用await等待消息保存完成
-            await self.chat_service.save_message(
-                session_id=session_id,
-                user_id=user_id,
-                role=user_id,  # 用户角色就是用户ID
-                content=user_input,
-                content_type="text",
-                metadata={"file_type": file_type} if file_type else None
-            )
-        
-        # 更新或创建会话元数据（仅对非匿名用户）
-        if user_id == "anonymous" or user_id.startswith("anonymous"):
-            logging.info(f"匿名用户，跳过数据库更新会话元数据: session_id={session_id}")
-        else:
-            logging.info(f"Updating session metadata for session {session_id}")
-            await self.chat_service.update_session(
-                session_id=session_id,
-                user_id=user_id,
-                title=user_input[:30] + ("..." if len(user_input) > 30 else ""),  # 使用用户输入的前30个字符作为标题
-                last_message=user_input,
-                last_message_time=datetime.now().isoformat()
-            )
-        
         # 2. 构建初始上下文
         logging.debug(f"Building initial context with user input and file data")
         
@@ -250,283 +421,268 @@ class AIAssistant:
             file_data=file_data
         )
         
-        # 3. 使用记忆增强上下文（如果不是匿名用户）
-        if user_id != "anonymous" and not user_id.startswith("anonymous"):
-            try:
-                # 导入超时处理模块
-                import asyncio
-                from asyncio import TimeoutError
-                
-                # 获取记忆增强，添加3秒超时
-                logging.info(f"开始获取记忆增强: user_id={user_id}, session_id={session_id}")
-                memory_enhancement = await asyncio.wait_for(
-                    self.chat_memory_integration.enhance_response_with_memories(
-                        user_id=user_id,
-                        user_message=user_input,
-                        current_session_id=session_id
-                    ),
-                    timeout=3.0  # 3秒超时
-                )
-                
-                enhanced_context = memory_enhancement.get("context_enhancement", "")
-                if enhanced_context:
-                    logging.info(f"成功获取记忆增强上下文: {len(enhanced_context)} 字符")
-                    
-                    # 在系统消息中添加记忆增强上下文
-                    system_message = None
-                    for msg in self.context_builder.messages:
-                        if msg.get("role") == "system":
-                            system_message = msg
-                            break
-                            
-                    if system_message:
-                        # 在系统消息中添加记忆增强
-                        original_content = system_message.get("content", "")
-                        system_message["content"] = f"{original_content}\n\n用户相关信息:\n{enhanced_context}"
-                        logging.info("记忆增强已添加到系统消息")
-            except TimeoutError:
-                logging.warning(f"记忆增强超时，继续处理但不使用记忆增强: session_id={session_id}")
-            except Exception as e:
-                logging.error(f"获取记忆增强失败: {str(e)}")
+        persistence = None
+        if anonymous:
+            logging.info(f"匿名用户，跳过保存用户消息、更新会话元数据和记忆增强: session_id={session_id}")
         else:
-            logging.info(f"匿名用户，跳过记忆增强: user_id={user_id}, session_id={session_id}")
-
+            # 3. 在后台并发保存用户消息和更新会话元数据，对话次数交给计数缓冲
+            self.chat_service.count_conversation(user_id)
+            logging.info(f"Saving user message and updating session metadata for session {session_id}")
+            persistence = _run_in_background(asyncio.gather(
+                _timed_stage(timings, "save_user_message", self.chat_service.save_message(
+                    session_id=session_id,
+                    user_id=user_id,
+                    role=user_id,  # 用户角色就是用户ID
+                    content=user_input,
+                    content_type="text",
+                    metadata={"file_type": file_type} if file_type else None
+                )),
+                _timed_stage(timings, "update_session", self.chat_service.update_session(
+                    session_id=session_id,
+                    user_id=user_id,
+                    title=user_input[:30] + ("..." if len(user_input) > 30 else ""),  # 使用用户输入的前30个字符作为标题
+                    last_message=user_input,
+                    last_message_time=datetime.now().isoformat()
+                )),
+                return_exceptions=True
+            ))
+            
+            # 4. 使用记忆增强上下文
+            await _timed_stage(timings, "memory_enhancement", self._enhance_with_memories(user_input, session_id, user_id))
         
         messages = self.context_builder.get_conversation_history()
-        
-        # 4. 第一次LLM调用（带工具定义）
-        tool_definitions = self.tool_invoker.get_tool_definitions()
-        logging.info(f"开始第一次LLM调用: session_id={session_id}, 消息数={len(messages)}")
-        llm_start_time = time.time()
-        first_response = await self.llm_caller.invoke(messages, tools=tool_definitions)
-        llm_duration = time.time() - llm_start_time
-        logging.info(f"完成第一次LLM调用: session_id={session_id}, 耗时={llm_duration:.2f}秒")
-        self.event_logger.log_llm_call(session_id, user_id, ai_id, messages, first_response, 1)
-        
-        # 检查AI回答是否表示不确定或无法回答
-        if not first_response.get("tool_calls"):
-            # 如果没有工具调用，检查AI回答是否表示不确定
-            initial_content = first_response.get("content", "").lower()
-            
-            # 检测AI是否表示不知道或无法回答
-            uncertainty_phrases = [
-                "我不知道", "无法提供", "没有这个信息", "无法回答", "不确定", 
-                "没有足够的信息", "知识有限", "知识库中没有", "训练数据中没有",
-                "知识库截止于", "信息可能过时", "无法获取实时信息", "无法搜索",
-                "建议您查询", "建议您搜索", "建议您查找", "无法访问互联网",
-                "抱歉", "sorry", "无法获取", "无法为您提供", "无法实时", "作为ai", "作为 ai",
-                "实时信息", "最新信息", "实时数据", "实时查询", "实时获取",
-                "天气应用程序", "气象网站", "搜索引擎"
-            ]
-            
-            logging.debug(f"检查AI回答是否包含不确定性短语: {initial_content[:100]}...")
-            
-            # 检测是否包含不确定性短语
-            matched_phrases = [phrase for phrase in uncertainty_phrases if phrase in initial_content]
-            
-            logging.debug(f"检测到的不确定性短语: {matched_phrases if matched_phrases else '无'}")
+        timings["prepare"] = round((time.time() - start_time) * 1000, 1)
+        return {
+            "session_id": session_id,
+            "user_id": user_id,
+            "ai_id": ai_id,
+            "messages": messages,
+            "start_time": start_time,
+            "persistence": persistence,
+            "timings": timings
+        }
+    
+    async def _enhance_with_memories(self, user_input: str, session_id: str, user_id: str):
+        """获取与用户输入相关的记忆并添加到系统消息中，最多等待3秒"""
+        try:
+            # 获取记忆增强，添加3秒超时
+            logging.info(f"开始获取记忆增强: user_id={user_id}, session_id={session_id}")
+            memory_enhancement = await asyncio.wait_for(
+                self.chat_memory_integration.enhance_response_with_memories(
+                    user_id=user_id,
+                    user_message=user_input,
+                    current_session_id=session_id
+                ),
+                timeout=3.0  # 3秒超时
+            )
             
-            # 如果AI表示不确定或无法回答，自动触发搜索
-            if matched_phrases:
-                logging.debug(f"AI表示不确定，检测到以下短语: {matched_phrases}")
-                logging.info("AI表示不确定，自动触发搜索")
-                
-                # 提取搜索查询
-                search_query = user_input
-                # 如果消息太长，尝试提取关键部分
-                if len(search_query) > 100:
-                    search_query = search_query[:100]
-                    
-                logging.info(f"由于AI不确定，触发搜索: '{search_query}'")
+            enhanced_context = memory_enhancement.get("context_enhancement", "")
+            if enhanced_context:
+                logging.info(f"成功获取记忆增强上下文: {len(enhanced_context)} 字符")
                 
-                try:
-                    # 导入Tavily客户端
-                    from tavily import TavilyClient
-                    
-                    # 从环境变量获取API密钥
-                    import os
-                    api_key = os.getenv("TAVILY_API_KEY")
-                    
-                    if api_key:
-                        # 创建Tavily客户端
-                        client_tavily = TavilyClient(api_key=api_key)
-                        
-                        # 执行搜索
-                        logging.debug(f"开始执行Tavily搜索，参数: query={search_query}, search_depth=basic, max_results=5")
-                        search_result = client_tavily.search(
-                            query=search_query,
-                            search_depth="basic",
-                            max_results=5,
-                            include_answer=True
-                        )
-                        logging.debug("Tavily搜索成功完成")
+                # 在系统消息中添加记忆增强上下文
+                system_message = None
+                for msg in self.context_builder.messages:
+                    if msg.get("role") == "system":
+                        system_message = msg
+                        break
                         
-                        # 将搜索结果添加到消息中
-                        if "answer" in search_result and search_result["answer"]:
-                            logging.debug(f"搜索结果包含答案，长度: {len(search_result['answer'])}")
-                            
-                            # 添加搜索结果作为系统消息
-                            search_message = {
-                                "role": "system",
-                                "content": f"我注意到你对这个问题不确定。根据最新的网络搜索结果，这是关于 '{search_query}' 的信息\n\n{search_result['answer']}\n\n请基于这些信息重新回答用户的问题。"
-                            }
-                            messages.append(search_message)
-                            logging.info(f"已将搜索结果添加到对话中，准备重新生成回答")
-                            
-                            # 添加搜索结果链接作为参考
-                            if "results" in search_result and search_result["results"]:
-                                sources = "\n\n数据来源:\n"
-                                for i, result in enumerate(search_result["results"][:3]):
-                                    sources += f"- {result.get('title', '无标题')}: {result.get('url', '')}\n"
-                                sources_message = {
-                                    "role": "system",
-                                    "content": f"{sources}\n请在回答中包含这些来源信息。"
-                                }
-                                messages.append(sources_message)
-                            
-                            # 重新调用LLM获取更新的回答
-                            logging.info("使用搜索结果重新调用LLM获取回答")
-                            llm_start_time = time.time()
-                            first_response = await self.llm_caller.invoke(messages)
-                            llm_duration = time.time() - llm_start_time
-                            logging.info(f"完成搜索后的LLM调用: session_id={session_id}, 耗时={llm_duration:.2f}秒")
-                            self.event_logger.log_llm_call(session_id, user_id, ai_id, messages, first_response, "search_enhanced")
-                    else:
-                        logging.error("未找到TAVILY_API_KEY环境变量，无法执行搜索")
-                except Exception as e:
-                    logging.error(f"Tavily搜索错误: {str(e)}")
+                if system_message:
+                    # 在系统消息中添加记忆增强
+                    original_content = system_message.get("content", "")
+                    system_message["content"] = f"{original_content}\n\n用户相关信息:\n{enhanced_context}"
+                    logging.info("记忆增强已添加到系统消息")
+        except asyncio.TimeoutError:
+            logging.warning(f"记忆增强超时，继续处理但不使用记忆增强: session_id={session_id}")
+        except Exception as e:
+            logging.error(f"获取记忆增强失败: {str(e)}")
+    
+    async def _stream_llm(self, context: Dict[str, Any], messages: List[Dict[str, Any]], tools: Optional[List[Dict[str, Any]]], call_index) -> AsyncIterator[Dict[str, Any]]:
+        """流式调用LLM，把文本片段转换为 token 事件，最后返回 done 事件并记录调用日志"""
+        logging.info(f"开始流式LLM调用({call_index}): session_id={context['session_id']}, 消息数={len(messages)}")
+        llm_start_time = time.time()
+        async for event in self.llm_caller.invoke_stream(messages, tools=tools):
+            if event["type"] == "content":
+                yield {"type": "token", "content": event["delta"]}
+            elif event["type"] == "done":
+                llm_duration = time.time() - llm_start_time
+                context["timings"][f"llm_{call_index}"] = round(llm_duration * 1000, 1)
+                logging.info(f"完成流式LLM调用({call_index}): session_id={context['session_id']}, 耗时={llm_duration:.2f}秒")
+                self.event_logger.log_llm_call(context["session_id"], context["user_id"], context["ai_id"], messages, event, call_index)
+                yield event
+    
+    async def _search_when_uncertain(self, messages: List[Dict[str, Any]], user_input: str, content: str) -> bool:
+        """AI回答表示不确定时执行搜索，把搜索结果添加到 messages 中
         
-        # 5. 检查是否有工具调用
-        if first_response.get("tool_calls"):
-            # 处理所有工具调用
-            for tool_call in first_response["tool_calls"]:
-                tool_name = tool_call["name"]
-                tool_args = tool_call["arguments"]
-                tool_call_id = tool_call.get("id", f"call_{int(time.time())}")
-                
-                # 6. 执行工具调用
-                tool_result = self.tool_invoker.invoke_tool(tool_name, **tool_args)
-                
-                # 记录工具调用
-                self.event_logger.log_tool_call(
-                    session_id, user_id, ai_id,
-                    tool_name, tool_args, tool_result
-                )
-                
-                # 7. 更新上下文
-                self.context_builder.update_context_with_tool_result(tool_name, tool_result, tool_call_id)
-            
-            # 8. 第二次LLM调用（不带工具定义）
-            updated_messages = self.context_builder.get_conversation_history()
-            logging.info(f"开始第二次LLM调用: session_id={session_id}, 消息数={len(updated_messages)}")
-            llm_start_time = time.time()
-            final_response = await self.llm_caller.invoke(updated_messages)
-            llm_duration = time.time() - llm_start_time
-            logging.info(f"完成第二次LLM调用: session_id={session_id}, 耗时={llm_duration:.2f}秒")
-            self.event_logger.log_llm_call(session_id, user_id, ai_id, updated_messages, final_response, 2)
-            
-            # 9. 添加助手回复到上下文
-            self.context_builder.add_assistant_message(final_response["content"])
+        Returns:
+            是否添加了搜索结果，需要重新调用LLM
+        """
+        initial_content = (content or "").lower()
+        
+        # 检测AI是否表示不知道或无法回答
+        uncertainty_phrases = [
+            "我不知道", "无法提供", "没有这个信息", "无法回答", "不确定", 
+            "没有足够的信息", "知识有限", "知识库中没有", "训练数据中没有",
+            "知识库截止于", "信息可能过时", "无法获取实时信息", "无法搜索",
+            "建议您查询", "建议您搜索", "建议您查找", "无法访问互联网",
+            "抱歉", "sorry", "无法获取", "无法为您提供", "无法实时", "作为ai", "作为 ai",
+            "实时信息", "最新信息", "实时数据", "实时查询", "实时获取",
+            "天气应用程序", "气象网站", "搜索引擎"
+        ]
+        
+        logging.debug(f"检查AI回答是否包含不确定性短语: {initial_content[:100]}...")
+        
+        # 检测是否包含不确定性短语
+        matched_phrases = [phrase for phrase in uncertainty_phrases if phrase in initial_content]
+        
+        logging.debug(f"检测到的不确定性短语: {matched_phrases if matched_phrases else '无'}")
+        
+        # 如果AI表示不确定或无法回答，自动触发搜索
+        if not matched_phrases:
+            return False
+        logging.debug(f"AI表示不确定，检测到以下短语: {matched_phrases}")
+        logging.info("AI表示不确定，自动触发搜索")
+        
+        # 提取搜索查询
+        search_query = user_input
+        # 如果消息太长，尝试提取关键部分
+        if len(search_query) > 100:
+            search_query = search_query[:100]
             
-            # 10. 记录最终响应
-            self.event_logger.log_final_response(
-                session_id, user_id, ai_id,
-                final_response["content"], True
-            )
+        logging.info(f"由于AI不确定，触发搜索: '{search_query}'")
+        
+        try:
+            # 导入Tavily客户端
+            from tavily import TavilyClient
             
-            # 保存AI回复到数据库（仅对非匿名用户）
+            # 从环境变量获取API密钥
+            api_key = os.getenv("TAVILY_API_KEY")
             
-            # 检查是否为匿名用户
-            if user_id == "anonymous" or user_id.startswith("anonymous"):
-                logging.info(f"匿名用户，跳过数据库保存AI回复: session_id={session_id}")
-            else:
-                logging.info(f"Saving AI response for session {session_id}")
-                # 使用await等待消息保存完成
-                await self.chat_service.save_message(
-                    session_id=session_id,
-                    user_id=user_id,
-                    role=f"{user_id}_aiR",  # AI回复的角色格式
-                    content=final_response["content"],
-                    content_type="text"
-                )
+            if not api_key:
+                logging.error("未找到TAVILY_API_KEY环境变量，无法执行搜索")
+                return False
             
-            # 临时禁用会话元数据更新，避免数据库阻塞
-            logging.info(f"临时跳过会话更新以避免阻塞: session_id={session_id}")
-            # 如果需要重新启用会话更新，请使用await
-            # await self.chat_service.update_session(
-            #     session_id=session_id,
-            #     user_id=user_id,
-            #     last_message=final_response["content"][:50] + ("..." if len(final_response["content"]) > 50 else ""),
-            #     last_message_time=datetime.now().isoformat()
-            # )
+            # 创建Tavily客户端
+            client_tavily = TavilyClient(api_key=api_key)
             
-            # 11. 保存日志
-            log_file = self.event_logger.save_logs(session_id)
+            # 执行搜索
+            logging.debug(f"开始执行Tavily搜索，参数: query={search_query}, search_depth=basic, max_results=5")
+            search_result = client_tavily.search(
+                query=search_query,
+                search_depth="basic",
+                max_results=5,
+                include_answer=True
+            )
+            logging.debug("Tavily搜索成功完成")
             
-            # 记录总处理时间
-            total_duration = time.time() - start_time
-            logging.info(f"完成查询处理(有工具调用): session_id={session_id}, 总耗时={total_duration:.2f}秒")
+            # 将搜索结果添加到消息中
+            if not ("answer" in search_result and search_result["answer"]):
+                return False
+            logging.debug(f"搜索结果包含答案，长度: {len(search_result['answer'])}")
             
-            # 返回结果
-            return {
-                "response": final_response["content"],
-                "session_id": session_id,
-                "has_tool_calls": True,
-                "tool_results": self.context_builder.tool_results,
-                "log_file": log_file
+            # 添加搜索结果作为系统消息
+            search_message = {
+                "role": "system",
+                "content": f"我注意到你对这个问题不确定。根据最新的网络搜索结果，这是关于 '{search_query}' 的信息\n\n{search_result['answer']}\n\n请基于这些信息重新回答用户的问题。"
             }
-        else:
-            # 如果没有工具调用，直接使用第一次响应
-            # 添加助手回复到上下文
-            self.context_builder.add_assistant_message(first_response["content"])
+            messages.append(search_message)
+            logging.info(f"已将搜索结果添加到对话中，准备重新生成回答")
             
-            # 记录最终响应
-            self.event_logger.log_final_response(
-                session_id, user_id, ai_id,
-                first_response["content"], False
+            # 添加搜索结果链接作为参考
+            if "results" in search_result and search_result["results"]:
+                sources = "\n\n数据来源:\n"
+                for i, result in enumerate(search_result["results"][:3]):
+                    sources += f"- {result.get('title', '无标题')}: {result.get('url', '')}\n"
+                sources_message = {
+                    "role": "system",
+                    "content": f"{sources}\n请在回答中包含这些来源信息。"
+                }
+                messages.append(sources_message)
+            return True
+        except Exception as e:
+            logging.error(f"Tavily搜索错误: {str(e)}")
+            return False
+    
+    async def _invoke_tool_calls(self, context: Dict[str, Any], tool_calls: List[Dict[str, Any]]) -> List[str]:
+        """并发执行一轮LLM响应中的全部工具调用，按模型给出的顺序记录日志并把结果加入上下文
+        
+        Returns:
+            与 tool_calls 顺序一致的工具结果
+        """
+        for index, tool_call in enumerate(tool_calls):
+            if not tool_call.get("id"):
+                tool_call["id"] = f"call_{int(time.time())}_{index}"
+        
+        tool_start_time = time.perf_counter()
+        tool_results = await self.tool_invoker.invoke_tools(
+            [(tool_call["name"], tool_call["arguments"]) for tool_call in tool_calls]
+        )
+        timings = context["timings"]
+        timings["tools"] = round(timings.get("tools", 0) + (time.perf_counter() - tool_start_time) * 1000, 1)
+        
+        # 记录工具调用
+        for tool_call, tool_result in zip(tool_calls, tool_results):
+            self.event_logger.log_tool_call(
+                context["session_id"], context["user_id"], context["ai_id"],
+                tool_call["name"], tool_call["arguments"], tool_result
             )
-            
-            # 保存AI回复到数据库（仅对非匿名用户）
-            
-            # 检查是否为匿名用户
-            if user_id == "anonymous" or user_id.startswith("anonymous"):
-                logging.info(f"匿名用户，跳过数据库保存AI回复: session_id={session_id}")
-            else:
-                logging.info(f"Saving AI response for session {session_id}")
-                # 使用await等待消息保存完成
-                await self.chat_service.save_message(
-                    session_id=session_id,
-                    user_id=user_id,
-                    role=f"{user_id}_aiR",  # AI回复的角色格式
-                    content=first_response["content"],
-                    content_type="text"
-                )
-            
-            # 临时禁用会话元数据更新，避免数据库阻塞
-            logging.info(f"临时跳过会话更新以避免阻塞: session_id={session_id}")
-            # 如果需要重新启用会话更新，请使用await
-            # await self.chat_service.update_session(
-            #     session_id=session_id,
-            #     user_id=user_id,
-            #     last_message=first_response["content"][:50] + ("..." if len(first_response["content"]) > 50 else ""),
-            #     last_message_time=datetime.now().isoformat()
-            # )
-            
-            # 保存日志
-            log_file = self.event_logger.save_logs(session_id)
-            
-            # 记录总处理时间
-            total_duration = time.time() - start_time
-            logging.info(f"完成查询处理(无工具调用): session_id={session_id}, 总耗时={total_duration:.2f}秒")
-            
-            # 返回结果
-            return {
-                "response": first_response["content"],
-                "session_id": session_id,
-                "has_tool_calls": False,
-                "tool_results": [],
-                "log_file": log_file
-            }
+        
+        # 更新上下文
+        self.context_builder.update_context_with_tool_results(tool_calls, tool_results)
+        return tool_results
+    
+    def _finish_query(self, context: Dict[str, Any], content: str, has_tool_calls: bool) -> Dict[str, Any]:
+        """LLM生成最终回复之后的步骤：更新上下文、记录最终响应、保存日志并构建返回结果
+        
+        AI回复和会话元数据交给延迟写入队列，不等待写入数据库，见 _save_ai_response。
+        """
+        session_id, user_id, ai_id = context["session_id"], context["user_id"], context["ai_id"]
+        
+        # 添加助手回复到上下文
+        self.context_builder.add_assistant_message(content)
+        
+        # 记录最终响应
+        self.event_logger.log_final_response(session_id, user_id, ai_id, content, has_tool_calls)
+        
+        _run_in_background(self._save_ai_response(self.chat_service, session_id, user_id, content, context["persistence"]))
+        
+        # 保存日志
+        log_file = self.event_logger.save_logs(session_id)
+        
+        # 记录总处理时间
+        total_duration = time.time() - context["start_time"]
+        context["timings"]["total"] = round(total_duration * 1000, 1)
+        logging.info(f"完成查询处理({'有' if has_tool_calls else '无'}工具调用): session_id={session_id}, 总耗时={total_duration:.2f}秒")
+        
+        return {
+            "response": content,
+            "session_id": session_id,
+            "has_tool_calls": has_tool_calls,
+            "tool_results": self.context_builder.tool_results if has_tool_calls else [],
+            "log_file": log_file,
+            "timings": dict(context["timings"])
+        }
+    
+    @staticmethod
+    async def _save_ai_response(chat_service, session_id: str, user_id: str, content: str, persistence=None):
+        """把AI回复和会话元数据交给延迟写入队列（仅对非匿名用户）
+        
+        chat_service 由调用方传入：后台保存时 AIAssistant 可能已经关闭。
+        persistence 为 _prepare_query 中保存用户消息的阶段，先等待它完成再提交，
+        保证AI回复写在用户消息之后。
+        """
+        if user_id == "anonymous" or user_id.startswith("anonymous"):
+            logging.info(f"匿名用户，跳过数据库保存AI回复: session_id={session_id}")
+            return
+        await _await_persistence(persistence)
+        logging.info(f"Queueing AI response for session {session_id}")
+        await chat_service.queue_message(
+            session_id=session_id,
+            user_id=user_id,
+            role=f"{user_id}_aiR",  # AI回复的角色格式
+            content=content,
+            content_type="text"
+        )
     
     def get_conversation_history(self, session_id: str) -> List[Dict[str, Any]]:
         """获取会话历史"""
@@ -0,0 +1,158 @@
+"""
+应用级服务容器
+在应用启动时创建一次 AI 助手依赖的服务，并为每个请求提供轻量的 AIAssistant 实例
+
+共享的部分：
+- 一个 HTTP 客户端（支持时使用 HTTP/2，长时间保持连接）和按模型缓存的 OpenAILLMCaller
+- 注册好默认工具的 ToolInvoker
+- ChatService 和 ChatMemoryIntegration（MemoryManager、LLMService、MemoryService）
+
+每个请求只新建 ContextBuilder 和 EventLogger。启动时向 LLM 服务发送一次请求建立连接，
+第一个用户请求不再等待 TLS 握手。
+"""
+
+import asyncio
+import logging
+import importlib.util
+import os
+import time
+from typing import Any, Dict, Optional
+
+import httpx
+
+from .ai_assistant import AIAssistant, register_default_tools
+from .llm_caller import OpenAILLMCaller
+from .tool_invoker import ToolInvoker
+
+# AIAssistant 的默认模型
+AGENT_DEFAULT_MODEL = os.getenv('AGENT_DEFAULT_MODEL', 'gpt-4o')
+# 与 LLM 服务之间使用 HTTP/2（需要安装 h2）
+AGENT_HTTP2 = os.getenv('AGENT_HTTP2', 'true').lower() in ('1', 'true', 'yes')
+# 连接池大小
+AGENT_HTTP_MAX_CONNECTIONS = int(os.getenv('AGENT_HTTP_MAX_CONNECTIONS', '100'))
+AGENT_HTTP_MAX_KEEPALIVE = int(os.getenv('AGENT_HTTP_MAX_KEEPALIVE', '20'))
+# 空闲连接保持的时间（秒）
+AGENT_HTTP_KEEPALIVE_EXPIRY = float(os.getenv('AGENT_HTTP_KEEPALIVE_EXPIRY', '120'))
+# 启动时预先建立与 LLM 服务的连接
+AGENT_WARMUP_ON_STARTUP = os.getenv('AGENT_WARMUP_ON_STARTUP', 'true').lower() in ('1', 'true', 'yes')
+AGENT_WARMUP_TIMEOUT = float(os.getenv('AGENT_WARMUP_TIMEOUT', '5'))
+OPENAI_BASE_URL = os.getenv('OPENAI_BASE_URL', 'https://api.openai.com/v1')
+
+# httpx 的 HTTP/2 支持依赖可选的 h2 包，只检查是否安装，不需要导入
+_HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+
+class AgentServices:
+    """应用级共享的 AI 助手服务"""
+
+    def __init__(self, default_model: str = AGENT_DEFAULT_MODEL, http2: bool = AGENT_HTTP2):
+        self.default_model = default_model
+        self.http2 = http2 and _HTTP2_AVAILABLE
+        if http2 and not _HTTP2_AVAILABLE:
+            logging.warning("未安装 h2，与 LLM 服务之间使用 HTTP/1.1")
+        self.http_client = None
+        self.tool_invoker = None
+        self.chat_service = None
+        self.chat_memory_integration = None
+        self._llm_callers = {}
+        self._sessions = 0
+        self._build_ms = None
+        self._warmup = {}
+
+    def _build(self):
+        """创建共享服务，第一次使用或应用启动时调用"""
+        if self.http_client is not None:
+            return
+        build_start = time.perf_counter()
+        self.http_client = httpx.AsyncClient(
+            http2=self.http2,
+            limits=httpx.Limits(
+                max_connections=AGENT_HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=AGENT_HTTP_MAX_KEEPALIVE,
+                keepalive_expiry=AGENT_HTTP_KEEPALIVE_EXPIRY
+            )
+        )
+        self.tool_invoker = ToolInvoker()
+        register_default_tools(self.tool_invoker)
+
+        from app.services.chat_service import ChatService
+        from app.services.chat_memory_integration import ChatMemoryIntegration
+        self.chat_service = ChatService()
+        self.chat_memory_integration = ChatMemoryIntegration()
+        self._build_ms = round((time.perf_counter() - build_start) * 1000, 1)
+        logging.info(f"AI助手共享服务已创建: 耗时={self._build_ms}ms, http2={self.http2}")
+
+    def llm_caller(self, model_name: Optional[str] = None) -> OpenAILLMCaller:
+        """返回指定模型的共享 LLM 调用器，所有模型共用一个 HTTP 客户端"""
+        self._build()
+        model_name = model_name or self.default_model
+        caller = self._llm_callers.get(model_name)
+        if caller is None:
+            caller = self._llm_callers[model_name] = OpenAILLMCaller(model_name, http_client=self.http_client)
+        return caller
+
+    def session(self, model_name: Optional[str] = None) -> AIAssistant:
+        """为一个请求创建 AIAssistant，只新建上下文和事件日志
+
+        实例可以用于 async with，退出时不会关闭共享的服务。
+        """
+        self._build()
+        self._sessions += 1
+        return AIAssistant(model_name or self.default_model, services=self)
+
+    async def start(self):
+        """创建共享服务并预先建立与 LLM 服务的连接，在应用启动时调用"""
+        self._build()
+        self.llm_caller()
+        if AGENT_WARMUP_ON_STARTUP:
+            await self.warm_up()
+
+    async def warm_up(self, timeout: float = AGENT_WARMUP_TIMEOUT):
+        """请求一次模型列表，完成 DNS、TCP 和 TLS 握手，连接保留在连接池中供后续请求复用"""
+        self._build()
+        warmup_start = time.perf_counter()
+        try:
+            response = await asyncio.wait_for(
+                self.http_client.get(
+                    f"{OPENAI_BASE_URL.rstrip('/')}/models",
+                    headers={"Authorization": f"Bearer {os.getenv('OPENAI_API_KEY', '')}"}
+                ),
+                timeout=timeout
+            )
+            self._warmup = {
+                "status_code": response.status_code,
+                "http_version": response.http_version,
+                "ms": round((time.perf_counter() - warmup_start) * 1000, 1)
+            }
+            logging.info(f"已建立与 LLM 服务的连接: {self._warmup}")
+        except Exception as e:
+            # 预热失败不影响启动，第一个请求时再建立连接
+            self._warmup = {"error": str(e) or type(e).__name__}
+            logging.warning(f"预先建立与 LLM 服务的连接失败: {self._warmup['error']}")
+
+    async def stop(self):
+        """关闭共享的 HTTP 客户端，在应用关闭时调用"""
+        for caller in self._llm_callers.values():
+            await caller.close()
+        self._llm_callers.clear()
+        if self.http_client is not None:
+            await self.http_client.aclose()
+            self.http_client = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "started": self.http_client is not None,
+            "http2": self.http2,
+            "models": list(self._llm_callers),
+            "tools": len(self.tool_invoker.tools) if self.tool_invoker is not None else 0,
+            "sessions": self._sessions,
+            "build_ms": self._build_ms,
+            "warmup": self._warmup,
+        }
+
+
+# 全局AI助手服务容器
+agent_services = AgentServices()
+
+def agent_services_stats() -> dict:
+    return agent_services.stats()
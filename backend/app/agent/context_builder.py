@@ -7,6 +7,7 @@ from dataclasses import dataclass, field
 from typing import List, Dict, Any, Optional
 import uuid
 import base64
+import json
 from datetime import datetime
 from .image_processor import ImageData, ImageProcessor
 import time
@@ -86,6 +87,47 @@ class ContextBuilder:
         
         return self.messages
     
+    def update_context_with_tool_results(self, tool_calls: List[Dict[str, Any]], tool_results: List[str]) -> List[Dict[str, Any]]:
+        """将一轮LLM响应中的全部工具调用及结果插入上下文
+        
+        先添加一条包含全部工具调用的助手消息，再按相同顺序添加每个工具的响应消息，
+        满足 OpenAI API 对 tool 消息的要求
+        
+        Args:
+            tool_calls: 工具调用列表，元素包含 id、name、arguments
+            tool_results: 与 tool_calls 顺序一致的工具结果
+        """
+        self.messages.append({
+            "role": "assistant",
+            "content": None,  # 使用工具时，内容可以为空
+            "tool_calls": [
+                {
+                    "id": tool_call["id"],
+                    "type": "function",
+                    "function": {
+                        "name": tool_call["name"],
+                        "arguments": json.dumps(tool_call.get("arguments") or {}, ensure_ascii=False)
+                    }
+                }
+                for tool_call in tool_calls
+            ]
+        })
+        
+        for tool_call, tool_result in zip(tool_calls, tool_results):
+            self.messages.append({
+                "role": "tool",
+                "tool_call_id": tool_call["id"],
+                "name": tool_call["name"],
+                "content": tool_result
+            })
+            self.tool_results.append({
+                "tool_name": tool_call["name"],
+                "result": tool_result,
+                "timestamp": datetime.now().isoformat()
+            })
+        
+        return self.messages
+    
     def add_assistant_message(self, content: str) -> List[Dict[str, Any]]:
         """添加助手消息到上下文"""
         assistant_message = {
@@ -9,6 +9,9 @@ from datetime import datetime
 import json
 import os
 
+# 已经创建过的日志目录，避免每次创建 EventLogger 都访问文件系统
+_created_log_dirs = set()
+
 @dataclass
 class LogEntry:
     """日志条目结构"""
@@ -42,7 +45,9 @@ class EventLogger:
         self.log_dir = log_dir or os.path.join(os.getcwd(), "logs")
         
         # 确保日志目录存在
-        os.makedirs(self.log_dir, exist_ok=True)
+        if self.log_dir not in _created_log_dirs:
+            os.makedirs(self.log_dir, exist_ok=True)
+            _created_log_dirs.add(self.log_dir)
         
     def log_user_input(self, session_id: str, user_id: str, ai_id: str, input_text: str, 
                      file_type: Optional[str] = None, file_info: Optional[Dict[str, Any]] = None) -> LogEntry:
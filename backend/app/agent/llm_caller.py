@@ -4,7 +4,7 @@ LLM调用器
 """
 
 from abc import ABC, abstractmethod
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, AsyncIterator
 import os
 import json
 import asyncio
@@ -20,13 +20,32 @@ class LLMCaller(ABC):
         """调用LLM (异步)"""
         pass
 
+    async def invoke_stream(self, messages: List[Dict[str, Any]], tools: Optional[List[Dict[str, Any]]] = None, max_tokens: int = 1000) -> AsyncIterator[Dict[str, Any]]:
+        """流式调用LLM，默认实现等待完整响应后一次性返回
+
+        事件格式：
+        - {"type": "content", "delta": 文本片段}
+        - {"type": "done", "content": 完整文本, "tool_calls": [...], "usage": {...}}，与 invoke 的返回值相同
+        """
+        result = await self.invoke(messages, tools=tools, max_tokens=max_tokens)
+        if result.get("content"):
+            yield {"type": "content", "delta": result["content"]}
+        yield dict(result, type="done")
+
 class OpenAILLMCaller(LLMCaller):
     """基于OpenAI的LLM调用实现"""
     
-    def __init__(self, model_name: str = "gpt-4o"):
+    # 等待第一个流式分片的最长时间（秒），与非流式调用的超时一致
+    STREAM_FIRST_CHUNK_TIMEOUT = 15.0
+    # 两个流式分片之间的最长间隔（秒）
+    STREAM_CHUNK_TIMEOUT = 15.0
+    
+    def __init__(self, model_name: str = "gpt-4o", http_client: Optional[httpx.AsyncClient] = None):
         self.model_name = model_name
+        # 传入共享的HTTP客户端时由创建者负责关闭，见 app.agent.container.AgentServices
+        self.owns_http_client = http_client is None
         # Create an async HTTP client without proxy settings
-        self.async_http_client = httpx.AsyncClient()
+        self.async_http_client = http_client or httpx.AsyncClient()
         self.client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), http_client=self.async_http_client)
         self.is_closed = False
         
@@ -40,7 +59,8 @@ class OpenAILLMCaller(LLMCaller):
         """关闭HTTP客户端连接"""
         if hasattr(self, 'async_http_client') and not self.is_closed:
             try:
-                await self.async_http_client.aclose()
+                if self.owns_http_client:
+                    await self.async_http_client.aclose()
                 self.is_closed = True
                 # 显式释放资源
                 self.async_http_client = None
@@ -83,6 +103,48 @@ class OpenAILLMCaller(LLMCaller):
                 "usage": {}
             }
             
+    def _build_request_params(self, messages: List[Dict[str, Any]], tools: Optional[List[Dict[str, Any]]] = None, max_tokens: int = 1000) -> Dict[str, Any]:
+        """构建 chat.completions.create 的请求参数"""
+        request_params = {
+            "model": self.model_name,
+            "messages": messages,
+            "temperature": 0.7,
+            "max_tokens": max_tokens,
+        }
+        
+        # 检查模型是否支持 tools 参数
+        # 只有特定模型支持 tools 参数，如 gpt-4-turbo, gpt-4o 等
+        tools_supported_models = ["gpt-4-turbo", "gpt-4o", "gpt-4-vision", "gpt-4-1106-preview", "gpt-4-0125-preview"]
+        tools_supported = any(model in self.model_name for model in tools_supported_models)
+        
+        # 检查是否有图片输入，如果有，设置特定参数
+        has_image = False
+        for message in messages:
+            if isinstance(message.get('content'), list):
+                for content_item in message['content']:
+                    if content_item.get('type') == 'image_url':
+                        has_image = True
+                        break
+            if has_image:
+                break
+                
+        # 如果有图片，添加特定参数
+        if has_image:
+            # 确保模型支持图片
+            if self.model_name not in ["gpt-4o", "gpt-4-turbo"]:
+                self.model_name = "gpt-4o"  # 自动切换到支持图片的模型
+                request_params["model"] = self.model_name
+                logging.info(f"检测到图片输入，切换到模型: {self.model_name}")
+        
+        # 如果提供了工具定义，且模型支持工具，添加到请求中
+        if tools and tools_supported:
+            logging.info(f"添加工具定义到请求，工具数量: {len(tools)}")
+            request_params["tools"] = tools
+            request_params["tool_choice"] = "auto"
+        elif tools and not tools_supported:
+            logging.warning(f"模型 {self.model_name} 不支持 tools 参数，已自动忽略工具定义")
+        return request_params
+            
     async def _invoke_with_retry(self, messages: List[Dict[str, Any]], tools: Optional[List[Dict[str, Any]]] = None, max_tokens: int = 1000) -> Dict[str, Any]:
         """带重试的OpenAI API调用"""
         import time
@@ -91,44 +153,7 @@ class OpenAILLMCaller(LLMCaller):
         
         try:
             # 准备请求参数
-            request_params = {
-                "model": self.model_name,
-                "messages": messages,
-                "temperature": 0.7,
-                "max_tokens": max_tokens,
-            }
-            
-            # 检查模型是否支持 tools 参数
-            # 只有特定模型支持 tools 参数，如 gpt-4-turbo, gpt-4o 等
-            tools_supported_models = ["gpt-4-turbo", "gpt-4o", "gpt-4-vision", "gpt-4-1106-preview", "gpt-4-0125-preview"]
-            tools_supported = any(model in self.model_name for model in tools_supported_models)
-            
-            # 检查是否有图片输入，如果有，设置特定参数
-            has_image = False
-            for message in messages:
-                if isinstance(message.get('content'), list):
-                    for content_item in message['content']:
-                        if content_item.get('type') == 'image_url':
-                            has_image = True
-                            break
-                if has_image:
-                    break
-                    
-            # 如果有图片，添加特定参数
-            if has_image:
-                # 确保模型支持图片
-                if self.model_name not in ["gpt-4o", "gpt-4-turbo"]:
-                    self.model_name = "gpt-4o"  # 自动切换到支持图片的模型
-                    request_params["model"] = self.model_name
-                    logging.info(f"检测到图片输入，切换到模型: {self.model_name}")
-            
-            # 如果提供了工具定义，且模型支持工具，添加到请求中
-            if tools and tools_supported:
-                logging.info(f"添加工具定义到请求，工具数量: {len(tools)}")
-                request_params["tools"] = tools
-                request_params["tool_choice"] = "auto"
-            elif tools and not tools_supported:
-                logging.warning(f"模型 {self.model_name} 不支持 tools 参数，已自动忽略工具定义")
+            request_params = self._build_request_params(messages, tools, max_tokens)
             
             # 异步调用API
             # 使用正确的OpenAI API v1.0.0格式
@@ -219,3 +244,112 @@ class OpenAILLMCaller(LLMCaller):
                 "tool_calls": [],
                 "usage": {}
             }
+
+    async def invoke_stream(self, messages: List[Dict[str, Any]], tools: Optional[List[Dict[str, Any]]] = None, max_tokens: int = 1000) -> AsyncIterator[Dict[str, Any]]:
+        """流式调用OpenAI模型 (异步)
+
+        逐个返回文本片段，工具调用的参数片段在内部按 index 拼接，流结束后随 done 事件返回。
+        出错或超时时与 invoke 一样返回友好的提示文本，而不是抛出异常。
+        流式响应不包含 token 用量，done 事件中的 usage 为空。
+
+        Yields:
+            {"type": "content", "delta": 文本片段}
+            {"type": "done", "content": 完整文本, "tool_calls": [...], "usage": {}, "finish_reason": ...}
+        """
+        import time
+        start_time = time.time()
+        logging.info(f"开始OpenAI流式API调用，消息数量: {len(messages)}")
+        request_params = self._build_request_params(messages, tools, max_tokens)
+        
+        content_parts = []
+        tool_call_parts = {}  # index -> {"id", "name", "arguments"}
+        finish_reason = None
+        try:
+            try:
+                stream = await asyncio.wait_for(
+                    self.client.chat.completions.create(stream=True, **request_params),
+                    timeout=self.STREAM_FIRST_CHUNK_TIMEOUT
+                )
+            except asyncio.TimeoutError:
+                raise
+            except Exception as api_error:
+                # 与非流式调用相同：如果错误与'tools'参数有关，则移除该参数重试
+                if 'tools' not in request_params:
+                    raise
+                logging.error(f"OpenAI流式API调用错误，移除tools参数并重试: {str(api_error)}")
+                request_params.pop('tools', None)
+                request_params.pop('tool_choice', None)
+                stream = await asyncio.wait_for(
+                    self.client.chat.completions.create(stream=True, **request_params),
+                    timeout=self.STREAM_FIRST_CHUNK_TIMEOUT
+                )
+            
+            iterator = stream.__aiter__()
+            first_chunk = True
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(
+                        iterator.__anext__(),
+                        timeout=self.STREAM_FIRST_CHUNK_TIMEOUT if first_chunk else self.STREAM_CHUNK_TIMEOUT
+                    )
+                except StopAsyncIteration:
+                    break
+                if first_chunk:
+                    first_chunk = False
+                    logging.info(f"OpenAI流式API首个分片到达，耗时: {time.time() - start_time:.2f}秒")
+                if not chunk.choices:
+                    continue
+                choice = chunk.choices[0]
+                delta = choice.delta
+                if choice.finish_reason:
+                    finish_reason = choice.finish_reason
+                if delta is None:
+                    continue
+                if delta.content:
+                    content_parts.append(delta.content)
+                    yield {"type": "content", "delta": delta.content}
+                # 工具调用的 id 和名称只出现在第一个分片中，参数分多个分片到达
+                for tool_delta in getattr(delta, 'tool_calls', None) or []:
+                    part = tool_call_parts.setdefault(tool_delta.index, {"id": None, "name": "", "arguments": ""})
+                    if tool_delta.id:
+                        part["id"] = tool_delta.id
+                    if tool_delta.function is not None:
+                        if tool_delta.function.name:
+                            part["name"] += tool_delta.function.name
+                        if tool_delta.function.arguments:
+                            part["arguments"] += tool_delta.function.arguments
+            logging.info(f"OpenAI流式API调用完成，耗时: {time.time() - start_time:.2f}秒")
+        except asyncio.TimeoutError:
+            logging.error("OpenAI流式API调用超时")
+            message = "抱歉，AI响应超时。请稍后再试或尝试更简短的问题。"
+            content_parts.append(message)
+            yield {"type": "content", "delta": message}
+            tool_call_parts = {}
+        except Exception as e:
+            logging.error(f"OpenAI流式API调用失败: {str(e)}")
+            message = f"抱歉，AI响应出现错误: {str(e)}。请稍后再试。"
+            content_parts.append(message)
+            yield {"type": "content", "delta": message}
+            tool_call_parts = {}
+        
+        tool_calls = []
+        for index in sorted(tool_call_parts):
+            part = tool_call_parts[index]
+            try:
+                arguments = json.loads(part["arguments"]) if part["arguments"] else {}
+            except ValueError:
+                logging.error(f"工具调用参数不是有效的JSON: {part['name']}: {part['arguments']}")
+                arguments = {}
+            tool_calls.append({
+                "id": part["id"] or f"call_{index}",
+                "name": part["name"],
+                "arguments": arguments
+            })
+        
+        yield {
+            "type": "done",
+            "content": "".join(content_parts),
+            "tool_calls": tool_calls,
+            "usage": {},
+            "finish_reason": finish_reason
+        }
@@ -3,14 +3,32 @@
 负责注册、管理和调用各种工具函数
 """
 
-from typing import Callable, Dict, Any, List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Any, List, Optional, Tuple
+import asyncio
+import functools
+import inspect
 import json
+import logging
 import requests
 import os
 import base64
 from datetime import datetime
 from .image_processor import ImageData, ImageProcessor
 
+# 执行同步工具函数的线程数，所有 ToolInvoker 共用
+TOOL_THREAD_POOL_SIZE = int(os.getenv('TOOL_THREAD_POOL_SIZE', '8'))
+# 单个工具调用的默认超时时间（秒）
+TOOL_CALL_TIMEOUT = float(os.getenv('TOOL_CALL_TIMEOUT', '10'))
+
+_tool_executor = None
+
+def _get_tool_executor() -> ThreadPoolExecutor:
+    global _tool_executor
+    if _tool_executor is None:
+        _tool_executor = ThreadPoolExecutor(max_workers=TOOL_THREAD_POOL_SIZE, thread_name_prefix="tool")
+    return _tool_executor
+
 class ToolInvoker:
     """工具调度和执行"""
     
@@ -104,19 +122,74 @@ class ToolInvoker:
             }
         }
         
+        # 重复注册同名工具时替换原来的定义，避免发送给模型的工具定义重名
+        self.tool_definitions = [d for d in self.tool_definitions if d["function"]["name"] != name]
         self.tool_definitions.append(tool_def)
         
     def invoke_tool(self, tool_name: str, **kwargs) -> str:
-        """执行工具调用"""
+        """执行工具调用（同步），在事件循环中请使用 ainvoke_tool"""
         if tool_name not in self.tools:
             return f"工具 {tool_name} 不存在"
             
         try:
             result = self.tools[tool_name](**kwargs)
+            if inspect.isawaitable(result):
+                result.close()
+                return f"工具 {tool_name} 是异步函数，请使用 ainvoke_tool 调用"
             return str(result)
         except Exception as e:
             return f"工具调用失败: {str(e)}"
     
+    async def ainvoke_tool(self, tool_name: str, arguments: Optional[Dict[str, Any]] = None, timeout: Optional[float] = TOOL_CALL_TIMEOUT) -> str:
+        """异步执行工具调用
+        
+        异步工具函数直接 await，同步工具函数放到线程池中执行，不阻塞事件循环。
+        
+        Args:
+            tool_name: 工具名称
+            arguments: 工具参数
+            timeout: 超时时间（秒），None 表示不限制。超时后不再等待结果；
+                     同步工具函数所在的线程无法中断，会在后台执行完
+        
+        Returns:
+            工具结果文本，工具不存在、超时或出错时为说明文本
+        """
+        func = self.tools.get(tool_name)
+        if func is None:
+            return f"工具 {tool_name} 不存在"
+        
+        arguments = arguments or {}
+        try:
+            if inspect.iscoroutinefunction(func):
+                call = func(**arguments)
+            else:
+                call = asyncio.get_running_loop().run_in_executor(
+                    _get_tool_executor(), functools.partial(func, **arguments)
+                )
+            result = await asyncio.wait_for(call, timeout=timeout)
+            return str(result)
+        except asyncio.TimeoutError:
+            logging.warning(f"工具调用超时({timeout}秒): {tool_name}")
+            return f"工具调用超时: {tool_name} 在 {timeout} 秒内没有返回结果"
+        except Exception as e:
+            return f"工具调用失败: {str(e)}"
+    
+    async def invoke_tools(self, tool_calls: List[Tuple[str, Dict[str, Any]]], timeout: Optional[float] = TOOL_CALL_TIMEOUT) -> List[str]:
+        """并发执行一轮LLM响应中的全部工具调用
+        
+        每个工具调用有各自的超时；调用方被取消时未完成的工具调用一起取消。
+        
+        Args:
+            tool_calls: (工具名称, 参数) 列表
+            timeout: 单个工具调用的超时时间（秒）
+        
+        Returns:
+            与 tool_calls 顺序一致的工具结果
+        """
+        return list(await asyncio.gather(*(
+            self.ainvoke_tool(tool_name, arguments, timeout) for tool_name, arguments in tool_calls
+        )))
+    
     def get_tool_definitions(self) -> List[Dict[str, Any]]:
         """获取所有工具定义"""
         return self.tool_definitions
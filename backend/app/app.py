@@ -9,7 +9,12 @@ from starlette.middleware.base import BaseHTTPMiddleware
 import os
 import gc
 from dotenv import load_dotenv
-from .db import init_db_connection, close_db
+from .db import init_db_connection, close_db, pool_stats, query_cache_stats, record_cache_stats, single_flight_stats, counter_buffer, counter_buffer_stats, query_metrics_stats, sync_repo
+from .db_migrations import run_migrations, RUN_MIGRATIONS_ON_STARTUP
+from .tasks.cascade_delete import cascade_deletes
+from .tasks.write_behind import write_behind, write_behind_stats
+from .db_live import live_hub, live_stats
+from .agent.container import agent_services, agent_services_stats
 
 # 设置日志级别
 logging.basicConfig(level=logging.INFO)
@@ -45,12 +50,37 @@ async def validation_exception_handler(request, exc):
 # 使用FastAPI的生命周期事件来初始化和关闭数据库连接
 @app.on_event("startup")
 async def startup_db_client():
-    await init_db_connection()
+    # 同步代码（定时任务等）通过应用的事件循环访问数据库，不另开连接
+    sync_repo.bind_loop(asyncio.get_running_loop())
+    pool = await init_db_connection()
     print("Database connection initialized on startup")
+    
+    # 应用数据库索引迁移，失败时不阻止服务启动
+    if pool is not None and RUN_MIGRATIONS_ON_STARTUP:
+        try:
+            await run_migrations()
+        except Exception as e:
+            logger.error(f"数据库索引迁移失败: {str(e)}")
+    
+    # 启动级联删除后台任务、计数缓冲和延迟写入队列
+    cascade_deletes.start()
+    counter_buffer.start()
+    write_behind.start()
+    # 开始推送会话和消息变更
+    live_hub.start()
+    # 创建AI助手的共享服务并预先建立与 LLM 服务的连接
+    await agent_services.start()
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    await live_hub.stop()
+    await agent_services.stop()
+    await cascade_deletes.stop()
+    # 关闭连接前写完延迟写入队列和缓冲中的计数
+    await write_behind.stop()
+    await counter_buffer.stop()
     await close_db()
+    sync_repo.bind_loop(None)
     print("Database connection closed on shutdown")
 
 # 自定义中间件类来处理资源清理和请求超时
@@ -123,6 +153,9 @@ from .routes.chat_history_routes import router as chat_history_router
 from .routes.chat_sessions_routes import router as chat_sessions_router
 from .routes.oauth_routes import router as oauth_router
 from .routes.search_routes import router as search_router
+from .routes.job_routes import router as job_router
+from .routes.live_routes import router as live_router
+from .routes.db_admin_routes import router as db_admin_router
 
 # 所有路由模块已经迁移到 FastAPI
 # 所有路由文件已经重命名，移除了 _fastapi 后缀
@@ -144,6 +177,9 @@ api_router.include_router(chat_history_router)
 api_router.include_router(chat_sessions_router)
 api_router.include_router(oauth_router)
 api_router.include_router(search_router)
+api_router.include_router(job_router)
+api_router.include_router(live_router)
+api_router.include_router(db_admin_router)
 
 # 将主路由器注册到应用
 app.include_router(api_router)
@@ -153,7 +189,7 @@ app.include_router(api_router)
 async def root():
     """健康检查端点"""
     logger.info("根路由被访问 - 健康检查")
-    return {"status": "ok", "message": "彩虹城 AI API 服务正常运行"}
+    return {"status": "ok", "message": "彩虹城 AI API 服务正常运行", "db_pool": pool_stats(), "query_cache": query_cache_stats(), "record_cache": record_cache_stats(), "single_flight": single_flight_stats(), "counter_buffer": counter_buffer_stats(), "write_behind": write_behind_stats(), "live": live_stats(), "agent": agent_services_stats(), "query_metrics": query_metrics_stats()}
 
 @app.get("/api/test")
 async def test_api():
@@ -1,198 +1,2495 @@
 import asyncio
+import base64
+import collections
+import contextlib
+import copy
 import os
+import json
+import re
+import secrets
+import string
 import time
 import surrealdb
 from dotenv import load_dotenv
 import logging
 
+from .db_journal import WriteJournal
+from .db_metrics import QueryMetrics, query_shape
+
 # 加载环境变量
 load_dotenv()
 
-# SurrealDB配置
-SURREAL_URL = os.getenv('SURREAL_URL', 'ws://localhost:8080')
-SURREAL_USER = os.getenv('SURREAL_USER', 'root')
-SURREAL_PASS = os.getenv('SURREAL_PASS', '123')
-SURREAL_NS = os.getenv('SURREAL_NS', 'rainbow')
-SURREAL_DB = os.getenv('SURREAL_DB', 'test')
+# SurrealDB配置
+SURREAL_URL = os.getenv('SURREAL_URL', 'ws://localhost:8080')
+SURREAL_USER = os.getenv('SURREAL_USER', 'root')
+SURREAL_PASS = os.getenv('SURREAL_PASS', '123')
+SURREAL_NS = os.getenv('SURREAL_NS', 'rainbow')
+SURREAL_DB = os.getenv('SURREAL_DB', 'test')
+
+# 连接池配置
+SURREAL_POOL_MIN_SIZE = int(os.getenv('SURREAL_POOL_MIN_SIZE', '2'))
+SURREAL_POOL_MAX_SIZE = int(os.getenv('SURREAL_POOL_MAX_SIZE', '20'))
+SURREAL_POOL_IDLE_TIMEOUT = float(os.getenv('SURREAL_POOL_IDLE_TIMEOUT', '300'))  # 秒
+SURREAL_POOL_ACQUIRE_TIMEOUT = float(os.getenv('SURREAL_POOL_ACQUIRE_TIMEOUT', '10'))  # 秒
+SURREAL_POOL_HEALTH_CHECK_INTERVAL = float(os.getenv('SURREAL_POOL_HEALTH_CHECK_INTERVAL', '30'))  # 秒，0 表示关闭
+
+# 存储后端：surrealdb（默认，远程 SurrealDB）或 sqlite（进程内嵌入式 SQLite）
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'surrealdb').lower()
+# SQLite 数据库文件路径，:memory: 表示只保存在内存中
+SQLITE_PATH = os.getenv('SQLITE_PATH', 'data/rainbow.sqlite3')
+
+# 本地写日志：SurrealDB 不可用（连接错误）时先写入本地日志，恢复后按顺序重放
+SURREAL_JOURNAL_ENABLED = os.getenv('SURREAL_JOURNAL_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+SURREAL_JOURNAL_DIR = os.getenv('SURREAL_JOURNAL_DIR', 'data/journal')
+SURREAL_JOURNAL_DURABILITY = os.getenv('SURREAL_JOURNAL_DURABILITY', 'fsync')  # fsync / batch / none
+SURREAL_JOURNAL_SEGMENT_BYTES = int(os.getenv('SURREAL_JOURNAL_SEGMENT_BYTES', str(16 * 1024 * 1024)))
+SURREAL_JOURNAL_REPLAY_INTERVAL = float(os.getenv('SURREAL_JOURNAL_REPLAY_INTERVAL', '5'))  # 秒
+# 写操作建立新连接的最长时间，超时视为数据库不可用，写入日志并立即返回
+SURREAL_JOURNAL_WRITE_TIMEOUT = float(os.getenv('SURREAL_JOURNAL_WRITE_TIMEOUT', '2'))  # 秒
+
+# 计数缓冲：合并计数器增量后定期批量写入
+COUNTER_FLUSH_INTERVAL = float(os.getenv('SURREAL_COUNTER_FLUSH_INTERVAL', '1'))  # 秒
+COUNTER_MAX_PENDING = int(os.getenv('SURREAL_COUNTER_MAX_PENDING', '1000'))  # 待写入的记录数超过该值时立即写入
+
+# 批量写入时每条 INSERT 语句包含的最大行数
+BULK_INSERT_CHUNK_SIZE = int(os.getenv('SURREAL_BULK_INSERT_CHUNK_SIZE', '500'))
+
+# query_iter 每次从数据库读取的记录数
+QUERY_ITER_CHUNK_SIZE = int(os.getenv('SURREAL_QUERY_ITER_CHUNK_SIZE', '500'))
+
+# 查询形状缓存最多保存的语句模板数
+QUERY_SHAPE_CACHE_SIZE = int(os.getenv('SURREAL_QUERY_CACHE_SIZE', '256'))
+
+# 记录缓存配置：按记录ID缓存单条记录，0 表示关闭
+RECORD_CACHE_TTL = float(os.getenv('SURREAL_RECORD_CACHE_TTL', '60'))  # 秒
+RECORD_CACHE_DEFAULT_SIZE = int(os.getenv('SURREAL_RECORD_CACHE_DEFAULT_SIZE', '1000'))
+# 每张表的容量，格式为 "users=5000,chat=5000"
+RECORD_CACHE_TABLE_SIZES = {
+    table.strip(): int(size)
+    for table, size in (
+        item.split('=', 1)
+        for item in os.getenv('SURREAL_RECORD_CACHE_SIZES', 'users=5000,chat=5000,relationship=2000').split(',')
+        if '=' in item
+    )
+}
+# 除记录ID外，可以作为缓存键的唯一字段
+RECORD_CACHE_UNIQUE_FIELDS = {
+    'relationship': 'relationship_id',
+}
+
+_connection_attempts = 0
+_max_connection_attempts = 3
+_connection_retry_delay = 2  # 秒
+
+
+class SurrealConnectionPool:
+    """SurrealDB 异步连接池
+
+    - 连接数在 min_size 与 max_size 之间，超过 max_size 的请求排队等待
+    - 通过 connection() 上下文管理器借出和归还连接
+    - 空闲超过 idle_timeout 的连接由后台回收任务关闭（保留 min_size 个）
+    - 启动时预热 min_size 个连接
+    - 借出只依赖信号量和双端队列，建立连接时不持有任何全局锁
+    - 借出时不做探活；后台健康检查任务按 health_check_interval 探测空闲连接，
+      请求过程中出现连接级错误的连接在归还时被剔除
+    """
+
+    def __init__(
+        self,
+        url: str,
+        user: str,
+        password: str,
+        namespace: str,
+        database: str,
+        min_size: int = 2,
+        max_size: int = 20,
+        idle_timeout: float = 300.0,
+        acquire_timeout: float = 10.0,
+        reap_interval: float = 30.0,
+        health_check_interval: float = 30.0,
+        health_check_timeout: float = 5.0
+    ):
+        self.url = url
+        self.user = user
+        self.password = password
+        self.namespace = namespace
+        self.database = database
+        self.min_size = max(0, min_size)
+        self.max_size = max(1, max_size, self.min_size)
+        self.idle_timeout = idle_timeout
+        self.acquire_timeout = acquire_timeout
+        self.reap_interval = reap_interval
+        self.health_check_interval = health_check_interval
+        self.health_check_timeout = health_check_timeout
+
+        # 空闲连接队列，元素为 (连接, 最后归还时间)
+        self._idle = collections.deque()
+        # 当前打开（含借出和正在建立）的连接数
+        self._size = 0
+        # 使用中出现连接级错误、归还时需要剔除的连接
+        self._broken = set()
+        self._semaphore = None
+        self._reaper_task = None
+        self._health_task = None
+        self._closed = False
+
+        # 连接状态计数器
+        self._counters = collections.Counter()
+
+    @property
+    def size(self) -> int:
+        """当前打开的连接数"""
+        return self._size
+
+    @property
+    def idle_count(self) -> int:
+        """当前空闲的连接数"""
+        return len(self._idle)
+
+    def stats(self) -> dict:
+        """返回连接池状态和计数器快照"""
+        return {
+            "size": self._size,
+            "idle": len(self._idle),
+            "in_use": self._size - len(self._idle),
+            "min_size": self.min_size,
+            "max_size": self.max_size,
+            "closed": self._closed,
+            "created": self._counters["created"],
+            "closed_connections": self._counters["closed"],
+            "connect_failures": self._counters["connect_failures"],
+            "acquired": self._counters["acquired"],
+            "acquire_timeouts": self._counters["acquire_timeouts"],
+            "evicted_on_error": self._counters["evicted_on_error"],
+            "reaped_idle": self._counters["reaped_idle"],
+            "health_checks": self._counters["health_checks"],
+            "health_check_failures": self._counters["health_check_failures"],
+        }
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        # 信号量延迟到事件循环中创建
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_size)
+        return self._semaphore
+
+    async def open_dedicated(self):
+        """建立一条不归连接池管理的连接，例如接收 LIVE 查询通知，由调用方负责关闭"""
+        conn = surrealdb.Surreal()
+        await conn.connect(self.url)
+        await conn.signin({"user": self.user, "pass": self.password})
+        await conn.use(self.namespace, self.database)
+        return conn
+
+    async def _open_connection(self):
+        """建立一条新连接并完成登录和命名空间选择"""
+        self._size += 1
+        try:
+            conn = await self.open_dedicated()
+            self._counters["created"] += 1
+            logging.info(f"连接池新建连接: {self.url}, 当前连接数={self._size}")
+            return conn
+        except BaseException:
+            # 包括建立连接超时被取消的情况
+            self._size -= 1
+            self._counters["connect_failures"] += 1
+            raise
+
+    async def _close_connection(self, conn):
+        """关闭连接并更新计数"""
+        self._size -= 1
+        self._broken.discard(id(conn))
+        self._counters["closed"] += 1
+        try:
+            await conn.close()
+        except Exception as e:
+            logging.error(f"关闭连接池连接出错: {str(e)}")
+
+    async def start(self) -> int:
+        """预热连接池并启动空闲连接回收和健康检查任务
+
+        Returns:
+            int: 成功预热的连接数
+        """
+        self._closed = False
+        needed = self.min_size - self._size
+        warmed = 0
+        if needed > 0:
+            results = await asyncio.gather(
+                *(self._open_connection() for _ in range(needed)),
+                return_exceptions=True
+            )
+            now = time.monotonic()
+            for result in results:
+                if isinstance(result, Exception):
+                    logging.error(f"连接池预热失败: {result}")
+                else:
+                    self._idle.append((result, now))
+                    warmed += 1
+            if warmed == 0:
+                raise ConnectionError(f"无法连接到 SurrealDB: {self.url}")
+
+        if self._reaper_task is None or self._reaper_task.done():
+            self._reaper_task = asyncio.create_task(self._reap_idle_connections())
+        if self.health_check_interval > 0 and (self._health_task is None or self._health_task.done()):
+            self._health_task = asyncio.create_task(self._check_idle_connections())
+
+        logging.info(f"连接池已启动: 预热 {warmed} 个连接, min={self.min_size}, max={self.max_size}")
+        return warmed
+
+    async def acquire(self, timeout: float = None, connect_timeout: float = None):
+        """借出一个连接
+
+        连接池已满时最多等待 timeout 秒（默认 acquire_timeout），超时抛出 asyncio.TimeoutError。
+        需要新建连接时最多等待 connect_timeout 秒（默认与 timeout 相同），超时抛出 ConnectionError，
+        调用方可以据此区分连接池已满和数据库不可用。
+        """
+        if self._closed:
+            raise ConnectionError("连接池已关闭")
+
+        timeout = self.acquire_timeout if timeout is None else timeout
+        semaphore = self._get_semaphore()
+        try:
+            await asyncio.wait_for(semaphore.acquire(), timeout=timeout)
+        except asyncio.TimeoutError:
+            self._counters["acquire_timeouts"] += 1
+            raise
+        try:
+            if self._idle:
+                # 后进先出，优先复用最近使用过的连接
+                conn, _ = self._idle.pop()
+            else:
+                try:
+                    conn = await asyncio.wait_for(
+                        self._open_connection(),
+                        timeout=timeout if connect_timeout is None else connect_timeout
+                    )
+                except asyncio.TimeoutError:
+                    raise ConnectionError(f"建立数据库连接超时: {self.url}") from None
+            self._counters["acquired"] += 1
+            return conn
+        except BaseException:
+            semaphore.release()
+            raise
+
+    def report_error(self, conn, exc: BaseException) -> bool:
+        """报告连接使用过程中的异常
+
+        连接级错误（网络断开、超时、取消等）会把连接标记为待剔除，
+        查询语法错误之类的业务错误不影响连接本身。
+
+        Returns:
+            bool: 连接是否被标记为待剔除
+        """
+        if conn is not None and is_connection_error(exc):
+            self._broken.add(id(conn))
+            return True
+        return False
+
+    async def release(self, conn, discard: bool = False):
+        """归还连接，discard=True 或连接已被标记失效时直接关闭该连接"""
+        try:
+            if id(conn) in self._broken:
+                discard = True
+                self._counters["evicted_on_error"] += 1
+                logging.warning("剔除出现连接错误的数据库连接")
+            if discard or self._closed:
+                await self._close_connection(conn)
+            else:
+                self._idle.append((conn, time.monotonic()))
+        finally:
+            self._get_semaphore().release()
+
+    @contextlib.asynccontextmanager
+    async def connection(self):
+        """借出连接的上下文管理器，退出时自动归还
+
+        使用期间抛出连接级错误的连接不再放回池中。
+        """
+        conn = await self.acquire()
+        try:
+            yield conn
+        except BaseException as e:
+            self.report_error(conn, e)
+            raise
+        finally:
+            await self.release(conn)
+
+    async def _reap_idle_connections(self):
+        """定期关闭空闲过久的连接，连接数不低于 min_size"""
+        while not self._closed:
+            await asyncio.sleep(self.reap_interval)
+            try:
+                now = time.monotonic()
+                # 最久未使用的连接位于队列左端
+                while (
+                    self._idle
+                    and self._size > self.min_size
+                    and now - self._idle[0][1] > self.idle_timeout
+                ):
+                    conn, _ = self._idle.popleft()
+                    await self._close_connection(conn)
+                    self._counters["reaped_idle"] += 1
+                    logging.info(f"回收空闲连接, 当前连接数={self._size}")
+            except Exception as e:
+                logging.error(f"回收空闲连接出错: {str(e)}")
+
+    async def _probe(self, conn) -> bool:
+        try:
+            return await asyncio.wait_for(is_connection_alive(conn), timeout=self.health_check_timeout)
+        except asyncio.TimeoutError:
+            return False
+
+    async def _check_idle_connections(self):
+        """后台健康检查：探测空闲时间超过一个检查周期的连接，剔除失效连接并补足 min_size"""
+        while not self._closed:
+            await asyncio.sleep(self.health_check_interval)
+            try:
+                now = time.monotonic()
+                # 最近刚归还的连接刚刚成功执行过请求，无需探测
+                # 探测中的连接各占用一个信号量名额，并发的 acquire 不会因此新建连接使连接数超过 max_size
+                semaphore = self._get_semaphore()
+                stale = collections.deque()
+                while (
+                    self._idle
+                    and now - self._idle[0][1] >= self.health_check_interval
+                    and not semaphore.locked()
+                ):
+                    # 信号量未满时 acquire 立即返回
+                    await semaphore.acquire()
+                    stale.append(self._idle.popleft())
+                try:
+                    results = await asyncio.gather(*(self._probe(conn) for conn, _ in stale)) if stale else []
+                    for alive in results:
+                        conn, last_used = stale.popleft()
+                        self._counters["health_checks"] += 1
+                        try:
+                            if alive and not self._closed:
+                                # 放回队列左端，保持按最后使用时间排序
+                                self._idle.appendleft((conn, last_used))
+                            else:
+                                if not alive:
+                                    self._counters["health_check_failures"] += 1
+                                    logging.warning("健康检查发现失效连接，已剔除")
+                                await self._close_connection(conn)
+                        finally:
+                            semaphore.release()
+                finally:
+                    # 探测或关闭过程中被取消（例如 close()）时，关闭剩余已取出的连接，保证 _size 准确
+                    while stale:
+                        conn, _ = stale.popleft()
+                        try:
+                            await self._close_connection(conn)
+                        finally:
+                            semaphore.release()
+
+                # 补足最小连接数
+                while not self._closed and self._size < self.min_size:
+                    conn = await self._open_connection()
+                    self._idle.appendleft((conn, time.monotonic()))
+            except Exception as e:
+                logging.error(f"连接健康检查出错: {str(e)}")
+
+    async def close(self):
+        """关闭连接池中的所有空闲连接，借出中的连接在归还时关闭"""
+        self._closed = True
+        for task in (self._reaper_task, self._health_task):
+            if task is not None:
+                task.cancel()
+                with contextlib.suppress(asyncio.CancelledError, Exception):
+                    await task
+        self._reaper_task = None
+        self._health_task = None
+
+        while self._idle:
+            conn, _ = self._idle.popleft()
+            await self._close_connection(conn)
+
+
+# 全局连接池
+_pool = SurrealConnectionPool(
+    SURREAL_URL,
+    SURREAL_USER,
+    SURREAL_PASS,
+    SURREAL_NS,
+    SURREAL_DB,
+    min_size=SURREAL_POOL_MIN_SIZE,
+    max_size=SURREAL_POOL_MAX_SIZE,
+    idle_timeout=SURREAL_POOL_IDLE_TIMEOUT,
+    acquire_timeout=SURREAL_POOL_ACQUIRE_TIMEOUT,
+    health_check_interval=SURREAL_POOL_HEALTH_CHECK_INTERVAL
+)
+
+# 检查连接是否可用（仅供后台健康检查使用，请求路径上不再探活）
+async def is_connection_alive(conn):
+    """检查数据库连接是否正常"""
+    if conn is None:
+        return False
+    
+    try:
+        # 尝试执行一个简单的查询
+        await conn.query('INFO FOR DB')
+        return True
+    except Exception:
+        return False
+
+def is_connection_error(exc: BaseException) -> bool:
+    """判断异常是否意味着连接本身已不可用"""
+    if isinstance(exc, (ConnectionError, OSError, asyncio.TimeoutError, asyncio.CancelledError, EOFError)):
+        return True
+    # websockets 库的连接关闭等异常
+    return type(exc).__module__.split('.')[0] == 'websockets'
+
+def pool_stats() -> dict:
+    """返回存储后端（SurrealDB 时为连接池）的状态计数器"""
+    return _backend.stats()
+
+# 初始化数据库连接
+async def init_db_connection():
+    """初始化存储后端，SurrealDB 时预热连接池"""
+    global _connection_attempts
+    
+    while _connection_attempts < _max_connection_attempts:
+        _connection_attempts += 1
+        try:
+            await _backend.start()
+            logging.info(f"Connected to {_backend.name} storage backend (attempt {_connection_attempts})")
+            # 重置连接尝试计数
+            _connection_attempts = 0
+            return _backend
+        except Exception as e:
+            logging.error(f"Error connecting to {_backend.name} storage backend (attempt {_connection_attempts}): {e}")
+            
+            # 如果还有尝试次数，等待一段时间后重试
+            if _connection_attempts < _max_connection_attempts:
+                logging.info(f"Retrying in {_connection_retry_delay} seconds...")
+                await asyncio.sleep(_connection_retry_delay)
+    
+    logging.error(f"Maximum connection attempts ({_max_connection_attempts}) reached. Using mock mode.")
+    _connection_attempts = 0
+    return None
+
+# 借出数据库连接
+@contextlib.asynccontextmanager
+async def db_connection(timeout: float = None):
+    """从连接池借出一个数据库连接，退出上下文时自动归还
+
+    无法获取连接时产出 None，调用方按 mock 模式处理（启用写日志时写操作写入日志）。
+    timeout 为等待连接的最长时间，默认使用连接池的 acquire_timeout。
+
+    用法::
+
+        async with db_connection() as db:
+            if db is None:
+                ...
+            result = await db.query(...)
+    """
+    try:
+        conn = await _pool.acquire(timeout)
+    except Exception as e:
+        logging.error(f"Error acquiring database connection: {e}")
+        yield None
+        return
+    
+    try:
+        yield conn
+    except BaseException as e:
+        _pool.report_error(conn, e)
+        raise
+    finally:
+        await _pool.release(conn)
+
+# 异步关闭数据库连接
+async def close_db():
+    """关闭存储后端"""
+    await _backend.close()
+    logging.info("All database connections closed")
+
+_RECORD_KEY_ALPHABET = string.ascii_lowercase + string.digits
+
+def _record_id(table, id):
+    """把记录ID规范为 table:id 形式，兼容传入完整ID、裸ID或带 id 字段的记录"""
+    if isinstance(id, dict):
+        id = id.get('id')
+    id = str(id)
+    if id.startswith(f"{table}:"):
+        return id
+    return f"{table}:{id}"
+
+def _new_record_key() -> str:
+    """生成与 SurrealDB 相同形式的随机记录ID（20 位小写字母和数字）"""
+    return "".join(secrets.choice(_RECORD_KEY_ALPHABET) for _ in range(20))
+
+def _with_record_id(table, data):
+    """返回带完整记录ID的数据副本，没有ID时生成一个"""
+    record = dict(data)
+    record['id'] = _record_id(table, data['id']) if data.get('id') else f"{table}:{_new_record_key()}"
+    return record
+
+def _first_result(result):
+    """从 SurrealDB 的查询响应中取出第一条语句的结果"""
+    if result and isinstance(result, list) and len(result) > 0 and isinstance(result[0], dict) and 'result' in result[0]:
+        return result[0]['result']
+    return None
+
+
+def _sort_order(order):
+    """把排序方向规范为 ASC / DESC，兼容 1 / -1 写法"""
+    if isinstance(order, int):
+        return "DESC" if order < 0 else "ASC"
+    return "DESC" if str(order).upper() == "DESC" else "ASC"
+
+def _build_where(condition, param_prefix="p"):
+    """构建参数化的 WHERE 子句
+
+    Returns:
+        tuple: (WHERE 子句（无条件时为空字符串）, 参数字典)
+    """
+    if not condition:
+        return "", {}
+    conditions = []
+    params = {}
+    for idx, (k, v) in enumerate(condition.items()):
+        param_name = f"{param_prefix}{idx}"
+        conditions.append(f"{k} = ${param_name}")
+        params[param_name] = v
+    return " WHERE " + " AND ".join(conditions), params
+
+class QueryShapeCache:
+    """查询形状缓存
+
+    SELECT 语句的文本只取决于"形状"：表名、投影字段、条件字段、排序以及是否带
+    LIMIT / START，具体的值全部作为参数绑定。同一形状的语句只编译一次，
+    语句文本保持稳定。缓存按 LRU 淘汰，并按形状统计命中次数。
+    """
+
+    def __init__(self, max_size: int = 256):
+        self.max_size = max_size
+        self._templates = collections.OrderedDict()
+        self._shape_hits = collections.Counter()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def compile(self, table, condition_keys, sort, has_limit, has_offset, param_prefix="p", fields=(), keyset=None):
+        """返回该形状的语句模板
+
+        Args:
+            keyset: 游标分页的 (排序字段, 比较符)，为空时不加游标条件
+
+        Returns:
+            tuple: (语句文本, 条件参数名列表, LIMIT 参数名, START 参数名)
+        """
+        key = (table, fields, condition_keys, sort, has_limit, has_offset, param_prefix, keyset)
+        template = self._templates.get(key)
+        if template is not None:
+            self._hits += 1
+            self._shape_hits[template[0]] += 1
+            self._templates.move_to_end(key)
+            return template
+
+        self._misses += 1
+        param_names = [f"{param_prefix}{idx}" for idx in range(len(condition_keys))]
+        query_str = f"SELECT {', '.join(fields) if fields else '*'} FROM {table}"
+        clauses = [f"{field} = ${name}" for field, name in zip(condition_keys, param_names)]
+        if keyset:
+            # (排序字段, id) 严格位于游标之后的记录
+            field, op = keyset
+            if field == "id":
+                clauses.append(f"id {op} type::thing(${param_prefix}ktb, ${param_prefix}kid)")
+            else:
+                clauses.append(
+                    f"({field} {op} ${param_prefix}kv OR ({field} = ${param_prefix}kv"
+                    f" AND id {op} type::thing(${param_prefix}ktb, ${param_prefix}kid)))"
+                )
+        if clauses:
+            query_str += " WHERE " + " AND ".join(clauses)
+        
+        # 添加排序
+        if sort:
+            query_str += " ORDER BY " + ", ".join(f"{field} {order}" for field, order in sort)
+        
+        # 添加分页，值同样参数化
+        limit_param = f"{param_prefix}limit" if has_limit else None
+        offset_param = f"{param_prefix}start" if has_offset else None
+        if limit_param:
+            query_str += f" LIMIT ${limit_param}"
+        if offset_param:
+            query_str += f" START ${offset_param}"
+
+        template = (query_str, param_names, limit_param, offset_param)
+        self._templates[key] = template
+        self._shape_hits[query_str] += 1
+        if len(self._templates) > self.max_size:
+            _, evicted = self._templates.popitem(last=False)
+            self._shape_hits.pop(evicted[0], None)
+            self._evictions += 1
+        return template
+
+    def stats(self, top: int = 10) -> dict:
+        """返回命中/未命中计数以及使用最多的查询形状"""
+        total = self._hits + self._misses
+        return {
+            "size": len(self._templates),
+            "max_size": self.max_size,
+            "hits": self._hits,
+            "misses": self._misses,
+            "evictions": self._evictions,
+            "hit_rate": round(self._hits / total, 4) if total else 0.0,
+            "top_shapes": [
+                {"query": query_str, "count": count}
+                for query_str, count in self._shape_hits.most_common(top)
+            ],
+        }
+
+    def clear(self):
+        self._templates.clear()
+        self._shape_hits.clear()
+        self._hits = self._misses = self._evictions = 0
+
+
+_query_cache = QueryShapeCache(QUERY_SHAPE_CACHE_SIZE)
+
+def query_cache_stats() -> dict:
+    """返回查询形状缓存的命中统计"""
+    return _query_cache.stats()
+
+_FIELD_PATTERN = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*(\.[A-Za-z_][A-Za-z0-9_]*)*$")
+
+def _projection(fields):
+    """校验并规范投影字段，始终包含 id
+
+    支持 metadata.source 这样的嵌套字段，返回结果中保持嵌套结构。
+    """
+    if not fields:
+        return ()
+    if isinstance(fields, str):
+        fields = [fields]
+    projection = ["id"]
+    for field in fields:
+        if not _FIELD_PATTERN.match(field):
+            raise ValueError(f"非法的投影字段: {field}")
+        if field not in projection:
+            projection.append(field)
+    return tuple(projection)
+
+def encode_cursor(value, record_id) -> str:
+    """把 (排序字段值, 记录ID) 编码为不透明的分页游标"""
+    raw = json.dumps([value, str(record_id)], separators=(",", ":"), ensure_ascii=False)
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor: str):
+    """解码分页游标
+
+    Returns:
+        tuple: (排序字段值, 记录ID)
+
+    Raises:
+        ValueError: 游标格式不正确
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        value, record_id = json.loads(raw.decode("utf-8"))
+    except Exception:
+        raise ValueError(f"无效的分页游标: {cursor}")
+    if ":" not in str(record_id):
+        raise ValueError(f"无效的分页游标: {cursor}")
+    return value, str(record_id)
+
+class RecordCache:
+    """按记录ID缓存单条记录（LRU + TTL）
+
+    Repository 的 create / update / merge / delete 会自动使对应记录失效；
+    按条件删除、批处理写入时整表失效。execute_raw 中的写入不会失效，
+    依赖 TTL 兜底。缓存返回记录的副本，调用方修改返回值不会影响缓存。
+
+    部分表的唯一字段（见 RECORD_CACHE_UNIQUE_FIELDS）也可以作为缓存键，
+    该表的任何写入都会清空这些别名，只保留按记录ID的缓存。
+
+    每次失效都会增加该表的版本号（generation）。读取前记下版本号，写入缓存时
+    版本号已变化说明读取期间有写入，读到的可能是写入前的旧记录，不再写入缓存。
+    """
+
+    def __init__(self, ttl: float = 60.0, default_size: int = 1000, table_sizes: dict = None,
+                 unique_fields: dict = None):
+        self.ttl = ttl
+        self.default_size = default_size
+        self.table_sizes = dict(table_sizes or {})
+        self.unique_fields = dict(unique_fields or {})
+        self._records = collections.defaultdict(collections.OrderedDict)  # table -> {record_id: (record, 写入时间)}
+        self._aliases = collections.defaultdict(dict)  # table -> {唯一字段值: record_id}
+        self._generations = collections.Counter()  # table -> 失效次数
+        self._counters = collections.defaultdict(collections.Counter)
+
+    def max_size(self, table: str) -> int:
+        return self.table_sizes.get(table, self.default_size)
+
+    def enabled(self, table: str) -> bool:
+        return self.ttl > 0 and self.max_size(table) > 0
+
+    def get(self, table: str, record_id: str):
+        """返回缓存记录的副本，未命中时返回 None"""
+        if not self.enabled(table):
+            return None
+        records = self._records[table]
+        entry = records.get(record_id)
+        if entry is not None and time.monotonic() - entry[1] > self.ttl:
+            del records[record_id]
+            self._counters[table]["expired"] += 1
+            entry = None
+        if entry is None:
+            self._counters[table]["misses"] += 1
+            return None
+        records.move_to_end(record_id)
+        self._counters[table]["hits"] += 1
+        return copy.deepcopy(entry[0])
+
+    def get_by_unique(self, table: str, value):
+        """按唯一字段值查找缓存记录"""
+        record_id = self._aliases[table].get(value)
+        if record_id is None:
+            if self.enabled(table):
+                self._counters[table]["misses"] += 1
+            return None
+        return self.get(table, record_id)
+
+    def generation(self, table: str) -> int:
+        """返回表的版本号，读取数据库前调用，写入缓存时传给 put"""
+        return self._generations[table]
+
+    def put(self, table: str, record: dict, generation: int = None):
+        """写入从数据库读取到的记录
+
+        generation 为读取前的 generation(table)，读取期间该表有写入时放弃写入缓存。
+        """
+        if not self.enabled(table) or not isinstance(record, dict) or not record.get('id'):
+            return
+        if generation is not None and generation != self._generations[table]:
+            self._counters[table]["stale_puts"] += 1
+            return
+        record_id = _record_id(table, record['id'])
+        records = self._records[table]
+        records[record_id] = (copy.deepcopy(record), time.monotonic())
+        records.move_to_end(record_id)
+        unique_field = self.unique_fields.get(table)
+        if unique_field and record.get(unique_field) is not None:
+            self._aliases[table][record[unique_field]] = record_id
+        while len(records) > self.max_size(table):
+            records.popitem(last=False)
+            self._counters[table]["evictions"] += 1
+
+    def invalidate(self, table: str, record_id=None):
+        """使单条记录失效；不提供记录ID时整表失效"""
+        self._generations[table] += 1
+        if record_id is None:
+            dropped = len(self._records[table])
+            self._records[table].clear()
+        else:
+            dropped = 1 if self._records[table].pop(_record_id(table, record_id), None) else 0
+        self._aliases[table].clear()
+        self._counters[table]["invalidations"] += dropped
+
+    def clear(self):
+        self._records.clear()
+        self._aliases.clear()
+        self._counters.clear()
+
+    def stats(self) -> dict:
+        """按表返回容量、命中率等统计"""
+        tables = {}
+        for table in set(self._records) | set(self._counters):
+            counters = self._counters[table]
+            lookups = counters["hits"] + counters["misses"]
+            tables[table] = {
+                "size": len(self._records[table]),
+                "max_size": self.max_size(table),
+                "hits": counters["hits"],
+                "misses": counters["misses"],
+                "hit_rate": round(counters["hits"] / lookups, 4) if lookups else 0.0,
+                "expired": counters["expired"],
+                "evictions": counters["evictions"],
+                "invalidations": counters["invalidations"],
+                "stale_puts": counters["stale_puts"],
+            }
+        return {"ttl": self.ttl, "tables": tables}
+
+
+_record_cache = RecordCache(
+    ttl=RECORD_CACHE_TTL,
+    default_size=RECORD_CACHE_DEFAULT_SIZE,
+    table_sizes=RECORD_CACHE_TABLE_SIZES,
+    unique_fields=RECORD_CACHE_UNIQUE_FIELDS
+)
+
+def record_cache_stats() -> dict:
+    """返回记录缓存的命中统计"""
+    return _record_cache.stats()
+
+class SingleFlight:
+    """合并并发的相同读请求
+
+    同一个键在执行期间的后续调用不会再访问数据库，而是等待同一个任务的结果。
+    调用方被取消不会影响共享的任务；有多个调用方时每个调用方拿到结果的副本，
+    互相修改不受影响。
+
+    表有写入时调用 forget，之后的调用不再加入写入前开始的读请求，而是重新读取。
+    """
+
+    def __init__(self):
+        self._inflight = {}  # key -> [task, 等待者数量, 涉及的表]
+        self._counters = collections.Counter()
+
+    async def do(self, key, factory, tables=None):
+        """执行 factory() 返回的协程，相同键的并发调用共享结果
+
+        Args:
+            key: 合并键
+            factory: 返回协程的函数
+            tables: 读请求涉及的表，默认为 key[1]
+        """
+        entry = self._inflight.get(key)
+        if entry is not None:
+            entry[1] += 1
+            self._counters["deduplicated"] += 1
+            return copy.deepcopy(await asyncio.shield(entry[0]))
+
+        self._counters["executed"] += 1
+        task = asyncio.ensure_future(factory())
+        entry = [task, 0, frozenset(tables) if tables is not None else frozenset((key[1],))]
+        self._inflight[key] = entry
+
+        def _done(_):
+            if self._inflight.get(key) is entry:
+                del self._inflight[key]
+        task.add_done_callback(_done)
+
+        result = await asyncio.shield(task)
+        return copy.deepcopy(result) if entry[1] else result
+
+    def forget(self, table: str):
+        """表有写入后调用，已经在等待的调用方仍拿到原来的结果"""
+        for key, entry in list(self._inflight.items()):
+            if table in entry[2]:
+                del self._inflight[key]
+                self._counters["forgotten"] += 1
+
+    def stats(self) -> dict:
+        executed = self._counters["executed"]
+        deduplicated = self._counters["deduplicated"]
+        total = executed + deduplicated
+        return {
+            "in_flight": len(self._inflight),
+            "executed": executed,
+            "deduplicated": deduplicated,
+            "forgotten": self._counters["forgotten"],
+            "dedup_rate": round(deduplicated / total, 4) if total else 0.0,
+        }
+
+
+def _flight_params(value) -> str:
+    """把查询参数序列化为稳定的合并键"""
+    return json.dumps(value, sort_keys=True, default=str)
+
+_single_flight = SingleFlight()
+
+def single_flight_stats() -> dict:
+    """返回并发查询合并的统计"""
+    return _single_flight.stats()
+
+def _build_count(table, condition=None, param_prefix="p"):
+    """构建参数化的计数语句 SELECT count() ... GROUP ALL
+
+    Returns:
+        tuple: (查询语句, 参数字典)
+    """
+    condition = condition or {}
+    query_str, param_names, _, _ = _query_cache.compile(
+        table, tuple(condition.keys()), (), False, False, param_prefix, fields=("count()",)
+    )
+    return f"{query_str} GROUP ALL", dict(zip(param_names, condition.values()))
+
+def _count_result(rows) -> int:
+    """从 GROUP ALL 计数结果中取出数量，没有匹配记录时为 0"""
+    if rows and isinstance(rows[0], dict):
+        return int(rows[0].get("count", 0))
+    return 0
+
+def _build_increment(table, id, deltas, fields=None, param_prefix=""):
+    """构建原子自增语句 UPDATE ... SET field += $d，由数据库完成读改写
+
+    语句只更新已存在的记录：WHERE id = ... 对不存在的记录不成立，已删除的记录不会因为
+    迟到的计数（缓冲的增量、重放的写日志）被重新创建。
+
+    Args:
+        deltas: {字段: 增量}，支持嵌套字段
+        fields: 同时直接赋值的字段，如 {'last_accessed': ...}
+
+    Returns:
+        tuple: (语句, 参数字典)
+    """
+    record_table, record_key = _record_id(table, id).split(":", 1)
+    params = {f"{param_prefix}tb": record_table, f"{param_prefix}id": record_key}
+    assignments = []
+    for operator, name, values in (("+=", "d", deltas), ("=", "v", fields or {})):
+        for idx, (field, value) in enumerate(values.items()):
+            if not _FIELD_PATTERN.match(field):
+                raise ValueError(f"非法的字段: {field}")
+            assignments.append(f"{field} {operator} ${param_prefix}{name}{idx}")
+            params[f"{param_prefix}{name}{idx}"] = value
+    if not assignments:
+        raise ValueError("自增语句至少需要一个字段")
+    target = f"type::thing(${param_prefix}tb, ${param_prefix}id)"
+    return f"UPDATE {target} SET {', '.join(assignments)} WHERE id = {target}", params
+
+def _field_value(record, field):
+    """按 a.b 形式的字段路径取值"""
+    for part in field.split("."):
+        record = record.get(part) if isinstance(record, dict) else None
+    return record
+
+def _build_select(table, condition=None, sort=None, limit=None, offset=None, param_prefix="p", fields=None, after=None):
+    """构建参数化的 SELECT 语句，语句文本来自查询形状缓存
+
+    Args:
+        fields: 只返回的字段列表，支持嵌套字段；为空时返回全部字段
+        after: 游标分页位置 (排序字段, 是否降序, 字段值, 记录ID)，只返回位于其后的记录
+
+    Returns:
+        tuple: (查询语句, 参数字典)
+    """
+    condition = condition or {}
+    sort_shape = tuple((field, _sort_order(order)) for field, order in sort) if sort else ()
+    query_str, param_names, limit_param, offset_param = _query_cache.compile(
+        table,
+        tuple(condition.keys()),
+        sort_shape,
+        limit is not None,
+        offset is not None,
+        param_prefix,
+        _projection(fields),
+        (after[0], "<" if after[1] else ">") if after else None
+    )
+    
+    params = dict(zip(param_names, condition.values()))
+    if after:
+        field, _, value, record_id = after
+        if field != "id":
+            params[f"{param_prefix}kv"] = value
+        params[f"{param_prefix}ktb"], params[f"{param_prefix}kid"] = str(record_id).split(":", 1)
+    if limit_param:
+        params[limit_param] = int(limit)
+    if offset_param:
+        params[offset_param] = int(offset)
+    return query_str, params
+
+
+class BatchStatementError(Exception):
+    """批处理中某条语句执行失败"""
+
+    def __init__(self, index: int, statement: str, detail):
+        self.index = index
+        self.statement = statement
+        self.detail = detail
+        super().__init__(f"批处理第 {index} 条语句执行失败: {detail} ({statement})")
+
+
+class QueryBatch:
+    """多语句批处理构建器
+
+    把多条参数化语句排队，execute() 时合并为一次请求发送给 SurrealDB，
+    按排队顺序返回每条语句转换后的结果::
+
+        batch = repo.batch()
+        batch.first('users', {'email': email})
+        batch.first('users', {'username': username})
+        by_email, by_username = await batch.execute()
+
+    各方法返回语句在批处理中的下标。结果类型：
+    query -> list，first -> dict 或 None，count -> int，create / update / increment -> dict 或 None，
+    delete -> bool，raw -> 该语句的原始结果。
+
+    transaction=True 时语句包裹在 BEGIN / COMMIT TRANSACTION 中，
+    任意一条失败则全部回滚，见 Repository.transaction()。
+    """
+
+    def __init__(self, repository: "Repository", transaction: bool = False):
+        self._repository = repository
+        self.transaction = transaction
+        # 元素为 (语句, 参数, 结果转换函数, mock 模式下的默认值, 操作描述)
+        # 操作描述供不执行 SurrealQL 的存储后端使用，如 ("query", 表名, 条件, ...)
+        self._statements = []
+        # 执行后需要在记录缓存中失效的 (表名, 记录ID)，记录ID为 None 表示整表
+        self._writes = []
+        # 只包含 query / first / count 时为只读批处理
+        self.read_only = True
+
+    def __len__(self):
+        return len(self._statements)
+
+    def _prefix(self) -> str:
+        # 每条语句的参数名加上语句下标前缀，避免合并后冲突
+        return f"s{len(self._statements)}_"
+
+    def _add(self, statement, params, convert, default, op) -> int:
+        self._statements.append((statement, params, convert, default, op))
+        return len(self._statements) - 1
+
+    def query(self, table, condition=None, sort=None, limit=None, offset=None, fields=None) -> int:
+        """排队一条条件查询，结果为记录列表"""
+        statement, params = _build_select(table, condition, sort, limit, offset, param_prefix=self._prefix() + "p", fields=fields)
+        return self._add(statement, params, lambda r: r or [], [], ("query", table, condition, sort, limit, offset, fields))
+
+    def first(self, table, condition=None, sort=None, fields=None) -> int:
+        """排队一条只取第一条记录的查询，结果为记录或 None"""
+        statement, params = _build_select(table, condition, sort, limit=1, param_prefix=self._prefix() + "p", fields=fields)
+        return self._add(statement, params, lambda r: r[0] if r else None, None, ("query", table, condition, sort, 1, None, fields))
+
+    def count(self, table, condition=None) -> int:
+        """排队一条计数语句，结果为匹配的记录数"""
+        statement, params = _build_count(table, condition, param_prefix=self._prefix() + "p")
+        return self._add(statement, params, _count_result, 0, ("count", table, condition))
+
+    def create(self, table, data) -> int:
+        """排队一条创建语句，结果为创建的记录"""
+        name = self._prefix() + "data"
+        self.read_only = False
+        if isinstance(data, dict) and data.get('id'):
+            self._writes.append((table, data['id']))
+        return self._add(f"CREATE {table} CONTENT ${name}", {name: data}, lambda r: r[0] if r else None, data, ("create", table, data))
+
+    def update(self, table, id, data) -> int:
+        """排队一条按ID整体更新的语句，结果为更新后的记录"""
+        prefix = self._prefix()
+        record_table, record_key = _record_id(table, id).split(":", 1)
+        self.read_only = False
+        self._writes.append((table, id))
+        statement = f"UPDATE type::thing(${prefix}tb, ${prefix}id) CONTENT ${prefix}data"
+        params = {f"{prefix}tb": record_table, f"{prefix}id": record_key, f"{prefix}data": data}
+        return self._add(statement, params, lambda r: r[0] if r else None, data, ("update", table, id, data))
+
+    def merge(self, table, id, data) -> int:
+        """排队一条按ID合并更新的语句，只修改 data 中给出的字段"""
+        prefix = self._prefix()
+        record_table, record_key = _record_id(table, id).split(":", 1)
+        self.read_only = False
+        self._writes.append((table, id))
+        statement = f"UPDATE type::thing(${prefix}tb, ${prefix}id) MERGE ${prefix}data"
+        params = {f"{prefix}tb": record_table, f"{prefix}id": record_key, f"{prefix}data": data}
+        return self._add(statement, params, lambda r: r[0] if r else None, data, ("merge", table, id, data))
+
+    def increment(self, table, id, deltas, fields=None) -> int:
+        """排队一条原子自增语句，deltas 为 {字段: 增量}，结果为更新后的记录"""
+        prefix = self._prefix()
+        statement, params = _build_increment(table, id, deltas, fields, param_prefix=prefix)
+        self.read_only = False
+        self._writes.append((table, id))
+        return self._add(statement, params, lambda r: r[0] if r else None, None, ("increment", table, id, deltas, fields or {}))
+
+    def delete(self, table, condition) -> int:
+        """排队一条条件删除语句，结果为 True"""
+        where_str, params = _build_where(condition, self._prefix() + "p")
+        self.read_only = False
+        self._writes.append((table, condition['id'] if condition and list(condition) == ['id'] else None))
+        return self._add(f"DELETE FROM {table}{where_str}", params, lambda r: True, False, ("delete", table, condition))
+
+    def raw(self, statement, params=None) -> int:
+        """排队一条原始语句，语句中的 $参数 会自动加上前缀"""
+        prefix = self._prefix()
+        params = params or {}
+        op = ("raw", statement, params)
+        statement = re.sub(
+            r"\$(\w+)",
+            lambda m: f"${prefix}{m.group(1)}" if m.group(1) in params else m.group(0),
+            statement.strip().rstrip(";")
+        )
+        self.read_only = False
+        return self._add(statement, {f"{prefix}{k}": v for k, v in params.items()}, lambda r: r, None, op)
+
+    def compile(self):
+        """合并所有语句
+
+        Returns:
+            tuple: (合并后的语句, 合并后的参数)
+        """
+        params = {}
+        for _, statement_params, _, _, _ in self._statements:
+            params.update(statement_params)
+        statements = [statement for statement, _, _, _, _ in self._statements]
+        if self.transaction:
+            statements = ["BEGIN TRANSACTION"] + statements + ["COMMIT TRANSACTION"]
+        return ";\n".join(statements) + ";", params
+
+    async def execute(self) -> list:
+        """一次请求执行所有语句，返回每条语句的结果
+
+        Raises:
+            BatchStatementError: 任意一条语句执行失败
+        """
+        if not self._statements:
+            return []
+        return await self._repository._execute_batch(self)
+
+    def _convert(self, response) -> list:
+        """把 SurrealDB 的多语句响应转换为各语句的结果"""
+        if self.transaction and isinstance(response, list) and len(response) == len(self._statements) + 2:
+            # 部分版本会为 BEGIN / COMMIT 也返回一条结果
+            response = response[1:-1]
+        if not isinstance(response, list) or len(response) != len(self._statements):
+            raise BatchStatementError(-1, "", f"响应语句数与请求不一致: {response}")
+        results = []
+        for index, ((statement, _, convert, _, _), entry) in enumerate(zip(self._statements, response)):
+            if isinstance(entry, dict):
+                if entry.get('status', 'OK') != 'OK':
+                    raise BatchStatementError(index, statement, entry.get('detail') or entry.get('result'))
+                entry = entry.get('result')
+            results.append(convert(entry))
+        return results
+
+    def _defaults(self) -> list:
+        return [default for _, _, _, default, _ in self._statements]
+
+    def _operations(self) -> list:
+        """返回 (语句, 操作描述) 列表，供不执行 SurrealQL 的存储后端逐条执行"""
+        return [(statement, op) for statement, _, _, _, op in self._statements]
+
+
+class StorageBackend:
+    """存储后端接口
+
+    Repository 负责记录缓存、并发查询合并和缓存失效，具体的读写由存储后端完成。
+    后端实现与 Repository 相同的 create / query / update / delete / batch 语义：
+
+    - 记录ID为 table:key 形式，create 未指定ID时由后端生成
+    - query 只支持等值条件、排序、LIMIT / START、字段投影和游标分页
+    - update 整体替换记录，merge 只修改给出的字段，两者在记录不存在时创建记录
+    - increment 在数据库端原子地给字段加上增量，返回更新后的记录；只更新已存在的记录，
+      记录不存在时不创建，返回 None
+    - batch 按顺序执行多条语句，transaction 要么全部写入，要么全部回滚
+
+    通过环境变量 STORAGE_BACKEND 选择：surrealdb（默认）或 sqlite，见 _create_backend。
+    """
+
+    name = "base"
+
+    async def start(self):
+        """建立连接，失败时抛出异常"""
+        raise NotImplementedError
+
+    async def close(self):
+        raise NotImplementedError
+
+    def stats(self) -> dict:
+        raise NotImplementedError
+
+    def pending_writes(self) -> int:
+        """写日志中尚未应用到数据库的写入数量，没有写日志的后端始终为 0"""
+        return 0
+
+    async def create(self, table, data):
+        raise NotImplementedError
+
+    async def create_many(self, table, rows, chunk_size=BULK_INSERT_CHUNK_SIZE):
+        raise NotImplementedError
+
+    async def select(self, table, condition=None, sort=None, limit=None, offset=None, fields=None, after=None):
+        raise NotImplementedError
+
+    async def count(self, table, condition=None):
+        raise NotImplementedError
+
+    async def update(self, table, id, data):
+        raise NotImplementedError
+
+    async def merge(self, table, id, data):
+        raise NotImplementedError
+
+    async def increment(self, table, id, deltas, fields=None):
+        raise NotImplementedError
+
+    async def delete(self, table, condition):
+        raise NotImplementedError
+
+    async def delete_chunk(self, table, condition, limit=BULK_INSERT_CHUNK_SIZE):
+        raise NotImplementedError
+
+    async def delete_record(self, table, id):
+        raise NotImplementedError
+
+    async def execute_batch(self, batch: QueryBatch) -> list:
+        raise NotImplementedError
+
+    async def execute_raw(self, query_str, params=None):
+        raise NotImplementedError
+
+    async def open_live_connection(self):
+        """建立接收 LIVE 查询通知的专用连接，后端不支持时返回 None，见 app.db_live"""
+        return None
+
+
+class SurrealBackend(StorageBackend):
+    """通过连接池访问远程 SurrealDB 的存储后端
+
+    无法获取连接时按 mock 模式处理：读操作返回空结果，写操作返回传入的数据。
+
+    提供 journal 时，写操作遇到连接错误（write_timeout 内连不上数据库，或写入中途连接断开）
+    会写入本地写日志并立即返回，由后台任务在数据库恢复后按顺序重放。连接池已满不算数据库
+    不可用，写操作按 acquire_timeout 等待连接，超时抛出 asyncio.TimeoutError。日志中还有
+    未重放的记录时，新的写操作同样进入日志，保证写入按提交顺序生效。重放是幂等的：创建的
+    记录在写入日志前就分配好ID，重放时按ID整体写入。自增操作，以及没有指定ID、写入中途
+    断线但实际已经写入的创建操作例外，重放时可能重复应用。
+    """
+
+    name = "surrealdb"
+
+    def __init__(self, pool: SurrealConnectionPool, journal: WriteJournal = None, write_timeout: float = None,
+                 replay_interval: float = 5.0, cache: "RecordCache" = None):
+        self._pool = pool
+        self._journal = journal
+        self._write_timeout = write_timeout
+        self._replay_interval = replay_interval
+        # 重放后需要失效的记录缓存
+        self._cache = cache
+        self._replay_task = None
+
+    async def start(self):
+        if self._journal is not None:
+            self._journal.open()
+            # 先启动重放任务，启动时数据库不可用也能在恢复后重放
+            if self._replay_task is None or self._replay_task.done():
+                self._replay_task = asyncio.create_task(self._replay_loop())
+        return await self._pool.start()
+
+    async def close(self):
+        if self._replay_task is not None:
+            self._replay_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError, Exception):
+                await self._replay_task
+            self._replay_task = None
+        await self._pool.close()
+        if self._journal is not None:
+            self._journal.close()
+
+    async def open_live_connection(self):
+        return await self._pool.open_dedicated()
+
+    def stats(self) -> dict:
+        stats = self._pool.stats()
+        if self._journal is not None:
+            stats["journal"] = self._journal.stats()
+        return stats
+
+    def pending_writes(self) -> int:
+        return self._journal.pending if self._journal is not None else 0
+
+    def _journaling(self) -> bool:
+        """日志中还有未重放的写入时，新的写入也必须进入日志"""
+        return self._journal is not None and self._journal.pending > 0
+
+    @contextlib.asynccontextmanager
+    async def _write_connection(self):
+        """借出写操作使用的连接
+
+        未启用写日志时与 db_connection 相同。启用写日志时只有连接错误才产出 None，
+        由调用方写入日志；连接池已满时抛出 asyncio.TimeoutError。
+        """
+        if self._journal is None:
+            async with db_connection() as db:
+                yield db
+            return
+        try:
+            conn = await self._pool.acquire(connect_timeout=self._write_timeout)
+        except asyncio.TimeoutError:
+            logging.error("等待数据库连接超时（连接池已满），写操作未执行")
+            raise
+        except Exception as e:
+            logging.error(f"Error acquiring database connection: {e}")
+            conn = None
+        if conn is None:
+            yield None
+            return
+        try:
+            yield conn
+        except BaseException as e:
+            self._pool.report_error(conn, e)
+            raise
+        finally:
+            await self._pool.release(conn)
+
+    def _journal_on_error(self, db, exc: BaseException) -> bool:
+        """写入中途出错时报告连接错误，返回是否应改为写入日志"""
+        return self._pool.report_error(db, exc) and self._journal is not None
+
+    async def _journal_write(self, op, result):
+        seq = await self._journal.append_async(op)
+        logging.warning(f"数据库不可用，写入已记入本地日志: seq={seq}, op={op[0]}")
+        return result
+
+    async def _journal_create(self, table, data):
+        record = _with_record_id(table, data)
+        return await self._journal_write(("create", table, record), record)
+
+    async def _journal_create_many(self, table, rows) -> list:
+        return [{"success": True, "record": await self._journal_create(table, row)} for row in rows]
+
+    async def _journal_batch(self, batch: QueryBatch) -> list:
+        """把写批处理整体记入日志，返回与执行成功时形状相同的结果"""
+        ops = []
+        results = []
+        for (_, op), default in zip(batch._operations(), batch._defaults()):
+            kind = op[0]
+            if kind == "create":
+                record = _with_record_id(op[1], op[2])
+                op = ("create", op[1], record)
+                results.append(record)
+            elif kind in ("update", "merge"):
+                record_id = _record_id(op[1], op[2])
+                op = (kind, op[1], record_id, op[3])
+                results.append(dict(op[3], id=record_id))
+            elif kind == "increment":
+                op = (kind, op[1], _record_id(op[1], op[2]), op[3], op[4])
+                results.append(None)
+            elif kind == "delete":
+                results.append(True)
+            else:
+                results.append(default)
+            ops.append(op)
+        return await self._journal_write(("batch", batch.transaction, ops), results)
+
+    def _replay_batch(self, op) -> QueryBatch:
+        """把一条日志记录转换为幂等的批处理：创建改为按ID整体写入，读操作跳过"""
+        if op[0] == "batch":
+            batch, ops = QueryBatch(None, transaction=op[1]), op[2]
+        else:
+            batch, ops = QueryBatch(None), [op]
+        for item in ops:
+            kind, table = item[0], item[1]
+            if kind == "create":
+                batch.update(table, item[2]["id"], item[2])
+            elif kind == "update":
+                batch.update(table, item[2], item[3])
+            elif kind == "merge":
+                batch.merge(table, item[2], item[3])
+            elif kind == "increment":
+                batch.increment(table, item[2], item[3], item[4])
+            elif kind == "delete":
+                batch.delete(table, item[2])
+            elif kind == "delete_record":
+                record_table, record_key = _record_id(table, item[2]).split(":", 1)
+                batch.raw("DELETE type::thing($tb, $id)", {"tb": record_table, "id": record_key})
+            elif kind == "raw":
+                batch.raw(item[1], item[2])
+        return batch
+
+    async def replay_journal(self) -> int:
+        """按顺序重放写日志，数据库仍不可用时停止
+
+        单条记录因数据错误重放失败时记录日志并跳过，不阻塞后续记录。
+
+        Returns:
+            int: 本次成功重放的记录数
+        """
+        if not self._journaling():
+            return 0
+        replayed = 0
+        async with db_connection() as db:
+            if db is None:
+                return 0
+            try:
+                while self._journal.pending:
+                    seq, op = self._journal.peek()
+                    batch = self._replay_batch(op)
+                    if len(batch):
+                        statement, params = batch.compile()
+                        try:
+                            batch._convert(await db.query(statement, params))
+                        except Exception as e:
+                            if self._pool.report_error(db, e):
+                                logging.error(f"重放写日志时连接中断，稍后继续: seq={seq}, error={e}")
+                                break
+                            logging.error(f"写日志记录重放失败，已跳过: seq={seq}, op={op}, error={e}")
+                            self._journal.ack(seq, failed=True)
+                            continue
+                        finally:
+                            if self._cache is not None:
+                                for table, id in batch._writes:
+                                    self._cache.invalidate(table, id)
+                    self._journal.ack(seq)
+                    replayed += 1
+            finally:
+                self._journal.checkpoint()
+        if replayed:
+            logging.info(f"已重放 {replayed} 条写日志记录，剩余 {self._journal.pending} 条")
+        return replayed
+
+    async def _replay_loop(self):
+        while True:
+            await asyncio.sleep(self._replay_interval)
+            try:
+                await self._journal.sync_async()
+                await self.replay_journal()
+            except Exception as e:
+                logging.error(f"重放写日志出错: {str(e)}")
+
+    async def create(self, table, data):
+        # 记录创建前的数据
+        logging.info(f"DB Create - Table: {table}")
+        logging.info(f"DB Create - Data before: {data}")
+        if 'password_hash' in data:
+            logging.info(f"DB Create - Password hash before: {data['password_hash']}")
+            logging.info(f"DB Create - Password hash type: {type(data['password_hash'])}")
+            logging.info(f"DB Create - Password hash length: {len(data['password_hash'])}")
+        
+        if self._journaling():
+            return await self._journal_create(table, data)
+        async with self._write_connection() as db:
+            if db is None:
+                if self._journal is not None:
+                    return await self._journal_create(table, data)
+                logging.debug("Using mock mode for create operation")
+                return data
+        
+            try:
+                # 执行创建操作
+                result = await db.create(table, data)
+            
+                # 记录创建后的结果
+                logging.info(f"DB Create - Result type: {type(result)}")
+                logging.info(f"DB Create - Result: {result}")
+                if result and isinstance(result, dict) and 'password_hash' in result:
+                    logging.info(f"DB Create - Password hash after: {result['password_hash']}")
+                    logging.info(f"DB Create - Password hash type after: {type(result['password_hash'])}")
+                    logging.info(f"DB Create - Password hash length after: {len(result['password_hash'])}")
+            
+                return result
+            except Exception as e:
+                logging.error(f"Error creating data in {table}: {e}")
+                if self._journal_on_error(db, e):
+                    return await self._journal_create(table, data)
+                return data
+
+    async def create_many(self, table, rows, chunk_size=BULK_INSERT_CHUNK_SIZE):
+        if self._journaling():
+            return await self._journal_create_many(table, rows)
+        results = []
+        async with self._write_connection() as db:
+            if db is None:
+                if self._journal is not None:
+                    return await self._journal_create_many(table, rows)
+                logging.debug("Using mock mode for create_many operation")
+                return [{"success": True, "record": row} for row in rows]
+            
+            for start in range(0, len(rows), chunk_size):
+                chunk = rows[start:start + chunk_size]
+                try:
+                    response = await db.query(f"INSERT INTO {table} $rows", {"rows": chunk})
+                    if response and isinstance(response[0], dict) and response[0].get('status') not in (None, 'OK'):
+                        raise ValueError(response[0].get('detail') or response[0].get('result'))
+                    records = _first_result(response)
+                    if not isinstance(records, list) or len(records) != len(chunk):
+                        raise ValueError(f"INSERT 返回 {len(records) if isinstance(records, list) else 0} 条记录，期望 {len(chunk)} 条")
+                    results.extend({"success": True, "record": record} for record in records)
+                except Exception as e:
+                    if self._pool.report_error(db, e):
+                        # 连接已不可用，剩余的行写入日志，未启用写日志时全部标记为失败
+                        logging.error(f"Error bulk inserting into {table}: {e}")
+                        if self._journal is not None:
+                            results.extend(await self._journal_create_many(table, rows[start:]))
+                        else:
+                            results.extend({"success": False, "data": row, "error": str(e)} for row in rows[start:])
+                        break
+                    
+                    logging.warning(f"Bulk insert chunk into {table} failed, retrying row by row: {e}")
+                    for row in chunk:
+                        try:
+                            record = await db.create(table, row)
+                            if isinstance(record, list):
+                                record = record[0] if record else None
+                            results.append({"success": True, "record": record})
+                        except Exception as row_error:
+                            self._pool.report_error(db, row_error)
+                            results.append({"success": False, "data": row, "error": str(row_error)})
+        return results
+
+    async def select(self, table, condition=None, sort=None, limit=None, offset=None, fields=None, after=None):
+        # 耗时、行数和慢查询由 Repository 记入查询统计，见 QueryMetrics
+        async with db_connection() as db:
+            if db is None:
+                logging.debug("Using mock mode for query operation")
+                return []
+        
+            # 根据条件执行查询
+            query_str = ""
+            params = {}
+            try:
+                if not fields and not after and condition and 'id' in condition and (
+                        str(condition['id']).startswith(f"{table}:") or len(condition) == 1):
+                    # 直接通过ID查询单条记录
+                    record_id = _record_id(table, condition['id'])
+                    try:
+                        # 尝试直接使用select方法
+                        record = await db.select(record_id)
+                        # 将结果包装为与查询结果相同的格式
+                        if record:
+                            result = [{'result': [record], 'status': 'OK'}]
+                        else:
+                            result = [{'result': [], 'status': 'OK'}]
+                    except Exception as e:
+                        logging.warning(f"Error in direct select of {record_id}: {e}, falling back to query")
+                        # 如果直接选择失败，回退到查询 - 使用参数化查询
+                        query_str = f"SELECT * FROM {table} WHERE id = $id"
+                        params = {"id": record_id}
+                        result = await db.query(query_str, params)
+                else:
+                    # 构建条件查询 - 使用参数化查询，语句文本来自查询形状缓存
+                    query_str, params = _build_select(table, condition, sort, limit, offset, fields=fields, after=after)
+                    result = await db.query(query_str, params)
+            except Exception as e:
+                logging.error(f"Error executing query '{query_str}' on {table}: {e}")
+                raise
+        
+        # 处理查询结果
+        try:
+            data = _first_result(result)
+            return data if data is not None else []
+        except Exception as e:
+            logging.error(f"Error processing query result from {table}: {e}")
+            return []
+
+    async def count(self, table, condition=None):
+        query_str, params = _build_count(table, condition)
+        async with db_connection() as db:
+            if db is None:
+                logging.debug("Using mock mode for count operation")
+                return 0
+        
+            try:
+                result = await db.query(query_str, params)
+            except Exception as e:
+                logging.error(f"Error executing count '{query_str}': {e}")
+                raise
+        return _count_result(_first_result(result))
+
+    async def update(self, table, id, data):
+        op = ("update", table, _record_id(table, id), data)
+        if self._journaling():
+            return await self._journal_write(op, dict(data, id=op[2]))
+        async with self._write_connection() as db:
+            if db is None:
+                if self._journal is not None:
+                    return await self._journal_write(op, dict(data, id=op[2]))
+                logging.debug("Using mock mode for update operation")
+                return data
+        
+            try:
+                # 使用SurrealDB的update方法更新记录
+                return await db.update(_record_id(table, id), data)
+            except Exception as e:
+                logging.error(f"Error updating data in {table}: {e}")
+                if self._journal_on_error(db, e):
+                    return await self._journal_write(op, dict(data, id=op[2]))
+                return None
+
+    async def merge(self, table, id, data):
+        op = ("merge", table, _record_id(table, id), data)
+        if self._journaling():
+            return await self._journal_write(op, dict(data, id=op[2]))
+        async with self._write_connection() as db:
+            if db is None:
+                if self._journal is not None:
+                    return await self._journal_write(op, dict(data, id=op[2]))
+                logging.debug("Using mock mode for merge operation")
+                return data
+        
+            try:
+                record_table, record_key = _record_id(table, id).split(":", 1)
+                result = await db.query(
+                    "UPDATE type::thing($tb, $id) MERGE $data",
+                    {"tb": record_table, "id": record_key, "data": data}
+                )
+                records = _first_result(result)
+                return records[0] if records else None
+            except Exception as e:
+                logging.error(f"Error merging data in {table}: {e}")
+                if self._journal_on_error(db, e):
+                    return await self._journal_write(op, dict(data, id=op[2]))
+                return None
+
+    async def increment(self, table, id, deltas, fields=None):
+        op = ("increment", table, _record_id(table, id), deltas, fields or {})
+        if self._journaling():
+            return await self._journal_write(op, None)
+        async with self._write_connection() as db:
+            if db is None:
+                if self._journal is not None:
+                    return await self._journal_write(op, None)
+                logging.debug("Using mock mode for increment operation")
+                return None
+        
+            try:
+                statement, params = _build_increment(table, id, deltas, fields)
+                result = await db.query(statement, params)
+                if result and isinstance(result[0], dict) and result[0].get('status') not in (None, 'OK'):
+                    raise ValueError(result[0].get('detail') or result[0].get('result'))
+                records = _first_result(result)
+                return records[0] if records else None
+            except Exception as e:
+                logging.error(f"Error incrementing data in {table}: {e}")
+                if self._journal_on_error(db, e):
+                    return await self._journal_write(op, None)
+                return None
+
+    async def delete(self, table, condition):
+        if self._journaling():
+            return await self._journal_write(("delete", table, condition), True)
+        async with self._write_connection() as db:
+            if db is None:
+                if self._journal is not None:
+                    return await self._journal_write(("delete", table, condition), True)
+                logging.debug("Using mock mode for delete operation")
+                return False
+        
+            try:
+                # 构建条件查询 - 使用参数化查询
+                where_str, params = _build_where(condition)
+                query_str = f"DELETE FROM {table}{where_str}"
+                await db.query(query_str, params)
+                return True
+            except Exception as e:
+                logging.error(f"Error deleting data from {table}: {e}")
+                if self._journal_on_error(db, e):
+                    return await self._journal_write(("delete", table, condition), True)
+                return False
+
+    async def delete_chunk(self, table, condition, limit=BULK_INSERT_CHUNK_SIZE):
+        where_str, params = _build_where(condition)
+        params["limit"] = int(limit)
+        query_str = (
+            f"DELETE FROM {table}{where_str} AND id IN "
+            f"(SELECT VALUE id FROM {table}{where_str} LIMIT $limit) RETURN id"
+        )
+        # 记入日志时整体删除，返回 0 表示没有剩余的分批
+        if self._journaling():
+            return await self._journal_write(("delete", table, condition), 0)
+        async with self._write_connection() as db:
+            if db is None:
+                if self._journal is not None:
+                    return await self._journal_write(("delete", table, condition), 0)
+                logging.debug("Using mock mode for delete_chunk operation")
+                return None
+        
+            try:
+                result = await db.query(query_str, params)
+                if result and isinstance(result[0], dict) and result[0].get('status') not in (None, 'OK'):
+                    raise ValueError(result[0].get('detail') or result[0].get('result'))
+            except Exception as e:
+                logging.error(f"Error deleting chunk from {table}: {e}")
+                if self._journal_on_error(db, e):
+                    return await self._journal_write(("delete", table, condition), 0)
+                raise
+        return len(_first_result(result) or [])
+
+    async def delete_record(self, table, id):
+        op = ("delete_record", table, _record_id(table, id))
+        if self._journaling():
+            return await self._journal_write(op, True)
+        async with self._write_connection() as db:
+            if db is None:
+                if self._journal is not None:
+                    return await self._journal_write(op, True)
+                logging.debug("Using mock mode for delete operation")
+                return False
+        
+            try:
+                await db.delete(_record_id(table, id))
+                return True
+            except Exception as e:
+                logging.error(f"Error deleting record from {table}: {e}")
+                if self._journal_on_error(db, e):
+                    return await self._journal_write(op, True)
+                return False
+
+    async def execute_batch(self, batch: QueryBatch) -> list:
+        journaled = self._journal is not None and not batch.read_only
+        if journaled and self._journaling():
+            return await self._journal_batch(batch)
+        statement, params = batch.compile()
+        async with (self._write_connection() if journaled else db_connection()) as db:
+            if db is None:
+                if journaled:
+                    return await self._journal_batch(batch)
+                logging.debug("Using mock mode for batch operation")
+                return batch._defaults()
+            
+            try:
+                response = await db.query(statement, params)
+            except Exception as e:
+                if journaled and self._journal_on_error(db, e):
+                    logging.error(f"Error executing batch: {e}")
+                    return await self._journal_batch(batch)
+                raise
+        return batch._convert(response)
+
+    async def execute_raw(self, query_str, params=None):
+        async with db_connection() as db:
+            if db is None:
+                logging.debug("Using mock mode for raw query operation")
+                return None
+        
+            try:
+                result = await db.query(query_str, params) if params else await db.query(query_str)
+            
+                data = _first_result(result)
+                return data if data is not None else result
+            except Exception as e:
+                logging.error(f"Error executing raw query: {e}")
+                raise
+
 
-# 全局数据库连接
-_db = None
-_db_lock = asyncio.Lock()
-_connection_attempts = 0
-_max_connection_attempts = 3
-_connection_retry_delay = 2  # 秒
-_db_pool = {}
-_db_pool_lock = asyncio.Lock()
+class Repository:
+    """异步数据访问接口
 
-# 检查连接是否可用
-async def is_connection_alive():
-    """检查数据库连接是否正常"""
-    global _db
-    if _db is None:
-        return False
-    
-    try:
-        # 尝试执行一个简单的查询
-        await _db.query('INFO FOR DB')
-        return True
-    except Exception:
-        return False
+    所有方法都是协程，在事件循环中直接 await 调用::
 
-# 初始化数据库连接
-async def init_db_connection():
-    """初始化数据库连接"""
-    global _db, _connection_attempts
+        users = await repo.query('users', {'email': email})
+
+    多个互不依赖的调用可以用 asyncio.gather 并发执行。
+    实际的读写由存储后端完成，见 StorageBackend。
+    """
+
+    def __init__(self, backend: StorageBackend, cache: RecordCache = None, flight: "SingleFlight" = None,
+                 metrics: QueryMetrics = None):
+        self._backend = backend
+        self._cache = cache
+        self._flight = flight or SingleFlight()
+        self._metrics = metrics
+        self._write_listeners = []
+
+    @property
+    def backend(self) -> StorageBackend:
+        return self._backend
+
+    def pending_writes(self) -> int:
+        """写日志中尚未应用到数据库的写入数量
+
+        大于 0 时新的写操作也会进入日志，返回前并没有真正写入数据库，见 SurrealBackend。
+        """
+        return self._backend.pending_writes()
     
-    # 使用异步锁确保只有一个协程在初始化连接
-    async with _db_lock:
-        # 如果连接已存在且正常，直接返回
-        if _db is not None and await is_connection_alive():
-            logging.info("DB连接已存在且正常，直接返回")
-            return _db
-        
-        # 检查连接尝试次数
-        if _connection_attempts >= _max_connection_attempts:
-            logging.error(f"Maximum connection attempts ({_max_connection_attempts}) reached. Using mock mode.")
-            return None
-        
-        # 尝试连接
-        _connection_attempts += 1
+    def _invalidate(self, table, id=None):
+        if self._cache is not None:
+            self._cache.invalidate(table, id)
+        self._flight.forget(table)
+
+    async def _measure(self, op, table, shape, call):
+        """执行一次存储后端请求并记入查询统计，见 QueryMetrics"""
+        if self._metrics is None or not self._metrics.enabled:
+            return await call()
+        start = time.perf_counter()
         try:
-            # 如果已有连接，先关闭
-            if _db is not None:
-                try:
-                    logging.info("关闭旧的数据库连接")
-                    await _db.close()
-                except Exception as e:
-                    logging.error(f"关闭旧连接出错: {str(e)}")
+            result = await call()
+        except Exception as e:
+            self._metrics.record(op, table, shape, time.perf_counter() - start, error=e)
+            raise
+        self._metrics.record(op, table, shape, time.perf_counter() - start, result)
+        return result
+
+    def add_write_listener(self, listener):
+        """注册写入监听器，每次写入成功后以 listener(表名, 操作, 记录) 调用
+
+        操作为 create / update / merge / delete。delete 按条件删除时记录为删除条件。
+        监听器在事件循环中同步调用，不能阻塞。
+        """
+        if listener not in self._write_listeners:
+            self._write_listeners.append(listener)
+
+    def remove_write_listener(self, listener):
+        if listener in self._write_listeners:
+            self._write_listeners.remove(listener)
+
+    def _notify(self, table, action, record):
+        if not self._write_listeners or not isinstance(record, dict):
+            return
+        for listener in list(self._write_listeners):
+            try:
+                listener(table, action, record)
+            except Exception as e:
+                logging.error(f"写入监听器出错: table={table}, action={action}, error={str(e)}")
+
+    async def create(self, table, data):
+        """在指定表中创建数据"""
+        result = await self._measure(
+            "create", table, query_shape("create", table),
+            lambda: self._backend.create(table, data)
+        )
+        if isinstance(data, dict) and data.get('id'):
+            self._invalidate(table, data['id'])
+        else:
+            self._flight.forget(table)
+        if result:
+            self._notify(table, "create", result if isinstance(result, dict) else data)
+        return result
+
+    async def create_many(self, table, rows, chunk_size=BULK_INSERT_CHUNK_SIZE):
+        """批量创建数据，每个分块只发送一条 INSERT INTO 语句
+        
+        某个分块整体失败时（例如其中一行违反唯一索引），逐行重试该分块，
+        以便准确报告每一行的结果。
+        
+        Args:
+            table (str): 表名
+            rows (list): 要创建的记录列表
+            chunk_size (int): 每条 INSERT 语句包含的最大行数
             
-            # 创建新连接
-            logging.info(f"尝试创建新的数据库连接: {SURREAL_URL}")
-            _db = surrealdb.Surreal()
-            await _db.connect(SURREAL_URL)
-            await _db.signin({"user": SURREAL_USER, "pass": SURREAL_PASS})
-            await _db.use(SURREAL_NS, SURREAL_DB)
-            logging.info(f"Connected to SurrealDB at {SURREAL_URL} (attempt {_connection_attempts})")
+        Returns:
+            list: 与 rows 一一对应的结果，每项为
+                {"success": True, "record": 创建的记录} 或
+                {"success": False, "data": 原始数据, "error": 错误信息}
+        """
+        rows = list(rows)
+        if not rows:
+            return []
+        
+        results = await self._measure(
+            "create_many", table, query_shape("insert", table),
+            lambda: self._backend.create_many(table, rows, chunk_size)
+        )
+        
+        self._flight.forget(table)
+        for row in rows:
+            if isinstance(row, dict) and row.get('id'):
+                self._invalidate(table, row['id'])
+        for result in results:
+            if result["success"]:
+                self._notify(table, "create", result["record"])
+        
+        failed = sum(1 for r in results if not r["success"])
+        logging.info(f"DB Create many - Table: {table}, rows: {len(rows)}, failed: {failed}")
+        return results
+
+
+    async def query(self, table, condition=None, sort=None, limit=None, offset=None, fields=None, after=None):
+        """查询指定表中的数据
+
+        Args:
+            table (str): 表名
+            condition (dict): 等值查询条件
+            sort (list): [(字段, 'ASC'/'DESC' 或 1/-1)] 排序
+            limit (int): 返回的最大记录数
+            offset (int): 跳过的记录数
+            fields (list): 只返回的字段，支持 metadata.source 这样的嵌套字段；
+                为空时返回全部字段（SELECT *）
+            after (tuple): 游标分页位置，一般不直接传入，见 query_page
+
+        按记录ID或唯一字段的单条查询会先查记录缓存，命中时不访问数据库。
+
+        Returns:
+            list: 记录列表
+        """
+        # 只有 {'id': ...} 或 {唯一字段: ...} 这样的单条件查询使用记录缓存
+        cache_key = None
+        if self._cache is not None and not fields and not after and condition and len(condition) == 1:
+            key, value = next(iter(condition.items()))
+            if key == 'id':
+                cache_key = key
+                cached = self._cache.get(table, _record_id(table, value))
+            elif key == self._cache.unique_fields.get(table):
+                cache_key = key
+                cached = self._cache.get_by_unique(table, value)
+            if cache_key and cached is not None:
+                return [cached]
+        
+        # 并发的相同查询共享同一次数据库请求
+        flight_key = ("query", table, _flight_params(condition), _flight_params(sort), limit, offset,
+                      _flight_params(fields), _flight_params(after))
+        generation = self._cache.generation(table) if cache_key else None
+        return await self._flight.do(
+            flight_key,
+            lambda: self._query(table, condition, sort, limit, offset, fields, after, cache_key, generation)
+        )
+
+    async def _query(self, table, condition, sort, limit, offset, fields, after, cache_key, generation=None):
+        data = await self._measure(
+            "select", table, query_shape("select", table, condition, sort, limit, offset, fields, after),
+            lambda: self._backend.select(table, condition, sort, limit, offset, fields, after)
+        )
+        if cache_key and len(data) == 1:
+            # 读取期间有写入时不写入缓存，见 RecordCache
+            self._cache.put(table, data[0], generation)
+        return data
+
+    async def count(self, table, condition=None):
+        """统计指定表中符合条件的记录数，由数据库计数，不加载记录
+        
+        Args:
+            table (str): 表名
+            condition (dict): 等值查询条件
             
-            # 重置连接尝试计数
-            _connection_attempts = 0
-            return _db
-        except Exception as e:
-            logging.error(f"Error connecting to SurrealDB (attempt {_connection_attempts}): {e}")
+        Returns:
+            int: 记录数
+        """
+        return await self._flight.do(
+            ("count", table, _flight_params(condition)),
+            lambda: self._measure(
+                "count", table, query_shape("count", table, condition),
+                lambda: self._backend.count(table, condition)
+            )
+        )
+
+    async def query_page(self, table, condition=None, order_field="timestamp", limit=20,
+                         cursor=None, descending=False, fields=None):
+        """基于 (排序字段, id) 的游标分页查询
+
+        与 LIMIT/START 不同，任意深度的页都只扫描一页的数据。
+        
+        Args:
+            table (str): 表名
+            condition (dict): 等值查询条件
+            order_field (str): 排序字段，如 timestamp、updated_at
+            limit (int): 每页记录数
+            cursor (str): 上一页返回的 next_cursor，为空时取第一页
+            descending (bool): 是否按排序字段降序
+            fields (list): 只返回的字段，会自动包含排序字段
             
-            # 如果还有尝试次数，等待一段时间后重试
-            if _connection_attempts < _max_connection_attempts:
-                logging.info(f"Retrying in {_connection_retry_delay} seconds...")
-                await asyncio.sleep(_connection_retry_delay)  # 使用异步睡眠而不是阻塞睡眠
-                return await init_db_connection()
+        Returns:
+            dict: {"items": 记录列表, "next_cursor": 下一页游标或 None, "has_more": 是否还有下一页}
+
+        Raises:
+            ValueError: 游标格式不正确
+        """
+        after = None
+        if cursor:
+            value, record_id = decode_cursor(cursor)
+            after = (order_field, descending, value, record_id)
+        if fields and order_field not in fields:
+            fields = list(fields) + [order_field]
+
+        order = "DESC" if descending else "ASC"
+        sort = [(order_field, order), ("id", order)] if order_field != "id" else [("id", order)]
+        # 多取一条用于判断是否还有下一页
+        rows = await self.query(
+            table,
+            condition,
+            sort=sort,
+            limit=limit + 1,
+            fields=fields,
+            after=after
+        )
+        items = rows[:limit]
+        has_more = len(rows) > limit
+        next_cursor = None
+        if has_more and items:
+            last = items[-1]
+            next_cursor = encode_cursor(last.get(order_field), _record_id(table, last.get("id")))
+        return {"items": items, "next_cursor": next_cursor, "has_more": has_more}
+
+    async def query_iter(self, table, condition=None, chunk_size=QUERY_ITER_CHUNK_SIZE,
+                         fields=None, order_field="id"):
+        """逐条遍历查询结果的异步生成器
+
+        按 (order_field, id) 游标分页，每次只从数据库读取 chunk_size 条记录，
+        遍历大表时内存占用保持不变::
+
+            async for user in repo.query_iter('users', fields=['email']):
+                ...
+        
+        Args:
+            table (str): 表名
+            condition (dict): 等值查询条件
+            chunk_size (int): 每次读取的记录数
+            fields (list): 只返回的字段
+            order_field (str): 遍历顺序，默认按记录ID
             
-            return None
+        Yields:
+            dict: 记录
+        """
+        cursor = None
+        while True:
+            page = await self.query_page(
+                table,
+                condition,
+                order_field=order_field,
+                limit=chunk_size,
+                cursor=cursor,
+                fields=fields
+            )
+            for record in page["items"]:
+                yield record
+            if not page["has_more"]:
+                break
+            cursor = page["next_cursor"]
 
-# 异步获取数据库连接
-async def get_db():
-    """获取数据库连接"""
-    global _db_pool
-    
-    # 获取当前任务 ID作为唯一标识符
-    task_id = id(asyncio.current_task())
-    
-    # 使用异步锁确保并发安全
-    async with _db_pool_lock:
-        # 检查这个任务是否已有连接
-        if task_id in _db_pool and _db_pool[task_id] is not None:
-            # 检查连接是否正常
-            try:
-                await _db_pool[task_id].query('INFO FOR DB')
-                logging.info(f"使用现有连接: task_id={task_id}")
-                return _db_pool[task_id]
-            except Exception as e:
-                # 如果连接出错，删除并创建新连接
-                logging.error(f"现有连接失效: task_id={task_id}, error={str(e)}")
-                try:
-                    await _db_pool[task_id].close()
-                except Exception as e:
-                    logging.error(f"关闭失效连接出错: {str(e)}")
-                del _db_pool[task_id]
+    async def update(self, table, id, data):
+        """更新指定表中的数据
+        
+        Args:
+            table (str): 表名
+            id (str): 记录ID，可以带或不带表名前缀
+            data (dict): 要更新的数据
+            
+        Returns:
+            dict: 更新后的记录
+        """
+        result = await self._measure(
+            "update", table, query_shape("update", table, {'id': id}),
+            lambda: self._backend.update(table, id, data)
+        )
+        self._invalidate(table, id)
+        if result:
+            self._notify(table, "update", result if isinstance(result, dict) else dict(data, id=id))
+        return result
+
+    async def merge(self, table, id, data):
+        """合并更新指定记录，只修改 data 中给出的字段
+        
+        与 update 不同，未出现在 data 中的字段保持不变，适合只读取了部分字段
+        （见 query 的 fields 参数）后回写的场景。
+        
+        Args:
+            table (str): 表名
+            id (str): 记录ID，可以带或不带表名前缀
+            data (dict): 要合并的字段
+            
+        Returns:
+            dict: 更新后的记录
+        """
+        result = await self._measure(
+            "merge", table, query_shape("merge", table, {'id': id}),
+            lambda: self._backend.merge(table, id, data)
+        )
+        self._invalidate(table, id)
+        if result:
+            self._notify(table, "merge", result if isinstance(result, dict) else dict(data, id=id))
+        return result
+
+    async def increment(self, table, id, field, delta=1, fields=None):
+        """原子地给记录的计数字段加上 delta，由数据库完成读改写，并发调用不会丢失增量
+        
+        高频且不需要立即读到结果的计数请使用 counter_buffer，见 CounterBuffer。
+        
+        Args:
+            table (str): 表名
+            id (str): 记录ID，可以带或不带表名前缀
+            field (str): 计数字段，支持嵌套字段
+            delta (int): 增量，可以为负数
+            fields (dict): 同时直接赋值的字段，如 {'last_accessed': ...}
+            
+        Returns:
+            计数字段的新值，记录不存在、数据库不可用或更新失败时为 None
+        """
+        record = await self._measure(
+            "increment", table, query_shape("increment", table, {'id': id}),
+            lambda: self._backend.increment(table, id, {field: delta}, fields)
+        )
+        self._invalidate(table, id)
+        if record:
+            self._notify(table, "merge", record)
+        return _field_value(record, field) if record else None
+
+    async def delete(self, table, condition):
+        """删除指定表中符合条件的数据
+        
+        Args:
+            table (str): 表名
+            condition (dict): 删除条件
+            
+        Returns:
+            bool: 是否删除成功
+        """
+        result = await self._measure(
+            "delete", table, query_shape("delete", table, condition),
+            lambda: self._backend.delete(table, condition)
+        )
+        if condition and list(condition) == ['id']:
+            self._invalidate(table, condition['id'])
+        else:
+            self._invalidate(table)
+        if result:
+            self._notify(table, "delete", condition)
+        return result
+
+    async def delete_chunk(self, table, condition, limit=BULK_INSERT_CHUNK_SIZE):
+        """删除最多 limit 条符合条件的数据，用于分批删除大量记录
         
-        # 创建新连接
+        Args:
+            table (str): 表名
+            condition (dict): 删除条件
+            limit (int): 本次最多删除的记录数
+            
+        Returns:
+            int: 实际删除的记录数，小于 limit 时表示已全部删除；
+                数据库不可用（mock 模式）、删除没有执行时为 None
+        """
+        if not condition:
+            raise ValueError("分批删除必须提供删除条件")
         try:
-            # 创建新连接
-            logging.info(f"为任务 {task_id} 创建新连接")
-            db = surrealdb.Surreal()
-            await db.connect(SURREAL_URL)
-            await db.signin({"user": SURREAL_USER, "pass": SURREAL_PASS})
-            await db.use(SURREAL_NS, SURREAL_DB)
-            logging.info(f"Created new connection for task {task_id}")
+            deleted = await self._measure(
+                "delete_chunk", table, query_shape("delete_chunk", table, condition, limit=limit),
+                lambda: self._backend.delete_chunk(table, condition, limit)
+            )
+        finally:
+            self._invalidate(table)
+        if deleted:
+            self._notify(table, "delete", condition)
+        return deleted
+
+    async def delete_record(self, table, id):
+        """按ID删除单条记录
+        
+        Args:
+            table (str): 表名
+            id (str): 记录ID，可以带或不带表名前缀
             
-            # 将连接存入连接池
-            _db_pool[task_id] = db
-            return db
-        except Exception as e:
-            logging.error(f"Error creating database connection: {e}")
-            return None
+        Returns:
+            bool: 是否删除成功
+        """
+        result = await self._measure(
+            "delete_record", table, query_shape("delete", table, {'id': id}),
+            lambda: self._backend.delete_record(table, id)
+        )
+        self._invalidate(table, id)
+        if result:
+            self._notify(table, "delete", {'id': id})
+        return result
 
-# 异步关闭数据库连接
-async def close_db():
-    """关闭数据库连接"""
-    global _db, _db_pool
-    
-    # 关闭全局连接
-    if _db is not None:
+    def batch(self) -> QueryBatch:
+        """创建多语句批处理，见 QueryBatch"""
+        return QueryBatch(self)
+
+    def transaction(self) -> QueryBatch:
+        """创建事务批处理：所有语句在一次请求中原子执行，要么全部写入，要么全部回滚"""
+        return QueryBatch(self, transaction=True)
+
+    async def _execute_batch(self, batch: QueryBatch) -> list:
+        if batch.read_only:
+            # 只读批处理同样可以与并发的相同批处理合并
+            statement, params = batch.compile()
+            return await self._flight.do(
+                ("batch", statement, _flight_params(params)),
+                lambda: self._run_batch(batch),
+                tables={op[1] for _, op in batch._operations()}
+            )
+        return await self._run_batch(batch)
+
+    async def _run_batch(self, batch: QueryBatch) -> list:
         try:
-            await _db.close()
-            logging.info("Closed global database connection")
-        except Exception as e:
-            logging.error(f"Error closing global database connection: {e}")
+            results = await self._measure(
+                "batch", "(batch)", _batch_shape(batch),
+                lambda: self._backend.execute_batch(batch)
+            )
         finally:
-            _db = None
-    
-    # 关闭连接池中的所有连接
-    async with _db_pool_lock:
-        for task_id, db in list(_db_pool.items()):
-            try:
-                await db.close()
-                logging.info(f"Closed database connection for task {task_id}")
-            except Exception as e:
-                logging.error(f"Error closing database connection for task {task_id}: {e}")
-            finally:
-                del _db_pool[task_id]
+            for table, id in batch._writes:
+                self._invalidate(table, id)
+            if not batch.read_only:
+                # 没有ID的创建不在 _writes 中，同样不能再加入写入前开始的读请求
+                for _, op in batch._operations():
+                    if op[0] == "create":
+                        self._flight.forget(op[1])
+        if self._write_listeners and not batch.read_only:
+            for (_, op), result in zip(batch._operations(), results):
+                action = op[0]
+                if action == "create" and result:
+                    self._notify(op[1], "create", result if isinstance(result, dict) else op[2])
+                elif action in ("update", "merge") and result:
+                    self._notify(op[1], action, result if isinstance(result, dict) else dict(op[3], id=op[2]))
+                elif action == "increment" and isinstance(result, dict):
+                    self._notify(op[1], "merge", result)
+                elif action == "delete" and result:
+                    self._notify(op[1], "delete", op[2])
+        return results
+
+    async def execute_raw(self, query_str, params=None):
+        """执行原始SQL查询
         
-        # 清空连接池
-        _db_pool.clear()
-    
-    logging.info("All database connections closed")
-    
-    # 强制进行垃圾回收
-    import gc
-    gc.collect()
-    logging.info("Garbage collection performed after closing DB connections")
-
-# 同步包装器，将异步操作转换为同步操作
-def run_async(async_func):
-    """运行异步函数并返回结果"""
-    try:
-        # Check if we're already in an event loop
-        loop = asyncio.get_running_loop()
-        # If we're in an event loop, we can't create a new one
-        # Instead, we should just return the coroutine directly
-        # The caller is responsible for awaiting it
-        return async_func
-    except RuntimeError:
-        # If we're not in an event loop, create a new one
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
+        Args:
+            query_str (str): SQL查询字符串
+            params (dict): 查询参数
+            
+        Returns:
+            Any: 查询结果
+        """
+        return await self._measure(
+            "raw", "(raw)", " ".join(query_str.split())[:200],
+            lambda: self._backend.execute_raw(query_str, params)
+        )
+
+
+def _batch_shape(batch: QueryBatch) -> str:
+    """批处理的形状：各语句的操作和表名"""
+    ops = []
+    for _, op in batch._operations():
+        ops.append(op[0] if op[0] == "raw" else f"{op[0]} {op[1]}")
+    kind = "TRANSACTION" if batch.transaction else "BATCH"
+    return f"{kind} [{'; '.join(ops)}]"
+
+
+class SyncRepository:
+    """Repository 的同步门面，供脚本、迁移和定时任务等同步代码使用
+
+    应用运行时（startup 中调用过 bind_loop），调用会通过 run_coroutine_threadsafe
+    交给应用的事件循环执行，与异步代码共用同一个连接池、缓存和写入日志；
+    没有应用事件循环时（独立脚本）才在私有事件循环中运行。
+    连接池中的连接绑定在创建它的事件循环上，不能在两个循环之间共用。
+    在事件循环中请直接 await repo 的方法。
+    """
+
+    def __init__(self, repository: Repository):
+        self._repository = repository
+        self._loop = None
+        self._app_loop = None
+
+    def bind_loop(self, loop):
+        """绑定应用的事件循环，之后其他线程中的同步调用都交给该循环执行
+
+        Args:
+            loop: 应用的事件循环，传入 None 解除绑定
+        """
+        self._app_loop = loop
+
+    def _bound_loop(self):
+        """返回仍在运行的应用事件循环，没有时返回 None"""
+        loop = self._app_loop
+        if loop is None or loop.is_closed() or not loop.is_running():
+            return None
+        return loop
+
+    def run(self, coro):
+        """运行一个使用 repo 的协程，例如遍历 query_iter 的批处理任务"""
+        return self._run(coro)
+
+    def _run(self, coro):
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            pass
+        else:
+            coro.close()
+            raise RuntimeError("SyncRepository 不能在事件循环中使用，请直接 await repo 的方法")
+        
+        app_loop = self._bound_loop()
+        if app_loop is not None:
+            return asyncio.run_coroutine_threadsafe(coro, app_loop).result()
+        
+        if self._loop is None or self._loop.is_closed():
+            self._loop = asyncio.new_event_loop()
+        return self._loop.run_until_complete(coro)
+
+    def connect(self):
+        """初始化连接池；绑定了应用事件循环时连接池由应用管理，这里不做任何事"""
+        if self._bound_loop() is not None:
+            return None
+        return self._run(init_db_connection())
+
+    def close(self):
+        """关闭私有事件循环及其连接池；应用的连接池由应用在 shutdown 时关闭"""
+        if self._loop is None or self._loop.is_closed():
+            return
+        if self._bound_loop() is not None:
+            return
         try:
-            return loop.run_until_complete(async_func)
+            self._run(close_db())
         finally:
-            loop.close()
+            self._loop.close()
+            self._loop = None
+
+    def create(self, table, data):
+        return self._run(self._repository.create(table, data))
+
+    def query(self, table, condition=None, sort=None, limit=None, offset=None, fields=None):
+        return self._run(self._repository.query(table, condition, sort=sort, limit=limit, offset=offset, fields=fields))
+
+    def count(self, table, condition=None):
+        return self._run(self._repository.count(table, condition))
+
+    def query_page(self, table, condition=None, order_field="timestamp", limit=20, cursor=None, descending=False, fields=None):
+        return self._run(self._repository.query_page(
+            table, condition, order_field=order_field, limit=limit,
+            cursor=cursor, descending=descending, fields=fields
+        ))
+
+    def create_many(self, table, rows, chunk_size=BULK_INSERT_CHUNK_SIZE):
+        return self._run(self._repository.create_many(table, rows, chunk_size=chunk_size))
+
+    def update(self, table, id, data):
+        return self._run(self._repository.update(table, id, data))
+
+    def merge(self, table, id, data):
+        return self._run(self._repository.merge(table, id, data))
+
+    def delete(self, table, condition):
+        return self._run(self._repository.delete(table, condition))
+
+    def delete_chunk(self, table, condition, limit=BULK_INSERT_CHUNK_SIZE):
+        return self._run(self._repository.delete_chunk(table, condition, limit))
+
+    def delete_record(self, table, id):
+        return self._run(self._repository.delete_record(table, id))
+
+    def execute_raw(self, query_str, params=None):
+        return self._run(self._repository.execute_raw(query_str, params))
+
+
+def _create_backend() -> StorageBackend:
+    """按 STORAGE_BACKEND 创建存储后端"""
+    if STORAGE_BACKEND == 'sqlite':
+        from .db_sqlite import SQLiteBackend
+        return SQLiteBackend(SQLITE_PATH)
+    if STORAGE_BACKEND != 'surrealdb':
+        raise ValueError(f"未知的存储后端: {STORAGE_BACKEND}，可选 surrealdb 或 sqlite")
+    journal = None
+    if SURREAL_JOURNAL_ENABLED:
+        journal = WriteJournal(SURREAL_JOURNAL_DIR, SURREAL_JOURNAL_DURABILITY, SURREAL_JOURNAL_SEGMENT_BYTES)
+    return SurrealBackend(
+        _pool,
+        journal=journal,
+        write_timeout=SURREAL_JOURNAL_WRITE_TIMEOUT,
+        replay_interval=SURREAL_JOURNAL_REPLAY_INTERVAL,
+        cache=_record_cache
+    )
+
+
+# 全局数据访问对象
+_backend = _create_backend()
+query_metrics = QueryMetrics()
+repo = Repository(_backend, _record_cache, _single_flight, query_metrics)
+sync_repo = SyncRepository(repo)
+
+# 迁移脚本使用的原始查询入口
+execute_raw_query = repo.execute_raw
+
+def query_metrics_stats() -> dict:
+    """返回查询统计的概要，详细数据见 /api/admin/db/queries"""
+    return query_metrics.stats()
+
+
+class CounterBuffer:
+    """计数器增量缓冲
+
+    add() 只在内存中累加增量，后台任务每隔 flush_interval 秒把所有增量合并为一个批处理，
+    每条记录一条 UPDATE ... SET field += $d 语句。同一条记录在一个周期内的多次计数只产生
+    一次写入。待写入的记录数超过 max_pending 时立即写入。每个分块在一个事务中写入，
+    失败时整个分块回滚，该分块及之后的增量放回缓冲区，在下一个周期重试，不会重复应用。
+    增量只作用于已存在的记录，写入前记录已被删除时增量被丢弃。
+
+    适合访问次数、点击次数这类高频且不需要立即读到最新值的计数。
+    需要立即得到新值时使用 repo.increment。
+    """
+
+    def __init__(self, repository: Repository, flush_interval: float = 1.0, max_pending: int = 1000):
+        self._repository = repository
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        # (表名, 记录ID) -> [{字段: 增量}, {字段: 值}]
+        self._pending = {}
+        self._task = None
+        self._flushing = None
+        self._counters = collections.Counter()
+
+    def add(self, table, id, field, delta=1, fields=None):
+        """累加一个计数增量，fields 中的字段在写入时直接赋值（后写入的值覆盖先前的值）"""
+        key = (table, _record_id(table, id))
+        entry = self._pending.get(key)
+        if entry is None:
+            entry = self._pending[key] = [collections.Counter(), {}]
+        entry[0][field] += delta
+        if fields:
+            entry[1].update(fields)
+        self._counters["added"] += 1
+        if len(self._pending) >= self.max_pending:
+            self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self._flushing is not None and not self._flushing.done():
+            return
+        try:
+            self._flushing = asyncio.get_running_loop().create_task(self.flush())
+        except RuntimeError:
+            # 没有事件循环（同步脚本）时等待显式调用 flush
+            pass
+
+    async def flush(self) -> int:
+        """把缓冲的增量写入数据库
+
+        Returns:
+            int: 写入的记录数
+        """
+        if not self._pending:
+            return 0
+        pending, self._pending = self._pending, {}
+        items = list(pending.items())
+        written = 0
+        for start in range(0, len(items), BULK_INSERT_CHUNK_SIZE):
+            chunk = items[start:start + BULK_INSERT_CHUNK_SIZE]
+            batch = self._repository.transaction()
+            for (table, record_id), (deltas, fields) in chunk:
+                batch.increment(table, record_id, dict(deltas), fields)
+            try:
+                await batch.execute()
+                written += len(chunk)
+            except Exception as e:
+                logging.error(f"写入计数增量失败，将在下个周期重试: {str(e)}")
+                self._counters["flush_failures"] += 1
+                for (table, record_id), (deltas, fields) in items[start:]:
+                    self._restore(table, record_id, deltas, fields)
+                break
+        self._counters["flushes"] += 1
+        self._counters["records_written"] += written
+        return written
+
+    def _restore(self, table, record_id, deltas, fields):
+        # 失败的增量与新累加的增量合并，新赋值的字段优先
+        entry = self._pending.setdefault((table, record_id), [collections.Counter(), {}])
+        entry[0].update(deltas)
+        entry[1] = dict(fields, **entry[1])
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.error(f"计数缓冲写入出错: {str(e)}")
+
+    def start(self):
+        """启动后台写入任务，在应用启动时调用"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        """停止后台写入任务并写入剩余的增量，在应用关闭时调用"""
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError, Exception):
+                await self._task
+            self._task = None
+        await self.flush()
+
+    def stats(self) -> dict:
+        added = self._counters["added"]
+        written = self._counters["records_written"]
+        return {
+            "pending_records": len(self._pending),
+            "added": added,
+            "flushes": self._counters["flushes"],
+            "records_written": written,
+            "flush_failures": self._counters["flush_failures"],
+            # 平均每次写入合并的计数次数
+            "coalescing_ratio": round(added / written, 2) if written else 0.0,
+        }
+
+
+# 全局计数缓冲
+counter_buffer = CounterBuffer(repo, COUNTER_FLUSH_INTERVAL, COUNTER_MAX_PENDING)
+
+def counter_buffer_stats() -> dict:
+    """返回计数缓冲的统计"""
+    return counter_buffer.stats()
 
 # 初始化数据库
 def init_db(app):
-    """初始化数据库"""
+    """初始化数据库（同步环境）"""
     # 在应用启动时初始化数据库连接
     with app.app_context():
         try:
-            run_async(init_db_connection())
+            sync_repo.connect()
             print("Database initialized successfully")
         except Exception as e:
             print(f"Failed to initialize database: {e}")
@@ -201,205 +2498,10 @@ def init_db(app):
     @app.teardown_appcontext
     def teardown_db(exception=None):
         try:
-            run_async(close_db())
+            sync_repo.close()
         except Exception as e:
             print(f"Error in teardown_db: {e}")
 
-# 同步创建数据
-def create(table, data):
-    """在指定表中创建数据"""
-    async def _create():
-        import logging
-        
-        # 记录创建前的数据
-        logging.info(f"DB Create - Table: {table}")
-        logging.info(f"DB Create - Data before: {data}")
-        if 'password_hash' in data:
-            logging.info(f"DB Create - Password hash before: {data['password_hash']}")
-            logging.info(f"DB Create - Password hash type: {type(data['password_hash'])}")
-            logging.info(f"DB Create - Password hash length: {len(data['password_hash'])}")
-        
-        db = await get_db()
-        if db is None:
-            print("Using mock mode for create operation")
-            return data
-        
-        try:
-            # 执行创建操作
-            result = await db.create(table, data)
-            
-            # 记录创建后的结果
-            logging.info(f"DB Create - Result type: {type(result)}")
-            logging.info(f"DB Create - Result: {result}")
-            if result and isinstance(result, dict) and 'password_hash' in result:
-                logging.info(f"DB Create - Password hash after: {result['password_hash']}")
-                logging.info(f"DB Create - Password hash type after: {type(result['password_hash'])}")
-                logging.info(f"DB Create - Password hash length after: {len(result['password_hash'])}")
-            
-            return result
-        except Exception as e:
-            logging.error(f"Error creating data in {table}: {e}")
-            return data
-    
-    return run_async(_create())
-
-# 同步查询数据
-def query(table, condition=None, sort=None, limit=None, offset=None):
-    """查询指定表中的数据"""
-    async def _query():
-        import time
-        start_time = time.time()
-        db = await get_db()
-        if db is None:
-            print("Using mock mode for query operation")
-            return []
-        
-        # 根据条件执行查询
-        query_str = ""
-        params = {}
-        try:
-            if not condition:
-                # 无条件查询所有记录
-                query_str = f"SELECT * FROM {table}"
-                print(f"Executing query: {query_str}")
-                result = await db.query(query_str)
-            elif 'id' in condition and condition['id'].startswith(f"{table}:"):
-                # 直接通过ID查询单条记录
-                record_id = condition['id']
-                print(f"Executing direct ID query for {record_id}")
-                try:
-                    # 尝试直接使用select方法
-                    record = await db.select(record_id)
-                    print(f"Direct select result: {record}")
-                    # 将结果包装为与查询结果相同的格式
-                    if record:
-                        result = [{'result': [record], 'status': 'OK'}]
-                    else:
-                        result = [{'result': [], 'status': 'OK'}]
-                except Exception as e:
-                    print(f"Error in direct select: {e}, falling back to query")
-                    # 如果直接选择失败，回退到查询 - 使用参数化查询
-                    query_str = f"SELECT * FROM {table} WHERE id = $id"
-                    params = {"id": record_id}
-                    print(f"Fallback query: {query_str} with params: {params}")
-                    result = await db.query(query_str, params)
-            else:
-                # 构建条件查询 - 使用参数化查询
-                conditions = []
-                for idx, (k, v) in enumerate(condition.items()):
-                    param_name = f"p{idx}"
-                    conditions.append(f"{k} = ${param_name}")
-                    params[param_name] = v
-                
-                conditions_str = " AND ".join(conditions)
-                query_str = f"SELECT * FROM {table} WHERE {conditions_str}"
-                
-                # 添加排序
-                if sort:
-                    sort_str = ", ".join([f"{field} {order}" for field, order in sort])
-                    query_str += f" ORDER BY {sort_str}"
-                
-                # 添加分页
-                if limit is not None:
-                    query_str += f" LIMIT {limit}"
-                    if offset is not None:
-                        query_str += f" START {offset}"
-                
-                print(f"Executing query: {query_str} with params: {params}")
-                result = await db.query(query_str, params)
-            
-            query_time = time.time() - start_time
-            if query_time > 1.0:  # 记录执行时间超过1秒的查询
-                print(f"SLOW QUERY WARNING: Query took {query_time:.2f} seconds: {query_str} with params: {params}")
-            
-            print(f"Query result type: {type(result)}")
-            print(f"Query returned in {query_time:.2f} seconds")
-        except Exception as e:
-            import traceback
-            print(f"Error executing query '{query_str}': {e}")
-            print(f"Query error details: {traceback.format_exc()}")
-            raise
-        
-        # 处理查询结果
-        try:
-            if result and isinstance(result, list) and len(result) > 0 and 'result' in result[0]:
-                data = result[0]['result']
-                print(f"Query returned {len(data)} results in {query_time:.2f} seconds")
-                return data
-            print(f"Query returned empty result in {query_time:.2f} seconds")
-            return []
-        except Exception as e:
-            import traceback
-            print(f"Error processing query result: {e}")
-            print(f"Error details: {traceback.format_exc()}")
-            return []
-    
-    result_or_coroutine = run_async(_query())
-    
-    # Check if the result is a coroutine (when called from an async context)
-    if asyncio.iscoroutine(result_or_coroutine):
-        # If it's a coroutine, we need to mark this function as async
-        # This is a bit of a hack, but it works for FastAPI routes
-        # The caller must await this result
-        return result_or_coroutine
-    else:
-        # If it's not a coroutine, it's already been executed and we can return it directly
-        return result_or_coroutine
-
-# 同步更新数据
-def update(table, id, data):
-    """更新指定表中的数据
-    
-    Args:
-        table (str): 表名
-        id (str): 记录ID
-        data (dict): 要更新的数据
-        
-    Returns:
-        dict: 更新后的记录
-    """
-    async def _update():
-        db = await get_db()
-        if db is None:
-            print("Using mock mode for update operation")
-            return data
-        
-        try:
-            # 使用SurrealDB的update方法更新记录
-            result = await db.update(f"{table}:{id}", data)
-            return result
-        except Exception as e:
-            print(f"Error updating data in {table}: {e}")
-            return None
-    
-    return run_async(_update())
-
-# 执行原始SQL查询
-async def execute_raw_query(query_str):
-    """执行原始SQL查询
-    
-    Args:
-        query_str (str): SQL查询字符串
-        
-    Returns:
-        Any: 查询结果
-    """
-    db = await get_db()
-    if db is None:
-        print("Using mock mode for raw query operation")
-        return None
-    
-    try:
-        print(f"Executing raw query: {query_str}")
-        result = await db.query(query_str)
-        
-        if result and isinstance(result, list) and len(result) > 0 and 'result' in result[0]:
-            return result[0]['result']
-        return result
-    except Exception as e:
-        print(f"Error executing raw query: {e}")
-        raise
-
 # 创建一个数据库会话对象，用于兼容SQLAlchemy风格的代码
 class DBSession:
     def __init__(self):
@@ -408,9 +2510,9 @@ class DBSession:
     def add(self, obj):
         """添加对象到会话"""
         print(f"添加对象到会话: {obj}")
-        # 实际上这里应该调用create函数
+        # 会话对象只在同步代码中使用，通过同步门面写入
         if hasattr(obj, '__tablename__') and hasattr(obj, 'to_dict'):
-            create(obj.__tablename__, obj.to_dict())
+            sync_repo.create(obj.__tablename__, obj.to_dict())
     
     def delete(self, obj):
         """从会话中删除对象"""
@@ -427,37 +2529,5 @@ class DBSession:
         print("回滚会话中的所有更改")
         # 实际上这里不需要做什么，因为每个操作都是立即执行的
 
-# 同步删除数据
-def delete(table, condition):
-    """删除指定表中的数据
-    
-    Args:
-        table (str): 表名
-        condition (dict): 删除条件
-        
-    Returns:
-        bool: 是否删除成功
-    """
-    async def _delete():
-        db = await get_db()
-        if db is None:
-            print("Using mock mode for delete operation")
-            return False
-        
-        try:
-            # 构建条件查询
-            conditions = " AND ".join([f"{k} = '{v}'" for k, v in condition.items()])
-            query_str = f"DELETE FROM {table} WHERE {conditions}"
-            print(f"Executing delete query: {query_str}")
-            result = await db.query(query_str)
-            
-            print(f"Delete result: {result}")
-            return True
-        except Exception as e:
-            print(f"Error deleting data from {table}: {e}")
-            return False
-    
-    return run_async(_delete())
-
 # 创建全局会话对象
-db_session = DBSession()
\ No newline at end of file
+db_session = DBSession()
@@ -0,0 +1,224 @@
+"""
+本地预写日志 - 数据库不可用时记录写操作，恢复后按顺序重放
+
+日志由若干只追加的段文件组成，每行一条 JSON 记录 {"seq": 序号, "op": 操作}，
+已重放的最大序号保存在 checkpoint 文件中。完全重放过的段文件会被删除。
+
+持久化模式（durability）：
+- fsync：每次追加后 fsync，进程或机器崩溃都不会丢失已确认的写入（append_async 在线程池中 fsync）
+- batch：每次追加后 flush，由 sync() 定期 fsync，机器崩溃时可能丢失最近一个周期的写入
+- none：只写入操作系统缓冲区
+
+日志本身不访问数据库，重放由 SurrealBackend.replay_journal 完成。
+"""
+
+import asyncio
+import collections
+import datetime
+import json
+import logging
+import os
+from typing import Any, Optional, Tuple
+
+DURABILITY_MODES = ("fsync", "batch", "none")
+
+_SEGMENT_SUFFIX = ".log"
+_CHECKPOINT_FILE = "checkpoint"
+
+
+def _json_default(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return str(value)
+
+
+class WriteJournal:
+    """只追加的本地写日志
+
+    待重放的记录同时保存在内存队列中，进程重启时从段文件恢复。
+    """
+
+    def __init__(self, directory: str, durability: str = "fsync", segment_bytes: int = 16 * 1024 * 1024):
+        if durability not in DURABILITY_MODES:
+            raise ValueError(f"未知的日志持久化模式: {durability}，可选 {', '.join(DURABILITY_MODES)}")
+        self.directory = directory
+        self.durability = durability
+        self.segment_bytes = segment_bytes
+
+        self._pending = collections.deque()  # (序号, 操作)
+        self._next_seq = 1
+        self._checkpoint = 0
+        self._segments = []  # [(首条记录序号, 文件路径)]，按序号排列
+        self._file = None
+        self._file_size = 0
+        self._dirty = False
+        self._opened = False
+        self._counters = collections.Counter()
+
+    @property
+    def pending(self) -> int:
+        """待重放的记录数"""
+        return len(self._pending)
+
+    def open(self):
+        """创建日志目录并恢复尚未重放的记录"""
+        if self._opened:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        checkpoint_path = os.path.join(self.directory, _CHECKPOINT_FILE)
+        if os.path.exists(checkpoint_path):
+            with open(checkpoint_path, "r", encoding="utf-8") as f:
+                self._checkpoint = int(f.read().strip() or 0)
+        self._next_seq = self._checkpoint + 1
+
+        names = sorted(name for name in os.listdir(self.directory) if name.endswith(_SEGMENT_SUFFIX))
+        for name in names:
+            path = os.path.join(self.directory, name)
+            self._segments.append((int(name[:-len(_SEGMENT_SUFFIX)]), path))
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # 崩溃时最后一行可能只写了一半
+                        logging.warning(f"跳过写日志中不完整的记录: {path}")
+                        continue
+                    seq = entry["seq"]
+                    self._next_seq = max(self._next_seq, seq + 1)
+                    if seq > self._checkpoint:
+                        self._pending.append((seq, entry["op"]))
+        self._opened = True
+        self._remove_applied_segments()
+        if self._pending:
+            logging.warning(f"写日志中有 {len(self._pending)} 条未重放的写入: {self.directory}")
+
+    def append(self, op: Any) -> int:
+        """追加一条写操作，返回其序号；fsync 模式下返回时记录已落盘"""
+        seq = self._write(op)
+        if self.durability == "fsync":
+            os.fsync(self._file.fileno())
+        return seq
+
+    async def append_async(self, op: Any) -> int:
+        """与 append 相同，但在线程池中 fsync，不阻塞事件循环"""
+        seq = self._write(op)
+        if self.durability == "fsync":
+            await self._fsync_in_thread()
+        return seq
+
+    def _write(self, op: Any) -> int:
+        """写入一条记录并 flush 到操作系统缓冲区，不做 fsync"""
+        self.open()
+        seq = self._next_seq
+        self._next_seq += 1
+        line = json.dumps({"seq": seq, "op": op}, default=_json_default, ensure_ascii=False) + "\n"
+        data = line.encode("utf-8")
+
+        if self._file is None or self._file_size + len(data) > self.segment_bytes:
+            self._roll(seq)
+        self._file.write(data)
+        self._file.flush()
+        self._file_size += len(data)
+        if self.durability != "fsync":
+            self._dirty = True
+
+        # 与落盘内容一致，保存反序列化后的操作
+        self._pending.append((seq, json.loads(line)["op"]))
+        self._counters["appended"] += 1
+        return seq
+
+    async def _fsync_in_thread(self):
+        # 复制文件描述符，fsync 期间段文件被切换或关闭也不受影响
+        fd = os.dup(self._file.fileno())
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, os.fsync, fd)
+        finally:
+            os.close(fd)
+
+    def peek(self) -> Optional[Tuple[int, Any]]:
+        """返回最早一条待重放的记录，没有时返回 None"""
+        return self._pending[0] if self._pending else None
+
+    def ack(self, seq: int, failed: bool = False):
+        """标记最早一条记录已处理（重放成功或放弃重放）"""
+        if not self._pending or self._pending[0][0] != seq:
+            raise ValueError(f"写日志记录必须按顺序确认: {seq}")
+        self._pending.popleft()
+        self._checkpoint = seq
+        self._counters["failed" if failed else "replayed"] += 1
+
+    def checkpoint(self):
+        """持久化已处理的序号并删除完全处理过的段文件"""
+        if not self._opened:
+            return
+        path = os.path.join(self.directory, _CHECKPOINT_FILE)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(str(self._checkpoint))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        self._remove_applied_segments()
+
+    def sync(self):
+        """batch 模式下把已追加的记录 fsync 到磁盘"""
+        if self._file is not None and self._dirty and self.durability != "none":
+            os.fsync(self._file.fileno())
+        self._dirty = False
+
+    async def sync_async(self):
+        """与 sync 相同，但在线程池中 fsync，不阻塞事件循环"""
+        if self._file is not None and self._dirty and self.durability != "none":
+            # 先清除标记，fsync 期间追加的记录留到下一次
+            self._dirty = False
+            await self._fsync_in_thread()
+
+    def close(self):
+        self.sync()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._opened:
+            self.checkpoint()
+
+    def stats(self) -> dict:
+        return {
+            "directory": self.directory,
+            "durability": self.durability,
+            "pending": len(self._pending),
+            "segments": len(self._segments),
+            "checkpoint": self._checkpoint,
+            "appended": self._counters["appended"],
+            "replayed": self._counters["replayed"],
+            "failed": self._counters["failed"],
+        }
+
+    def _roll(self, first_seq: int):
+        """关闭当前段文件并以 first_seq 命名新的段文件"""
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+        path = os.path.join(self.directory, f"{first_seq:012d}{_SEGMENT_SUFFIX}")
+        self._file = open(path, "ab")
+        self._file_size = 0
+        self._segments.append((first_seq, path))
+
+    def _remove_applied_segments(self):
+        # 下一个段的首条序号不超过 checkpoint + 1 时，当前段中的记录都已处理
+        while self._segments:
+            first_seq, path = self._segments[0]
+            next_first = self._segments[1][0] if len(self._segments) > 1 else None
+            if next_first is not None and next_first <= self._checkpoint + 1:
+                pass
+            elif next_first is None and not self._pending and self._checkpoint >= first_seq:
+                # 最后一个段也已全部处理，关闭后删除，下次追加时新建
+                if self._file is not None:
+                    self._file.close()
+                    self._file = None
+            else:
+                break
+            self._segments.pop(0)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,313 @@
+"""
+实时订阅 - 把会话和消息的变更推送给客户端
+
+客户端通过 /api/live/events（SSE）或 /api/live/ws（WebSocket）订阅当前用户的变更，
+不再轮询 GET /api/chats 和 /api/chats/{id}/messages。每个事件是一条记录级的增量::
+
+    {"table": "chat_messages", "action": "create", "id": "chat_messages:...", "data": {...}, "ts": ...}
+
+变更来源：
+- surrealdb：在专用连接上对每张表执行一次 LIVE SELECT，其他进程的写入也能推送
+- local：监听本进程 Repository 的写入（见 Repository.add_write_listener），
+  用于 SQLite 后端、测试以及 SurrealDB 不可用的时候
+
+LIVE 查询建立之前和连接断开期间自动使用 local 来源，连接恢复后切回。
+LIVE 查询按表订阅，由 LiveHub 根据记录的 user_id（或所属会话的用户）分发给订阅者。
+message 表的记录只有 chat_id，所属会话的用户不在映射缓存中时从 chat（或 chat_sessions）表查询。
+订阅者的队列满时丢弃最早的事件并发送一条 resync 事件，客户端收到后重新拉取一次列表。
+"""
+
+import asyncio
+import collections
+import contextlib
+import json
+import logging
+import os
+import time
+from typing import Any, Dict, Iterable, Optional
+
+from app.db import repo, _record_id
+
+# 推送变更的表
+LIVE_QUERY_TABLES = [t.strip() for t in os.getenv('LIVE_QUERY_TABLES', 'chat_sessions,chat_messages,message').split(',') if t.strip()]
+# 变更来源：auto（SurrealDB 后端使用 LIVE SELECT，其他后端使用 local）/ surrealdb / local
+LIVE_QUERY_SOURCE = os.getenv('LIVE_QUERY_SOURCE', 'auto').lower()
+# 每个订阅者最多缓存的事件数
+LIVE_QUERY_QUEUE_SIZE = int(os.getenv('LIVE_QUERY_QUEUE_SIZE', '256'))
+# 记录/会话到用户的映射缓存大小，用于分发没有 user_id 字段的记录（如 message 表）
+LIVE_QUERY_OWNER_CACHE_SIZE = int(os.getenv('LIVE_QUERY_OWNER_CACHE_SIZE', '10000'))
+# LIVE 查询连接断开后的重连间隔（秒）
+LIVE_QUERY_RECONNECT_DELAY = float(os.getenv('LIVE_QUERY_RECONNECT_DELAY', '5'))
+# SSE / WebSocket 连接没有事件时发送心跳的间隔（秒）
+LIVE_QUERY_HEARTBEAT_INTERVAL = float(os.getenv('LIVE_QUERY_HEARTBEAT_INTERVAL', '15'))
+
+_ACTIONS = {"CREATE": "create", "UPDATE": "update", "DELETE": "delete"}
+
+
+class LiveSubscription:
+    """一个客户端连接的订阅"""
+
+    def __init__(self, user_id: str, tables: Iterable[str], queue_size: int = LIVE_QUERY_QUEUE_SIZE):
+        self.user_id = user_id
+        self.tables = set(tables)
+        self._queue = asyncio.Queue(maxsize=queue_size)
+        self.dropped = 0
+
+    def put(self, event: Dict[str, Any]):
+        """放入一个事件，队列满时丢弃最早的事件并要求客户端重新同步"""
+        if self._queue.full():
+            while not self._queue.empty():
+                self._queue.get_nowait()
+                self.dropped += 1
+            self._queue.put_nowait({"action": "resync", "ts": time.time()})
+            return
+        self._queue.put_nowait(event)
+
+    async def get(self, timeout: float = None) -> Optional[Dict[str, Any]]:
+        """等待下一个事件，超时返回 None"""
+        try:
+            return await asyncio.wait_for(self._queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class LiveHub:
+    """变更分发中心：接收 LIVE 查询通知或本地写入，按用户分发给订阅者"""
+
+    def __init__(self, repository, tables: Iterable[str] = LIVE_QUERY_TABLES, source: str = LIVE_QUERY_SOURCE,
+                 owner_cache_size: int = LIVE_QUERY_OWNER_CACHE_SIZE, reconnect_delay: float = LIVE_QUERY_RECONNECT_DELAY):
+        if source not in ("auto", "surrealdb", "local"):
+            raise ValueError(f"未知的实时订阅来源: {source}，可选 auto、surrealdb 或 local")
+        self._repository = repository
+        self.tables = list(tables)
+        self.source = source
+        self.reconnect_delay = reconnect_delay
+        self._owner_cache_size = owner_cache_size
+        self._subscribers = collections.defaultdict(list)  # 用户ID -> [LiveSubscription]
+        # 记录ID或会话ID -> 用户ID
+        self._owners = collections.OrderedDict()
+        # 正在查询所属用户的会话ID -> 等待分发的 [(表名, 操作, 记录)]
+        self._lookups = {}
+        self._lookup_tasks = set()
+        self._live_connected = False
+        self._task = None
+        self._counters = collections.Counter()
+
+    def start(self):
+        """开始接收变更，在应用启动时调用"""
+        self._repository.add_write_listener(self._on_write)
+        if self.source == "local":
+            return
+        if self.source == "auto" and self._repository.backend.name != "surrealdb":
+            return
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._live_loop())
+
+    async def stop(self):
+        self._repository.remove_write_listener(self._on_write)
+        for task in list(self._lookup_tasks):
+            task.cancel()
+        self._lookups.clear()
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError, Exception):
+                await self._task
+            self._task = None
+        self._live_connected = False
+
+    def subscribe(self, user_id: str, tables: Iterable[str] = None) -> LiveSubscription:
+        """订阅用户的变更，tables 为空时订阅全部表"""
+        tables = [t for t in (tables or self.tables) if t in self.tables]
+        subscription = LiveSubscription(user_id, tables)
+        self._subscribers[str(user_id)].append(subscription)
+        self._counters["subscribed"] += 1
+        return subscription
+
+    def unsubscribe(self, subscription: LiveSubscription):
+        subscriptions = self._subscribers.get(str(subscription.user_id))
+        if subscriptions and subscription in subscriptions:
+            subscriptions.remove(subscription)
+            if not subscriptions:
+                del self._subscribers[str(subscription.user_id)]
+
+    def publish(self, table: str, action: str, record: Dict[str, Any]):
+        """把一条记录的变更分发给所属用户的订阅者"""
+        if table not in self.tables or not isinstance(record, dict):
+            return
+        self._counters["received"] += 1
+        owner = self._resolve_owner(table, record)
+        if action == "delete":
+            self._forget(table, record)
+        else:
+            self._remember(table, record)
+        if owner is None:
+            chat_id = record.get('chat_id') or record.get('session_id')
+            if chat_id and action != "delete":
+                self._lookup_owner(_session_key(chat_id), table, action, record)
+                return
+            self._counters["unrouted"] += 1
+            return
+        self._deliver(table, action, record, owner)
+
+    def _deliver(self, table, action, record, owner):
+        subscriptions = self._subscribers.get(str(owner))
+        if not subscriptions:
+            return
+        record_id = record.get('id')
+        event = {
+            "table": table,
+            "action": action,
+            "id": _record_id(table, record_id) if record_id else None,
+            "data": record,
+            "ts": time.time()
+        }
+        for subscription in subscriptions:
+            if table in subscription.tables:
+                subscription.put(event)
+                self._counters["delivered"] += 1
+
+    def stats(self) -> dict:
+        return {
+            "source": "surrealdb" if self._live_connected else "local",
+            "tables": self.tables,
+            "subscribers": sum(len(s) for s in self._subscribers.values()),
+            "users": len(self._subscribers),
+            "owners_cached": len(self._owners),
+            "received": self._counters["received"],
+            "delivered": self._counters["delivered"],
+            "unrouted": self._counters["unrouted"],
+            "owner_lookups": self._counters["owner_lookups"],
+            "dropped": sum(sub.dropped for subs in self._subscribers.values() for sub in subs),
+            "reconnects": self._counters["reconnects"],
+        }
+
+    def _on_write(self, table, action, record):
+        # LIVE 查询已建立时本进程的写入也会收到通知，不再重复分发
+        if self._live_connected:
+            return
+        self.publish(table, action, record)
+
+    # 记录所属用户：优先使用 user_id 字段，其次是记录ID或所属会话（session_id / chat_id）的用户
+    def _owner_keys(self, table, record):
+        keys = []
+        if record.get('id'):
+            keys.append(_record_id(table, record['id']))
+        if table == 'chat_sessions' and record.get('id'):
+            keys.append(("session", _record_id(table, record['id']).split(":", 1)[1]))
+        for field in ('session_id', 'chat_id'):
+            if record.get(field):
+                keys.append(("session", _session_key(record[field])))
+        return keys
+
+    def _resolve_owner(self, table, record):
+        if record.get('user_id'):
+            return record['user_id']
+        for key in self._owner_keys(table, record):
+            owner = self._owners.get(key)
+            if owner is not None:
+                return owner
+        return None
+
+    def _remember(self, table, record):
+        owner = record.get('user_id')
+        if not owner:
+            return
+        for key in self._owner_keys(table, record):
+            self._owners[key] = owner
+            self._owners.move_to_end(key)
+        while len(self._owners) > self._owner_cache_size:
+            self._owners.popitem(last=False)
+
+    def _lookup_owner(self, session_key, table, action, record):
+        """从数据库查询会话所属的用户，查到后按顺序分发等待中的事件"""
+        pending = self._lookups.get(session_key)
+        if pending is not None:
+            pending.append((table, action, record))
+            return
+        self._lookups[session_key] = [(table, action, record)]
+        self._counters["owner_lookups"] += 1
+        task = asyncio.ensure_future(self._resolve_session_owner(session_key))
+        self._lookup_tasks.add(task)
+        task.add_done_callback(self._lookup_tasks.discard)
+
+    async def _resolve_session_owner(self, session_key):
+        owner = None
+        try:
+            # 按记录ID查询，命中 Repository 的记录缓存时不访问数据库
+            for table in ('chat', 'chat_sessions'):
+                rows = await self._repository.query(table, {'id': _record_id(table, session_key)})
+                if rows and rows[0].get('user_id'):
+                    owner = rows[0]['user_id']
+                    break
+        except Exception as e:
+            logging.warning(f"查询会话所属用户失败: session={session_key}, error={str(e)}")
+        pending = self._lookups.pop(session_key, [])
+        if owner is None:
+            self._counters["unrouted"] += len(pending)
+            return
+        self._owners[("session", session_key)] = owner
+        self._owners.move_to_end(("session", session_key))
+        while len(self._owners) > self._owner_cache_size:
+            self._owners.popitem(last=False)
+        for table, action, record in pending:
+            self._deliver(table, action, record, owner)
+
+    def _forget(self, table, record):
+        # 会话删除后其消息的删除事件仍需要分发，只移除记录自身的映射
+        if record.get('id'):
+            self._owners.pop(_record_id(table, record['id']), None)
+
+    async def _live_loop(self):
+        """在专用连接上执行 LIVE SELECT 并分发通知，断开后自动重连"""
+        while True:
+            conn = None
+            try:
+                conn = await self._repository.backend.open_live_connection()
+                # SurrealDB 客户端没有通知回调，直接读取专用连接的 WebSocket
+                ws = getattr(conn, "ws", None)
+                if ws is None:
+                    logging.warning("SurrealDB 客户端不支持读取 LIVE 查询通知，实时订阅使用本地写入")
+                    return
+                live_ids = {}
+                for table in self.tables:
+                    response = await conn.query(f"LIVE SELECT * FROM {table}")
+                    live_ids[str(response[0]['result'])] = table
+                self._live_connected = True
+                logging.info(f"LIVE 查询已建立: {', '.join(self.tables)}")
+                while True:
+                    message = json.loads(await ws.recv())
+                    notification = message.get('result') if isinstance(message, dict) else None
+                    if not isinstance(notification, dict):
+                        continue
+                    table = live_ids.get(str(notification.get('id')))
+                    action = _ACTIONS.get(str(notification.get('action', '')).upper())
+                    if table is None or action is None:
+                        continue
+                    record = notification.get('result')
+                    if not isinstance(record, dict):
+                        # 部分版本的 DELETE 通知只包含记录ID
+                        record = {'id': record}
+                    self.publish(table, action, record)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"LIVE 查询连接出错，{self.reconnect_delay} 秒后重连: {str(e)}")
+            finally:
+                self._live_connected = False
+                if conn is not None:
+                    with contextlib.suppress(Exception):
+                        await conn.close()
+            self._counters["reconnects"] += 1
+            await asyncio.sleep(self.reconnect_delay)
+
+
+def _session_key(value) -> str:
+    """会话ID可能带有 chat: 或 chat_sessions: 表名前缀，统一为不带前缀的形式"""
+    return str(value).split(":", 1)[-1]
+
+
+# 全局实时订阅分发中心
+live_hub = LiveHub(repo)
+
+def live_stats() -> dict:
+    return live_hub.stats()
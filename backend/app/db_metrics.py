@@ -0,0 +1,246 @@
+"""
+查询统计 - 按表和语句形状记录数据库请求的耗时分布、行数和数据量
+
+Repository 在每次访问存储后端时调用 QueryMetrics.record（缓存命中和并发合并的查询不计入），
+语句形状只包含表名、条件字段、排序和分页方式，不包含参数值，例如::
+
+    SELECT * FROM chat_messages WHERE chat_id ORDER BY created_at ASC LIMIT START
+
+超过阈值的请求记入固定大小的慢查询环形缓冲区并输出一条 warning 日志。
+统计结果通过 /api/admin/db/queries 和 /api/admin/db/slow-queries 查看，用于判断需要添加哪些索引。
+"""
+
+import bisect
+import collections
+import json
+import logging
+import os
+import time
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+QUERY_METRICS_ENABLED = os.getenv('QUERY_METRICS_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+# 是否统计结果的 JSON 字节数（需要序列化一次结果）
+QUERY_METRICS_PAYLOAD = os.getenv('QUERY_METRICS_PAYLOAD', 'true').lower() in ('1', 'true', 'yes')
+# 最多分别统计的语句形状数，超出后计入 (other)
+QUERY_METRICS_MAX_SHAPES = int(os.getenv('QUERY_METRICS_MAX_SHAPES', '500'))
+# 慢查询阈值（毫秒），可以按表覆盖，格式为 "chat_messages=200,memory=500"
+SLOW_QUERY_THRESHOLD_MS = float(os.getenv('SLOW_QUERY_THRESHOLD_MS', '1000'))
+SLOW_QUERY_TABLE_THRESHOLDS = {
+    table.strip(): float(threshold)
+    for table, threshold in (
+        item.split('=', 1)
+        for item in os.getenv('SLOW_QUERY_TABLE_THRESHOLDS', '').split(',')
+        if '=' in item
+    )
+}
+# 慢查询环形缓冲区大小
+SLOW_QUERY_LOG_SIZE = int(os.getenv('SLOW_QUERY_LOG_SIZE', '200'))
+
+# 耗时直方图的桶上界（毫秒），最后一个桶为 +inf
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+_OTHER_SHAPE = "(other)"
+
+
+def _payload_bytes(result) -> int:
+    try:
+        return len(json.dumps(result, default=str, ensure_ascii=False).encode("utf-8"))
+    except (TypeError, ValueError):
+        return 0
+
+def _row_count(op: str, result) -> int:
+    if isinstance(result, list):
+        if op == "batch":
+            return sum(len(r) if isinstance(r, list) else 1 if isinstance(r, dict) else 0 for r in result)
+        return len(result)
+    if isinstance(result, dict):
+        return 1
+    if op == "delete_chunk" and isinstance(result, int):
+        return result
+    return 0
+
+
+class LatencyStats:
+    """一组请求的耗时直方图、行数和数据量"""
+
+    __slots__ = ("count", "errors", "total_ms", "max_ms", "rows", "bytes", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.rows = 0
+        self.bytes = 0
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+    def add(self, elapsed_ms: float, rows: int, payload: int, error: bool):
+        self.count += 1
+        self.errors += int(error)
+        self.total_ms += elapsed_ms
+        self.max_ms = max(self.max_ms, elapsed_ms)
+        self.rows += rows
+        self.bytes += payload
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS_MS, elapsed_ms)] += 1
+
+    def percentile(self, q: float) -> Optional[float]:
+        """由直方图估算分位数，返回所在桶的上界（毫秒）"""
+        if not self.count:
+            return None
+        target = q * self.count
+        seen = 0
+        for index, n in enumerate(self.buckets):
+            seen += n
+            if seen >= target:
+                return LATENCY_BUCKETS_MS[index] if index < len(LATENCY_BUCKETS_MS) else self.max_ms
+        return self.max_ms
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "total_ms": round(self.total_ms, 3),
+            "avg_ms": round(self.total_ms / self.count, 3) if self.count else 0,
+            "max_ms": round(self.max_ms, 3),
+            "p50_ms": self.percentile(0.5),
+            "p95_ms": self.percentile(0.95),
+            "p99_ms": self.percentile(0.99),
+            "rows": self.rows,
+            "avg_rows": round(self.rows / self.count, 2) if self.count else 0,
+            "bytes": self.bytes,
+            "histogram": {
+                (f"le_{bound}" if index < len(LATENCY_BUCKETS_MS) else "inf"): n
+                for index, (bound, n) in enumerate(zip(LATENCY_BUCKETS_MS + (None,), self.buckets))
+            },
+        }
+
+
+class QueryMetrics:
+    """按表和语句形状汇总的数据库请求统计，以及慢查询环形缓冲区"""
+
+    def __init__(self, enabled: bool = QUERY_METRICS_ENABLED, payload: bool = QUERY_METRICS_PAYLOAD,
+                 max_shapes: int = QUERY_METRICS_MAX_SHAPES, slow_threshold_ms: float = SLOW_QUERY_THRESHOLD_MS,
+                 table_thresholds: Dict[str, float] = None, slow_log_size: int = SLOW_QUERY_LOG_SIZE):
+        self.enabled = enabled
+        self.payload = payload
+        self.max_shapes = max_shapes
+        self.slow_threshold_ms = slow_threshold_ms
+        self.table_thresholds = dict(SLOW_QUERY_TABLE_THRESHOLDS if table_thresholds is None else table_thresholds)
+        self._tables = collections.defaultdict(LatencyStats)
+        self._shapes = {}  # (表名, 形状) -> LatencyStats
+        self._slow = collections.deque(maxlen=slow_log_size)
+        self._slow_total = 0
+        self._since = time.time()
+
+    def threshold_ms(self, table: str) -> float:
+        return self.table_thresholds.get(table, self.slow_threshold_ms)
+
+    def record(self, op: str, table: str, shape: str, elapsed: float, result: Any = None, error: Exception = None):
+        """记录一次请求
+
+        Args:
+            op: 操作，如 select、count、create、batch
+            table: 表名，批处理为 (batch)，原始语句为 (raw)
+            shape: 不含参数值的语句形状
+            elapsed: 耗时（秒）
+            result: 请求结果，用于统计行数和数据量
+            error: 请求抛出的异常
+        """
+        if not self.enabled:
+            return
+        elapsed_ms = elapsed * 1000
+        rows = _row_count(op, result) if error is None else 0
+        payload = _payload_bytes(result) if self.payload and error is None and result is not None else 0
+
+        self._tables[table].add(elapsed_ms, rows, payload, error is not None)
+        key = (table, shape)
+        stats = self._shapes.get(key)
+        if stats is None:
+            if len(self._shapes) >= self.max_shapes:
+                key = (table, _OTHER_SHAPE)
+                stats = self._shapes.get(key)
+            if stats is None:
+                stats = self._shapes[key] = LatencyStats()
+        stats.add(elapsed_ms, rows, payload, error is not None)
+
+        if elapsed_ms >= self.threshold_ms(table):
+            self._slow_total += 1
+            self._slow.append({
+                "at": datetime.now().isoformat(),
+                "op": op,
+                "table": table,
+                "shape": shape,
+                "elapsed_ms": round(elapsed_ms, 3),
+                "rows": rows,
+                "bytes": payload,
+                "error": str(error) if error is not None else None,
+            })
+            logging.warning(f"慢查询: {elapsed_ms:.1f}ms, table={table}, rows={rows}, shape={shape}")
+
+    def snapshot(self, table: str = None, sort: str = "total_ms", top: int = 50) -> Dict[str, Any]:
+        """返回按表和按语句形状的统计，形状按 sort 字段降序取前 top 个"""
+        shapes = [
+            dict(stats.to_dict(), table=shape_table, shape=shape)
+            for (shape_table, shape), stats in self._shapes.items()
+            if table is None or shape_table == table
+        ]
+        shapes.sort(key=lambda s: s.get(sort) or 0, reverse=True)
+        return {
+            "since": datetime.fromtimestamp(self._since).isoformat(),
+            "enabled": self.enabled,
+            "tables": {
+                name: stats.to_dict()
+                for name, stats in sorted(self._tables.items())
+                if table is None or name == table
+            },
+            "shapes": shapes[:top],
+            "shape_count": len(self._shapes),
+        }
+
+    def slow_queries(self, limit: int = None) -> Dict[str, Any]:
+        """返回最近的慢查询，最新的在前"""
+        entries = list(reversed(self._slow))
+        return {
+            "threshold_ms": self.slow_threshold_ms,
+            "table_thresholds": self.table_thresholds,
+            "total": self._slow_total,
+            "queries": entries[:limit] if limit else entries,
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "requests": sum(stats.count for stats in self._tables.values()),
+            "errors": sum(stats.errors for stats in self._tables.values()),
+            "shapes": len(self._shapes),
+            "slow_queries": self._slow_total,
+        }
+
+    def reset(self):
+        self._tables.clear()
+        self._shapes.clear()
+        self._slow.clear()
+        self._slow_total = 0
+        self._since = time.time()
+
+
+def query_shape(op: str, table: str, condition=None, sort=None, limit=None, offset=None, fields=None, after=None) -> str:
+    """生成不含参数值的语句形状"""
+    parts = [op.upper()]
+    if op == "select":
+        parts.append(", ".join(fields) if fields else "*")
+    parts.append(f"FROM {table}" if op in ("select", "count", "delete", "delete_chunk") else table)
+    if condition:
+        parts.append("WHERE " + ", ".join(sorted(str(key) for key in condition)))
+    if after:
+        parts.append("AFTER")
+    if sort:
+        parts.append("ORDER BY " + ", ".join(
+            f"{field} {'DESC' if str(order).upper() in ('DESC', '-1') else 'ASC'}" for field, order in sort
+        ))
+    if limit is not None:
+        parts.append("LIMIT")
+    if offset:
+        parts.append("START")
+    return " ".join(parts)
@@ -0,0 +1,129 @@
+"""
+数据库索引迁移 - 声明式的版本化索引定义与启动时执行的迁移器
+
+每个 IndexMigration 对应一个版本号，已应用的版本记录在数据库的
+schema_version:current 记录中。启动时只执行高于当前版本的迁移，
+每个版本的索引定义和版本号更新在同一个事务中提交。
+
+新增查询模式时，在 INDEX_MIGRATIONS 末尾追加一个新版本，不要修改已发布的版本。
+"""
+
+import logging
+import os
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import List
+
+from app.db import repo
+
+# 记录已应用版本的表和记录
+SCHEMA_VERSION_TABLE = 'schema_version'
+SCHEMA_VERSION_RECORD = 'current'
+
+# 设为 false 可以在启动时跳过迁移（例如由独立的部署步骤执行）
+RUN_MIGRATIONS_ON_STARTUP = os.getenv('SURREAL_RUN_MIGRATIONS', 'true').lower() in ('1', 'true', 'yes')
+
+
+@dataclass(frozen=True)
+class Index:
+    """一个 SurrealDB 索引定义"""
+    name: str
+    table: str
+    fields: List[str]
+    unique: bool = False
+
+    def statement(self) -> str:
+        unique = " UNIQUE" if self.unique else ""
+        return f"DEFINE INDEX IF NOT EXISTS {self.name} ON {self.table} FIELDS {', '.join(self.fields)}{unique}"
+
+
+@dataclass(frozen=True)
+class IndexMigration:
+    """一个版本的索引迁移"""
+    version: int
+    description: str
+    indexes: List[Index] = field(default_factory=list)
+
+
+INDEX_MIGRATIONS = [
+    IndexMigration(1, "聊天会话与聊天消息索引（原 migrations/add_chat_indexes.py）", [
+        Index('idx_chat_sessions_id', 'chat_sessions', ['id']),
+        Index('idx_chat_sessions_session_id', 'chat_sessions', ['session_id']),
+        Index('idx_chat_sessions_user_id', 'chat_sessions', ['user_id']),
+        Index('idx_chat_messages_session_id', 'chat_messages', ['session_id']),
+        Index('idx_chat_messages_user_id', 'chat_messages', ['user_id']),
+    ]),
+    IndexMigration(2, "覆盖 services 与 routes 中所有查询模式的索引", [
+        # 记忆：按用户和类型过滤，按更新时间/重要性排序；按会话查找聊天历史和摘要
+        Index('idx_memory_user_type', 'memory', ['user_id', 'memory_type']),
+        Index('idx_memory_user_updated', 'memory', ['user_id', 'updated_at']),
+        Index('idx_memory_user_importance', 'memory', ['user_id', 'importance']),
+        Index('idx_memory_session_type', 'memory', ['session_id', 'memory_type']),
+        Index('idx_memory_source_session', 'memory', ['source_session_id']),
+        # 消息：按聊天分页，按 (timestamp, id) 游标排序
+        Index('idx_message_chat_id', 'message', ['chat_id']),
+        Index('idx_message_chat_timestamp', 'message', ['chat_id', 'timestamp']),
+        Index('idx_chat_messages_session_created', 'chat_messages', ['session_id', 'created_at']),
+        Index('idx_chat_messages_chat_created', 'chat_messages', ['chat_id', 'created_at']),
+        # 会话列表：按用户过滤，按更新时间游标排序
+        Index('idx_chat_sessions_user_updated', 'chat_sessions', ['user_id', 'updated_at']),
+        Index('idx_chat_user_archived', 'chat', ['user_id', 'is_archived']),
+        Index('idx_conversations_user_id', 'conversations', ['user_id']),
+        # 用户：注册、登录和找回密码时按邮箱、用户名查找，两者都不允许重复
+        Index('idx_users_email', 'users', ['email'], unique=True),
+        Index('idx_users_username', 'users', ['username'], unique=True),
+        # 邀请码
+        Index('idx_invite_code_code', 'invite_code', ['code']),
+        Index('idx_invite_code_creator_id', 'invite_code', ['creator_id']),
+        # AI 与人类关系
+        Index('idx_relationship_relationship_id', 'relationship', ['relationship_id']),
+        Index('idx_relationship_ai_id', 'relationship', ['ai_id']),
+        Index('idx_relationship_human_id', 'relationship', ['human_id']),
+        # AI ID 与频率编号
+        Index('idx_ai_id_ai_id', 'ai_id', ['ai_id']),
+        Index('idx_frequency_frequency_number', 'frequency', ['frequency_number']),
+    ]),
+]
+
+
+async def get_schema_version() -> int:
+    """返回数据库中已应用的迁移版本，没有记录时为 0"""
+    records = await repo.query(SCHEMA_VERSION_TABLE, {'id': f"{SCHEMA_VERSION_TABLE}:{SCHEMA_VERSION_RECORD}"})
+    if records:
+        return int(records[0].get('version', 0))
+    return 0
+
+
+async def apply_migration(migration: IndexMigration):
+    """在一个事务中应用一个版本的索引并更新版本号"""
+    tx = repo.transaction()
+    for index in migration.indexes:
+        tx.raw(index.statement())
+    tx.merge(SCHEMA_VERSION_TABLE, SCHEMA_VERSION_RECORD, {
+        'version': migration.version,
+        'description': migration.description,
+        'applied_at': datetime.utcnow().isoformat()
+    })
+    await tx.execute()
+
+
+async def run_migrations(migrations: List[IndexMigration] = None) -> int:
+    """应用所有高于当前版本的迁移
+
+    Returns:
+        迁移后的版本号
+    """
+    migrations = sorted(migrations or INDEX_MIGRATIONS, key=lambda m: m.version)
+    current = await get_schema_version()
+    pending = [m for m in migrations if m.version > current]
+    if not pending:
+        logging.info(f"数据库索引已是最新版本: v{current}")
+        return current
+
+    for migration in pending:
+        logging.info(f"应用数据库索引迁移 v{migration.version}: {migration.description} ({len(migration.indexes)} 个索引)")
+        await apply_migration(migration)
+        current = migration.version
+
+    logging.info(f"数据库索引迁移完成，当前版本: v{current}")
+    return current
@@ -0,0 +1,457 @@
+"""
+嵌入式 SQLite 存储后端 - 在进程内实现与 SurrealDB 后端相同的数据访问语义
+
+每张表对应一张 SQLite 表 (id TEXT PRIMARY KEY, data TEXT)，记录以 JSON 文档保存，
+条件、排序和索引通过 json_extract 作用在文档字段上。适合单机部署、压测和 CI，
+设置 STORAGE_BACKEND=sqlite 启用，数据库文件由 SQLITE_PATH 指定。
+
+sqlite3 是同步接口，所有操作在一个专用线程中串行执行，不阻塞事件循环。
+"""
+
+import asyncio
+import collections
+import datetime
+import json
+import logging
+import os
+import re
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+from app.db import (
+    BULK_INSERT_CHUNK_SIZE,
+    BatchStatementError,
+    QueryBatch,
+    StorageBackend,
+    _FIELD_PATTERN,
+    _field_value,
+    _projection,
+    _record_id,
+    _sort_order,
+    _with_record_id,
+)
+
+_TABLE_PATTERN = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+# DEFINE INDEX [IF NOT EXISTS] 名称 ON [TABLE] 表 FIELDS|COLUMNS 字段[, 字段] [UNIQUE]
+_DEFINE_INDEX_PATTERN = re.compile(
+    r"^DEFINE\s+INDEX\s+(?:IF\s+NOT\s+EXISTS\s+)?(\w+)\s+ON\s+(?:TABLE\s+)?(\w+)\s+"
+    r"(?:FIELDS|COLUMNS)\s+([\w.,\s]+?)(\s+UNIQUE)?\s*;?$",
+    re.IGNORECASE
+)
+
+
+def _json_default(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return str(value)
+
+def _dumps(record) -> str:
+    return json.dumps(record, default=_json_default, ensure_ascii=False)
+
+def _sql_value(value):
+    """把条件值转换为 SQLite 可以与 json_extract 结果比较的值"""
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    if isinstance(value, (dict, list)):
+        return _dumps(value)
+    return value
+
+def _table_name(table) -> str:
+    if not _TABLE_PATTERN.match(str(table)):
+        raise ValueError(f"非法的表名: {table}")
+    return f'"{table}"'
+
+def _field_expr(field) -> str:
+    """文档字段对应的 SQL 表达式，id 直接使用主键列"""
+    if field == "id":
+        return "id"
+    if not _FIELD_PATTERN.match(field):
+        raise ValueError(f"非法的字段: {field}")
+    return f"json_extract(data, '$.{field}')"
+
+def _project(record, fields):
+    """按投影字段裁剪记录，嵌套字段保持嵌套结构"""
+    projection = _projection(fields)
+    if not projection:
+        return record
+    result = {}
+    for field in projection:
+        parts = field.split(".")
+        value = record
+        for part in parts:
+            value = value.get(part) if isinstance(value, dict) else None
+        target = result
+        for part in parts[:-1]:
+            target = target.setdefault(part, {})
+        target[parts[-1]] = value
+    return result
+
+def _set_path(record: dict, field: str, value):
+    parts = field.split(".")
+    for part in parts[:-1]:
+        if not isinstance(record.get(part), dict):
+            record[part] = {}
+        record = record[part]
+    record[parts[-1]] = value
+
+def _merge(target: dict, changes: dict) -> dict:
+    """与 SurrealDB 的 MERGE 一致，嵌套对象逐层合并"""
+    for key, value in changes.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            _merge(target[key], value)
+        else:
+            target[key] = value
+    return target
+
+
+class SQLiteBackend(StorageBackend):
+    """嵌入式 SQLite 存储后端
+
+    不支持任意 SurrealQL：原始语句中只支持 DEFINE INDEX（转换为 json_extract 表达式索引），
+    其他语句抛出 NotImplementedError。
+    """
+
+    name = "sqlite"
+
+    def __init__(self, path: str = ":memory:"):
+        self.path = path
+        self._conn = None
+        self._executor = None
+        self._tables = set()
+        self._counters = collections.Counter()
+
+    async def _call(self, fn, *args):
+        # 所有 sqlite3 调用在同一个线程中串行执行
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-backend")
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            if self.path != ":memory:":
+                directory = os.path.dirname(os.path.abspath(self.path))
+                os.makedirs(directory, exist_ok=True)
+            # isolation_level=None：自动提交，事务由 BEGIN / COMMIT 显式控制
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            if self.path != ":memory:":
+                self._conn.execute("PRAGMA journal_mode=WAL")
+                self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._tables = {
+                row[0] for row in self._conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+            }
+            logging.info(f"SQLite 存储后端已打开: {self.path}")
+        return self._conn
+
+    def _ensure_table(self, table):
+        if table not in self._tables:
+            self._connection().execute(
+                f"CREATE TABLE IF NOT EXISTS {_table_name(table)} (id TEXT PRIMARY KEY, data TEXT NOT NULL)"
+            )
+            self._tables.add(table)
+
+    async def start(self):
+        await self._call(self._connection)
+        return self
+
+    async def close(self):
+        if self._conn is not None:
+            await self._call(self._conn.close)
+            self._conn = None
+            self._tables = set()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        logging.info("SQLite 存储后端已关闭")
+
+    def stats(self) -> dict:
+        return {
+            "backend": self.name,
+            "path": self.path,
+            "open": self._conn is not None,
+            "tables": len(self._tables),
+            "statements": dict(self._counters),
+        }
+
+    # 以下 _do_* 方法在 SQLite 线程中执行
+
+    def _where(self, table, condition, after=None):
+        clauses = []
+        params = []
+        for field, value in (condition or {}).items():
+            if field == "id":
+                clauses.append("id = ?")
+                params.append(_record_id(table, value))
+            elif value is None:
+                clauses.append(f"{_field_expr(field)} IS NULL")
+            else:
+                clauses.append(f"{_field_expr(field)} = ?")
+                params.append(_sql_value(value))
+        if after:
+            # (排序字段, id) 严格位于游标之后的记录
+            field, descending, value, record_id = after
+            op = "<" if descending else ">"
+            if field == "id":
+                clauses.append(f"id {op} ?")
+                params.append(record_id)
+            else:
+                expr = _field_expr(field)
+                clauses.append(f"({expr} {op} ? OR ({expr} = ? AND id {op} ?))")
+                params.extend([_sql_value(value), _sql_value(value), record_id])
+        return (" WHERE " + " AND ".join(clauses) if clauses else ""), params
+
+    def _do_select(self, table, condition=None, sort=None, limit=None, offset=None, fields=None, after=None):
+        self._counters["select"] += 1
+        self._ensure_table(table)
+        where_str, params = self._where(table, condition, after)
+        query_str = f"SELECT data FROM {_table_name(table)}{where_str}"
+        if sort:
+            query_str += " ORDER BY " + ", ".join(f"{_field_expr(field)} {_sort_order(order)}" for field, order in sort)
+        if limit is not None or offset is not None:
+            query_str += " LIMIT ? OFFSET ?"
+            params.extend([int(limit) if limit is not None else -1, int(offset or 0)])
+        rows = self._connection().execute(query_str, params).fetchall()
+        return [_project(json.loads(row[0]), fields) for row in rows]
+
+    def _do_count(self, table, condition=None):
+        self._counters["count"] += 1
+        self._ensure_table(table)
+        where_str, params = self._where(table, condition)
+        return self._connection().execute(f"SELECT count(*) FROM {_table_name(table)}{where_str}", params).fetchone()[0]
+
+    def _do_create(self, table, data):
+        self._counters["create"] += 1
+        self._ensure_table(table)
+        record = _with_record_id(table, data)
+        self._connection().execute(
+            f"INSERT INTO {_table_name(table)} (id, data) VALUES (?, ?)", (record["id"], _dumps(record))
+        )
+        return record
+
+    def _do_create_many(self, table, rows):
+        """整块在一个事务中写入，失败时回滚并抛出异常"""
+        conn = self._connection()
+        conn.execute("BEGIN")
+        try:
+            records = [self._do_create(table, row) for row in rows]
+            conn.execute("COMMIT")
+            return records
+        except BaseException:
+            self._rollback()
+            raise
+
+    def _rollback(self):
+        self._connection().execute("ROLLBACK")
+        # 事务中新建的表随回滚一起消失，下次使用时重新建表
+        self._tables.clear()
+
+    def _get(self, table, record_id):
+        row = self._connection().execute(
+            f"SELECT data FROM {_table_name(table)} WHERE id = ?", (record_id,)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _do_update(self, table, id, data):
+        """整体替换记录，记录不存在时创建"""
+        self._counters["update"] += 1
+        self._ensure_table(table)
+        record_id = _record_id(table, id)
+        record = dict(data, id=record_id)
+        self._connection().execute(
+            f"INSERT OR REPLACE INTO {_table_name(table)} (id, data) VALUES (?, ?)", (record_id, _dumps(record))
+        )
+        return record
+
+    def _do_merge(self, table, id, data):
+        """合并给出的字段，记录不存在时创建"""
+        self._counters["merge"] += 1
+        self._ensure_table(table)
+        record_id = _record_id(table, id)
+        record = _merge(self._get(table, record_id) or {}, json.loads(_dumps(data)))
+        record["id"] = record_id
+        self._connection().execute(
+            f"INSERT OR REPLACE INTO {_table_name(table)} (id, data) VALUES (?, ?)", (record_id, _dumps(record))
+        )
+        return record
+
+    def _do_increment(self, table, id, deltas, fields=None):
+        """在 SQLite 线程中读改写，所有操作串行执行，因此是原子的；记录不存在时不创建，返回 None"""
+        self._counters["increment"] += 1
+        self._ensure_table(table)
+        record_id = _record_id(table, id)
+        record = self._get(table, record_id)
+        if record is None:
+            return None
+        for field, delta in deltas.items():
+            _field_expr(field)
+            _set_path(record, field, (_field_value(record, field) or 0) + delta)
+        for field, value in json.loads(_dumps(fields or {})).items():
+            _field_expr(field)
+            _set_path(record, field, value)
+        record["id"] = record_id
+        self._connection().execute(
+            f"INSERT OR REPLACE INTO {_table_name(table)} (id, data) VALUES (?, ?)", (record_id, _dumps(record))
+        )
+        return record
+
+    def _do_delete(self, table, condition):
+        self._counters["delete"] += 1
+        self._ensure_table(table)
+        where_str, params = self._where(table, condition)
+        return self._connection().execute(f"DELETE FROM {_table_name(table)}{where_str}", params).rowcount
+
+    def _do_delete_chunk(self, table, condition, limit):
+        self._counters["delete"] += 1
+        self._ensure_table(table)
+        where_str, params = self._where(table, condition)
+        name = _table_name(table)
+        return self._connection().execute(
+            f"DELETE FROM {name} WHERE id IN (SELECT id FROM {name}{where_str} LIMIT ?)", params + [int(limit)]
+        ).rowcount
+
+    def _do_delete_record(self, table, id):
+        self._counters["delete"] += 1
+        self._ensure_table(table)
+        return self._connection().execute(
+            f"DELETE FROM {_table_name(table)} WHERE id = ?", (_record_id(table, id),)
+        ).rowcount
+
+    def _do_raw(self, statement, params=None):
+        """执行原始语句，只支持 DEFINE INDEX"""
+        self._counters["raw"] += 1
+        match = _DEFINE_INDEX_PATTERN.match(statement.strip())
+        if not match:
+            raise NotImplementedError(f"SQLite 存储后端不支持该语句: {statement}")
+        name, table, fields, unique = match.groups()
+        self._ensure_table(table)
+        exprs = ", ".join(_field_expr(field.strip()) for field in fields.split(","))
+        self._connection().execute(
+            f"CREATE {'UNIQUE ' if unique else ''}INDEX IF NOT EXISTS \"{name}\" ON {_table_name(table)} ({exprs})"
+        )
+        return []
+
+    def _do_operation(self, op):
+        """执行一条批处理操作，返回与 SurrealDB 响应中 result 相同形状的结果"""
+        kind = op[0]
+        if kind == "query":
+            return self._do_select(*op[1:])
+        if kind == "count":
+            return [{"count": self._do_count(*op[1:])}]
+        if kind == "create":
+            return [self._do_create(*op[1:])]
+        if kind == "update":
+            return [self._do_update(*op[1:])]
+        if kind == "merge":
+            return [self._do_merge(*op[1:])]
+        if kind == "increment":
+            record = self._do_increment(*op[1:])
+            return [record] if record is not None else []
+        if kind == "delete":
+            self._do_delete(*op[1:])
+            return []
+        if kind == "raw":
+            return self._do_raw(*op[1:])
+        raise ValueError(f"未知的批处理操作: {kind}")
+
+    def _do_batch(self, batch: QueryBatch):
+        self._counters["batch"] += 1
+        conn = self._connection()
+        operations = batch._operations()
+        response = []
+        if batch.transaction:
+            conn.execute("BEGIN")
+            for index, (statement, op) in enumerate(operations):
+                try:
+                    response.append({"status": "OK", "result": self._do_operation(op)})
+                except Exception as e:
+                    self._rollback()
+                    raise BatchStatementError(index, statement, str(e))
+            conn.execute("COMMIT")
+        else:
+            # 非事务批处理中每条语句独立执行，失败的语句不影响其他语句
+            for statement, op in operations:
+                try:
+                    response.append({"status": "OK", "result": self._do_operation(op)})
+                except Exception as e:
+                    response.append({"status": "ERR", "detail": str(e)})
+        return response
+
+    # StorageBackend 接口
+
+    async def create(self, table, data):
+        try:
+            return await self._call(self._do_create, table, data)
+        except sqlite3.Error as e:
+            logging.error(f"Error creating data in {table}: {e}")
+            return data
+
+    async def create_many(self, table, rows, chunk_size=BULK_INSERT_CHUNK_SIZE):
+        results = []
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start:start + chunk_size]
+            try:
+                records = await self._call(self._do_create_many, table, chunk)
+                results.extend({"success": True, "record": record} for record in records)
+            except sqlite3.Error as e:
+                logging.warning(f"Bulk insert chunk into {table} failed, retrying row by row: {e}")
+                for row in chunk:
+                    try:
+                        record = await self._call(self._do_create, table, row)
+                        results.append({"success": True, "record": record})
+                    except sqlite3.Error as row_error:
+                        results.append({"success": False, "data": row, "error": str(row_error)})
+        return results
+
+    async def select(self, table, condition=None, sort=None, limit=None, offset=None, fields=None, after=None):
+        return await self._call(self._do_select, table, condition, sort, limit, offset, fields, after)
+
+    async def count(self, table, condition=None):
+        return await self._call(self._do_count, table, condition)
+
+    async def update(self, table, id, data):
+        try:
+            return await self._call(self._do_update, table, id, data)
+        except sqlite3.Error as e:
+            logging.error(f"Error updating data in {table}: {e}")
+            return None
+
+    async def merge(self, table, id, data):
+        try:
+            return await self._call(self._do_merge, table, id, data)
+        except sqlite3.Error as e:
+            logging.error(f"Error merging data in {table}: {e}")
+            return None
+
+    async def increment(self, table, id, deltas, fields=None):
+        try:
+            return await self._call(self._do_increment, table, id, deltas, fields)
+        except sqlite3.Error as e:
+            logging.error(f"Error incrementing data in {table}: {e}")
+            return None
+
+    async def delete(self, table, condition):
+        try:
+            await self._call(self._do_delete, table, condition)
+            return True
+        except sqlite3.Error as e:
+            logging.error(f"Error deleting data from {table}: {e}")
+            return False
+
+    async def delete_chunk(self, table, condition, limit=BULK_INSERT_CHUNK_SIZE):
+        return await self._call(self._do_delete_chunk, table, condition, limit)
+
+    async def delete_record(self, table, id):
+        try:
+            await self._call(self._do_delete_record, table, id)
+            return True
+        except sqlite3.Error as e:
+            logging.error(f"Error deleting record from {table}: {e}")
+            return False
+
+    async def execute_batch(self, batch: QueryBatch) -> list:
+        response = await self._call(self._do_batch, batch)
+        return batch._convert(response)
+
+    async def execute_raw(self, query_str, params=None):
+        return await self._call(self._do_raw, query_str, params)
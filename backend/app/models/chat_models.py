@@ -34,10 +34,12 @@ class ChatHistoryResponse(BaseModel):
     success: bool
     session_id: str
     messages: List[ChatMessage]
+    next_cursor: Optional[str] = None
     error: Optional[str] = None
     
 class ChatSessionsResponse(BaseModel):
     """聊天会话列表响应模型"""
     success: bool
     sessions: List[ChatSession]
+    next_cursor: Optional[str] = None
     error: Optional[str] = None
@@ -72,3 +72,4 @@ class MemoryQuery(BaseModel):
     offset: int = 0  # 记忆偏移量
     sort_by: str = "relevance"  # 排序方式：relevance（相关性）, recency（最近）, importance（重要性）
     metadata_filter: Optional[Dict[str, Any]] = None  # 元数据过滤条件
+    fields: Optional[List[str]] = None  # 只返回的字段，为空时使用 MEMORY_LIST_FIELDS
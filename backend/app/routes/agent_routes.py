@@ -11,7 +11,6 @@ import uuid
 import json
 import asyncio
 import sys
-import tracemalloc
 from datetime import datetime
 from typing import Dict, Any, List, Optional
 
@@ -19,10 +18,11 @@ from fastapi import APIRouter, HTTPException, Depends, Request, Response
 from fastapi.responses import JSONResponse
 from pydantic import BaseModel
 
-from app.agent.ai_assistant import AIAssistant
+from app.agent.container import agent_services
 from app.agent.image_processor import ImageData
 from app.agent.file_processor import handle_file_upload
 from app.routes.auth_routes import get_current_user
+from app.utils.sse import sse_response, wants_event_stream
 
 # 配置日志
 logging.basicConfig(level=logging.DEBUG)
@@ -48,6 +48,7 @@ class ChatRequest(BaseModel):
     user_id: Optional[str] = "anonymous"
     ai_id: Optional[str] = "ai_rainbow_city"
     image_data: Optional[str] = None
+    stream: Optional[bool] = None  # 为 true 时以 SSE 逐段返回回复
 
 class ChatResponse(BaseModel):
     success: bool
@@ -77,14 +78,16 @@ class ClearSessionResponse(BaseModel):
     error: Optional[str] = None
 
 @router.post("", response_model=ChatResponse)
-async def chat_agent(chat_data: ChatRequest):
-    """AI-Agent聊天接口"""
+async def chat_agent(chat_data: ChatRequest, request: Request):
+    """AI-Agent聊天接口
+    
+    请求体中 stream 为 true 或 Accept 为 text/event-stream 时以 SSE 返回，
+    事件见 AIAssistant.process_query_stream。
+    """
     request_id = str(uuid.uuid4())[:8]  # 生成请求ID用于跟踪
     logging.info(f"[调试-{request_id}] 收到聊天请求: session_id={chat_data.session_id}, user_id={chat_data.user_id}")
     logging.info(f"[调试-{request_id}] 请求开始时间: {datetime.now().isoformat()}")
     logging.info(f"[调试-{request_id}] 消息数量: {len(chat_data.messages) if chat_data.messages else 0}")
-    import gc
-    gc.collect()  # 强制进行垃圾回收
     try:
         # 获取请求数据
         messages = chat_data.messages
@@ -102,21 +105,31 @@ async def chat_agent(chat_data: ChatRequest):
             if user_messages:
                 user_message = user_messages[-1].content
         
-        # 创建AI助手实例并使用异步上下文管理器确保资源正确关闭
-        logging.info(f"[调试-{request_id}] 准备创建AI助手实例: {datetime.now().isoformat()}")
-        async with AIAssistant() as ai_assistant:
-            logging.info(f"[调试-{request_id}] AI助手实例创建成功: {datetime.now().isoformat()}")
+        if wants_event_stream(request, chat_data.stream):
+            async def stream_events():
+                # 本次请求的AI助手，共享的服务由应用关闭时释放
+                async with agent_services.session() as ai_assistant:
+                    async for event in ai_assistant.process_query_stream(
+                        user_input=user_message,
+                        session_id=session_id,
+                        user_id=user_id,
+                        ai_id=ai_id,
+                        image_data=image_data
+                    ):
+                        if event["type"] == "done":
+                            event = dict(event, success=True, turn_id=turn_id)
+                        yield event
+            
+            logging.info(f"[调试-{request_id}] 以流式响应处理查询: session_id={session_id}")
+            return sse_response(stream_events())
+        
+        # 获取本次请求的AI助手，LLM调用器、工具和服务在应用启动时已经创建
+        async with agent_services.session() as ai_assistant:
             try:
                 # 处理用户查询 - 使用异步方式调用，需要await
                 # 添加超时处理，设置为28秒（低于前端的30秒超时）
                 logging.info(f"[调试-{request_id}] 开始调用AI助手处理查询: session_id={session_id}, user_message='{user_message[:50]}...'")
                 logging.info(f"[调试-{request_id}] 调用process_query时间: {datetime.now().isoformat()}")
-                import sys
-                logging.info(f"[调试-{request_id}] 当前内存使用: {sys.getsizeof(ai_assistant)/1024/1024:.2f} MB")
-                logging.info(f"[调试-{request_id}] 当前对象引用计数: {sys.getrefcount(ai_assistant)}")
-                import tracemalloc
-                tracemalloc.start()
-                snapshot1 = tracemalloc.take_snapshot()
                 result = await asyncio.wait_for(
                     ai_assistant.process_query(
                         user_input=user_message,
@@ -127,19 +140,9 @@ async def chat_agent(chat_data: ChatRequest):
                     ),
                     timeout=28.0
                 )
-                snapshot2 = tracemalloc.take_snapshot()
-                top_stats = snapshot2.compare_to(snapshot1, 'lineno')
-                logging.info(f"[调试-{request_id}] 内存差异 TOP 5:")
-                for stat in top_stats[:5]:
-                    logging.info(f"[调试-{request_id}] {stat}")
-                tracemalloc.stop()
-                
                 logging.info(f"[调试-{request_id}] AI助手处理查询成功: session_id={session_id}, 时间: {datetime.now().isoformat()}")
-                logging.info(f"[调试-{request_id}] 处理完成后内存使用: {sys.getsizeof(ai_assistant)/1024/1024:.2f} MB")
-                logging.info(f"[调试-{request_id}] 处理完成后对象引用计数: {sys.getrefcount(ai_assistant)}")
             except asyncio.TimeoutError:
                 logging.error(f"[调试-{request_id}] 处理查询超时(28秒): session_id={session_id}, 时间: {datetime.now().isoformat()}")
-                tracemalloc.stop()
                 result = {
                     "response": "抱歉，处理您的请求超时。这可能是由于数据库查询耗时过长。请尝试发送更简短的消息或稍后再试。",
                     "session_id": session_id,
@@ -159,14 +162,6 @@ async def chat_agent(chat_data: ChatRequest):
                 result["response"]["metadata"]["session_id"] = session_id
                 result["response"]["metadata"]["turn_id"] = turn_id
         
-        # 在异步上下文管理器结束后记录日志
-        logging.info(f"[调试-{request_id}] 异步上下文管理器结束: {datetime.now().isoformat()}")
-        logging.info(f"[调试-{request_id}] 资源应该已被释放")
-        
-        # 再次强制进行垃圾回收
-        gc.collect()
-        logging.info(f"[调试-{request_id}] 强制垃圾回收完成")
-        
         # 使用JSONResponse直接返回结果，避免FastAPI尝试将其视为协程
         response_dict = dict(result)
         logging.info(f"[调试-{request_id}] 返回响应成功: session_id={session_id}, 时间: {datetime.now().isoformat()}")
@@ -176,11 +171,6 @@ async def chat_agent(chat_data: ChatRequest):
         import traceback
         logging.error(f"[调试-{request_id}] 错误详情: {traceback.format_exc()}")
         logging.error(f"[调试-{request_id}] 错误发生时间: {datetime.now().isoformat()}")
-        
-        # 尝试清理资源
-        if 'tracemalloc' in sys.modules and tracemalloc.is_tracing():
-            tracemalloc.stop()
-        gc.collect()
         return JSONResponse(content={
             "success": False,
             "session_id": chat_data.session_id or str(uuid.uuid4()),
@@ -272,9 +262,9 @@ async def chat_with_file(
         
         logging.debug(f"File processing complete. File type: {file_type}, File data present: {file_data is not None}")
         
-        # 创建AI助手实例
-        ai_assistant = AIAssistant()
-        logging.debug("Created AI Assistant instance")
+        # 获取本次请求的AI助手
+        ai_assistant = agent_services.session()
+        logging.debug("Created AI Assistant session")
         
         # 准备文件数据参数
         file_data_param = None
@@ -352,8 +342,7 @@ async def chat_with_image(
 async def get_history(session_id: str):
     """获取会话历史"""
     try:
-        # 创建新的AI助手实例并使用异步上下文管理器确保资源正确关闭
-        async with AIAssistant() as ai_assistant:
+        async with agent_services.session() as ai_assistant:
             history = ai_assistant.get_conversation_history(session_id)
             return {
                 "success": True,
@@ -373,8 +362,7 @@ async def get_history(session_id: str):
 async def get_logs(session_id: str):
     """获取会话日志"""
     try:
-        # 创建新的AI助手实例并使用异步上下文管理器确保资源正确关闭
-        async with AIAssistant() as ai_assistant:
+        async with agent_services.session() as ai_assistant:
             logs = ai_assistant.get_session_logs(session_id)
             
             return {
@@ -396,8 +384,7 @@ async def get_logs(session_id: str):
 async def clear_session(session_id: str):
     """清除会话数据"""
     try:
-        # 创建新的AI助手实例并使用异步上下文管理器确保资源正确关闭
-        async with AIAssistant() as ai_assistant:
+        async with agent_services.session() as ai_assistant:
             success = ai_assistant.clear_session(session_id)
         
         return {
@@ -7,7 +7,7 @@ import logging
 
 from app.utils.ai_utils import generate_ai_id, generate_frequency_number, get_frequency_info, get_personality_info, get_ai_type_info
 from app.models.frequency import FrequencyNumber
-from app.db import create, query
+from app.db import repo
 
 # 创建路由器
 router = APIRouter(prefix="/ai", tags=["AI服务"])
@@ -85,7 +85,7 @@ async def generate_ai_id_api(request: AiIdRequest):
         ai_id_data = ai_id.to_dict()
         
         # 使用同步包装的数据库操作
-        result = create('ai_id', ai_id_data)
+        result = await repo.create('ai_id', ai_id_data)
         
         # 如果成功存储，记录日志
         if result:
@@ -112,7 +112,7 @@ async def get_ai_id(ai_id_str: str):
         
     try:
         # 使用同步包装的数据库查询
-        results = query('ai_id', {'ai_id': ai_id_str})
+        results = await repo.query('ai_id', {'ai_id': ai_id_str})
         
         # 处理查询结果
         if not results:
@@ -156,7 +156,7 @@ async def generate_frequency_api(request: FrequencyRequest):
         frequency_data['created_at'] = datetime.now().isoformat()
         
         # 存储到数据库
-        result = create('frequency', frequency_data)
+        result = await repo.create('frequency', frequency_data)
         
         # 获取颜色、符号和价值观信息
         value_info = get_frequency_info(frequency_obj.value_code)
@@ -205,7 +205,7 @@ async def get_frequency(frequency_number: str):
         
     try:
         # 查询数据库
-        results = query('frequency', {'frequency_number': frequency_number})
+        results = await repo.query('frequency', {'frequency_number': frequency_number})
         
         if not results:
             # 如果数据库中没有找到，尝试解析频率编号
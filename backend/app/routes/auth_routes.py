@@ -1,17 +1,18 @@
 from fastapi import APIRouter, HTTPException, Depends, Request, Header, status, Security
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from pydantic import BaseModel, Field, validator  # Removed EmailStr import temporarily
 from typing import Dict, Any, Optional, List, Union
 from datetime import datetime, timedelta
 import uuid
 import re
+import json
 import logging
 import os
 import asyncio
 from functools import wraps
 
-from app.db import db_session, query, create, update as db_update
+from app.db import repo, db_session
 from app.models.user import User
 from app.models.invite import InviteCode
 from app.models.enums import VIPLevel, UserRole
@@ -158,26 +159,29 @@ async def register(user: UserRegister):
                 detail="Password must be at least 8 characters and contain uppercase, lowercase, and numbers"
             )
             
+        # 一次请求完成邮箱、用户名和邀请码的查找
+        lookup = repo.batch()
+        lookup.first('users', {'email': user.email})
+        lookup.first('users', {'username': user.username})
+        if user.invite_code:
+            lookup.first('invite_code', {'code': user.invite_code})
+        existing_user, existing_username, *invites = await lookup.execute()
+        
         # 检查邮箱是否已存在
-        existing_users = await query('users', {'email': user.email})
-        if existing_users and len(existing_users) > 0:
+        if existing_user:
             raise HTTPException(status_code=400, detail="Email already registered")
             
         # 检查用户名是否已存在
-        existing_usernames = await query('users', {'username': user.username})
-        if existing_usernames and len(existing_usernames) > 0:
+        if existing_username:
             raise HTTPException(status_code=400, detail="Username already taken")
             
         # 验证邀请码（如果提供）
         invite_benefits = {}
         if user.invite_code:
-            # 查找邀请码
-            invites = await query('invite_code', {'code': user.invite_code})
+            invite = invites[0]
             
-            if not invites or len(invites) == 0:
+            if not invite:
                 raise HTTPException(status_code=400, detail="Invalid invite code")
-                
-            invite = invites[0]
             
             # 检查邀请码是否有效
             if invite.get('max_uses', 0) > 0 and invite.get('used_count', 0) >= invite.get('max_uses'):
@@ -189,8 +193,11 @@ async def register(user: UserRegister):
             # 获取邀请码提供的权益
             invite_benefits = invite.get('benefits', {})
             
-            # 更新邀请码使用次数
-            await db_update('invite_code', invite.get('id'), {'used_count': invite.get('used_count', 0) + 1})
+            # 原子地更新邀请码使用次数，并发注册超过上限时回退本次计数
+            used_count = await repo.increment('invite_code', invite.get('id'), 'used_count')
+            if used_count is not None and invite.get('max_uses', 0) > 0 and used_count > invite.get('max_uses'):
+                await repo.increment('invite_code', invite.get('id'), 'used_count', -1)
+                raise HTTPException(status_code=400, detail="Invite code has reached maximum uses")
             
         # 使用新的密码哈希函数
         password_hash = get_password_hash(user.password)
@@ -216,7 +223,7 @@ async def register(user: UserRegister):
         }
         
         # 创建用户
-        result = await create('users', user_data)
+        result = await repo.create('users', user_data)
         
         if not result:
             raise HTTPException(status_code=500, detail="Failed to create user")
@@ -316,7 +323,7 @@ async def update_profile(profile: ProfileUpdate, current_user: Dict[str, Any] =
         
         # 检查用户名是否已存在
         if profile.username and profile.username != current_user.get('username'):
-            existing_usernames = query('users', {'username': profile.username})
+            existing_usernames = await repo.query('users', {'username': profile.username})
             if existing_usernames and len(existing_usernames) > 0:
                 raise HTTPException(status_code=400, detail="Username already taken")
             update_data['username'] = profile.username
@@ -329,14 +336,13 @@ async def update_profile(profile: ProfileUpdate, current_user: Dict[str, Any] =
             return current_user
             
         # 更新用户资料
-        from app.db import update as db_update
-        result = db_update('users', current_user.get('id'), update_data)
+        result = await repo.update('users', current_user.get('id'), update_data)
         
         if not result:
             raise HTTPException(status_code=500, detail="Failed to update profile")
             
         # 返回更新后的用户信息
-        users = query('users', {'id': current_user.get('id')})
+        users = await repo.query('users', {'id': current_user.get('id')})
         if not users or len(users) == 0:
             raise HTTPException(status_code=404, detail="User not found")
             
@@ -371,8 +377,7 @@ async def change_password(password_data: PasswordChange, current_user: Dict[str,
         new_password_hash = generate_password_hash(password_data.new_password, method='pbkdf2:sha256', salt_length=8)
         
         # 更新密码
-        from app.db import update as db_update
-        result = db_update('users', current_user.get('id'), {'password_hash': new_password_hash})
+        result = await repo.update('users', current_user.get('id'), {'password_hash': new_password_hash})
         
         if not result:
             raise HTTPException(status_code=500, detail="Failed to update password")
@@ -392,7 +397,7 @@ async def get_invite_codes(current_user: Dict[str, Any] = Depends(get_current_us
     获取当前用户的邀请码
     """
     # 查询用户创建的邀请码
-    invite_codes = query('invite_code', {'creator_id': current_user.get('id')})
+    invite_codes = await repo.query('invite_code', {'creator_id': current_user.get('id')})
     
     return {
         'personal_invite_code': current_user.get('personal_invite_code'),
@@ -407,7 +412,7 @@ async def verify_invite_code(invite_data: InviteCodeVerify):
     """
     try:
         # 查找邀请码
-        invites = query('invite_code', {'code': invite_data.code})
+        invites = await repo.query('invite_code', {'code': invite_data.code})
         
         if not invites or len(invites) == 0:
             return {"valid": False, "error": "Invite code not found"}
@@ -462,8 +467,7 @@ async def create_system_invite(invite_data: SystemInviteCodeCreate, current_user
         }
         
         # 创建邀请码
-        from app.db import create
-        result = create('invite_code', invite_data_dict)
+        result = await repo.create('invite_code', invite_data_dict)
         
         if not result:
             raise HTTPException(status_code=500, detail="Failed to create invite code")
@@ -476,6 +480,13 @@ async def create_system_invite(invite_data: SystemInviteCodeCreate, current_user
         logging.error(f"Error creating system invite: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to create system invite: {str(e)}")
 
+# 管理员用户列表返回的字段
+ADMIN_USER_LIST_FIELDS = [
+    'email', 'username', 'display_name', 'created_at', 'is_activated',
+    'activation_status', 'roles', 'vip_level', 'personal_invite_code',
+    'daily_chat_limit', 'weekly_invite_limit', 'ai_companions_limit'
+]
+
 # 管理员获取所有用户
 @router.get("/admin/users", response_model=Dict[str, Any])
 async def get_all_users(current_user: Dict[str, Any] = Depends(get_current_user)):
@@ -487,13 +498,17 @@ async def get_all_users(current_user: Dict[str, Any] = Depends(get_current_user)
         if 'admin' not in current_user.get('roles', []):
             raise HTTPException(status_code=403, detail="Only administrators can access this endpoint")
             
-        # 查询所有用户
-        users = query('users', {})
+        # 分块读取所有用户并以流的形式返回，用户数量增长时内存占用不变
+        # 只返回列表展示所需字段（不包含密码哈希）
+        async def stream_users():
+            total = 0
+            yield '{"users": ['
+            async for user in repo.query_iter('users', fields=ADMIN_USER_LIST_FIELDS):
+                yield ("," if total else "") + json.dumps(user, ensure_ascii=False, default=str)
+                total += 1
+            yield f'], "total": {total}}}'
         
-        return {
-            'total': len(users),
-            'users': users
-        }
+        return StreamingResponse(stream_users(), media_type="application/json")
         
     except HTTPException:
         raise
@@ -517,14 +532,13 @@ async def update_user_roles(
             raise HTTPException(status_code=403, detail="Only administrators can update user roles")
             
         # 查询用户
-        users = query('users', {'id': user_id})
+        users = await repo.query('users', {'id': user_id})
         
         if not users or len(users) == 0:
             raise HTTPException(status_code=404, detail="User not found")
             
         # 更新用户角色
-        from app.db import update as db_update
-        result = db_update('users', user_id, {'roles': roles})
+        result = await repo.update('users', user_id, {'roles': roles})
         
         if not result:
             raise HTTPException(status_code=500, detail="Failed to update user roles")
@@ -554,13 +568,7 @@ async def reset_password(reset_data: PasswordReset):
             )
             
         # 查询用户
-        users_result = query('users', {'email': reset_data.email})
-        
-        # 检查结果是否为协程并等待它
-        if asyncio.iscoroutine(users_result):
-            users = await users_result
-        else:
-            users = users_result
+        users = await repo.query('users', {'email': reset_data.email})
         
         if not users or len(users) == 0:
             # 为了安全考虑，不透露用户是否存在
@@ -579,8 +587,7 @@ async def reset_password(reset_data: PasswordReset):
         logging.info(f"New password hash length: {len(new_hash)}")
         
         # 更新用户密码哈希
-        from app.db import update as db_update
-        update_result = db_update('users', user_id, {'password_hash': new_hash})
+        update_result = await repo.update('users', user_id, {'password_hash': new_hash})
         
         if not update_result:
             raise HTTPException(status_code=500, detail="Failed to reset password")
@@ -606,13 +613,7 @@ async def fix_password_hash(current_user: Dict[str, Any] = Depends(get_current_u
             raise HTTPException(status_code=403, detail="Only administrators can perform this operation")
             
         # 查询所有用户
-        users_result = query('users', {})
-        
-        # 检查结果是否为协程并等待它
-        if asyncio.iscoroutine(users_result):
-            users = await users_result
-        else:
-            users = users_result
+        users = await repo.query('users', {})
             
         if not users:
             return {"message": "No users found to fix"}
@@ -643,8 +644,7 @@ async def fix_password_hash(current_user: Dict[str, Any] = Depends(get_current_u
                 new_hash = generate_password_hash(temp_password, method='pbkdf2:sha256', salt_length=8)
                 
                 # 更新用户密码哈希
-                from app.db import update as db_update
-                update_result = db_update('users', user_id, {'password_hash': new_hash})
+                update_result = await repo.update('users', user_id, {'password_hash': new_hash})
                 
                 if update_result:
                     fixed_count += 1
@@ -690,14 +690,13 @@ async def update_user_vip(
             raise HTTPException(status_code=400, detail=f"Invalid VIP level: {vip_level}")
             
         # 查询用户
-        users = query('users', {'id': user_id})
+        users = await repo.query('users', {'id': user_id})
         
         if not users or len(users) == 0:
             raise HTTPException(status_code=404, detail="User not found")
             
         # 更新用户VIP级别
-        from app.db import update as db_update
-        result = db_update('users', user_id, {'vip_level': vip_level})
+        result = await repo.update('users', user_id, {'vip_level': vip_level})
         
         if not result:
             raise HTTPException(status_code=500, detail="Failed to update user VIP level")
@@ -12,7 +12,9 @@ import json
 from datetime import datetime
 import logging
 
-from app.db import create, query, update, run_async, get_db
+from app.db import repo, encode_cursor
+from app.services.chat_service import message_counts
+from app.tasks.cascade_delete import cascade_deletes, chat_delete_steps
 from app.routes.auth_routes import get_current_user
 from app.utils.chat_utils import ensure_chat_id_format
 
@@ -91,15 +93,76 @@ class MessageResponse(BaseModel):
 
 class MessagesResponse(BaseModel):
     messages: List[Message]
-    total: int
-    page: int
+    total: Optional[int] = None  # 使用游标分页时不返回
+    page: Optional[int] = None  # 使用游标分页时不返回
     per_page: int
     has_more: bool
+    next_cursor: Optional[str] = None  # 下一页游标，传给 cursor 参数继续获取
 
 class MessagesBatchResponse(BaseModel):
     message: str
     messages: List[Message]
 
+def _normalize_message(msg: Dict[str, Any]) -> Dict[str, Any]:
+    """确保返回的消息都有必需的字段，且 content 为字符串"""
+    # 确保所有必需字段都存在
+    if 'id' not in msg:
+        msg['id'] = f"msg_{int(time.time())}_{id(msg)}"
+    if 'role' not in msg:
+        msg['role'] = 'unknown'
+    if 'content' not in msg:
+        msg['content'] = ''
+        
+    # 确保content字段是字符串类型
+    if not isinstance(msg['content'], str):
+        try:
+            # 如果是字典类型，尝试提取response字段或转换为JSON字符串
+            if isinstance(msg['content'], dict):
+                if 'response' in msg['content']:
+                    msg['content'] = str(msg['content']['response'])
+                else:
+                    msg['content'] = json.dumps(msg['content'])
+            else:
+                # 其他类型直接转换为字符串
+                msg['content'] = str(msg['content'])
+        except Exception as e:
+            logging.error(f"转换消息内容为字符串时出错: {str(e)}")
+            msg['content'] = ''
+            
+    # 记录处理后的消息内容类型
+    logging.info(f"消息 {msg['id']} 内容类型: {type(msg['content'])}")
+    if not isinstance(msg['content'], str):
+        logging.error(f"消息 {msg['id']} 内容仍然不是字符串类型: {type(msg['content'])}")
+        # 强制转换为字符串
+        msg['content'] = ''
+    return msg
+
+# 旧版本把消息写在 chat_messages 表（按 session_id 关联），message 表中没有消息时回退到该表
+LEGACY_MESSAGE_TABLE = 'chat_messages'
+
+def _convert_legacy_message(msg: Dict[str, Any], chat_id: str) -> Dict[str, Any]:
+    """把 chat_messages 表中的消息转换为 message 表的格式"""
+    converted_msg = {
+        'id': msg.get('id', f"msg_{int(time.time())}_{id(msg)}"),
+        'chat_id': chat_id,
+        'role': msg.get('role', 'unknown'),
+        'content': msg.get('content', ''),
+        'timestamp': msg.get('created_at', datetime.now().isoformat())
+    }
+    # 添加可选字段
+    if 'metadata' in msg:
+        converted_msg['metadata'] = msg['metadata']
+    if 'token_count' in msg:
+        converted_msg['token_count'] = msg['token_count']
+    return _normalize_message(converted_msg)
+
+def _message_cursor(message: Dict[str, Any], table: str) -> str:
+    """根据当前页最后一条消息生成下一页游标"""
+    last_id = str(message['id'])
+    if ':' not in last_id:
+        last_id = f"{table}:{last_id}"
+    return encode_cursor(message.get('timestamp'), last_id)
+
 @router.get("")
 async def get_user_chats(current_user: Dict[str, Any] = Depends(get_current_user)):
     """获取当前用户的所有聊天会话"""
@@ -107,7 +170,7 @@ async def get_user_chats(current_user: Dict[str, Any] = Depends(get_current_user
     
     try:
         # 使用query函数查询用户的所有未归档聊天
-        chats = await query('chat', {'user_id': user_id, 'is_archived': False})
+        chats = await repo.query('chat', {'user_id': user_id, 'is_archived': False})
         
         # 按最后消息时间和置顶状态排序
         if chats:
@@ -184,7 +247,7 @@ async def create_chat(
         if chat_data.last_message_preview:
             new_chat['last_message_preview'] = chat_data.last_message_preview
         
-        result = await create('chat', new_chat)
+        result = await repo.create('chat', new_chat)
         
         # 增强对result的检查
         if not result:
@@ -244,7 +307,8 @@ async def create_chat(
                     
                     last_timestamp = last_message.get('timestamp', datetime.now().isoformat())
                 
-                # 批量创建消息
+                # 准备消息数据
+                message_rows = []
                 for msg in valid_messages:
                     try:
                         # 创建消息数据
@@ -279,14 +343,14 @@ async def create_chat(
                     if 'metadata' in msg:
                         message_data['metadata'] = msg.get('metadata', {})
                         
-                    # 创建消息 - 使用message表而不chat_messages表
-                    try:
-                        await create('message', message_data)
-                        logging.info(f"Message created successfully for chat: {chat_id}")
-                    except Exception as msg_err:
-                        logging.error(f"Failed to create message: {str(msg_err)}")
-                        # 继续处理下一条消息，不中断整个批处理
-                    
+                    message_rows.append(message_data)
+                
+                # 批量创建消息 - 使用message表而不chat_messages表，一条 INSERT 语句写入
+                create_results = await repo.create_many('message', message_rows)
+                created_count = sum(1 for r in create_results if r['success'])
+                message_counts.set(chat_id, created_count)  # 新会话的消息总数已知，直接写入缓存
+                logging.info(f"Messages created for chat {chat_id}: {created_count}/{len(message_rows)}")
+                
                 # 更新聊天会话的最后一条消息预览和时间戳
                 update_data = {
                     'last_message_preview': str(last_message_content)[:50] if last_message_content else "",  # 只取前50个字符
@@ -295,7 +359,7 @@ async def create_chat(
                 
                 # 安全地更新数据库
                 try:
-                    await update('chat', chat_id, update_data)
+                    await repo.update('chat', chat_id, update_data)
                 except Exception as db_err:
                     logging.error(f"Failed to update chat in database: {str(db_err)}")
                 
@@ -399,7 +463,7 @@ async def get_chat(
         else:
             chat_id_for_query = f"chat:{chat_id}"
         logging.info(f"查询聊天会话，ID: {chat_id_for_query}")
-        chats = await query("chat", {"id": chat_id_for_query})
+        chats = await repo.query("chat", {"id": chat_id_for_query})
         
         if not chats or len(chats) == 0:
             raise HTTPException(status_code=404, detail="聊天会话不存在")
@@ -440,7 +504,7 @@ async def update_chat(
         else:
             chat_id_for_query = f"chat:{chat_id}"
         logging.info(f"查询聊天会话，ID: {chat_id_for_query}")
-        chats = await query("chat", {"id": chat_id_for_query})
+        chats = await repo.query("chat", {"id": chat_id_for_query})
         
         if not chats or len(chats) == 0:
             raise HTTPException(status_code=404, detail="聊天会话不存在")
@@ -470,7 +534,7 @@ async def update_chat(
             update_data['last_message_preview'] = chat_data.last_message_preview
         
         # 更新聊天会话
-        updated_chat = update('chat', chat_id, update_data)
+        updated_chat = await repo.update('chat', chat_id, update_data)
         
         return {
             'message': 'Chat updated successfully',
@@ -483,12 +547,17 @@ async def update_chat(
         logging.error(f"更新聊天会话时出错: {str(e)}")
         raise HTTPException(status_code=500, detail=f"更新聊天会话失败: {str(e)}")
 
-@router.delete("/{chat_id}", response_model=Dict[str, str])
+@router.delete("/{chat_id}", status_code=202)
 async def delete_chat(
     chat_id: str = Path(..., description="聊天会话ID"),
     current_user: Dict[str, Any] = Depends(get_current_user)
 ):
-    """删除聊天会话"""
+    """删除聊天会话
+
+    聊天的消息和记忆由后台任务分批删除，聊天记录在最后删除，
+    返回的 job_id 可以通过 /api/jobs/{job_id} 查询删除进度。
+    任务只保存在内存中，服务重启后未完成的删除不会继续执行。
+    """
     user_id = current_user.get('id')
     
     try:
@@ -501,7 +570,7 @@ async def delete_chat(
         else:
             chat_id_for_query = f"chat:{chat_id}"
         logging.info(f"查询聊天会话，ID: {chat_id_for_query}")
-        chats = await query("chat", {"id": chat_id_for_query})
+        chats = await repo.query("chat", {"id": chat_id_for_query})
         
         if not chats or len(chats) == 0:
             raise HTTPException(status_code=404, detail="聊天会话不存在")
@@ -512,27 +581,11 @@ async def delete_chat(
         if chat.get('user_id') != user_id:
             raise HTTPException(status_code=403, detail="无权删除此聊天会话")
         
-        # 删除聊天会话
-        async def _delete_chat():
-            db = await get_db()
-            if db is None:
-                return False
-            
-            # 删除聊天会话
-            await db.delete(f"chat:{chat_id}")
-            
-            # 删除相关的消息
-            # 注意：这里应该使用批量删除，但当前DB接口可能不支持
-            # 实际应用中应该考虑使用事务或批量操作
-            
-            return True
+        message_counts.invalidate(chat_id_for_query)
         
-        result = await run_async(_delete_chat())
-        
-        if result:
-            return {"message": "Chat deleted successfully"}
-        else:
-            raise HTTPException(status_code=500, detail="删除聊天会话失败")
+        # 聊天的消息、记忆和聊天记录本身都在后台分批删除
+        job = cascade_deletes.submit('chat', chat_id_for_query, chat_delete_steps(chat_id_for_query), user_id=user_id)
+        return {"message": "Chat deleted successfully", "job_id": job.id, "status": job.status}
             
     except HTTPException:
         raise
@@ -545,6 +598,7 @@ async def get_chat_messages(
     chat_id: str = Path(..., description="聊天会话ID"),
     page: int = Query(1, description="页码，从1开始"),
     per_page: int = Query(20, description="每页消息数"),
+    cursor: Optional[str] = Query(None, description="分页游标，传入上一页返回的 next_cursor；传入时忽略 page"),
     current_user: Dict[str, Any] = Depends(get_current_user)
 ):
     """获取特定聊天会话的消息"""
@@ -560,7 +614,7 @@ async def get_chat_messages(
         else:
             chat_id_for_query = f"chat:{chat_id}"
         logging.info(f"查询聊天会话，ID: {chat_id_for_query}")
-        chats = await query("chat", {"id": chat_id_for_query})
+        chats = await repo.query("chat", {"id": chat_id_for_query})
         
         if not chats or len(chats) == 0:
             raise HTTPException(status_code=404, detail="聊天会话不存在")
@@ -575,152 +629,86 @@ async def get_chat_messages(
         chat_id_with_prefix = ensure_chat_id_format(chat_id)
         logging.info(f"查询消息，chat_id: {chat_id_with_prefix}")
         
-        # 先从 message 表查询
-        all_messages = await query('message', {'chat_id': chat_id_with_prefix})
-        logging.info(f"message表查询结果: {all_messages}")
-        logging.info(f"message表查询结果类型: {type(all_messages)}")
-        
-        # 如果在message表中没有找到，尝试从 chat_messages 表查询
-        if not all_messages or len(all_messages) == 0:
-            logging.info(f"在message表中没有找到消息，尝试从 chat_messages 表查询")
-            try:
-                chat_messages = await query('chat_messages', {'session_id': chat_id_with_prefix})
-                logging.info(f"chat_messages表查询结果: {chat_messages}")
-                
-                # 如果在chat_messages表中找到了消息，将其转换为message表的格式
-                if chat_messages and len(chat_messages) > 0:
-                    all_messages = []
-                    for msg in chat_messages:
-                        # 转换格式
-                        converted_msg = {
-                            'id': msg.get('id', f"msg_{int(time.time())}_{id(msg)}"),
-                            'chat_id': chat_id_with_prefix,
-                            'role': msg.get('role', 'unknown'),
-                            'content': msg.get('content', ''),
-                            'timestamp': msg.get('created_at', datetime.now().isoformat())
-                        }
-                        # 添加可选字段
-                        if 'metadata' in msg:
-                            converted_msg['metadata'] = msg['metadata']
-                        if 'token_count' in msg:
-                            converted_msg['token_count'] = msg['token_count']
-                        
-                        all_messages.append(converted_msg)
-                    
-                    logging.info(f"从 chat_messages 表转换了 {len(all_messages)} 条消息")
-            except Exception as e:
-                logging.error(f"查询 chat_messages 表出错: {str(e)}")
-        
-        # 如果仍然没有找到消息，尝试使用原始 SQL 查询
-        if not all_messages or len(all_messages) == 0:
-            try:
-                from app.db import execute_raw_query
-                logging.info(f"尝试使用原始 SQL 查询消息")
-                # 先查询 message 表
-                message_query_result = await execute_raw_query(f"SELECT * FROM message WHERE chat_id = '{chat_id_with_prefix}'")
-                logging.info(f"message表原始查询结果: {message_query_result}")
-                
-                # 如果没有结果，查询 chat_messages 表
-                if not message_query_result or len(message_query_result) == 0:
-                    chat_messages_query_result = await execute_raw_query(f"SELECT * FROM chat_messages WHERE session_id = '{chat_id_with_prefix}'")
-                    logging.info(f"chat_messages表原始查询结果: {chat_messages_query_result}")
-                    
-                    # 如果在chat_messages表中找到了消息，将其转换为message表的格式
-                    if chat_messages_query_result and len(chat_messages_query_result) > 0:
-                        all_messages = []
-                        for msg in chat_messages_query_result:
-                            # 转换格式
-                            converted_msg = {
-                                'id': msg.get('id', f"msg_{int(time.time())}_{id(msg)}"),
-                                'chat_id': chat_id_with_prefix,
-                                'role': msg.get('role', 'unknown'),
-                                'content': msg.get('content', ''),
-                                'timestamp': msg.get('created_at', datetime.now().isoformat())
-                            }
-                            # 添加可选字段
-                            if 'metadata' in msg:
-                                converted_msg['metadata'] = msg['metadata']
-                            if 'token_count' in msg:
-                                converted_msg['token_count'] = msg['token_count']
-                            
-                            all_messages.append(converted_msg)
-                else:
-                    all_messages = message_query_result
-            except Exception as e:
-                logging.error(f"原始 SQL 查询出错: {str(e)}")
-        
-        total = len(all_messages) if all_messages else 0
-        logging.info(f"消息总数: {total}")
-        
-        # 如果仍然没有消息，记录详细日志
-        if total == 0:
-            logging.warning(f"没有找到任何消息，尝试查询数据库中的所有消息表")
+        # 游标分页：按 (timestamp, id) 直接取下一页，深度分页与第一页代价相同
+        if cursor:
             try:
-                from app.db import execute_raw_query
-                message_sample = await execute_raw_query("SELECT * FROM message LIMIT 10")
-                chat_messages_sample = await execute_raw_query("SELECT * FROM chat_messages LIMIT 10")
-                logging.info(f"message表样本数据: {message_sample}")
-                logging.info(f"chat_messages表样本数据: {chat_messages_sample}")
-            except Exception as e:
-                logging.error(f"查询样本数据出错: {str(e)}")
-
-        
+                result = await repo.query_page(
+                    'message',
+                    {'chat_id': chat_id_with_prefix},
+                    order_field='timestamp',
+                    limit=per_page,
+                    cursor=cursor
+                )
+                messages = [_normalize_message(msg) for msg in result['items']]
+                if not messages and not await repo.count('message', {'chat_id': chat_id_with_prefix}):
+                    # 旧会话的游标由 chat_messages 表生成，按 created_at 继续翻页
+                    result = await repo.query_page(
+                        LEGACY_MESSAGE_TABLE,
+                        {'session_id': chat_id_with_prefix},
+                        order_field='created_at',
+                        limit=per_page,
+                        cursor=cursor
+                    )
+                    messages = [_convert_legacy_message(msg, chat_id_with_prefix) for msg in result['items']]
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            
+            return {
+                'messages': messages,
+                'per_page': per_page,
+                'has_more': result['has_more'],
+                'next_cursor': result['next_cursor']
+            }
         
         # 计算分页
         offset = (page - 1) * per_page
         
-        # 按时间戳排序
-        if all_messages:
-            # 确保所有消息都有timestamp字段，如果没有则使用当前时间
-            for msg in all_messages:
-                if 'timestamp' not in msg or not msg['timestamp']:
-                    msg['timestamp'] = datetime.now().isoformat()
-                    logging.info(f"添加缺失的timestamp字段: {msg['id'] if 'id' in msg else 'unknown'}")
-            
-            all_messages.sort(key=lambda x: x.get('timestamp', ''))
-            
-            # 分页获取消息
-            messages = all_messages[offset:offset + per_page] if offset < total else []
-            
-            # 确保所有返回的消息都有必需的字段
-            for msg in messages:
-                # 确保所有必需字段都存在
-                if 'id' not in msg:
-                    msg['id'] = f"msg_{int(time.time())}_{id(msg)}"
-                if 'role' not in msg:
-                    msg['role'] = 'unknown'
-                if 'content' not in msg:
-                    msg['content'] = ''
-                    
-                # 确保content字段是字符串类型
-                if not isinstance(msg['content'], str):
-                    try:
-                        # 如果是字典类型，尝试提取response字段或转换为JSON字符串
-                        if isinstance(msg['content'], dict):
-                            if 'response' in msg['content']:
-                                msg['content'] = str(msg['content']['response'])
-                            else:
-                                msg['content'] = json.dumps(msg['content'])
-                        else:
-                            # 其他类型直接转换为字符串
-                            msg['content'] = str(msg['content'])
-                    except Exception as e:
-                        logging.error(f"转换消息内容为字符串时出错: {str(e)}")
-                        msg['content'] = ''
-                        
-                # 记录处理后的消息内容类型
-                logging.info(f"消息 {msg['id']} 内容类型: {type(msg['content'])}")
-                if not isinstance(msg['content'], str):
-                    logging.error(f"消息 {msg['id']} 内容仍然不是字符串类型: {type(msg['content'])}")
-                    # 强制转换为字符串
-                    msg['content'] = ''
-        else:
-            messages = []
+        # 总数优先使用缓存，未缓存时与当前页在同一次请求中由数据库计数
+        total = message_counts.get(chat_id_with_prefix)
+        lookup = repo.batch()
+        if total is None:
+            lookup.count('message', {'chat_id': chat_id_with_prefix})
+        lookup.query(
+            'message',
+            {'chat_id': chat_id_with_prefix},
+            sort=[('timestamp', 'ASC'), ('id', 'ASC')],
+            limit=per_page,
+            offset=offset
+        )
+        results = await lookup.execute()
+        if total is None:
+            total = results[0]
+            message_counts.set(chat_id_with_prefix, total)
+        messages = [_normalize_message(msg) for msg in results[-1]]
+        table = 'message'
+        
+        if total == 0:
+            # message 表中没有消息，回退到旧版本的 chat_messages 表，同样只取当前页
+            logging.info("在message表中没有找到消息，尝试从 chat_messages 表查询")
+            legacy = repo.batch()
+            legacy.count(LEGACY_MESSAGE_TABLE, {'session_id': chat_id_with_prefix})
+            legacy.query(
+                LEGACY_MESSAGE_TABLE,
+                {'session_id': chat_id_with_prefix},
+                sort=[('created_at', 'ASC'), ('id', 'ASC')],
+                limit=per_page,
+                offset=offset
+            )
+            legacy_total, legacy_page = await legacy.execute()
+            if legacy_total:
+                total = legacy_total
+                messages = [_convert_legacy_message(msg, chat_id_with_prefix) for msg in legacy_page]
+                table = LEGACY_MESSAGE_TABLE
+        logging.info(f"消息总数: {total}, 返回消息数量: {len(messages)}")
         
         # 计算是否有更多消息
         has_more = (offset + len(messages)) < total
         
-        logging.info(f"返回消息数量: {len(messages)}")
+        # 返回下一页游标，客户端可改用游标继续翻页
+        next_cursor = None
+        if has_more and messages:
+            next_cursor = _message_cursor(messages[-1], table)
+        
         if messages:
             logging.info(f"第一条消息示例: {messages[0]}")
         else:
@@ -731,7 +719,8 @@ async def get_chat_messages(
             'total': total,
             'page': page,
             'per_page': per_page,
-            'has_more': has_more
+            'has_more': has_more,
+            'next_cursor': next_cursor
         }
             
     except HTTPException:
@@ -763,7 +752,7 @@ async def add_chat_message(
         else:
             chat_id_for_query = f"chat:{chat_id}"
         logging.info(f"查询聊天会话，ID: {chat_id_for_query}")
-        chats = await query("chat", {"id": chat_id_for_query})
+        chats = await repo.query("chat", {"id": chat_id_for_query})
         
         if not chats or len(chats) == 0:
             raise HTTPException(status_code=404, detail="聊天会话不存在")
@@ -792,8 +781,10 @@ async def add_chat_message(
         # 创建消息 - 使用异步版本的create函数
         try:
             logging.info(f"尝试创建消息: {new_message}")
-            result = await create('message', new_message)  # 使用await关键字
+            result = await repo.create('message', new_message)  # 使用await关键字
             logging.info(f"消息创建结果: {result}")
+            if result:
+                message_counts.increment(chat_id_for_query)
             
             if result and (isinstance(result, dict) or (isinstance(result, list) and len(result) > 0)):
                 # 处理字典结果
@@ -816,7 +807,7 @@ async def add_chat_message(
                 }
                 
                 # 使用异步版本的update函数
-                await update('chat', chat_id_for_query, update_data)  # 使用正确格式的chat_id
+                await repo.update('chat', chat_id_for_query, update_data)  # 使用正确格式的chat_id
                 
                 # 成功后返回结果
                 return {
@@ -851,7 +842,7 @@ async def add_chat_messages_batch(
     
     try:
         # 先验证聊天会话存在且属于当前用户
-        chats = await query('chat', {'id': f'chat:{chat_id}'})
+        chats = await repo.query('chat', {'id': f'chat:{chat_id}'})
         
         if not chats or len(chats) == 0:
             raise HTTPException(status_code=404, detail="聊天会话不存在")
@@ -861,58 +852,50 @@ async def add_chat_messages_batch(
         if chat.get('user_id') != user_id:
             raise HTTPException(status_code=403, detail="无权访问此聊天会话")
         
-        # 批量创建消息
-        async def _create_messages_batch():
-            db = await get_db()
-            if db is None:
-                return []
+        # 准备消息数据
+        rows = []
+        for msg in messages_data.messages:
+            # 验证角色
+            if msg.role not in ['user', 'assistant', 'system']:
+                continue
             
-            created_messages = []
-            last_message = None
+            message_data = {
+                'chat_id': f'chat:{chat_id}',
+                'role': msg.role,
+                'content': msg.content,
+                'timestamp': msg.timestamp or datetime.now().isoformat()
+            }
             
-            for msg in messages_data.messages:
-                # 验证角色
-                if msg.role not in ['user', 'assistant', 'system']:
-                    continue
-                
-                # 准备消息数据
-                message_data = {
-                    'chat_id': f'chat:{chat_id}',
-                    'role': msg.role,
-                    'content': msg.content,
-                    'timestamp': msg.timestamp or datetime.now().isoformat()
-                }
-                
-                # 添加可选字段
-                if msg.token_count is not None:
-                    message_data['token_count'] = msg.token_count
-                
-                if msg.metadata is not None:
-                    message_data['metadata'] = msg.metadata
-                
-                # 创建消息
-                result = await db.create('message', message_data)
-                
-                if result and len(result) > 0:
-                    created_messages.append(result[0])
-                    last_message = result[0]
+            # 添加可选字段
+            if msg.token_count is not None:
+                message_data['token_count'] = msg.token_count
             
-            # 如果有消息被创建，更新聊天会话的最后消息时间和预览
-            if last_message:
-                preview = last_message.get('content', '')
-                if len(preview) > 100:
-                    preview = preview[:97] + '...'
-                
-                update_data = {
-                    'last_message_at': last_message.get('timestamp', datetime.now().isoformat()),
-                    'last_message_preview': preview
-                }
-                
-                await db.update(f"chat:{chat_id}", update_data)
+            if msg.metadata is not None:
+                message_data['metadata'] = msg.metadata
             
-            return created_messages
+            rows.append(message_data)
+        
+        # 批量创建消息 - 一条 INSERT 语句写入所有消息
+        results = await repo.create_many('message', rows)
+        created_messages = [r['record'] for r in results if r['success'] and r['record']]
+        message_counts.increment(f'chat:{chat_id}', len(created_messages))
+        failed_count = len(results) - len(created_messages)
+        if failed_count:
+            logging.warning(f"批量添加消息部分失败: chat_id={chat_id}, 失败 {failed_count} 条")
         
-        created_messages = await run_async(_create_messages_batch())
+        # 如果有消息被创建，更新聊天会话的最后消息时间和预览
+        if created_messages:
+            last_message = created_messages[-1]
+            preview = last_message.get('content', '')
+            if len(preview) > 100:
+                preview = preview[:97] + '...'
+            
+            update_data = {
+                'last_message_at': last_message.get('timestamp', datetime.now().isoformat()),
+                'last_message_preview': preview
+            }
+            
+            await repo.update('chat', chat_id, update_data)
         
         if created_messages:
             return {
@@ -2,6 +2,7 @@ from fastapi import APIRouter, Request, Response, Depends, HTTPException
 from fastapi.responses import JSONResponse
 from pydantic import BaseModel, Field
 from typing import List, Dict, Any, Optional
+import asyncio
 import json
 import os
 import time
@@ -16,7 +17,8 @@ from tavily import TavilyClient
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
 # 导入AI-Agent模块
-from app.agent.ai_assistant import AIAssistant
+from app.agent.container import agent_services
+from app.utils.sse import sse_response, wants_event_stream
 
 # 导入记忆系统模块
 from app.services.chat_memory_integration import ChatMemoryIntegration
@@ -36,8 +38,8 @@ OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 http_client = httpx.Client()
 client = OpenAI(api_key=OPENAI_API_KEY, http_client=http_client)
 
-# 创建AI-Agent实例
-ai_assistant = AIAssistant(model_name="gpt-3.5-turbo")
+# AI-Agent使用的模型，每个请求通过 agent_services.session() 获取独立的上下文
+CHAT_AGENT_MODEL = "gpt-3.5-turbo"
 
 # 创建聊天记忆集成实例
 chat_memory = ChatMemoryIntegration()
@@ -45,6 +47,15 @@ chat_memory = ChatMemoryIntegration()
 # 创建API路由器
 router = APIRouter(tags=["聊天"])
 
+# 把对话写入记忆系统的后台任务，保留引用避免任务被回收
+_background_tasks = set()
+
+def _run_in_background(coro):
+    task = asyncio.ensure_future(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
 # 定义可用工具列表
 AVAILABLE_TOOLS = [
     {
@@ -126,6 +137,7 @@ class ChatRequest(BaseModel):
     messages: List[Message] = Field(default_factory=list)
     session_id: str = ""
     turn_id: str = ""
+    stream: Optional[bool] = None  # 为 true 时以 SSE 逐段返回回复
 
 class ToolCall(BaseModel):
     id: str
@@ -150,7 +162,7 @@ class ChatResponse(BaseModel):
 
 # 添加一个支持工具调用的聊天端点
 @router.post("/chat", response_model=ChatResponse)
-async def chat(request: ChatRequest):
+async def chat(request: ChatRequest, http_request: Request):
     logging.info("===== CHAT FUNCTION EXECUTED =====")
     try:
         messages = request.messages
@@ -383,6 +395,10 @@ async def chat(request: ChatRequest):
                     logging.error(f"处理天气查询时出错: {str(e)}")
                     # 失败时继续正常处理
 
+        # 流式响应：搜索结果已加入 openai_messages，直接逐段返回模型的回复
+        if wants_event_stream(http_request, request.stream):
+            return sse_response(_stream_chat(openai_messages, session_id, turn_id))
+
         # 检查是否有工具调用
         if ai_message.tool_calls:
             # 有工具调用，处理工具调用
@@ -724,6 +740,34 @@ async def chat(request: ChatRequest):
         logging.error(f"Error in chat endpoint: {str(e)}")
         raise HTTPException(status_code=500, detail=f"聊天处理失败: {str(e)}")
 
+async def _stream_chat(openai_messages: List[Dict[str, Any]], session_id: str, turn_id: str):
+    """/chat 的流式响应，与 /chat-agent 一样可以调用工具
+
+    token 事件为文本片段，tool_call / tool_result / reset 事件见 AIAssistant.process_query_stream，
+    done 事件与非流式响应的格式相同。
+    """
+    ai_assistant = agent_services.session(CHAT_AGENT_MODEL)
+    async for event in ai_assistant.stream_messages(openai_messages, session_id):
+        if event["type"] == "start":
+            continue
+        if event["type"] == "done":
+            event = {
+                "type": "done",
+                "success": True,
+                "response": {
+                    "content": event.get("response", ""),
+                    "type": "text",
+                    "metadata": {
+                        "model": ai_assistant.llm_caller.model_name,
+                        "created": int(time.time()),
+                        "session_id": session_id,
+                        "turn_id": turn_id,
+                        "timings": event.get("timings")
+                    }
+                }
+            }
+        yield event
+
 # 健康检查端点
 @router.get("/health")
 async def health_check():
@@ -752,7 +796,7 @@ async def chat_test(request: ChatRequest):
 
 # 使用AI-Agent的聊天端点，集成记忆系统
 @router.post("/chat-agent")
-async def chat_agent(request: ChatRequest):
+async def chat_agent(request: ChatRequest, http_request: Request):
     # 导入超时处理模块
     import asyncio
     from asyncio import TimeoutError
@@ -799,6 +843,7 @@ async def chat_agent(request: ChatRequest):
             # 使用AI-Agent处理请求
             try:
                 # 设置会话信息
+                ai_assistant = agent_services.session(CHAT_AGENT_MODEL)
                 ai_assistant.context_builder.session_id = session_id
                 ai_assistant.context_builder.user_id = user_id
                 
@@ -810,10 +855,16 @@ async def chat_agent(request: ChatRequest):
                 # 处理用户查询，添加记忆上下文
                 enhanced_query = f"{context_prefix}{user_message}" if context_prefix else user_message
                 
+                if wants_event_stream(http_request, request.stream):
+                    return sse_response(_stream_chat_agent(
+                        ai_assistant, enhanced_query, user_message, session_id, user_id, request.turn_id,
+                        bool(context_prefix), memory_context
+                    ))
+                
                 # 添加超时处理，最多等待25秒
                 try:
                     response = await asyncio.wait_for(
-                        asyncio.create_task(ai_assistant.process_query(enhanced_query)),
+                        ai_assistant.process_query(enhanced_query),
                         timeout=25.0  # 25秒超时
                     )
                 except TimeoutError:
@@ -829,7 +880,7 @@ async def chat_agent(request: ChatRequest):
                 # 异步保存消息到记忆系统，但不等待完成
                 try:
                     # 创建任务但不等待
-                    asyncio.create_task(
+                    _run_in_background(
                         chat_memory.process_chat_message(
                             session_id=session_id,
                             user_id=user_id,
@@ -840,7 +891,7 @@ async def chat_agent(request: ChatRequest):
                     )
                     
                     # 创建任务但不等待
-                    asyncio.create_task(
+                    _run_in_background(
                         chat_memory.process_chat_message(
                             session_id=session_id,
                             user_id=user_id,
@@ -864,7 +915,8 @@ async def chat_agent(request: ChatRequest):
                             "created": int(time.time()),
                             "session_id": session_id,
                             "turn_id": request.turn_id,
-                            "memory_enhanced": bool(context_prefix)
+                            "memory_enhanced": bool(context_prefix),
+                            "timings": response.get("timings") if isinstance(response, dict) else None
                         }
                     },
                     "memory_context": memory_context if memory_context else None
@@ -905,6 +957,45 @@ async def chat_agent(request: ChatRequest):
             content={"error": f"处理请求时发生错误: {str(e)}"}
         )
 
+async def _stream_chat_agent(ai_assistant, enhanced_query: str, user_message: str, session_id: str, user_id: str, turn_id: str,
+                            memory_enhanced: bool, memory_context: Dict[str, Any]):
+    """/chat-agent 的流式响应，回复完整生成后再把本轮对话写入记忆系统"""
+    async for event in ai_assistant.process_query_stream(enhanced_query):
+        if event["type"] == "done":
+            content = event.get("response", "")
+            try:
+                # 异步保存消息到记忆系统，但不等待完成
+                for role, message in (("user", user_message), ("assistant", content)):
+                    _run_in_background(
+                        chat_memory.process_chat_message(
+                            session_id=session_id,
+                            user_id=user_id,
+                            role=role,
+                            content=message,
+                            content_type="text"
+                        )
+                    )
+            except Exception as e:
+                logging.error(f"创建保存消息任务失败: {str(e)}")
+            event = {
+                "type": "done",
+                "success": True,
+                "response": {
+                    "content": content,
+                    "type": "text",
+                    "metadata": {
+                        "model": "agent-model",
+                        "created": int(time.time()),
+                        "session_id": session_id,
+                        "turn_id": turn_id,
+                        "memory_enhanced": memory_enhanced,
+                        "timings": event.get("timings")
+                    }
+                },
+                "memory_context": memory_context if memory_context else None
+            }
+        yield event
+
 # 简单的聊天端点，直接返回JSON响应，支持工具调用和多模态消息
 @router.post("/chat-simple")
 async def chat_simple(request: ChatRequest):
@@ -19,18 +19,29 @@ router = APIRouter(prefix="/chats", tags=["聊天会话"])
 async def get_user_sessions(
     limit: int = Query(20, description="每页会话数量"),
     offset: int = Query(0, description="分页偏移量"),
+    cursor: Optional[str] = Query(None, description="分页游标，传入上一页返回的 next_cursor；传入时忽略 offset"),
     current_user: Dict[str, Any] = Depends(get_current_user)
 ):
     """
     获取当前用户的所有聊天会话
     
-    返回用户的聊天会话列表，按最后消息时间倒序排序
+    返回用户的聊天会话列表，按最后消息时间倒序排序。
+    第一页和游标分页返回 next_cursor，用于获取下一页。
     """
     try:
         user_id = current_user.get('id')
         
-        # 获取用户会话
-        sessions = await ChatService.get_user_sessions(user_id, limit, offset)
+        # 获取用户会话：第一页或带游标时使用游标分页，否则兼容旧的偏移量分页
+        next_cursor = None
+        if cursor or offset == 0:
+            try:
+                page = await ChatService.get_user_sessions_page(user_id, limit, cursor)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            sessions = page["items"]
+            next_cursor = page["next_cursor"]
+        else:
+            sessions = await ChatService.get_user_sessions(user_id, limit, offset)
         
         # 处理会话数据格式，确保与前端期望的格式匹配
         formatted_sessions = []
@@ -44,8 +55,11 @@ async def get_user_sessions(
             })
         
         return {
-            "chats": formatted_sessions
+            "chats": formatted_sessions,
+            "next_cursor": next_cursor
         }
+    except HTTPException:
+        raise
     except Exception as e:
         logging.error(f"获取用户会话失败: {str(e)}")
         return {
@@ -171,18 +185,29 @@ async def get_session_messages(
     session_id: str = Path(..., description="会话ID"),
     limit: int = Query(100, description="每页消息数量"),
     offset: int = Query(0, description="分页偏移量"),
+    cursor: Optional[str] = Query(None, description="分页游标，传入上一页返回的 next_cursor；传入时忽略 offset"),
     current_user: Dict[str, Any] = Depends(get_current_user)
 ):
     """
     获取指定会话的聊天记录
     
-    返回会话中的消息列表，按时间顺序排序
+    返回会话中的消息列表，按时间顺序排序。
+    第一页和游标分页返回 next_cursor，用于获取下一页。
     """
     try:
         user_id = current_user.get('id')
         
-        # 获取会话消息
-        messages = await ChatService.get_messages(session_id, limit, offset)
+        # 获取会话消息：第一页或带游标时使用游标分页，否则兼容旧的偏移量分页
+        next_cursor = None
+        if cursor or offset == 0:
+            try:
+                page = await ChatService.get_messages_page(session_id, limit, cursor)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            messages = page["items"]
+            next_cursor = page["next_cursor"]
+        else:
+            messages = await ChatService.get_messages(session_id, limit, offset)
         
         # 验证用户是否有权限访问该会话
         if messages and len(messages) > 0:
@@ -202,8 +227,11 @@ async def get_session_messages(
             "chat": {
                 "id": session_id,
                 "messages": messages
-            }
+            },
+            "next_cursor": next_cursor
         }
+    except HTTPException:
+        raise
     except Exception as e:
         logging.error(f"获取会话消息失败: {str(e)}")
         return {
@@ -213,7 +241,7 @@ async def get_session_messages(
             "error": str(e)
         }
 
-@router.delete("/{session_id}")
+@router.delete("/{session_id}", status_code=202)
 async def delete_session(
     session_id: str = Path(..., description="会话ID"),
     current_user: Dict[str, Any] = Depends(get_current_user)
@@ -221,16 +249,19 @@ async def delete_session(
     """
     删除指定的聊天会话
     
-    删除会话及其所有消息
+    会话及其所有消息和记忆由后台任务分批删除，
+    返回的 job_id 可以通过 /api/jobs/{job_id} 查询删除进度。
+    任务只保存在内存中，服务重启后未完成的删除需要重新提交。
     """
     try:
-        # 删除会话
-        success = await ChatService.delete_session(session_id)
+        job = ChatService.delete_session(session_id, user_id=current_user.get('id'))
         
         return {
-            "success": success,
+            "success": True,
             "session_id": session_id,
-            "message": "会话已删除" if success else "删除会话失败"
+            "job_id": job.id,
+            "status": job.status,
+            "message": "会话删除任务已提交"
         }
     except Exception as e:
         logging.error(f"删除会话失败: {str(e)}")
@@ -9,7 +9,7 @@ from typing import Dict, Any, Optional, List, Union
 from datetime import datetime
 import logging
 
-from app.db import create, query, update, run_async, get_db
+from app.db import repo
 from app.routes.auth_routes import get_current_user
 
 # 创建路由器
@@ -54,63 +54,13 @@ async def get_conversations(current_user: Dict[str, Any] = Depends(get_current_u
     user_id = current_user.get('id')
     
     try:
-        async def _get_conversations():
-            try:
-                db = await get_db()
-                if db is None:
-                    logging.warning("数据库连接为空，返回空列表")
-                    return []
-                
-                # 先尝试直接查询
-                try:
-                    query_str = f"SELECT * FROM conversations WHERE user_id = '{user_id}'"
-                    logging.debug(f"Direct SQL query: {query_str}")
-                    result = await db.query(query_str)
-                    
-                    logging.debug(f"查询结果: {result}")
-                    
-                    if result and isinstance(result, list) and len(result) > 0:
-                        if 'result' in result[0]:
-                            return result[0]['result']
-                        elif isinstance(result[0], list):
-                            return result[0]
-                        else:
-                            return result
-                except Exception as e:
-                    logging.error(f"第一种查询方式出错: {str(e)}")
-                
-                # 尝试第二种查询方式
-                try:
-                    logging.debug("尝试第二种查询方式...")
-                    result = await db.query(f"SELECT * FROM conversations")
-                    logging.debug(f"全表查询结果: {result}")
-                    
-                    if result and isinstance(result, list) and len(result) > 0:
-                        if 'result' in result[0]:
-                            all_conversations = result[0]['result']
-                            # 手动过滤用户ID
-                            return [conv for conv in all_conversations if conv.get('user_id') == user_id]
-                except Exception as e:
-                    logging.error(f"第二种查询方式出错: {str(e)}")
-                
-                # 如果前两种方式都失败，尝试直接获取所有记录然后在应用层过滤
-                try:
-                    logging.debug("尝试获取所有记录...")
-                    all_records = await db.select("conversations")
-                    logging.debug(f"所有记录: {all_records}")
-                    
-                    if all_records and isinstance(all_records, list):
-                        # 手动过滤用户ID
-                        return [conv for conv in all_records if conv.get('user_id') == user_id]
-                except Exception as e:
-                    logging.error(f"第三种查询方式出错: {str(e)}")
-                
-                return []
-            except Exception as e:
-                logging.error(f"获取对话时出错: {str(e)}")
-                return []
-        
-        conversations = await run_async(_get_conversations())
+        # 分块读取当前用户的对话，不再全表扫描后在应用层过滤
+        conversations = []
+        try:
+            async for conv in repo.query_iter('conversations', {'user_id': user_id}):
+                conversations.append(conv)
+        except Exception as e:
+            logging.error(f"获取对话时出错: {str(e)}")
         
         # 如果没有找到对话，返回空列表
         if not conversations:
@@ -165,7 +115,7 @@ async def create_conversation(
             'last_updated': datetime.utcnow().isoformat()
         }
         
-        conversation = create('conversations', new_conversation)
+        conversation = await repo.create('conversations', new_conversation)
         
         return {
             'message': 'Conversation created successfully',
@@ -186,7 +136,7 @@ async def update_conversation(
         user_id = current_user.get('id')
         
         # 检查对话是否属于当前用户
-        conversations = query('conversations', {'id': f'conversations:{conversation_id}'})
+        conversations = await repo.query('conversations', {'id': f'conversations:{conversation_id}'})
         if not conversations or len(conversations) == 0:
             raise HTTPException(status_code=404, detail="对话不存在")
         
@@ -222,7 +172,7 @@ async def update_conversation(
         update_data['last_updated'] = datetime.utcnow().isoformat()
         
         # 更新对话
-        updated_conversation = update('conversations', conversation_id, update_data)
+        updated_conversation = await repo.update('conversations', conversation_id, update_data)
         
         return {
             'message': 'Conversation updated successfully',
@@ -244,7 +194,7 @@ async def delete_conversation(
         user_id = current_user.get('id')
         
         # 检查对话是否属于当前用户
-        conversations = query('conversations', {'id': f'conversations:{conversation_id}'})
+        conversations = await repo.query('conversations', {'id': f'conversations:{conversation_id}'})
         if not conversations or len(conversations) == 0:
             raise HTTPException(status_code=404, detail="对话不存在")
         
@@ -253,19 +203,7 @@ async def delete_conversation(
             raise HTTPException(status_code=403, detail="无权操作此对话")
         
         # 删除对话
-        async def _delete():
-            try:
-                db = await get_db()
-                if db is None:
-                    return False
-                
-                await db.delete(f"conversations:{conversation_id}")
-                return True
-            except Exception as e:
-                logging.error(f"删除对话时数据库操作出错: {str(e)}")
-                return False
-        
-        result = await run_async(_delete())
+        result = await repo.delete_record('conversations', conversation_id)
         
         if result:
             return {"message": "Conversation deleted successfully"}
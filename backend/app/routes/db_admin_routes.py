@@ -0,0 +1,61 @@
+"""
+数据库管理API路由
+查看按表和语句形状汇总的查询统计以及最近的慢查询，见 app.db_metrics
+"""
+
+from fastapi import APIRouter, HTTPException, Depends, Query
+from typing import Dict, Any, Optional
+
+from app.db import query_metrics
+from app.routes.auth_routes import get_current_user
+
+# 创建路由器
+router = APIRouter(prefix="/admin/db", tags=["数据库管理"])
+
+# 形状统计可以排序的字段
+QUERY_SORT_FIELDS = ("total_ms", "count", "avg_ms", "max_ms", "p95_ms", "p99_ms", "rows", "bytes", "errors")
+
+
+def _require_admin(current_user: Dict[str, Any]):
+    if 'admin' not in current_user.get('roles', []):
+        raise HTTPException(status_code=403, detail="Only administrators can access this endpoint")
+
+
+@router.get("/queries")
+async def get_query_stats(
+    table: Optional[str] = Query(None, description="只返回该表的统计"),
+    sort: str = Query("total_ms", description="语句形状的排序字段"),
+    top: int = Query(50, ge=1, le=500, description="返回的语句形状数"),
+    current_user: Dict[str, Any] = Depends(get_current_user)
+):
+    """
+    获取查询统计
+
+    返回每张表以及每种语句形状的请求数、错误数、耗时分位数和直方图、行数和数据量。
+    """
+    _require_admin(current_user)
+    if sort not in QUERY_SORT_FIELDS:
+        raise HTTPException(status_code=400, detail=f"sort 必须是 {', '.join(QUERY_SORT_FIELDS)} 之一")
+    return query_metrics.snapshot(table=table, sort=sort, top=top)
+
+
+@router.get("/slow-queries")
+async def get_slow_queries(
+    limit: int = Query(100, ge=1, le=1000, description="返回的慢查询数"),
+    current_user: Dict[str, Any] = Depends(get_current_user)
+):
+    """
+    获取最近的慢查询，最新的在前
+    """
+    _require_admin(current_user)
+    return query_metrics.slow_queries(limit)
+
+
+@router.delete("/queries")
+async def reset_query_stats(current_user: Dict[str, Any] = Depends(get_current_user)):
+    """
+    清空查询统计和慢查询记录
+    """
+    _require_admin(current_user)
+    query_metrics.reset()
+    return {"success": True}
@@ -0,0 +1,37 @@
+"""
+后台任务API路由
+查询级联删除等后台任务的执行状态和进度
+"""
+
+from fastapi import APIRouter, HTTPException, Depends, Path
+from typing import Dict, Any
+
+from app.tasks.cascade_delete import cascade_deletes
+from app.routes.auth_routes import get_current_user
+
+# 创建路由器
+router = APIRouter(prefix="/jobs", tags=["后台任务"])
+
+@router.get("/{job_id}")
+async def get_job(
+    job_id: str = Path(..., description="任务ID"),
+    current_user: Dict[str, Any] = Depends(get_current_user)
+):
+    """
+    获取后台任务的状态
+
+    返回任务状态（pending/running/completed/failed/skipped/journaled）以及每张表已删除的记录数。
+    skipped 表示数据库不可用，删除没有执行；journaled 表示删除已写入写日志，
+    等数据库恢复、写日志重放后才会生效。
+
+    任务只保存在内存中，服务重启后查询返回 404，未完成的删除需要重新提交。
+    """
+    job = cascade_deletes.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="任务不存在")
+
+    # 只有提交任务的用户可以查看任务
+    if job.user_id and job.user_id != current_user.get('id'):
+        raise HTTPException(status_code=403, detail="无权查看此任务")
+
+    return job.to_dict()
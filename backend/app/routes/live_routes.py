@@ -0,0 +1,102 @@
+"""
+实时订阅API路由
+通过 SSE 或 WebSocket 推送当前用户的会话和消息变更，见 app.db_live
+"""
+
+from fastapi import APIRouter, HTTPException, Query, Header, Request, WebSocket, WebSocketDisconnect, status
+from fastapi.responses import StreamingResponse
+from typing import Dict, Any, List, Optional
+import json
+import logging
+
+from app.db_live import live_hub, LIVE_QUERY_HEARTBEAT_INTERVAL
+from app.utils.auth_utils import get_user_by_token
+from app.utils.sse import format_sse, SSE_HEADERS
+
+# 创建路由器
+router = APIRouter(prefix="/live", tags=["实时订阅"])
+
+
+def _parse_tables(tables: Optional[str]) -> Optional[List[str]]:
+    if not tables:
+        return None
+    return [t.strip() for t in tables.split(',') if t.strip()]
+
+async def _authenticate(token: Optional[str], authorization: Optional[str]) -> Optional[Dict[str, Any]]:
+    """EventSource 和浏览器 WebSocket 不能设置请求头，因此同时支持 token 查询参数"""
+    if not token and authorization and authorization.lower().startswith("bearer "):
+        token = authorization[7:]
+    if not token:
+        return None
+    return await get_user_by_token(token)
+
+
+@router.get("/events")
+async def live_events(
+    request: Request,
+    tables: Optional[str] = Query(None, description="订阅的表，逗号分隔，默认全部"),
+    token: Optional[str] = Query(None, description="访问令牌，无法设置 Authorization 请求头时使用"),
+    authorization: Optional[str] = Header(None)
+):
+    """
+    以 SSE 推送当前用户的会话和消息变更
+
+    每个事件的 data 为 {"table", "action", "id", "data", "ts"}；
+    action 为 resync 时客户端应重新拉取一次会话列表和消息。
+    """
+    current_user = await _authenticate(token, authorization)
+    if not current_user:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+
+    subscription = live_hub.subscribe(current_user.get('id'), _parse_tables(tables))
+
+    async def event_stream():
+        try:
+            yield "retry: 3000\n\n"
+            while not await request.is_disconnected():
+                event = await subscription.get(LIVE_QUERY_HEARTBEAT_INTERVAL)
+                if event is None:
+                    yield ": keepalive\n\n"
+                    continue
+                yield format_sse(event, event['action'])
+        finally:
+            live_hub.unsubscribe(subscription)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers=SSE_HEADERS
+    )
+
+
+@router.websocket("/ws")
+async def live_websocket(
+    websocket: WebSocket,
+    tables: Optional[str] = Query(None),
+    token: Optional[str] = Query(None)
+):
+    """
+    以 WebSocket 推送当前用户的会话和消息变更，消息格式与 SSE 相同；
+    没有事件时每隔一段时间发送 {"action": "ping"}
+    """
+    current_user = await _authenticate(token, websocket.headers.get("authorization"))
+    if not current_user:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+
+    await websocket.accept()
+    subscription = live_hub.subscribe(current_user.get('id'), _parse_tables(tables))
+    try:
+        while True:
+            event = await subscription.get(LIVE_QUERY_HEARTBEAT_INTERVAL)
+            await websocket.send_text(json.dumps(event or {"action": "ping"}, default=str, ensure_ascii=False))
+    except WebSocketDisconnect:
+        pass
+    except Exception as e:
+        logging.error(f"实时订阅 WebSocket 出错: {str(e)}")
+    finally:
+        live_hub.unsubscribe(subscription)
@@ -2,7 +2,7 @@
 记忆系统API路由 - 提供记忆系统的HTTP接口
 """
 
-from fastapi import APIRouter, HTTPException, Query
+from fastapi import APIRouter, HTTPException, Query, Depends
 from pydantic import BaseModel
 from typing import List, Dict, Any, Optional
 import json
@@ -10,6 +10,7 @@ import time
 
 from app.services.memory_service import MemoryService
 from app.services.memory_manager import MemoryManager
+from app.routes.auth_routes import get_current_user
 from app.models.memory_models import MemoryType, MemoryImportance, MemoryQuery
 
 # 创建API路由器
@@ -44,6 +45,7 @@ class MemoryQueryRequest(BaseModel):
     offset: Optional[int] = 0
     sort_by: Optional[str] = "recency"
     metadata_filter: Optional[Dict[str, Any]] = None
+    cursor: Optional[str] = None  # 分页游标，传入上一页返回的 next_cursor；传入时忽略 offset
 
 # API端点
 @router.post("/memories/user", response_model=Dict[str, Any])
@@ -92,8 +94,18 @@ async def search_memories(request: MemoryQueryRequest):
             sort_by=request.sort_by,
             metadata_filter=request.metadata_filter
         )
-        memories = await MemoryService.search_memories(query)
-        return {"success": True, "memories": memories}
+        # 第一页或带游标时使用游标分页，否则兼容旧的偏移量分页
+        next_cursor = None
+        if request.cursor or not request.offset:
+            try:
+                memories, next_cursor = await MemoryService.search_memories_page(query, request.cursor)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+        else:
+            memories = await MemoryService.search_memories(query)
+        return {"success": True, "memories": memories, "next_cursor": next_cursor}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"搜索记忆失败: {str(e)}")
 
@@ -102,9 +114,10 @@ async def get_user_memories(
     user_id: str,
     memory_type: Optional[str] = None,
     limit: int = 10,
-    offset: int = 0
+    offset: int = 0,
+    cursor: Optional[str] = None
 ):
-    """获取用户记忆"""
+    """获取用户记忆，第一页和游标分页返回 next_cursor"""
     try:
         query = MemoryQuery(
             user_id=user_id,
@@ -113,8 +126,18 @@ async def get_user_memories(
             offset=offset,
             sort_by="recency"
         )
-        memories = await MemoryService.search_memories(query)
-        return {"success": True, "memories": memories}
+        # 第一页或带游标时使用游标分页，否则兼容旧的偏移量分页
+        next_cursor = None
+        if cursor or offset == 0:
+            try:
+                memories, next_cursor = await MemoryService.search_memories_page(query, cursor)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+        else:
+            memories = await MemoryService.search_memories(query)
+        return {"success": True, "memories": memories, "next_cursor": next_cursor}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"获取用户记忆失败: {str(e)}")
 
@@ -153,12 +176,18 @@ async def delete_user_memory(memory_id: str):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"删除用户记忆失败: {str(e)}")
 
-@router.delete("/memories/session/{session_id}", response_model=Dict[str, Any])
-async def delete_session_memories(session_id: str):
-    """删除会话相关的所有记忆"""
+@router.delete("/memories/session/{session_id}", response_model=Dict[str, Any], status_code=202)
+async def delete_session_memories(
+    session_id: str,
+    current_user: Dict[str, Any] = Depends(get_current_user)
+):
+    """提交删除会话相关所有记忆的后台任务，通过 /api/jobs/{job_id} 查询进度
+
+    任务只保存在内存中，服务重启后未完成的删除需要重新提交。
+    """
     try:
-        success = await MemoryService.delete_session_memories(session_id)
-        return {"success": success}
+        job = MemoryService.delete_session_memories(session_id, user_id=current_user.get('id'))
+        return {"success": True, "job_id": job.id, "status": job.status}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"删除会话记忆失败: {str(e)}")
 
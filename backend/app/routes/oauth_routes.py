@@ -14,7 +14,7 @@ from app.utils.oauth_utils import (
     get_github_user_info
 )
 from app.utils.auth_utils import create_access_token, get_password_hash
-from app.db import query, create, update as db_update
+from app.db import repo
 
 # 设置日志记录
 logging.basicConfig(level=logging.INFO)
@@ -92,7 +92,7 @@ async def google_callback(request: Request):
         logger.info(f"Processing Google OAuth for email: {email}")
         
         # 检查用户是否已存在
-        existing_users = await query('users', {'email': email})
+        existing_users = await repo.query('users', {'email': email})
         
         if existing_users and len(existing_users) > 0:
             # 用户已存在，更新OAuth信息
@@ -110,7 +110,7 @@ async def google_callback(request: Request):
                 'access_token': access_token
             }
             
-            await db_update('users', user_id, {'oauth_info': oauth_info})
+            await repo.update('users', user_id, {'oauth_info': oauth_info})
             logger.info(f"Updated OAuth info for existing user: {user_id}")
         else:
             # 创建新用户
@@ -151,7 +151,7 @@ async def google_callback(request: Request):
                 'oauth_provider': 'google'
             }
             
-            await create('users', user)
+            await repo.create('users', user)
             logger.info(f"Created new user with ID: {user_id}")
             
         # 创建访问令牌
@@ -161,22 +161,22 @@ async def google_callback(request: Request):
         
         # 获取用户信息返回给前端 - 尝试多种可能的查询方式
         logger.info(f"Querying user with original ID: {user_id}")
-        user_data = await query('users', {'id': user_id})
+        user_data = await repo.query('users', {'id': user_id})
         
         # 如果查询失败，尝试使用email查询（更可靠）
         if not user_data or len(user_data) == 0:
             logger.info(f"Original ID query failed, trying with email: {email}")
-            user_data = await query('users', {'email': email})
+            user_data = await repo.query('users', {'email': email})
             
         # 如果仍然失败，尝试使用格式化的ID查询
         if not user_data or len(user_data) == 0:
             formatted_id = f"users:{user_id}"
             logger.info(f"Email query failed, trying with formatted ID: {formatted_id}")
-            user_data = await query('users', {'id': formatted_id})
+            user_data = await repo.query('users', {'id': formatted_id})
             
         # 如果所有尝试都失败，记录调试信息
         if not user_data or len(user_data) == 0:
-            all_users = await query('users', {})
+            all_users = await repo.query('users', {})
             logger.error(f"Failed to find user after creation. User ID: {user_id}, Email: {email}")
             logger.error(f"Total users in database: {len(all_users)}")
             for u in all_users:
@@ -246,7 +246,7 @@ async def github_callback(request: Request):
         logger.info(f"Processing GitHub OAuth for email: {email}")
         
         # 检查用户是否已存在
-        existing_users = await query('users', {'email': email})
+        existing_users = await repo.query('users', {'email': email})
         
         if existing_users and len(existing_users) > 0:
             # 用户已存在，更新OAuth信息
@@ -265,7 +265,7 @@ async def github_callback(request: Request):
                 'access_token': access_token
             }
             
-            await db_update('users', user_id, {'oauth_info': oauth_info})
+            await repo.update('users', user_id, {'oauth_info': oauth_info})
             logger.info(f"Updated OAuth info for existing user: {user_id}")
         else:
             # 创建新用户
@@ -307,7 +307,7 @@ async def github_callback(request: Request):
                 'oauth_provider': 'github'
             }
             
-            await create('users', user)
+            await repo.create('users', user)
             logger.info(f"Created new user with ID: {user_id}")
             
         # 创建访问令牌
@@ -317,22 +317,22 @@ async def github_callback(request: Request):
         
         # 获取用户信息返回给前端 - 尝试多种可能的查询方式
         logger.info(f"Querying user with original ID: {user_id}")
-        user_data = await query('users', {'id': user_id})
+        user_data = await repo.query('users', {'id': user_id})
         
         # 如果查询失败，尝试使用email查询（更可靠）
         if not user_data or len(user_data) == 0:
             logger.info(f"Original ID query failed, trying with email: {email}")
-            user_data = await query('users', {'email': email})
+            user_data = await repo.query('users', {'email': email})
             
         # 如果仍然失败，尝试使用格式化的ID查询
         if not user_data or len(user_data) == 0:
             formatted_id = f"users:{user_id}"
             logger.info(f"Email query failed, trying with formatted ID: {formatted_id}")
-            user_data = await query('users', {'id': formatted_id})
+            user_data = await repo.query('users', {'id': formatted_id})
             
         # 如果所有尝试都失败，记录调试信息
         if not user_data or len(user_data) == 0:
-            all_users = await query('users', {})
+            all_users = await repo.query('users', {})
             logger.error(f"Failed to find user after creation. User ID: {user_id}, Email: {email}")
             logger.error(f"Total users in database: {len(all_users)}")
             for u in all_users:
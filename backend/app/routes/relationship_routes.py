@@ -16,7 +16,7 @@ from app.utils.relationship_utils import (
     calculate_ris,
     update_relationship_status,
 )
-from app.db import create, query, update as db_update
+from app.db import repo
 
 # 创建路由器
 router = APIRouter(prefix="/relationships", tags=["关系管理"])
@@ -77,7 +77,7 @@ async def create_relationship(relationship: RelationshipCreate):
             data["status"] = RelationshipStatus.ACTIVE.value
             
         # 存储到 SurrealDB
-        result = create('relationship', data)
+        result = await repo.create('relationship', data)
         
         if result:
             logging.info(f"Successfully created relationship: {data['relationship_id']}")
@@ -102,7 +102,7 @@ async def get_relationship(relationship_id: str):
     """
     try:
         # 查询 SurrealDB
-        results = query('relationship', {'relationship_id': relationship_id})
+        results = await repo.query('relationship', {'relationship_id': relationship_id})
         
         # 处理查询结果
         if not results:
@@ -127,12 +127,12 @@ async def update_relationship(relationship_id: str, data: Dict[str, Any]):
     """
     try:
         # 首先查询关系是否存在
-        results = query('relationship', {'relationship_id': relationship_id})
+        results = await repo.query('relationship', {'relationship_id': relationship_id})
         if not results:
             raise HTTPException(status_code=404, detail="Relationship not found")
             
         # 使用 SurrealDB 的更新函数更新关系
-        result = db_update('relationship', relationship_id, data)
+        result = await repo.update('relationship', relationship_id, data)
         
         if result:
             logging.info(f"Successfully updated relationship: {relationship_id}")
@@ -156,7 +156,7 @@ async def get_ai_relationships(ai_id: str):
     """
     try:
         # 查询 SurrealDB
-        results = query('relationship', {'ai_id': ai_id})
+        results = await repo.query('relationship', {'ai_id': ai_id})
         
         # 返回结果，可能是空列表
         return results
@@ -175,7 +175,7 @@ async def get_user_relationships(human_id: str):
     """
     try:
         # 查询 SurrealDB
-        results = query('relationship', {'human_id': human_id})
+        results = await repo.query('relationship', {'human_id': human_id})
         
         # 返回结果，可能是空列表
         return results
@@ -194,7 +194,7 @@ async def get_relationship_status(relationship_id: str):
     """
     try:
         # 查询 SurrealDB
-        results = query('relationship', {'relationship_id': relationship_id})
+        results = await repo.query('relationship', {'relationship_id': relationship_id})
         
         # 处理查询结果
         if not results:
@@ -231,13 +231,13 @@ async def update_relationship_status_route(relationship_id: str, status_update:
             raise HTTPException(status_code=400, detail=f"Invalid status: {status_update.status}")
 
         # 首先查询关系是否存在
-        results = query('relationship', {'relationship_id': relationship_id})
+        results = await repo.query('relationship', {'relationship_id': relationship_id})
         if not results:
             raise HTTPException(status_code=404, detail="Relationship not found")
             
         # 使用 SurrealDB 的更新函数更新状态
         update_data = {"status": status_value}
-        result = db_update('relationship', relationship_id, update_data)
+        result = await repo.update('relationship', relationship_id, update_data)
         
         if result:
             logging.info(f"Successfully updated relationship status: {relationship_id} to {status_value}")
@@ -261,7 +261,7 @@ async def get_relationship_ris(relationship_id: str):
     """
     try:
         # 查询 SurrealDB
-        results = query('relationship', {'relationship_id': relationship_id})
+        results = await repo.query('relationship', {'relationship_id': relationship_id})
         
         # 处理查询结果
         if not results:
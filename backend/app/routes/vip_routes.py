@@ -7,7 +7,7 @@ import stripe
 import logging
 import os
 
-from app.db import query, update as db_update, create
+from app.db import repo
 from app.models.enums import VIPLevel, UserRole
 from app.routes.auth_routes import get_current_user
 
@@ -293,7 +293,7 @@ async def payment_success(
                 'vip_expiry': new_expiry
             }
             
-            result = db_update('users', current_user.get('id'), update_data)
+            result = await repo.update('users', current_user.get('id'), update_data)
             
             if not result:
                 raise HTTPException(status_code=500, detail="Failed to update VIP status")
@@ -352,7 +352,7 @@ async def stripe_webhook(request: Request):
             months = int(session.metadata.get('months', 1))
             
             # 查找用户
-            users = query('users', {'id': user_id})
+            users = await repo.query('users', {'id': user_id})
             if not users or len(users) == 0:
                 logging.error(f"User not found: {user_id}")
                 return {"status": "error", "message": "User not found"}
@@ -386,7 +386,7 @@ async def stripe_webhook(request: Request):
                 'vip_expiry': new_expiry
             }
             
-            result = db_update('users', user_id, update_data)
+            result = await repo.update('users', user_id, update_data)
             
             if not result:
                 logging.error(f"Failed to update VIP status for user {user_id}")
@@ -418,7 +418,7 @@ async def admin_set_vip(
         duration_days = vip_data.duration_days or 30
         
         # 查找用户
-        users = query('users', {'id': user_id})
+        users = await repo.query('users', {'id': user_id})
         if not users or len(users) == 0:
             raise HTTPException(status_code=404, detail="User not found")
         
@@ -435,7 +435,7 @@ async def admin_set_vip(
             'vip_expiry': new_expiry
         }
         
-        result = db_update('users', user_id, update_data)
+        result = await repo.update('users', user_id, update_data)
         
         if not result:
             raise HTTPException(status_code=500, detail="Failed to update VIP status")
@@ -6,7 +6,6 @@ import logging
 from typing import Dict, Any, List, Optional, Union
 
 from app.services.chat_service import ChatService
-from app.services.memory_service import MemoryService
 from app.services.memory_manager import MemoryManager
 
 
@@ -112,43 +111,32 @@ class ChatMemoryIntegration:
         import asyncio
         from asyncio import TimeoutError
         
-        # 1. 检索相关的用户记忆（带超时处理）
+        # 1. 检索相关的用户记忆和当前会话的摘要（一次数据库请求，带超时处理）
         try:
             # 添加超时处理，最多等待3秒
-            relevant_memories = await asyncio.wait_for(
-                self.memory_manager.retrieve_relevant_memories(
+            relevant_memories, session_summary = await asyncio.wait_for(
+                self.memory_manager.retrieve_memories_with_summary(
                     user_id=user_id,
                     query=user_message,
+                    session_id=current_session_id,
                     limit=5
                 ),
                 timeout=3.0  # 3秒超时
             )
             result["relevant_memories"] = relevant_memories
-            logging.info(f"成功检索到{len(relevant_memories)}条相关记忆")
-        except TimeoutError:
-            logging.warning(f"检索相关记忆超时，继续处理但不使用记忆增强")
-            relevant_memories = []
-        except Exception as e:
-            logging.error(f"检索相关记忆失败: {str(e)}")
-            relevant_memories = []
-        
-        # 2. 获取当前会话的摘要（带超时处理）
-        try:
-            # 添加超时处理，最多等待2秒
-            session_summary = await asyncio.wait_for(
-                MemoryService.get_session_summary(current_session_id),
-                timeout=2.0  # 2秒超时
-            )
             result["session_summary"] = session_summary
+            logging.info(f"成功检索到{len(relevant_memories)}条相关记忆")
             logging.info(f"成功获取会话摘要: {session_summary is not None}")
         except TimeoutError:
-            logging.warning(f"获取会话摘要超时，继续处理但不使用会话摘要")
+            logging.warning(f"检索记忆和会话摘要超时，继续处理但不使用记忆增强")
+            relevant_memories = []
             session_summary = None
         except Exception as e:
-            logging.error(f"获取会话摘要失败: {str(e)}")
+            logging.error(f"检索记忆和会话摘要失败: {str(e)}")
+            relevant_memories = []
             session_summary = None
         
-        # 3. 构建上下文增强信息
+        # 2. 构建上下文增强信息
         try:
             context_enhancement = ""
             
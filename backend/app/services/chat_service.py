@@ -2,13 +2,74 @@
 聊天服务 - 处理聊天记录的存储和检索
 """
 
+import collections
 import logging
+import os
+import time
 import uuid
 from datetime import datetime
 from typing import Dict, Any, List, Optional
 
-from app.db import query, create, update, delete
+from app.db import repo, counter_buffer
 from app.models.chat_models import ChatMessage, ChatSession
+from app.tasks.cascade_delete import CascadeDeleteJob, cascade_deletes, session_delete_steps
+from app.tasks.write_behind import write_behind
+
+# 会话列表默认返回的字段
+SESSION_LIST_FIELDS = [
+    'session_id', 'user_id', 'title', 'last_message', 'last_message_time',
+    'updated_at', 'message_count'
+]
+
+class MessageCountCache:
+    """按聊天ID缓存消息总数
+
+    第一次需要总数时由数据库计数并写入缓存，之后插入消息时直接累加，
+    避免每次分页都重新计数。缓存按 LRU 淘汰，并带有过期时间，
+    以纠正其它进程写入造成的偏差。
+    """
+
+    def __init__(self, max_size: int = 10000, ttl: float = 600.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._counts = collections.OrderedDict()  # chat_id -> (count, 写入时间)
+
+    def get(self, chat_id: str) -> Optional[int]:
+        """返回缓存的消息总数，没有缓存或已过期时返回 None"""
+        entry = self._counts.get(chat_id)
+        if entry is None:
+            return None
+        count, stored_at = entry
+        if time.monotonic() - stored_at > self.ttl:
+            del self._counts[chat_id]
+            return None
+        self._counts.move_to_end(chat_id)
+        return count
+
+    def set(self, chat_id: str, count: int):
+        """写入数据库统计出的消息总数"""
+        self._counts[chat_id] = (count, time.monotonic())
+        self._counts.move_to_end(chat_id)
+        while len(self._counts) > self.max_size:
+            self._counts.popitem(last=False)
+
+    def increment(self, chat_id: str, delta: int = 1):
+        """插入消息后累加总数，未缓存的聊天不处理，下次读取时再计数"""
+        entry = self._counts.get(chat_id)
+        if entry is not None:
+            self._counts[chat_id] = (entry[0] + delta, entry[1])
+
+    def invalidate(self, chat_id: str):
+        """删除聊天或消息后清除缓存"""
+        self._counts.pop(chat_id, None)
+
+
+# 全局消息总数缓存
+message_counts = MessageCountCache(
+    max_size=int(os.getenv('MESSAGE_COUNT_CACHE_SIZE', '10000')),
+    ttl=float(os.getenv('MESSAGE_COUNT_CACHE_TTL', '600'))
+)
+
 
 class ChatService:
     """聊天服务类"""
@@ -37,77 +98,26 @@ class ChatService:
             保存的消息记录
         """
         try:
-            # 准备消息数据
-            message_id = str(uuid.uuid4())
-            created_at = datetime.now().isoformat()
-            
-            message_data = {
-                "id": message_id,
-                "session_id": session_id,
-                "user_id": user_id,
-                "role": role,
-                "content": content,
-                "content_type": content_type,
-                "metadata": metadata or {},
-                "created_at": created_at
-            }
+            message_data, message_table_data = ChatService._message_records(
+                session_id, user_id, role, content, content_type, metadata
+            )
+            message_id = message_data["id"]
             
-            # 保存消息到数据库
-            # 同时保存到 chat_messages 和 message 表
-            chat_messages_result = create('chat_messages', message_data)
-            
-            # 创建 message 表的消息数据
-            message_table_data = {
-                'id': message_id,
-                'chat_id': session_id,  # 使用 session_id 作为 chat_id
-                'role': role,
-                'content': content,
-                'timestamp': created_at,
-                'metadata': metadata or {}
-            }
-            
-            # 如果有其他字段需要添加
-            if content_type != "text":
-                message_table_data['type'] = content_type
-                
-            # 保存到 message 表
-            message_table_result = create('message', message_table_data)
-            
-            # 合并两个结果
-            result = chat_messages_result
-            
-            # 检查结果是否为协程并等待它
+            # 在同一个事务中写入 chat_messages 和 message 表，一次请求完成，两张表不会只写入一半
             import asyncio
-            
-            # 处理 chat_messages 表的结果
-            if asyncio.iscoroutine(chat_messages_result):
-                try:
-                    # 添加超时处理
-                    saved_chat_message = await asyncio.wait_for(chat_messages_result, timeout=15.0)
-                    logging.info(f"chat_messages表消息保存成功: session_id={session_id}, id={message_id}")
-                except asyncio.TimeoutError:
-                    logging.error(f"chat_messages表保存消息超时(15秒): session_id={session_id}, user_id={user_id}, role={role}")
-                    saved_chat_message = message_data
-                except Exception as e:
-                    logging.error(f"chat_messages表保存消息失败: {str(e)}")
-                    saved_chat_message = message_data
-            else:
-                saved_chat_message = chat_messages_result
-                
-            # 处理 message 表的结果
-            if asyncio.iscoroutine(message_table_result):
-                try:
-                    # 添加超时处理
-                    saved_message_table = await asyncio.wait_for(message_table_result, timeout=15.0)
-                    logging.info(f"message表消息保存成功: chat_id={session_id}, id={message_id}")
-                except asyncio.TimeoutError:
-                    logging.error(f"message表保存消息超时(15秒): chat_id={session_id}, role={role}")
-                    saved_message_table = message_table_data
-                except Exception as e:
-                    logging.error(f"message表保存消息失败: {str(e)}")
-                    saved_message_table = message_table_data
-            else:
-                saved_message_table = message_table_result
+            tx = repo.transaction()
+            tx.create('chat_messages', message_data)
+            tx.create('message', message_table_data)
+            try:
+                saved_chat_message, saved_message_table = await asyncio.wait_for(tx.execute(), timeout=15.0)
+                message_counts.increment(session_id)
+                logging.info(f"消息保存成功: session_id={session_id}, id={message_id}")
+            except asyncio.TimeoutError:
+                logging.error(f"保存消息超时(15秒)，事务未提交: session_id={session_id}, user_id={user_id}, role={role}")
+                saved_chat_message, saved_message_table = None, None
+            except Exception as tx_error:
+                logging.error(f"保存消息失败，事务已回滚: session_id={session_id}, error={str(tx_error)}")
+                saved_chat_message, saved_message_table = None, None
                 
             # 优先使用 message 表的结果作为返回值，因为前端主要使用该表
             saved_message = saved_message_table or saved_chat_message
@@ -130,6 +140,96 @@ class ChatService:
             # 返回原始数据而不是抛出异常，确保流程继续
             return message_data
     
+    @staticmethod
+    def _message_records(
+        session_id: str,
+        user_id: str,
+        role: str,
+        content: str,
+        content_type: str = "text",
+        metadata: Optional[Dict[str, Any]] = None
+    ):
+        """生成一条消息在 chat_messages 表和 message 表中的记录
+        
+        Returns:
+            (chat_messages 记录, message 记录)
+        """
+        message_id = str(uuid.uuid4())
+        created_at = datetime.now().isoformat()
+        
+        message_data = {
+            "id": message_id,
+            "session_id": session_id,
+            "user_id": user_id,
+            "role": role,
+            "content": content,
+            "content_type": content_type,
+            "metadata": metadata or {},
+            "created_at": created_at
+        }
+        
+        # 创建 message 表的消息数据
+        message_table_data = {
+            'id': message_id,
+            'chat_id': session_id,  # 使用 session_id 作为 chat_id
+            'role': role,
+            'content': content,
+            'timestamp': created_at,
+            'metadata': metadata or {}
+        }
+        
+        # 如果有其他字段需要添加
+        if content_type != "text":
+            message_table_data['type'] = content_type
+        return message_data, message_table_data
+    
+    @staticmethod
+    async def queue_message(
+        session_id: str,
+        user_id: str,
+        role: str,
+        content: str,
+        content_type: str = "text",
+        metadata: Optional[Dict[str, Any]] = None
+    ) -> Dict[str, Any]:
+        """
+        把聊天消息和会话的最后一条消息交给延迟写入队列，不等待写入数据库
+        
+        消息和会话元数据在同一个事务中写入；同一个会话的写入按提交顺序执行，
+        因此消息不会早于之前用 save_message 保存的消息写入。参数与 save_message 相同。
+        
+        Returns:
+            待写入的消息记录
+        """
+        message_data, message_table_data = ChatService._message_records(
+            session_id, user_id, role, content, content_type, metadata
+        )
+        created_at = message_data["created_at"]
+        await write_behind.submit(session_id, [
+            ("create", "chat_messages", message_data),
+            ("create", "message", message_table_data),
+            # 合并更新：会话不存在时创建，已有的标题等字段保持不变
+            ("merge", "chat_sessions", session_id, {
+                "session_id": session_id,
+                "user_id": user_id,
+                "last_message": content[:50] + "..." if len(content) > 50 else content,
+                "last_message_time": created_at,
+                "updated_at": created_at
+            }),
+        ], on_written=lambda: message_counts.increment(session_id))
+        return message_data
+    
+    @staticmethod
+    def count_conversation(user_id: str):
+        """
+        记录用户的一次对话：累计对话次数（conversation_count）交给 counter_buffer 合并写入，
+        不读取也不修改用户记录中的其他字段
+        
+        Args:
+            user_id: 用户ID
+        """
+        counter_buffer.add('users', user_id, 'conversation_count')
+    
     @staticmethod
     async def update_session(
         session_id: str,
@@ -190,22 +290,20 @@ class ChatService:
                 result = None
                 try:
                     # 首先尝试更新现有记录
-                    update_result = update('chat_sessions', session_id, session_data)
-                    if asyncio.iscoroutine(update_result):
-                        result = await asyncio.wait_for(update_result, timeout=TIMEOUT_SECONDS)
-                    else:
-                        result = update_result
+                    result = await asyncio.wait_for(
+                        repo.update('chat_sessions', session_id, session_data),
+                        timeout=TIMEOUT_SECONDS
+                    )
                     
                     logging.info(f"ChatService.update_session - 更新结果: {result}")
                     
                     # 如果更新失败，尝试创建新记录
                     if not result:
                         session_data["created_at"] = now  # 添加创建时间
-                        create_result = create('chat_sessions', session_data)
-                        if asyncio.iscoroutine(create_result):
-                            result = await asyncio.wait_for(create_result, timeout=TIMEOUT_SECONDS)
-                        else:
-                            result = create_result
+                        result = await asyncio.wait_for(
+                            repo.create('chat_sessions', session_data),
+                            timeout=TIMEOUT_SECONDS
+                        )
                         logging.info(f"ChatService.update_session - 创建结果: {result}")
                 except (asyncio.TimeoutError, FuturesTimeoutError) as e:
                     logging.error(f"ChatService.update_session - 操作超时(15秒): session_id={session_id}, user_id={user_id}, error={str(e)}")
@@ -244,24 +342,12 @@ class ChatService:
         try:
             # 查询消息记录
             # 先尝试使用chat_id查询
-            query_result = query('chat_messages', {'chat_id': session_id}, sort=[('created_at', 'ASC')], limit=limit, offset=offset)
-            
-            # 检查结果是否为协程并等待它
-            import asyncio
-            if asyncio.iscoroutine(query_result):
-                messages = await query_result
-            else:
-                messages = query_result
+            messages = await repo.query('chat_messages', {'chat_id': session_id}, sort=[('created_at', 'ASC')], limit=limit, offset=offset)
                 
             # 如果没有找到消息，尝试使用session_id查询
             if not messages:
                 logging.info(f"未找到chat_id={session_id}的消息，尝试使用session_id查询")
-                query_result = query('chat_messages', {'session_id': session_id}, sort=[('created_at', 'ASC')], limit=limit, offset=offset)
-                
-                if asyncio.iscoroutine(query_result):
-                    messages = await query_result
-                else:
-                    messages = query_result
+                messages = await repo.query('chat_messages', {'session_id': session_id}, sort=[('created_at', 'ASC')], limit=limit, offset=offset)
             
             return messages or []
         except Exception as e:
@@ -269,7 +355,86 @@ class ChatService:
             return []
     
     @staticmethod
-    async def get_user_sessions(user_id: str, limit: int = 20, offset: int = 0) -> List[Dict[str, Any]]:
+    async def get_messages_page(session_id: str, limit: int = 100, cursor: Optional[str] = None) -> Dict[str, Any]:
+        """
+        按 (created_at, id) 游标分页获取会话消息
+        
+        Args:
+            session_id: 会话ID
+            limit: 每页消息数量
+            cursor: 上一页返回的 next_cursor，为空时取第一页
+            
+        Returns:
+            {"items": 消息列表, "next_cursor": 下一页游标, "has_more": 是否还有下一页}
+            
+        Raises:
+            ValueError: 游标格式不正确
+        """
+        try:
+            return await repo.query_page(
+                'chat_messages',
+                {'session_id': session_id},
+                order_field='created_at',
+                limit=limit,
+                cursor=cursor
+            )
+        except ValueError:
+            raise
+        except Exception as e:
+            logging.error(f"获取聊天消息失败: {str(e)}")
+            return {"items": [], "next_cursor": None, "has_more": False}
+    
+    @staticmethod
+    async def get_user_sessions_page(
+        user_id: str,
+        limit: int = 20,
+        cursor: Optional[str] = None,
+        fields: Optional[List[str]] = SESSION_LIST_FIELDS
+    ) -> Dict[str, Any]:
+        """
+        按 (updated_at, id) 游标分页获取用户会话，最近更新的在前
+        
+        Args:
+            user_id: 用户ID
+            limit: 每页会话数量
+            cursor: 上一页返回的 next_cursor，为空时取第一页
+            fields: 只返回的字段，默认为会话列表展示所需字段
+            
+        Returns:
+            {"items": 会话列表, "next_cursor": 下一页游标, "has_more": 是否还有下一页}
+            
+        Raises:
+            ValueError: 游标格式不正确
+        """
+        import asyncio
+        try:
+            return await asyncio.wait_for(
+                repo.query_page(
+                    'chat_sessions',
+                    {'user_id': user_id},
+                    order_field='updated_at',
+                    limit=limit,
+                    cursor=cursor,
+                    descending=True,
+                    fields=fields
+                ),
+                timeout=15.0
+            )
+        except ValueError:
+            raise
+        except asyncio.TimeoutError:
+            logging.error(f"获取用户会话超时(15秒): user_id={user_id}")
+        except Exception as e:
+            logging.error(f"获取用户会话失败: user_id={user_id}, error={str(e)}")
+        return {"items": [], "next_cursor": None, "has_more": False}
+    
+    @staticmethod
+    async def get_user_sessions(
+        user_id: str,
+        limit: int = 20,
+        offset: int = 0,
+        fields: Optional[List[str]] = SESSION_LIST_FIELDS
+    ) -> List[Dict[str, Any]]:
         """
         获取用户的所有会话
         
@@ -277,6 +442,7 @@ class ChatService:
             user_id: 用户ID
             limit: 限制返回的会话数量
             offset: 会话偏移量，用于分页
+            fields: 只返回的字段，默认为会话列表展示所需字段，传 None 返回全部字段
             
         Returns:
             会话列表
@@ -292,19 +458,16 @@ class ChatService:
             logging.info(f"正在获取用户会话: user_id={user_id}, limit={limit}, offset={offset}")
             
             # 查询用户会话
-            query_result = query('chat_sessions', {'user_id': user_id}, sort=[('updated_at', 'DESC')], limit=limit, offset=offset)
-            
-            # 检查结果是否为协程并等待它
             import asyncio
-            if asyncio.iscoroutine(query_result):
-                try:
-                    # 添加15秒超时
-                    sessions = await asyncio.wait_for(query_result, timeout=15.0)
-                except asyncio.TimeoutError:
-                    logging.error(f"获取用户会话超时(15秒): user_id={user_id}")
-                    return []
-            else:
-                sessions = query_result
+            try:
+                # 添加15秒超时
+                sessions = await asyncio.wait_for(
+                    repo.query('chat_sessions', {'user_id': user_id}, sort=[('updated_at', 'DESC')], limit=limit, offset=offset, fields=fields),
+                    timeout=15.0
+                )
+            except asyncio.TimeoutError:
+                logging.error(f"获取用户会话超时(15秒): user_id={user_id}")
+                return []
             
             query_time = time.time() - start_time
             if query_time > 1.0:  # 记录执行时间超过1秒的查询
@@ -323,33 +486,19 @@ class ChatService:
             return []
     
     @staticmethod
-    async def delete_session(session_id: str) -> bool:
+    def delete_session(session_id: str, user_id: Optional[str] = None) -> CascadeDeleteJob:
         """
-        删除会话及其所有消息
+        提交删除会话的后台任务
+        
+        会话记录、会话消息（chat_messages 和 message）以及会话相关的记忆
+        由后台任务分批删除，调用方可以通过任务ID查询进度。
         
         Args:
             session_id: 会话ID
+            user_id: 发起删除的用户ID
             
         Returns:
-            是否删除成功
+            级联删除任务
         """
-        try:
-            # 删除会话
-            session_result = delete('chat_sessions', {'session_id': session_id})
-            
-            # 检查结果是否为协程并等待它
-            import asyncio
-            if asyncio.iscoroutine(session_result):
-                await session_result
-            
-            # 删除所有相关消息
-            message_result = delete('chat_messages', {'session_id': session_id})
-            
-            # 检查结果是否为协程并等待它
-            if asyncio.iscoroutine(message_result):
-                await message_result
-                
-            return True
-        except Exception as e:
-            logging.error(f"删除会话失败: {str(e)}")
-            return False
+        message_counts.invalidate(session_id)
+        return cascade_deletes.submit('session', session_id, session_delete_steps(session_id), user_id=user_id)
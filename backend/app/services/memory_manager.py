@@ -114,19 +114,20 @@ class MemoryManager:
             # 解析LLM响应
             memories = self._parse_memory_extraction_response(llm_response)
             
-            # 保存提取的记忆
-            for memory in memories:
-                saved_memory = await MemoryService.save_user_memory(
-                    user_id=user_id,
-                    content=memory["content"],
-                    memory_type=memory["type"],
-                    importance=memory["importance"],
-                    source_session_id=session_id,
-                    metadata={"extracted": True, "confidence": memory.get("confidence", 0.8)}
-                )
-                
-                if saved_memory:
-                    extracted_memories.append(saved_memory)
+            # 一次批量写入保存所有提取的记忆
+            extracted_memories = await MemoryService.save_user_memories(
+                user_id=user_id,
+                memories=[
+                    {
+                        "content": memory["content"],
+                        "memory_type": memory["type"],
+                        "importance": memory["importance"],
+                        "metadata": {"extracted": True, "confidence": memory.get("confidence", 0.8)}
+                    }
+                    for memory in memories
+                ],
+                source_session_id=session_id
+            )
                     
             return extracted_memories
         except Exception as e:
@@ -425,3 +426,39 @@ class MemoryManager:
         except Exception as e:
             logging.error(f"检索相关记忆失败: {str(e)}")
             return []
+    
+    async def retrieve_memories_with_summary(
+        self,
+        user_id: str,
+        query: str,
+        session_id: str,
+        limit: int = 5
+    ) -> Tuple[List[Dict[str, Any]], Optional[Dict[str, Any]]]:
+        """
+        在一次数据库请求中检索相关记忆和当前会话摘要
+        
+        Args:
+            user_id: 用户ID
+            query: 查询内容
+            session_id: 会话ID
+            limit: 限制返回的记忆数量
+            
+        Returns:
+            (相关记忆列表, 会话摘要)
+        """
+        from ..models.memory_models import MemoryQuery
+        
+        # 上下文增强只用到记忆内容和类型
+        memory_query = MemoryQuery(
+            user_id=user_id,
+            query=query,
+            limit=limit,
+            sort_by="relevance",
+            fields=['content', 'memory_type', 'importance', 'access_count']
+        )
+        
+        return await MemoryService.search_memories_with_summary(
+            memory_query,
+            session_id,
+            summary_fields=['summary']
+        )
@@ -2,18 +2,28 @@
 记忆服务 - 处理分层记忆系统的创建、存储和检索
 """
 
+import asyncio
 import logging
 import uuid
 from datetime import datetime
-from typing import Dict, Any, List, Optional, Union
+from typing import Dict, Any, List, Optional, Tuple, Union
 
-from app.db import query, create, update, delete
+from app.db import repo, counter_buffer
+from app.tasks.cascade_delete import CascadeDeleteJob, cascade_deletes, session_memories_delete_steps
 from app.models.memory_models import (
     MemoryType, MemoryImportance, ChatHistoryMemory,
     UserMemory, SessionSummary, MemoryQuery
 )
 
 
+# 记忆列表默认返回的字段：不包含聊天历史记忆中可能很大的 messages 数组
+MEMORY_LIST_FIELDS = [
+    'user_id', 'session_id', 'content', 'summary', 'memory_type', 'importance',
+    'source_session_id', 'topics', 'key_points', 'created_at', 'updated_at',
+    'last_accessed', 'access_count', 'metadata'
+]
+
+
 class MemoryService:
     """记忆服务类 - 管理三层记忆系统"""
     
@@ -53,7 +63,7 @@ class MemoryService:
             }
             
             # 查询是否已存在该会话的聊天历史
-            existing_history = await query('memory', {
+            existing_history = await repo.query('memory', {
                 'session_id': session_id,
                 'memory_type': MemoryType.CHAT_HISTORY
             })
@@ -63,10 +73,10 @@ class MemoryService:
                 memory_id = existing_history[0]['id']
                 memory_data['id'] = memory_id
                 memory_data['created_at'] = existing_history[0]['created_at']
-                result = await update('memory', {'id': memory_id}, memory_data)
+                result = await repo.update('memory', {'id': memory_id}, memory_data)
             else:
                 # 创建新记录
-                result = await create('memory', memory_data)
+                result = await repo.create('memory', memory_data)
                 
             return result or memory_data
         except Exception as e:
@@ -97,28 +107,17 @@ class MemoryService:
         Returns:
             保存的用户记忆
         """
+        memory_data = _build_user_memory(
+            user_id=user_id,
+            content=content,
+            memory_type=memory_type,
+            importance=importance,
+            source_session_id=source_session_id,
+            metadata=metadata
+        )
         try:
-            # 准备记忆数据
-            memory_id = str(uuid.uuid4())
-            current_time = datetime.now().isoformat()
-            
-            memory_data = {
-                "id": memory_id,
-                "user_id": user_id,
-                "content": content,
-                "memory_type": memory_type,
-                "importance": importance,
-                "source_session_id": source_session_id,
-                "created_at": current_time,
-                "updated_at": current_time,
-                "last_accessed": current_time,
-                "access_count": 1,
-                "metadata": metadata or {},
-                "memory_type": MemoryType.USER_MEMORY
-            }
-            
             # 创建新记录
-            result = await create('memory', memory_data)
+            result = await repo.create('memory', memory_data)
                 
             return result or memory_data
         except Exception as e:
@@ -126,6 +125,50 @@ class MemoryService:
             # 返回原始数据而不是抛出异常，确保流程继续
             return memory_data
     
+    @staticmethod
+    async def save_user_memories(
+        user_id: str,
+        memories: List[Dict[str, Any]],
+        source_session_id: Optional[str] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        批量保存用户记忆（第二层），所有记忆通过一次批量写入保存
+        
+        Args:
+            user_id: 用户ID
+            memories: 记忆列表，每项包含 content、memory_type、importance、metadata
+            source_session_id: 来源会话ID
+            
+        Returns:
+            保存成功的用户记忆列表
+        """
+        rows = [
+            _build_user_memory(
+                user_id=user_id,
+                content=memory["content"],
+                memory_type=memory["memory_type"],
+                importance=memory.get("importance", MemoryImportance.MEDIUM),
+                source_session_id=source_session_id,
+                metadata=memory.get("metadata")
+            )
+            for memory in memories
+        ]
+        if not rows:
+            return []
+        
+        try:
+            results = await repo.create_many('memory', rows)
+            saved = []
+            for row, result in zip(rows, results):
+                if result["success"]:
+                    saved.append(result["record"] or row)
+                else:
+                    logging.error(f"保存用户记忆失败: {result['error']}")
+            return saved
+        except Exception as e:
+            logging.error(f"批量保存用户记忆失败: {str(e)}")
+            return []
+    
     @staticmethod
     async def save_session_summary(
         session_id: str,
@@ -173,7 +216,7 @@ class MemoryService:
             }
             
             # 查询是否已存在该会话的摘要
-            existing_summary = await query('memory', {
+            existing_summary = await repo.query('memory', {
                 'session_id': session_id,
                 'memory_type': MemoryType.SESSION_SUMMARY
             })
@@ -183,10 +226,10 @@ class MemoryService:
                 memory_id = existing_summary[0]['id']
                 memory_data['id'] = memory_id
                 memory_data['created_at'] = existing_summary[0]['created_at']
-                result = await update('memory', {'id': memory_id}, memory_data)
+                result = await repo.update('memory', {'id': memory_id}, memory_data)
             else:
                 # 创建新记录
-                result = await create('memory', memory_data)
+                result = await repo.create('memory', memory_data)
                 
             return result or memory_data
         except Exception as e:
@@ -198,7 +241,8 @@ class MemoryService:
     async def get_chat_history(
         session_id: str,
         limit: int = 100,
-        offset: int = 0
+        offset: int = 0,
+        fields: Optional[List[str]] = None
     ) -> Optional[Dict[str, Any]]:
         """
         获取聊天历史记忆
@@ -207,26 +251,24 @@ class MemoryService:
             session_id: 会话ID
             limit: 限制返回的消息数量
             offset: 消息偏移量
+            fields: 只返回的字段，不需要消息内容时可以省略 messages
             
         Returns:
             聊天历史记忆
         """
         try:
             # 查询聊天历史
-            results = await query('memory', {
+            results = await repo.query('memory', {
                 'session_id': session_id,
                 'memory_type': MemoryType.CHAT_HISTORY
-            })
+            }, limit=1, fields=fields)
             
             if not results:
                 return None
                 
-            # 更新访问时间和计数
+            # 更新访问时间和计数，由计数缓冲合并后写入，不回写整个 messages 数组
             memory = results[0]
-            memory['last_accessed'] = datetime.now().isoformat()
-            memory['access_count'] = memory.get('access_count', 0) + 1
-            
-            await update('memory', {'id': memory['id']}, memory)
+            _record_memory_access(memory)
             
             return memory
         except Exception as e:
@@ -276,7 +318,7 @@ class MemoryService:
                 sort_order = -1
                 
             # 查询用户记忆
-            results = await query(
+            results = await repo.query(
                 'memory',
                 query_params,
                 sort=[(sort_field, sort_order)],
@@ -286,9 +328,7 @@ class MemoryService:
             
             # 更新访问时间和计数
             for memory in results:
-                memory['last_accessed'] = datetime.now().isoformat()
-                memory['access_count'] = memory.get('access_count', 0) + 1
-                await update('memory', {'id': memory['id']}, memory)
+                _record_memory_access(memory)
             
             return results or []
         except Exception as e:
@@ -296,22 +336,26 @@ class MemoryService:
             return []
     
     @staticmethod
-    async def get_session_summary(session_id: str) -> Optional[Dict[str, Any]]:
+    async def get_session_summary(
+        session_id: str,
+        fields: Optional[List[str]] = None
+    ) -> Optional[Dict[str, Any]]:
         """
         获取会话摘要
         
         Args:
             session_id: 会话ID
+            fields: 只返回的字段，为空时返回全部字段
             
         Returns:
             会话摘要
         """
         try:
             # 查询会话摘要
-            results = await query('memory', {
+            results = await repo.query('memory', {
                 'session_id': session_id,
                 'memory_type': MemoryType.SESSION_SUMMARY
-            })
+            }, limit=1, fields=fields)
             
             if not results:
                 return None
@@ -333,25 +377,7 @@ class MemoryService:
             匹配的记忆列表
         """
         try:
-            # 构建基本查询条件
-            db_query = {'user_id': query_params.user_id}
-            
-            # 添加记忆类型过滤
-            if query_params.memory_type:
-                db_query['memory_type'] = query_params.memory_type
-                
-            # 添加元数据过滤
-            if query_params.metadata_filter:
-                for key, value in query_params.metadata_filter.items():
-                    db_query[f'metadata.{key}'] = value
-                    
-            # 确定排序方式
-            sort_field = 'updated_at'
-            sort_order = 'DESC'  # 降序
-            
-            if query_params.sort_by == "importance":
-                sort_field = 'importance'
-                sort_order = 'DESC'
+            db_query, sort = _build_memory_search(query_params)
             
             # 添加超时处理，防止数据库查询挂起
             import asyncio
@@ -360,12 +386,13 @@ class MemoryService:
             try:
                 # 执行查询，添加5秒超时
                 results = await asyncio.wait_for(
-                    query(
+                    repo.query(
                         'memory',
                         db_query,
-                        sort=[(sort_field, sort_order)],
+                        sort=sort,
                         limit=query_params.limit,
-                        offset=query_params.offset
+                        offset=query_params.offset,
+                        fields=query_params.fields or MEMORY_LIST_FIELDS
                     ),
                     timeout=5.0  # 5秒超时
                 )
@@ -376,41 +403,94 @@ class MemoryService:
                 logging.error(f"数据库查询错误: {str(db_error)}")
                 return []  # 查询错误时返回空结果
             
-            # 如果是相关性排序，需要进一步处理
-            if query_params.sort_by == "relevance" and query_params.query:
-                # 这里应该调用向量搜索或其他相关性搜索方法
-                # 简单实现：根据内容匹配度排序
-                try:
-                    results = sorted(
-                        results,
-                        key=lambda x: _calculate_relevance(x, query_params.query),
-                        reverse=True
-                    )
-                except Exception as sort_error:
-                    logging.error(f"相关性排序错误: {str(sort_error)}")
-                    # 排序错误时，返回未排序的结果
-            
-            # 更新访问时间和计数 - 使用异步任务处理，不阻塞主流程
-            async def update_memory_access(memory):
-                try:
-                    memory['last_accessed'] = datetime.now().isoformat()
-                    memory['access_count'] = memory.get('access_count', 0) + 1
-                    await asyncio.wait_for(
-                        update('memory', {'id': memory['id']}, memory),
-                        timeout=2.0  # 2秒超时
-                    )
-                except Exception as update_error:
-                    logging.error(f"更新记忆访问信息失败: {str(update_error)}")
-            
-            # 创建更新任务但不等待它们完成
-            for memory in results:
-                asyncio.create_task(update_memory_access(memory))
-            
-            return results or []
+            return _finish_memory_search(results, query_params)
         except Exception as e:
             logging.error(f"搜索记忆失败: {str(e)}")
             return []
     
+    @staticmethod
+    async def search_memories_page(
+        query_params: MemoryQuery,
+        cursor: Optional[str] = None
+    ) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """
+        按 (排序字段, id) 游标分页搜索记忆，忽略 query_params.offset
+        
+        按重要性排序时游标基于 importance，否则基于 updated_at；
+        相关性排序只在当前页内进行。
+        
+        Args:
+            query_params: 查询参数
+            cursor: 上一页返回的 next_cursor，为空时取第一页
+            
+        Returns:
+            (匹配的记忆列表, 下一页游标)
+            
+        Raises:
+            ValueError: 游标格式不正确
+        """
+        db_query, sort = _build_memory_search(query_params)
+        
+        try:
+            page = await asyncio.wait_for(
+                repo.query_page(
+                    'memory',
+                    db_query,
+                    order_field=sort[0][0],
+                    limit=query_params.limit,
+                    cursor=cursor,
+                    descending=True,
+                    fields=query_params.fields or MEMORY_LIST_FIELDS
+                ),
+                timeout=5.0  # 5秒超时
+            )
+        except ValueError:
+            raise
+        except asyncio.TimeoutError:
+            logging.error("数据库查询超时，返回空结果")
+            return [], None
+        except Exception as db_error:
+            logging.error(f"数据库查询错误: {str(db_error)}")
+            return [], None
+        
+        return _finish_memory_search(page["items"], query_params), page["next_cursor"]
+    
+    @staticmethod
+    async def search_memories_with_summary(
+        query_params: MemoryQuery,
+        session_id: str,
+        summary_fields: Optional[List[str]] = None
+    ) -> Tuple[List[Dict[str, Any]], Optional[Dict[str, Any]]]:
+        """
+        在一次数据库请求中搜索记忆并获取会话摘要
+        
+        Args:
+            query_params: 查询参数
+            session_id: 会话ID
+            summary_fields: 会话摘要只返回的字段，为空时返回全部字段
+            
+        Returns:
+            (匹配的记忆列表, 会话摘要)
+        """
+        db_query, sort = _build_memory_search(query_params)
+        
+        batch = repo.batch()
+        batch.query(
+            'memory',
+            db_query,
+            sort=sort,
+            limit=query_params.limit,
+            offset=query_params.offset,
+            fields=query_params.fields or MEMORY_LIST_FIELDS
+        )
+        batch.first('memory', {
+            'session_id': session_id,
+            'memory_type': MemoryType.SESSION_SUMMARY
+        }, fields=summary_fields)
+        results, summary = await batch.execute()
+        
+        return _finish_memory_search(results, query_params), summary
+    
     @staticmethod
     async def delete_memory(memory_id: str) -> bool:
         """
@@ -424,33 +504,121 @@ class MemoryService:
         """
         try:
             # 删除记忆
-            result = await delete('memory', {'id': memory_id})
+            result = await repo.delete('memory', {'id': memory_id})
             return True
         except Exception as e:
             logging.error(f"删除记忆失败: {str(e)}")
             return False
     
     @staticmethod
-    async def delete_session_memories(session_id: str) -> bool:
+    def delete_session_memories(session_id: str, user_id: Optional[str] = None) -> CascadeDeleteJob:
         """
-        删除会话相关的所有记忆
+        提交删除会话相关所有记忆的后台任务
         
         Args:
             session_id: 会话ID
+            user_id: 发起删除的用户ID
             
         Returns:
-            是否删除成功
+            级联删除任务
         """
-        try:
-            # 删除会话相关的所有记忆
-            await delete('memory', {'session_id': session_id})
-            return True
-        except Exception as e:
-            logging.error(f"删除会话记忆失败: {str(e)}")
-            return False
+        return cascade_deletes.submit('session_memories', session_id, session_memories_delete_steps(session_id), user_id=user_id)
 
 
 # 辅助函数
+def _build_memory_search(query_params: MemoryQuery) -> Tuple[Dict[str, Any], List[Tuple[str, str]]]:
+    """根据查询参数构建记忆搜索的查询条件和排序"""
+    # 构建基本查询条件
+    db_query = {'user_id': query_params.user_id}
+    
+    # 添加记忆类型过滤
+    if query_params.memory_type:
+        db_query['memory_type'] = query_params.memory_type
+        
+    # 添加元数据过滤
+    if query_params.metadata_filter:
+        for key, value in query_params.metadata_filter.items():
+            db_query[f'metadata.{key}'] = value
+            
+    # 确定排序方式
+    sort_field = 'updated_at'
+    sort_order = 'DESC'  # 降序
+    
+    if query_params.sort_by == "importance":
+        sort_field = 'importance'
+        sort_order = 'DESC'
+    
+    return db_query, [(sort_field, sort_order)]
+
+def _finish_memory_search(results: List[Dict[str, Any]], query_params: MemoryQuery) -> List[Dict[str, Any]]:
+    """对记忆搜索结果做相关性排序，并在后台更新访问信息"""
+    results = results or []
+    
+    # 如果是相关性排序，需要进一步处理
+    if query_params.sort_by == "relevance" and query_params.query:
+        # 这里应该调用向量搜索或其他相关性搜索方法
+        # 简单实现：根据内容匹配度排序
+        try:
+            results = sorted(
+                results,
+                key=lambda x: _calculate_relevance(x, query_params.query),
+                reverse=True
+            )
+        except Exception as sort_error:
+            logging.error(f"相关性排序错误: {str(sort_error)}")
+            # 排序错误时，返回未排序的结果
+    
+    # 更新访问时间和计数，由计数缓冲合并后写入，不阻塞主流程
+    for memory in results:
+        _record_memory_access(memory)
+    
+    return results
+
+def _record_memory_access(memory: Dict[str, Any]):
+    """记录一次记忆访问：更新返回给调用方的记录，并把计数增量交给计数缓冲"""
+    memory['last_accessed'] = datetime.now().isoformat()
+    memory['access_count'] = memory.get('access_count', 0) + 1
+    counter_buffer.add('memory', memory['id'], 'access_count', fields={'last_accessed': memory['last_accessed']})
+
+
+def _build_user_memory(
+    user_id: str,
+    content: str,
+    memory_type: str,
+    importance: MemoryImportance = MemoryImportance.MEDIUM,
+    source_session_id: Optional[str] = None,
+    metadata: Optional[Dict[str, Any]] = None
+) -> Dict[str, Any]:
+    """
+    构建用户记忆记录
+    
+    Args:
+        user_id: 用户ID
+        content: 记忆内容
+        memory_type: 记忆类型（如：偏好、事实、关系等）
+        importance: 重要性
+        source_session_id: 来源会话ID
+        metadata: 元数据
+        
+    Returns:
+        用户记忆记录
+    """
+    current_time = datetime.now().isoformat()
+    
+    return {
+        "id": str(uuid.uuid4()),
+        "user_id": user_id,
+        "content": content,
+        "memory_type": memory_type,
+        "importance": importance,
+        "source_session_id": source_session_id,
+        "created_at": current_time,
+        "updated_at": current_time,
+        "last_accessed": current_time,
+        "access_count": 1,
+        "metadata": metadata or {},
+        "memory_type": MemoryType.USER_MEMORY
+    }
 
 def _calculate_relevance(memory: Dict[str, Any], query: str) -> float:
     """
@@ -0,0 +1,239 @@
+"""
+级联删除任务 - 在后台分批删除会话、聊天和记忆及其关联数据
+
+API 提交任务后立即返回任务ID（202），后台 worker 按步骤分批删除关联记录，
+并记录每一步的删除进度，可以通过 /api/jobs/{job_id} 查询。
+
+任务只保存在进程内存中：服务重启后未完成的任务和任务记录都会丢失，已删除的部分不会
+恢复，剩余的关联数据需要重新提交删除（删除步骤是幂等的，重复提交是安全的）。
+数据库不可用（mock 模式）时删除不会执行，任务状态为 skipped。
+数据库连接中断、删除写入本地写日志时，任务状态为 journaled：删除会在数据库恢复、
+写日志重放后生效，此时还不能确认已经删除，各步骤的删除数量也没有统计。
+"""
+
+import asyncio
+import collections
+import logging
+import os
+import uuid
+from dataclasses import dataclass, field, asdict
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from app.db import repo
+
+# 每次 DELETE 最多删除的记录数
+CASCADE_DELETE_BATCH_SIZE = int(os.getenv('CASCADE_DELETE_BATCH_SIZE', '500'))
+# 并发执行的删除任务数
+CASCADE_DELETE_WORKERS = int(os.getenv('CASCADE_DELETE_WORKERS', '2'))
+# 内存中保留的已结束任务数量
+CASCADE_DELETE_JOB_HISTORY = int(os.getenv('CASCADE_DELETE_JOB_HISTORY', '1000'))
+
+# 已结束的任务状态
+FINISHED_STATUSES = ("completed", "failed", "skipped", "journaled")
+
+
+@dataclass
+class DeleteStep:
+    """一个删除步骤：分批删除某张表中符合条件的所有记录
+
+    指定 record_id 时只删除这一条记录（用于最后删除父记录），condition 不使用。
+    """
+    table: str
+    condition: Dict[str, Any]
+    deleted: int = 0
+    done: bool = False
+    journaled: bool = False
+    record_id: Optional[str] = None
+
+
+@dataclass
+class CascadeDeleteJob:
+    """级联删除任务"""
+    id: str
+    kind: str  # session / chat / session_memories
+    target_id: str
+    user_id: Optional[str]
+    steps: List[DeleteStep]
+    status: str = "pending"  # pending / running / completed / failed / skipped / journaled
+    error: Optional[str] = None
+    created_at: str = field(default_factory=lambda: datetime.now().isoformat())
+    started_at: Optional[str] = None
+    finished_at: Optional[str] = None
+
+    @property
+    def deleted(self) -> int:
+        return sum(step.deleted for step in self.steps)
+
+    def to_dict(self) -> Dict[str, Any]:
+        data = asdict(self)
+        data["deleted"] = self.deleted
+        data["progress"] = {
+            "completed_steps": sum(1 for step in self.steps if step.done),
+            "total_steps": len(self.steps)
+        }
+        return data
+
+
+class CascadeDeleteQueue:
+    """级联删除任务队列和后台 worker"""
+
+    def __init__(self, batch_size: int = CASCADE_DELETE_BATCH_SIZE, workers: int = CASCADE_DELETE_WORKERS,
+                 history: int = CASCADE_DELETE_JOB_HISTORY):
+        self.batch_size = batch_size
+        self.workers = workers
+        self.history = history
+        self._jobs = collections.OrderedDict()
+        self._queue = None
+        self._tasks = []
+
+    def start(self):
+        """启动后台 worker，在应用启动时调用"""
+        if self._tasks:
+            return
+        self._queue = asyncio.Queue()
+        # 同一进程内 stop() 后再次 start() 时，未执行完的任务重新入队；任务不持久化，进程重启后不会恢复
+        for job in self._jobs.values():
+            if job.status in ("pending", "running"):
+                job.status = "pending"
+                self._queue.put_nowait(job)
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+        logging.info(f"级联删除 worker 已启动: {self.workers} 个")
+
+    async def stop(self):
+        """停止后台 worker，在应用关闭时调用；执行中的任务保持 running 状态"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        logging.info("级联删除 worker 已停止")
+
+    def submit(self, kind: str, target_id: str, steps: List[DeleteStep], user_id: Optional[str] = None) -> CascadeDeleteJob:
+        """提交一个级联删除任务并立即返回"""
+        job = CascadeDeleteJob(
+            id=str(uuid.uuid4()),
+            kind=kind,
+            target_id=target_id,
+            user_id=user_id,
+            steps=steps
+        )
+        self._jobs[job.id] = job
+        self._trim_history()
+        if self._queue is None:
+            # worker 尚未启动（例如脚本中使用），启动后会执行待处理的任务
+            logging.warning(f"级联删除 worker 未启动，任务等待执行: {job.id}")
+        else:
+            self._queue.put_nowait(job)
+        logging.info(f"已提交级联删除任务: id={job.id}, kind={kind}, target={target_id}")
+        return job
+
+    def get(self, job_id: str) -> Optional[CascadeDeleteJob]:
+        return self._jobs.get(job_id)
+
+    def _trim_history(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.status in FINISHED_STATUSES]
+        for job_id in finished[:max(0, len(self._jobs) - self.history)]:
+            del self._jobs[job_id]
+
+    async def _worker(self, index: int):
+        while True:
+            job = await self._queue.get()
+            try:
+                await self.run(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"级联删除 worker {index} 执行任务出错: {str(e)}")
+            finally:
+                self._queue.task_done()
+
+    async def run(self, job: CascadeDeleteJob):
+        """按步骤分批执行删除，已完成的步骤不会重复执行"""
+        job.status = "running"
+        job.started_at = job.started_at or datetime.now().isoformat()
+        try:
+            for step in job.steps:
+                if step.done:
+                    continue
+                if step.record_id is not None:
+                    await self._delete_record(job, step)
+                elif not await self._delete_all(job, step):
+                    return
+                step.done = True
+                logging.info(f"级联删除任务 {job.id}: {step.table} 已删除 {step.deleted} 条")
+            if any(step.journaled for step in job.steps):
+                job.status = "journaled"
+                logging.warning(f"级联删除任务 {job.id} 的删除已写入写日志，等待数据库恢复后生效")
+            else:
+                job.status = "completed"
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            job.status = "failed"
+            job.error = str(e)
+            logging.error(f"级联删除任务失败: id={job.id}, error={str(e)}")
+        finally:
+            if job.status in FINISHED_STATUSES:
+                job.finished_at = datetime.now().isoformat()
+
+
+    async def _delete_all(self, job: CascadeDeleteJob, step: DeleteStep) -> bool:
+        """分批删除步骤中的所有记录，数据库不可用、删除没有执行时返回 False"""
+        while True:
+            deleted = await repo.delete_chunk(step.table, step.condition, self.batch_size)
+            if deleted is None:
+                # 数据库不可用（mock 模式），删除没有执行，不能报告为已完成
+                job.status = "skipped"
+                job.error = "数据库不可用，删除未执行"
+                logging.warning(f"级联删除任务未执行: id={job.id}, {step.table} 删除时数据库不可用")
+                return False
+            if repo.pending_writes():
+                # 删除写入了写日志，重放时整体删除，没有剩余的分批
+                step.journaled = True
+                return True
+            step.deleted += deleted
+            if deleted < self.batch_size:
+                return True
+            # 让出事件循环，避免长时间占用
+            await asyncio.sleep(0)
+
+    async def _delete_record(self, job: CascadeDeleteJob, step: DeleteStep):
+        """删除步骤指定的单条记录"""
+        deleted = await repo.delete_record(step.table, step.record_id)
+        if repo.pending_writes():
+            step.journaled = True
+        elif deleted:
+            step.deleted += 1
+
+
+# 全局级联删除任务队列
+cascade_deletes = CascadeDeleteQueue()
+
+
+# 各类删除任务的步骤定义
+def session_delete_steps(session_id: str) -> List[DeleteStep]:
+    """会话：会话记录、两张消息表中的消息以及会话相关的记忆"""
+    return [
+        DeleteStep('chat_sessions', {'session_id': session_id}),
+        DeleteStep('chat_messages', {'session_id': session_id}),
+        DeleteStep('message', {'chat_id': session_id}),
+        DeleteStep('memory', {'session_id': session_id}),
+    ]
+
+def chat_delete_steps(chat_id: str) -> List[DeleteStep]:
+    """聊天：聊天的消息和记忆，最后删除聊天记录本身
+
+    聊天记录最后删除，中途失败时聊天仍然存在，可以重新提交删除。
+    """
+    return [
+        DeleteStep('message', {'chat_id': chat_id}),
+        DeleteStep('chat_messages', {'session_id': chat_id}),
+        DeleteStep('memory', {'session_id': chat_id}),
+        DeleteStep('chat', {'id': chat_id}, record_id=chat_id),
+    ]
+
+def session_memories_delete_steps(session_id: str) -> List[DeleteStep]:
+    """会话记忆：会话相关的所有记忆"""
+    return [
+        DeleteStep('memory', {'session_id': session_id}),
+    ]
@@ -1,47 +1,79 @@
 from datetime import datetime
-from app.db import db_session
-from app.models.user import User
-from app.models.enums import VIPLevel, UserRole, PromoterStatus
+from app.db import repo, sync_repo, db_session
+from app.models.enums import VIPLevel, UserRole
 import logging
 
 # 设置日志
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# VIP过期后恢复的免费用户限制，与 User.update_limits_based_on_vip 保持一致
+FREE_USER_LIMITS = {
+    'daily_chat_limit': 10,
+    'daily_lio_limit': 0,
+    'ai_companions_limit': 1,
+    'ai_awakener_limit': 0,
+    'weekly_invite_limit': 10
+}
+
+# 推广权限暂停状态（models.enums 中没有对应的枚举）
+PROMOTER_STATUS_SUSPENDED = 'suspended'
+
+# 检查VIP过期只需要的用户字段
+VIP_SWEEP_FIELDS = ['username', 'email', 'vip_level', 'vip_expiry', 'roles', 'promoter_status']
+
+def _is_free(vip_level) -> bool:
+    return not vip_level or str(vip_level).lower() == VIPLevel.free.name
+
+def _is_expired(vip_expiry, now: datetime) -> bool:
+    if not vip_expiry:
+        return False
+    try:
+        expiry = vip_expiry if isinstance(vip_expiry, datetime) else datetime.fromisoformat(str(vip_expiry).replace('Z', '+00:00'))
+    except ValueError:
+        logger.warning(f"无法解析VIP到期时间: {vip_expiry}")
+        return False
+    return now > expiry.replace(tzinfo=None)
+
+async def sweep_vip_expiry() -> int:
+    """分块遍历所有用户，处理VIP过期的用户
+
+    通过 repo.query_iter 每次只读取一块用户，用户数量增长时内存占用不变。
+
+    Returns:
+        处理的过期VIP用户数量
+    """
+    now = datetime.utcnow()
+    expired_count = 0
+    async for user in repo.query_iter('users', fields=VIP_SWEEP_FIELDS):
+        if _is_free(user.get('vip_level')) or not _is_expired(user.get('vip_expiry'), now):
+            continue
+
+        # 降级为免费用户并更新用户限制
+        changes = dict(FREE_USER_LIMITS, vip_level=VIPLevel.free.name)
+
+        # 如果是推广用户，暂停推广权限
+        if UserRole.promoter.value in (user.get('roles') or []) and user.get('promoter_status') != PROMOTER_STATUS_SUSPENDED:
+            changes['promoter_status'] = PROMOTER_STATUS_SUSPENDED
+            logger.info(f"用户 {user.get('id')} ({user.get('username') or user.get('email')}) 的推广权限已暂停")
+
+        await repo.merge('users', user['id'], changes)
+        expired_count += 1
+        logger.info(f"用户 {user.get('id')} ({user.get('username') or user.get('email')}) 的VIP已过期，从 {user.get('vip_level')} 降级为 {VIPLevel.free.name}")
+
+    return expired_count
+
 def check_vip_expiry():
     """检查所有用户的VIP过期状态并处理"""
     logger.info("开始检查VIP过期状态...")
-    
-    # 查询所有VIP用户
-    vip_users = User.query.filter(User.vip_level != VIPLevel.free).all()
-    
-    expired_count = 0
-    for user in vip_users:
-        if user.vip_expiry and datetime.utcnow() > user.vip_expiry:
-            # 处理VIP过期
-            old_level = user.vip_level
-            
-            # 降级为免费用户
-            user.vip_level = VIPLevel.free
-            
-            # 更新用户限制
-            user.update_limits_based_on_vip()
-            
-            # 如果是推广用户，暂停推广权限
-            if user.has_role(UserRole.promoter) and user.promoter_status != PromoterStatus.suspended:
-                user.promoter_status = PromoterStatus.suspended
-                logger.info(f"用户 {user.id} ({user.username or user.email}) 的推广权限已暂停")
-            
-            expired_count += 1
-            logger.info(f"用户 {user.id} ({user.username or user.email}) 的VIP已过期，从 {old_level.value} 降级为 {user.vip_level.value}")
-    
+
+    expired_count = sync_repo.run(sweep_vip_expiry())
+
     if expired_count > 0:
-        # 提交数据库更改
-        db_session.commit()
         logger.info(f"共处理 {expired_count} 个过期VIP用户")
     else:
         logger.info("没有发现过期VIP用户")
-    
+
     return expired_count
 
 def run_scheduled_tasks():
@@ -49,9 +81,9 @@ def run_scheduled_tasks():
     try:
         # 检查VIP过期
         check_vip_expiry()
-        
+
         # 可以添加其他定时任务
-        
+
         logger.info("所有计划任务已完成")
     except Exception as e:
         logger.error(f"计划任务执行出错: {str(e)}")
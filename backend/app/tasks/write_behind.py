@@ -0,0 +1,286 @@
+"""
+延迟写入队列 - 在后台批量写入不需要立即落库的数据（AI回复、会话元数据）
+
+调用方提交写操作后立即返回，后台任务定期把排队的写操作合并为一个事务写入：
+
+    await write_behind.submit(session_id, [
+        ("create", "chat_messages", message_data),
+        ("merge", "chat_sessions", session_id, {"last_message": ...}),
+    ])
+
+- 顺序：同一个 key（会话ID）的写操作按提交顺序写入，前一个失败重试时后面的等待
+- 有界：排队的写操作达到 max_pending 时 submit 等待队列腾出空间
+- 批量：每次最多合并 batch_size 个写操作为一个事务；事务失败时逐个重试，
+  只有失败的 key 被阻塞，重试 max_retries 次后丢弃并记录错误日志
+- 关闭：stop() 等待进行中的写入完成，再在 drain_timeout 秒内写完剩余的写操作
+"""
+
+import asyncio
+import collections
+import contextlib
+import logging
+import os
+import time
+from typing import Any, Callable, List, Optional, Tuple
+
+from app.db import repo
+
+# 排队的写操作上限，达到后 submit 等待
+WRITE_BEHIND_MAX_PENDING = int(os.getenv('WRITE_BEHIND_MAX_PENDING', '1000'))
+# 后台写入间隔（秒）
+WRITE_BEHIND_FLUSH_INTERVAL = float(os.getenv('WRITE_BEHIND_FLUSH_INTERVAL', '0.2'))
+# 每个事务最多合并的写操作数，排队数达到该值时立即写入
+WRITE_BEHIND_BATCH_SIZE = int(os.getenv('WRITE_BEHIND_BATCH_SIZE', '100'))
+# 单个写操作最多重试次数
+WRITE_BEHIND_MAX_RETRIES = int(os.getenv('WRITE_BEHIND_MAX_RETRIES', '5'))
+# 第一次重试的等待时间（秒），之后每次翻倍
+WRITE_BEHIND_RETRY_DELAY = float(os.getenv('WRITE_BEHIND_RETRY_DELAY', '1'))
+# 应用关闭时等待剩余写操作写入的最长时间（秒）
+WRITE_BEHIND_DRAIN_TIMEOUT = float(os.getenv('WRITE_BEHIND_DRAIN_TIMEOUT', '10'))
+
+_OPERATIONS = ("create", "update", "merge", "increment")
+
+
+class WriteBehindEntry:
+    """一次提交的写操作，ops 中的操作在同一个事务中写入"""
+
+    __slots__ = ("key", "ops", "on_written", "attempts", "not_before", "submitted_at")
+
+    def __init__(self, key: str, ops: List[Tuple], on_written: Optional[Callable[[], Any]] = None):
+        self.key = key
+        self.ops = ops
+        self.on_written = on_written
+        self.attempts = 0
+        self.not_before = 0.0
+        self.submitted_at = time.monotonic()
+
+
+class WriteBehindQueue:
+    """按 key 保序的有界延迟写入队列"""
+
+    def __init__(self, repository, max_pending: int = WRITE_BEHIND_MAX_PENDING,
+                 flush_interval: float = WRITE_BEHIND_FLUSH_INTERVAL, batch_size: int = WRITE_BEHIND_BATCH_SIZE,
+                 max_retries: int = WRITE_BEHIND_MAX_RETRIES, retry_delay: float = WRITE_BEHIND_RETRY_DELAY,
+                 drain_timeout: float = WRITE_BEHIND_DRAIN_TIMEOUT):
+        self._repository = repository
+        self.max_pending = max_pending
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.drain_timeout = drain_timeout
+        # key -> deque[WriteBehindEntry]，按 key 第一次提交的顺序排列
+        self._queues = collections.OrderedDict()
+        self._pending = 0
+        self._space = None
+        self._lock = None
+        self._task = None
+        self._flushing = None
+        # 进行中的写入任务，见 flush
+        self._writing = set()
+        self._counters = collections.Counter()
+
+    async def submit(self, key: str, ops: List[Tuple], on_written: Optional[Callable[[], Any]] = None):
+        """提交一组写操作，写入前立即返回；队列已满时等待
+
+        Args:
+            key: 保序的范围，通常为会话ID
+            ops: 写操作列表，元素为 ("create", 表名, 数据)、("update" / "merge", 表名, 记录ID, 数据)
+                 或 ("increment", 表名, 记录ID, {字段: 增量})，与 QueryBatch 的方法对应
+            on_written: 写入成功后调用的回调
+        """
+        for op in ops:
+            if op[0] not in _OPERATIONS:
+                raise ValueError(f"不支持的延迟写操作: {op[0]}，可选 {', '.join(_OPERATIONS)}")
+        while self._pending >= self.max_pending:
+            self._counters["backpressure_waits"] += 1
+            self._schedule_flush()
+            if self._space is None:
+                self._space = asyncio.Event()
+            self._space.clear()
+            await self._space.wait()
+
+        self._queues.setdefault(key, collections.deque()).append(WriteBehindEntry(key, ops, on_written))
+        self._pending += 1
+        self._counters["submitted"] += 1
+        if self._pending >= self.batch_size or self._task is None:
+            self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self._flushing is not None and not self._flushing.done():
+            return
+        try:
+            self._flushing = asyncio.get_running_loop().create_task(self.flush())
+        except RuntimeError:
+            # 没有事件循环（同步脚本）时等待显式调用 flush
+            pass
+
+    def _take(self) -> List[WriteBehindEntry]:
+        """按 key 取出可以写入的写操作，同一个 key 的写操作在结果中保持提交顺序"""
+        now = time.monotonic()
+        entries = []
+        for key in list(self._queues):
+            queue = self._queues[key]
+            # 等待重试的写操作阻塞同一个 key 后面的写操作
+            while queue and queue[0].not_before <= now and len(entries) < self.batch_size:
+                entries.append(queue.popleft())
+            if not queue:
+                del self._queues[key]
+            if len(entries) >= self.batch_size:
+                break
+        return entries
+
+    def _restore(self, entries: List[WriteBehindEntry]):
+        # 放回各自 key 的队首，保持原来的顺序
+        for entry in reversed(entries):
+            self._queues.setdefault(entry.key, collections.deque()).appendleft(entry)
+
+    def _release(self, count: int):
+        self._pending -= count
+        if self._space is not None and self._pending < self.max_pending:
+            self._space.set()
+
+    async def flush(self) -> int:
+        """写入一批排队的写操作
+
+        写入在独立的任务中进行，调用方被取消（例如 stop() 取消后台任务）时，
+        已经取出的写操作仍会写完或放回队列，不会丢失。
+
+        Returns:
+            int: 本次写入成功的写操作数
+        """
+        task = asyncio.ensure_future(self._flush())
+        self._writing.add(task)
+        task.add_done_callback(self._writing.discard)
+        return await asyncio.shield(task)
+
+    async def _flush(self) -> int:
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            entries = self._take()
+            if not entries:
+                return 0
+            transaction = self._repository.transaction()
+            for entry in entries:
+                for op in entry.ops:
+                    getattr(transaction, op[0])(*op[1:])
+            try:
+                await transaction.execute()
+                written = entries
+            except Exception as e:
+                logging.warning(f"延迟写入事务失败，逐个重试 {len(entries)} 个写操作: {str(e)}")
+                self._counters["batch_failures"] += 1
+                written = await self._write_each(entries)
+            self._counters["flushes"] += 1
+            self._counters["written"] += len(written)
+            for entry in written:
+                self._counters["lag_ms_total"] += int((time.monotonic() - entry.submitted_at) * 1000)
+                if entry.on_written is not None:
+                    try:
+                        entry.on_written()
+                    except Exception as e:
+                        logging.error(f"延迟写入回调出错: {str(e)}")
+            self._release(len(written))
+            return len(written)
+
+    async def _write_each(self, entries: List[WriteBehindEntry]) -> List[WriteBehindEntry]:
+        """逐个写入，某个 key 的写操作失败后该 key 剩余的写操作放回队列"""
+        written = []
+        failed_keys = {}
+        for entry in entries:
+            if entry.key in failed_keys:
+                failed_keys[entry.key].append(entry)
+                continue
+            transaction = self._repository.transaction()
+            for op in entry.ops:
+                getattr(transaction, op[0])(*op[1:])
+            try:
+                await transaction.execute()
+                written.append(entry)
+                continue
+            except Exception as e:
+                error = e
+            entry.attempts += 1
+            if entry.attempts > self.max_retries:
+                logging.error(f"延迟写入重试 {self.max_retries} 次后仍然失败，已丢弃: key={entry.key}, error={str(error)}")
+                self._counters["dropped"] += 1
+                self._release(1)
+                continue
+            entry.not_before = time.monotonic() + self.retry_delay * 2 ** (entry.attempts - 1)
+            self._counters["retries"] += 1
+            failed_keys[entry.key] = [entry]
+        for blocked in failed_keys.values():
+            self._restore(blocked)
+        return written
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                # 积压较多时连续写入多批
+                while await self.flush() >= self.batch_size:
+                    pass
+            except Exception as e:
+                logging.error(f"延迟写入出错: {str(e)}")
+
+    def start(self):
+        """启动后台写入任务，在应用启动时调用"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        """停止后台写入任务并写完剩余的写操作，在应用关闭时调用"""
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError, Exception):
+                await self._task
+            self._task = None
+        # 等待进行中的写入，包括 submit 触发的写入
+        if self._writing:
+            for result in await asyncio.gather(*self._writing, return_exceptions=True):
+                if isinstance(result, Exception):
+                    logging.error(f"延迟写入出错: {str(result)}")
+        if self._flushing is not None:
+            with contextlib.suppress(asyncio.CancelledError, Exception):
+                await self._flushing
+            self._flushing = None
+        await self.drain(self.drain_timeout)
+
+    async def drain(self, timeout: float):
+        """在 timeout 秒内写完排队的写操作，超时后剩余的写操作记录错误日志后丢弃"""
+        deadline = time.monotonic() + timeout
+        while self._pending and time.monotonic() < deadline:
+            try:
+                if await self.flush():
+                    continue
+            except Exception as e:
+                logging.error(f"延迟写入出错: {str(e)}")
+            # 剩余的写操作都在等待重试
+            await asyncio.sleep(min(self.retry_delay, max(0.0, deadline - time.monotonic())))
+        if self._pending:
+            logging.error(f"延迟写入队列关闭时仍有 {self._pending} 个写操作未写入")
+
+    def stats(self) -> dict:
+        written = self._counters["written"]
+        return {
+            "pending": self._pending,
+            "keys": len(self._queues),
+            "submitted": self._counters["submitted"],
+            "written": written,
+            "flushes": self._counters["flushes"],
+            "batch_failures": self._counters["batch_failures"],
+            "retries": self._counters["retries"],
+            "dropped": self._counters["dropped"],
+            "backpressure_waits": self._counters["backpressure_waits"],
+            # 从提交到写入的平均延迟
+            "avg_lag_ms": round(self._counters["lag_ms_total"] / written, 1) if written else 0.0,
+        }
+
+
+# 全局延迟写入队列
+write_behind = WriteBehindQueue(repo)
+
+def write_behind_stats() -> dict:
+    """返回延迟写入队列的统计"""
+    return write_behind.stats()
@@ -8,6 +8,7 @@ from fastapi.security import OAuth2PasswordBearer
 from passlib.context import CryptContext
 from app.models.user import User
 from app.extensions import db
+from app.db import repo
 import asyncio
 
 # 设置日志记录
@@ -65,8 +66,7 @@ async def get_user(user_id: str) -> Optional[User]:
             uuid = user_id
         
         # 使用query函数代替db.fetch_one
-        from app.db import query
-        users = await query('users', {'id': uuid})
+        users = await repo.query('users', {'id': uuid})
         
         if users and len(users) > 0:
             # 获取第一个匹配的用户
@@ -109,12 +109,11 @@ async def authenticate_user(username: str, password: str) -> Optional[User]:
     验证用户名和密码
     """
     try:
-        # 使用query函数代替db.fetch_one
-        from app.db import query
-        
-        # 查询用户名或邮箱匹配的用户
-        users_by_username = await query('users', {'username': username})
-        users_by_email = await query('users', {'email': username})
+        # 一次请求查询用户名或邮箱匹配的用户
+        lookup = repo.batch()
+        lookup.query('users', {'username': username})
+        lookup.query('users', {'email': username})
+        users_by_username, users_by_email = await lookup.execute()
         
         # 合并结果
         users = users_by_username or users_by_email
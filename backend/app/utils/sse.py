@@ -0,0 +1,34 @@
+"""
+Server-Sent Events 工具函数
+"""
+
+import json
+from typing import Any, AsyncIterator, Dict, Optional
+
+from fastapi import Request
+from fastapi.responses import StreamingResponse
+
+# 禁止代理缓冲，保证事件立即送达客户端
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+
+def format_sse(data: Any, event: Optional[str] = None) -> str:
+    """把数据编码为一条 SSE 消息，data 按 JSON 序列化"""
+    message = f"event: {event}\n" if event else ""
+    return message + f"data: {json.dumps(data, default=str, ensure_ascii=False)}\n\n"
+
+
+def wants_event_stream(request: Request, stream: Optional[bool] = None) -> bool:
+    """请求体中 stream 为 true，或 Accept 请求头包含 text/event-stream 时使用流式响应"""
+    if stream is not None:
+        return stream
+    return "text/event-stream" in request.headers.get("accept", "")
+
+
+def sse_response(events: AsyncIterator[Dict[str, Any]], event_key: str = "type") -> StreamingResponse:
+    """把事件字典的异步迭代器包装为 SSE 响应，事件名取自 event_key 字段"""
+    async def stream():
+        async for event in events:
+            yield format_sse(event, event.get(event_key))
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers=SSE_HEADERS)
@@ -1,48 +1,33 @@
 """
 为聊天相关表添加必要的索引，提高查询性能
+
+索引定义已移到 app/db_migrations.py 的 INDEX_MIGRATIONS 中统一管理，并在服务启动时自动应用。
+此脚本保留为手动执行迁移的入口。
 """
 
 import logging
-from app.db import execute_raw_query
+from app.db_migrations import run_migrations
 
 async def run_migration():
-    """执行迁移脚本，添加必要的索引"""
+    """执行迁移脚本，应用所有未应用的索引迁移"""
     try:
-        logging.info("开始添加聊天表索引...")
-        
-        # 为chat_sessions表添加索引
-        await execute_raw_query("""
-        DEFINE INDEX IF NOT EXISTS idx_chat_sessions_id ON chat_sessions FIELDS id;
-        """)
-        logging.info("已添加chat_sessions.id索引")
-        
-        await execute_raw_query("""
-        DEFINE INDEX IF NOT EXISTS idx_chat_sessions_session_id ON chat_sessions FIELDS session_id;
-        """)
-        logging.info("已添加chat_sessions.session_id索引")
-        
-        await execute_raw_query("""
-        DEFINE INDEX IF NOT EXISTS idx_chat_sessions_user_id ON chat_sessions FIELDS user_id;
-        """)
-        logging.info("已添加chat_sessions.user_id索引")
-        
-        # 为chat_messages表添加索引
-        await execute_raw_query("""
-        DEFINE INDEX IF NOT EXISTS idx_chat_messages_session_id ON chat_messages FIELDS session_id;
-        """)
-        logging.info("已添加chat_messages.session_id索引")
-        
-        await execute_raw_query("""
-        DEFINE INDEX IF NOT EXISTS idx_chat_messages_user_id ON chat_messages FIELDS user_id;
-        """)
-        logging.info("已添加chat_messages.user_id索引")
-        
-        logging.info("聊天表索引添加完成")
+        logging.info("开始应用数据库索引迁移...")
+        version = await run_migrations()
+        logging.info(f"数据库索引迁移完成，当前版本: v{version}")
         return True
     except Exception as e:
-        logging.error(f"添加聊天表索引失败: {str(e)}")
+        logging.error(f"应用数据库索引迁移失败: {str(e)}")
         return False
 
 if __name__ == "__main__":
     import asyncio
-    asyncio.run(run_migration())
+    from app.db import init_db_connection, close_db
+
+    async def main():
+        await init_db_connection()
+        try:
+            await run_migration()
+        finally:
+            await close_db()
+
+    asyncio.run(main())
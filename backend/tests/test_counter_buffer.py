@@ -0,0 +1,101 @@
+"""
+CounterBuffer 与原子自增测试：合并增量、失败重试不重复应用、不重新创建已删除的记录
+"""
+
+import asyncio
+
+from app.db import CounterBuffer, Repository, SingleFlight
+from app.db_sqlite import SQLiteBackend
+
+
+def run_with_repo(scenario):
+    async def main():
+        backend = SQLiteBackend(":memory:")
+        await backend.start()
+        try:
+            await scenario(Repository(backend, None, SingleFlight()))
+        finally:
+            await backend.close()
+
+    asyncio.run(main())
+
+
+def test_increment_is_update_only():
+    async def scenario(repo):
+        await repo.create("users", {"id": "users:1", "visits": 1})
+        assert await repo.increment("users", "users:1", "visits", 2) == 3
+        assert await repo.increment("users", "users:missing", "visits") is None
+        assert await repo.query("users", {"id": "users:missing"}) == []
+
+    run_with_repo(scenario)
+
+
+def test_flush_coalesces_increments_per_record():
+    async def scenario(repo):
+        await repo.create("users", {"id": "users:1", "conversation_count": 0})
+        buffer = CounterBuffer(repo)
+        for _ in range(5):
+            buffer.add("users", "users:1", "conversation_count", fields={"last_seen": "t"})
+        assert await buffer.flush() == 1
+        record = (await repo.query("users", {"id": "users:1"}))[0]
+        assert record["conversation_count"] == 5
+        assert record["last_seen"] == "t"
+        stats = buffer.stats()
+        assert (stats["added"], stats["records_written"], stats["coalescing_ratio"]) == (5, 1, 5.0)
+
+    run_with_repo(scenario)
+
+
+def test_deleted_records_are_not_recreated():
+    async def scenario(repo):
+        await repo.create("users", {"id": "users:1", "conversation_count": 0})
+        buffer = CounterBuffer(repo)
+        buffer.add("users", "users:1", "conversation_count")
+        await repo.delete_record("users", "users:1")
+        await buffer.flush()
+        assert await repo.query("users", {"id": "users:1"}) == []
+
+    run_with_repo(scenario)
+
+
+def test_failed_chunk_is_retried_without_double_counting(monkeypatch):
+    async def scenario(repo):
+        monkeypatch.setattr("app.db.BULK_INSERT_CHUNK_SIZE", 2)
+        for i in range(4):
+            await repo.create("users", {"id": f"users:{i}", "n": 0})
+        buffer = CounterBuffer(repo)
+        for i in range(4):
+            buffer.add("users", f"users:{i}", "n")
+
+        # 第二个分块的事务失败：整个分块回滚，只有它放回缓冲区
+        transaction = repo.transaction
+        calls = []
+
+        def failing_transaction():
+            batch = transaction()
+            calls.append(batch)
+            if len(calls) == 2:
+                batch.raw("THIS IS NOT VALID")
+            return batch
+
+        monkeypatch.setattr(repo, "transaction", failing_transaction)
+        assert await buffer.flush() == 2
+        assert buffer.stats()["pending_records"] == 2
+        assert buffer.stats()["flush_failures"] == 1
+
+        monkeypatch.setattr(repo, "transaction", transaction)
+        buffer.add("users", "users:3", "n")
+        assert await buffer.flush() == 2
+        counts = {row["id"]: row["n"] for row in await repo.query("users")}
+        assert counts == {"users:0": 1, "users:1": 1, "users:2": 1, "users:3": 2}
+
+    run_with_repo(scenario)
+
+
+def test_flush_without_pending_counts_is_a_no_op():
+    async def scenario(repo):
+        buffer = CounterBuffer(repo)
+        assert await buffer.flush() == 0
+        assert buffer.stats()["flushes"] == 0
+
+    run_with_repo(scenario)
@@ -0,0 +1,169 @@
+"""
+SurrealConnectionPool 测试：借出与归还、排队超时、错误剔除和健康检查
+"""
+
+import asyncio
+
+import pytest
+
+from app.db import SurrealConnectionPool
+
+
+class FakeConnection:
+    """模拟的 SurrealDB 连接，alive 为 False 时探活查询失败"""
+
+    def __init__(self):
+        self.alive = True
+        self.closed = False
+
+    async def query(self, statement, params=None):
+        if not self.alive:
+            raise ConnectionError("connection lost")
+        return [{"status": "OK", "result": []}]
+
+    async def close(self):
+        self.closed = True
+
+
+def make_pool(**kwargs):
+    kwargs.setdefault("min_size", 0)
+    kwargs.setdefault("max_size", 2)
+    kwargs.setdefault("health_check_interval", 0)
+    pool = SurrealConnectionPool("ws://test", "root", "root", "test", "test", **kwargs)
+    pool.opened = []
+
+    async def open_dedicated():
+        conn = FakeConnection()
+        pool.opened.append(conn)
+        return conn
+
+    pool.open_dedicated = open_dedicated
+    return pool
+
+
+def test_released_connection_is_reused():
+    async def scenario():
+        pool = make_pool()
+        async with pool.connection() as first:
+            pass
+        async with pool.connection() as second:
+            assert second is first
+        assert pool.size == 1
+        assert pool.idle_count == 1
+        assert pool.stats()["acquired"] == 2
+
+    asyncio.run(scenario())
+
+
+def test_acquire_times_out_when_pool_is_full():
+    async def scenario():
+        pool = make_pool(max_size=1)
+        conn = await pool.acquire()
+        with pytest.raises(asyncio.TimeoutError):
+            await pool.acquire(timeout=0.01)
+        assert pool.stats()["acquire_timeouts"] == 1
+        assert pool.size == 1
+
+        await pool.release(conn)
+        assert await pool.acquire(timeout=0.01) is conn
+
+    asyncio.run(scenario())
+
+
+def test_connect_timeout_raises_connection_error():
+    async def scenario():
+        pool = make_pool()
+
+        async def slow_open():
+            await asyncio.sleep(1)
+
+        pool.open_dedicated = slow_open
+        with pytest.raises(ConnectionError):
+            await pool.acquire(timeout=1, connect_timeout=0.01)
+        # 建立失败的连接不占用连接数和信号量名额
+        assert pool.size == 0
+        assert not pool._get_semaphore().locked()
+
+    asyncio.run(scenario())
+
+
+def test_connection_error_evicts_connection():
+    async def scenario():
+        pool = make_pool()
+        with pytest.raises(ConnectionError):
+            async with pool.connection() as conn:
+                raise ConnectionError("connection reset")
+        assert conn.closed
+        assert pool.size == 0
+        assert pool.stats()["evicted_on_error"] == 1
+
+    asyncio.run(scenario())
+
+
+def test_query_error_keeps_connection():
+    async def scenario():
+        pool = make_pool()
+        with pytest.raises(ValueError):
+            async with pool.connection() as conn:
+                raise ValueError("parse error")
+        assert not conn.closed
+        assert pool.idle_count == 1
+
+    asyncio.run(scenario())
+
+
+def test_health_check_evicts_dead_idle_connections():
+    async def scenario():
+        pool = make_pool(min_size=2, health_check_interval=0.01)
+        await pool.start()
+        dead = pool.opened[0]
+        dead.alive = False
+        await asyncio.sleep(0.1)
+        await pool.close()
+        assert dead.closed
+        assert pool.stats()["health_check_failures"] >= 1
+        # 剔除后补足了最小连接数
+        assert len(pool.opened) >= 3
+
+    asyncio.run(scenario())
+
+
+def test_health_check_holds_a_slot_per_probed_connection():
+    async def scenario():
+        pool = make_pool(min_size=1, max_size=1, health_check_interval=0.01)
+        probing = asyncio.Event()
+        finish = asyncio.Event()
+
+        async def slow_probe(conn):
+            probing.set()
+            await finish.wait()
+            return True
+
+        pool._probe = slow_probe
+        await pool.start()
+        await probing.wait()
+        # 唯一的连接正在被探测，占用了唯一的名额，acquire 不会新建第二条连接
+        with pytest.raises(asyncio.TimeoutError):
+            await pool.acquire(timeout=0.01)
+        assert pool.size == 1
+
+        finish.set()
+        conn = await pool.acquire(timeout=1)
+        assert conn is pool.opened[0]
+        await pool.release(conn)
+        await pool.close()
+
+    asyncio.run(scenario())
+
+
+def test_close_closes_idle_connections():
+    async def scenario():
+        pool = make_pool(min_size=2)
+        await pool.start()
+        await pool.close()
+        assert pool.size == 0
+        assert all(conn.closed for conn in pool.opened)
+        with pytest.raises(ConnectionError):
+            await pool.acquire()
+
+    asyncio.run(scenario())
@@ -0,0 +1,49 @@
+"""
+游标分页测试：游标的编码与解码，以及 (排序字段, id) 之后的 WHERE 条件
+"""
+
+import pytest
+
+from app.db import encode_cursor, decode_cursor, _build_select
+
+
+def test_cursor_round_trip():
+    cursor = encode_cursor("2024-05-01T12:00:00", "message:abc")
+    assert "=" not in cursor
+    assert decode_cursor(cursor) == ("2024-05-01T12:00:00", "message:abc")
+
+
+def test_cursor_keeps_value_types():
+    assert decode_cursor(encode_cursor(42, "users:1")) == (42, "users:1")
+    assert decode_cursor(encode_cursor(None, "chat:x")) == (None, "chat:x")
+    assert decode_cursor(encode_cursor("会话", "chat:中文")) == ("会话", "chat:中文")
+
+
+@pytest.mark.parametrize("cursor", [
+    "not-a-cursor",
+    encode_cursor("2024-05-01", "no-table-prefix"),
+    "",
+])
+def test_invalid_cursor_raises_value_error(cursor):
+    with pytest.raises(ValueError):
+        decode_cursor(cursor)
+
+
+def test_ascending_page_after_cursor():
+    query_str, params = _build_select(
+        "message", {"chat_id": "chat:a"}, sort=[("timestamp", "ASC"), ("id", "ASC")], limit=20,
+        after=("timestamp", False, "2024-05-01", "message:abc")
+    )
+    assert query_str == (
+        "SELECT * FROM message WHERE chat_id = $p0 AND (timestamp > $pkv OR (timestamp = $pkv"
+        " AND id > type::thing($pktb, $pkid))) ORDER BY timestamp ASC, id ASC LIMIT $plimit"
+    )
+    assert params == {"p0": "chat:a", "pkv": "2024-05-01", "pktb": "message", "pkid": "abc", "plimit": 20}
+
+
+def test_descending_page_by_id_only():
+    query_str, params = _build_select(
+        "users", sort=[("id", "DESC")], limit=10, after=("id", True, "users:9", "users:9")
+    )
+    assert query_str == "SELECT * FROM users WHERE id < type::thing($pktb, $pkid) ORDER BY id DESC LIMIT $plimit"
+    assert params == {"pktb": "users", "pkid": "9", "plimit": 10}
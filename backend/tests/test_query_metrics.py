@@ -0,0 +1,64 @@
+"""
+QueryMetrics 测试：按表和语句形状的统计、慢查询记录和形状数量上限
+"""
+
+from app.db_metrics import QueryMetrics, query_shape
+
+
+def make_metrics(**kwargs):
+    kwargs.setdefault("enabled", True)
+    kwargs.setdefault("payload", True)
+    kwargs.setdefault("slow_threshold_ms", 100)
+    kwargs.setdefault("table_thresholds", {})
+    return QueryMetrics(**kwargs)
+
+
+def test_records_per_table_and_shape():
+    metrics = make_metrics()
+    shape = query_shape("select", "users", {"email": "a@example.com"}, limit=1)
+    metrics.record("select", "users", shape, 0.004, [{"id": "users:1"}])
+    metrics.record("select", "users", shape, 0.020, [])
+    metrics.record("count", "message", query_shape("count", "message"), 0.001, 7, error=ValueError("boom"))
+
+    snapshot = metrics.snapshot()
+    users = snapshot["tables"]["users"]
+    assert (users["count"], users["rows"], users["errors"]) == (2, 1, 0)
+    assert users["max_ms"] == 20.0
+    assert users["p50_ms"] == 5
+    assert snapshot["tables"]["message"]["errors"] == 1
+    assert snapshot["shapes"][0]["shape"] == "SELECT * FROM users WHERE email LIMIT"
+    assert metrics.stats() == {"enabled": True, "requests": 3, "errors": 1, "shapes": 2, "slow_queries": 0}
+
+
+def test_shapes_do_not_contain_values():
+    first = query_shape("select", "message", {"chat_id": "chat:a"}, [("timestamp", "ASC")], limit=20, offset=40)
+    second = query_shape("select", "message", {"chat_id": "chat:b"}, [("timestamp", 1)], limit=50, offset=80)
+    assert first == second == "SELECT * FROM message WHERE chat_id ORDER BY timestamp ASC LIMIT START"
+
+
+def test_slow_queries_use_table_thresholds():
+    metrics = make_metrics(table_thresholds={"memory": 10}, slow_log_size=2)
+    metrics.record("select", "users", "SELECT * FROM users", 0.050)
+    metrics.record("select", "memory", "SELECT * FROM memory", 0.050)
+    metrics.record("select", "users", "SELECT * FROM users", 0.150)
+    metrics.record("select", "users", "SELECT * FROM users", 0.200)
+
+    slow = metrics.slow_queries()
+    assert slow["total"] == 3
+    # 环形缓冲区只保留最近的记录，最新的在前
+    assert [entry["elapsed_ms"] for entry in slow["queries"]] == [200.0, 150.0]
+
+
+def test_shape_count_is_capped():
+    metrics = make_metrics(max_shapes=2)
+    for i in range(5):
+        metrics.record("select", "users", f"shape {i}", 0.001)
+    shapes = {entry["shape"]: entry["count"] for entry in metrics.snapshot()["shapes"]}
+    assert shapes == {"shape 0": 1, "shape 1": 1, "(other)": 3}
+
+
+def test_disabled_metrics_record_nothing():
+    metrics = make_metrics(enabled=False)
+    metrics.record("select", "users", "SELECT * FROM users", 1.0)
+    assert metrics.stats()["requests"] == 0
+    assert metrics.slow_queries()["total"] == 0
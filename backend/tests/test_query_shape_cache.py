@@ -0,0 +1,51 @@
+"""
+QueryShapeCache 测试：同一形状只编译一次，值全部作为参数绑定
+"""
+
+from app.db import QueryShapeCache, _build_select
+
+
+def test_same_shape_is_compiled_once():
+    cache = QueryShapeCache()
+    first = cache.compile("message", ("chat_id",), (("timestamp", "ASC"),), True, True)
+    second = cache.compile("message", ("chat_id",), (("timestamp", "ASC"),), True, True)
+    assert first is second
+    assert first[0] == "SELECT * FROM message WHERE chat_id = $p0 ORDER BY timestamp ASC LIMIT $plimit START $pstart"
+
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["size"]) == (1, 1, 1)
+    assert stats["top_shapes"][0] == {"query": first[0], "count": 2}
+
+
+def test_limit_and_offset_are_bound_as_params():
+    first_query, first_params = _build_select("message", {"chat_id": "chat:a"}, limit=20, offset=0)
+    second_query, second_params = _build_select("message", {"chat_id": "chat:b"}, limit=50, offset=100)
+    assert first_query == second_query
+    assert first_params == {"p0": "chat:a", "plimit": 20, "pstart": 0}
+    assert second_params == {"p0": "chat:b", "plimit": 50, "pstart": 100}
+
+
+def test_different_shapes_get_different_templates():
+    cache = QueryShapeCache()
+    with_limit = cache.compile("users", ("email",), (), True, False)
+    without_limit = cache.compile("users", ("email",), (), False, False)
+    projected = cache.compile("users", ("email",), (), False, False, fields=("id", "email"))
+    assert with_limit[0] == "SELECT * FROM users WHERE email = $p0 LIMIT $plimit"
+    assert without_limit[0] == "SELECT * FROM users WHERE email = $p0"
+    assert projected[0] == "SELECT id, email FROM users WHERE email = $p0"
+    assert cache.stats()["misses"] == 3
+
+
+def test_least_recently_used_shape_is_evicted():
+    cache = QueryShapeCache(max_size=2)
+    cache.compile("a", (), (), False, False)
+    cache.compile("b", (), (), False, False)
+    # 使用 a 之后，b 成为最久未使用的形状
+    cache.compile("a", (), (), False, False)
+    cache.compile("c", (), (), False, False)
+
+    stats = cache.stats()
+    assert stats["evictions"] == 1
+    assert {shape["query"] for shape in stats["top_shapes"]} == {"SELECT * FROM a", "SELECT * FROM c"}
+    cache.compile("b", (), (), False, False)
+    assert cache.stats()["misses"] == 4
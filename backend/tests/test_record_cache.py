@@ -0,0 +1,77 @@
+"""
+RecordCache 测试：TTL 过期、LRU 淘汰、唯一字段别名和版本号（generation）
+"""
+
+from app.db import RecordCache
+
+
+def test_get_returns_a_copy():
+    cache = RecordCache()
+    cache.put("users", {"id": "users:1", "profile": {"name": "a"}})
+    record = cache.get("users", "users:1")
+    record["profile"]["name"] = "changed"
+    assert cache.get("users", "users:1")["profile"]["name"] == "a"
+
+
+def test_entries_expire_after_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("app.db.time.monotonic", lambda: now[0])
+    cache = RecordCache(ttl=60)
+    cache.put("users", {"id": "users:1"})
+    now[0] += 59
+    assert cache.get("users", "users:1") is not None
+    now[0] += 2
+    assert cache.get("users", "users:1") is None
+    assert cache.stats()["tables"]["users"]["expired"] == 1
+
+
+def test_least_recently_used_record_is_evicted():
+    cache = RecordCache(default_size=2)
+    cache.put("users", {"id": "users:1"})
+    cache.put("users", {"id": "users:2"})
+    cache.get("users", "users:1")
+    cache.put("users", {"id": "users:3"})
+    assert cache.get("users", "users:2") is None
+    assert cache.get("users", "users:1") is not None
+    assert cache.stats()["tables"]["users"]["evictions"] == 1
+
+
+def test_put_is_dropped_when_generation_changed():
+    cache = RecordCache()
+    generation = cache.generation("users")
+    # 读取期间有写入：旧记录不能写入缓存
+    cache.invalidate("users", "users:1")
+    cache.put("users", {"id": "users:1", "name": "old"}, generation)
+    assert cache.get("users", "users:1") is None
+    assert cache.stats()["tables"]["users"]["stale_puts"] == 1
+
+    cache.put("users", {"id": "users:1", "name": "new"}, cache.generation("users"))
+    assert cache.get("users", "users:1")["name"] == "new"
+
+
+def test_invalidate_record_and_table():
+    cache = RecordCache()
+    cache.put("users", {"id": "users:1"})
+    cache.put("users", {"id": "users:2"})
+    cache.invalidate("users", "1")
+    assert cache.get("users", "users:1") is None
+    assert cache.get("users", "users:2") is not None
+    cache.invalidate("users")
+    assert cache.get("users", "users:2") is None
+
+
+def test_unique_field_alias_is_cleared_on_write():
+    cache = RecordCache(unique_fields={"users": "email"})
+    cache.put("users", {"id": "users:1", "email": "a@example.com"})
+    assert cache.get_by_unique("users", "a@example.com")["id"] == "users:1"
+    # 同表其他记录的写入也可能修改唯一字段，别名全部清空
+    cache.invalidate("users", "users:2")
+    assert cache.get_by_unique("users", "a@example.com") is None
+    assert cache.get("users", "users:1") is not None
+
+
+def test_disabled_tables_are_not_cached():
+    cache = RecordCache(table_sizes={"message": 0})
+    cache.put("message", {"id": "message:1"})
+    assert cache.get("message", "message:1") is None
+    assert RecordCache(ttl=0).enabled("users") is False
@@ -0,0 +1,127 @@
+"""
+Repository 测试：使用嵌入式 SQLite 存储后端，覆盖读写、分页、批处理、事务和记录缓存
+"""
+
+import asyncio
+
+import pytest
+
+from app.db import Repository, RecordCache, SingleFlight, BatchStatementError
+from app.db_sqlite import SQLiteBackend
+
+
+def run_with_repo(scenario, cache=None):
+    """在新的内存数据库上运行 scenario(repo, backend)"""
+    async def main():
+        backend = SQLiteBackend(":memory:")
+        await backend.start()
+        try:
+            await scenario(Repository(backend, cache, SingleFlight()), backend)
+        finally:
+            await backend.close()
+
+    asyncio.run(main())
+
+
+def test_create_query_merge_update_delete():
+    async def scenario(repo, backend):
+        created = await repo.create("users", {"email": "a@example.com", "profile": {"name": "a"}})
+        assert created["id"].startswith("users:")
+        assert await repo.query("users", {"email": "a@example.com"}) == [created]
+
+        await repo.merge("users", created["id"], {"profile": {"age": 3}})
+        record = (await repo.query("users", {"id": created["id"]}))[0]
+        assert record["profile"] == {"name": "a", "age": 3}
+
+        await repo.update("users", created["id"], {"email": "b@example.com"})
+        record = (await repo.query("users", {"id": created["id"]}))[0]
+        assert record == {"id": created["id"], "email": "b@example.com"}
+
+        assert await repo.delete_record("users", created["id"]) is True
+        assert await repo.query("users", {"id": created["id"]}) == []
+
+    run_with_repo(scenario)
+
+
+def test_sort_limit_offset_count_and_projection():
+    async def scenario(repo, backend):
+        await repo.create_many("message", [
+            {"chat_id": "chat:a", "timestamp": f"2024-01-0{i}", "content": str(i)} for i in range(1, 6)
+        ])
+        await repo.create("message", {"chat_id": "chat:b", "timestamp": "2024-01-01", "content": "x"})
+
+        assert await repo.count("message", {"chat_id": "chat:a"}) == 5
+        rows = await repo.query("message", {"chat_id": "chat:a"}, sort=[("timestamp", "DESC")], limit=2, offset=1)
+        assert [row["content"] for row in rows] == ["4", "3"]
+
+        rows = await repo.query("message", {"chat_id": "chat:b"}, fields=["content"])
+        assert set(rows[0]) == {"id", "content"}
+
+    run_with_repo(scenario)
+
+
+def test_query_page_walks_all_records_with_ties():
+    async def scenario(repo, backend):
+        # 相同的 timestamp 按 id 区分先后，翻页不会重复或遗漏
+        await repo.create_many("message", [
+            {"id": f"message:{i:02d}", "chat_id": "chat:a", "timestamp": f"2024-01-0{i // 3}"} for i in range(10)
+        ])
+        seen, cursor = [], None
+        while True:
+            page = await repo.query_page("message", {"chat_id": "chat:a"}, limit=3, cursor=cursor)
+            seen.extend(row["id"] for row in page["items"])
+            if not page["has_more"]:
+                break
+            cursor = page["next_cursor"]
+        assert seen == [f"message:{i:02d}" for i in range(10)]
+
+        iterated = [row["id"] async for row in repo.query_iter("message", chunk_size=4)]
+        assert iterated == seen
+
+    run_with_repo(scenario)
+
+
+def test_batch_returns_results_in_order():
+    async def scenario(repo, backend):
+        await repo.create("chat", {"id": "chat:a", "title": "t"})
+        batch = repo.batch()
+        batch.create("message", {"chat_id": "chat:a"})
+        batch.count("message", {"chat_id": "chat:a"})
+        batch.query("chat", {"id": "chat:a"})
+        created, count, chats = await batch.execute()
+        assert created["chat_id"] == "chat:a"
+        assert count == 1
+        assert chats[0]["title"] == "t"
+
+    run_with_repo(scenario)
+
+
+def test_transaction_rolls_back_on_failure():
+    async def scenario(repo, backend):
+        await repo.execute_raw("DEFINE INDEX idx_users_email ON users FIELDS email UNIQUE")
+        await repo.create("users", {"id": "users:1", "email": "a@example.com"})
+
+        tx = repo.transaction()
+        tx.create("users", {"id": "users:2", "email": "b@example.com"})
+        tx.create("users", {"id": "users:3", "email": "a@example.com"})
+        with pytest.raises(BatchStatementError) as error:
+            await tx.execute()
+        assert error.value.index == 1
+        assert await repo.count("users") == 1
+
+    run_with_repo(scenario)
+
+
+def test_id_lookups_are_served_from_record_cache():
+    async def scenario(repo, backend):
+        await repo.create("users", {"id": "users:1", "name": "a"})
+        await repo.query("users", {"id": "users:1"})
+        await repo.query("users", {"id": "users:1"})
+        assert backend.stats()["statements"]["select"] == 1
+
+        # 写入使缓存失效，下一次读取拿到新值
+        await repo.merge("users", "users:1", {"name": "b"})
+        assert (await repo.query("users", {"id": "users:1"}))[0]["name"] == "b"
+        assert backend.stats()["statements"]["select"] == 2
+
+    run_with_repo(scenario, cache=RecordCache())
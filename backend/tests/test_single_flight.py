@@ -0,0 +1,121 @@
+"""
+SingleFlight 测试：并发的相同读请求只执行一次，写入后不再加入旧的读请求
+"""
+
+import asyncio
+
+import pytest
+
+from app.db import SingleFlight
+
+
+def test_concurrent_calls_share_one_execution():
+    async def scenario():
+        flight = SingleFlight()
+        calls = []
+        release = asyncio.Event()
+
+        async def read():
+            calls.append(1)
+            await release.wait()
+            return [{"id": "users:1"}]
+
+        waiters = [asyncio.ensure_future(flight.do(("query", "users"), read)) for _ in range(3)]
+        await asyncio.sleep(0)
+        release.set()
+        results = await asyncio.gather(*waiters)
+
+        assert len(calls) == 1
+        assert results == [[{"id": "users:1"}]] * 3
+        # 每个调用方拿到独立的副本
+        results[0][0]["id"] = "changed"
+        assert results[1][0]["id"] == "users:1"
+        stats = flight.stats()
+        assert (stats["executed"], stats["deduplicated"], stats["in_flight"]) == (1, 2, 0)
+
+    asyncio.run(scenario())
+
+
+def test_forget_starts_a_new_read_after_write():
+    async def scenario():
+        flight = SingleFlight()
+        versions = iter(["before", "after"])
+        release = asyncio.Event()
+
+        async def read():
+            value = next(versions)
+            await release.wait()
+            return value
+
+        first = asyncio.ensure_future(flight.do(("query", "users"), read))
+        await asyncio.sleep(0)
+        flight.forget("users")
+        second = asyncio.ensure_future(flight.do(("query", "users"), read))
+        await asyncio.sleep(0)
+        release.set()
+
+        assert await first == "before"
+        assert await second == "after"
+        assert flight.stats()["forgotten"] == 1
+
+    asyncio.run(scenario())
+
+
+def test_forget_matches_all_tables_of_a_batch():
+    async def scenario():
+        flight = SingleFlight()
+        release = asyncio.Event()
+
+        async def read():
+            await release.wait()
+            return 1
+
+        task = asyncio.ensure_future(flight.do(("batch", "stmt"), read, tables={"chat", "message"}))
+        await asyncio.sleep(0)
+        flight.forget("users")
+        assert flight.stats()["in_flight"] == 1
+        flight.forget("message")
+        assert flight.stats()["in_flight"] == 0
+        release.set()
+        assert await task == 1
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_caller_does_not_cancel_shared_read():
+    async def scenario():
+        flight = SingleFlight()
+        release = asyncio.Event()
+
+        async def read():
+            await release.wait()
+            return "value"
+
+        first = asyncio.ensure_future(flight.do(("query", "users"), read))
+        second = asyncio.ensure_future(flight.do(("query", "users"), read))
+        await asyncio.sleep(0)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        release.set()
+        assert await second == "value"
+
+    asyncio.run(scenario())
+
+
+def test_errors_are_shared_and_not_cached():
+    async def scenario():
+        flight = SingleFlight()
+
+        async def fail():
+            raise ValueError("boom")
+
+        with pytest.raises(ValueError):
+            await flight.do(("query", "users"), fail)
+
+        async def succeed():
+            return "ok"
+
+        assert await flight.do(("query", "users"), succeed) == "ok"
+
+    asyncio.run(scenario())
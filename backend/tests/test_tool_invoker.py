@@ -0,0 +1,103 @@
+"""
+ToolInvoker 测试：并发执行、结果顺序、单个调用超时和工具定义
+"""
+
+import asyncio
+import time
+
+from app.agent.tool_invoker import ToolInvoker
+
+
+def test_invoke_tools_runs_concurrently_and_keeps_order():
+    async def scenario():
+        invoker = ToolInvoker()
+
+        async def slow_echo(text: str, delay: float):
+            await asyncio.sleep(delay)
+            return text
+
+        def sync_echo(text: str):
+            time.sleep(0.1)
+            return text.upper()
+
+        invoker.register_tool("slow_echo", slow_echo, "异步回显", {"text": {"type": "string"}, "delay": {"type": "number"}})
+        invoker.register_tool("sync_echo", sync_echo, "同步回显", {"text": {"type": "string"}})
+
+        started = time.monotonic()
+        results = await invoker.invoke_tools([
+            ("slow_echo", {"text": "a", "delay": 0.1}),
+            ("sync_echo", {"text": "b"}),
+            ("slow_echo", {"text": "c", "delay": 0.01}),
+        ])
+        elapsed = time.monotonic() - started
+
+        assert results == ["a", "B", "c"]
+        # 三个调用并发执行，总耗时接近最慢的一个而不是三者之和
+        assert elapsed < 0.2
+
+    asyncio.run(scenario())
+
+
+def test_timeout_only_affects_the_slow_call():
+    async def scenario():
+        invoker = ToolInvoker()
+
+        async def hang():
+            await asyncio.sleep(1)
+            return "never"
+
+        async def quick():
+            return "ok"
+
+        invoker.register_tool("hang", hang, "不返回", {})
+        invoker.register_tool("quick", quick, "立即返回", {})
+
+        results = await invoker.invoke_tools([("hang", {}), ("quick", {})], timeout=0.05)
+        assert results[0].startswith("工具调用超时: hang")
+        assert results[1] == "ok"
+
+    asyncio.run(scenario())
+
+
+def test_unknown_tool_and_errors_become_result_text():
+    async def scenario():
+        invoker = ToolInvoker()
+
+        def broken():
+            raise ValueError("boom")
+
+        invoker.register_tool("broken", broken, "总是失败", {})
+
+        results = await invoker.invoke_tools([("missing", {}), ("broken", None)])
+        assert results == ["工具 missing 不存在", "工具调用失败: boom"]
+
+    asyncio.run(scenario())
+
+
+def test_invoke_tool_rejects_async_tools():
+    invoker = ToolInvoker()
+
+    async def async_tool():
+        return "ok"
+
+    invoker.register_tool("async_tool", async_tool, "异步工具", {})
+    assert invoker.invoke_tool("async_tool") == "工具 async_tool 是异步函数，请使用 ainvoke_tool 调用"
+    assert invoker.invoke_tool("missing") == "工具 missing 不存在"
+
+
+def test_register_tool_replaces_definition_and_strips_optional():
+    invoker = ToolInvoker()
+    invoker.register_tool("lookup", lambda key: key, "旧描述", {"key": {"type": "string"}})
+    invoker.register_tool(
+        "lookup",
+        lambda key, limit=10: key,
+        "新描述",
+        {"key": {"type": "string"}, "limit": {"type": "integer", "optional": True}},
+    )
+
+    definitions = [d for d in invoker.get_tool_definitions() if d["function"]["name"] == "lookup"]
+    assert len(definitions) == 1
+    function = definitions[0]["function"]
+    assert function["description"] == "新描述"
+    assert function["parameters"]["required"] == ["key"]
+    assert function["parameters"]["properties"]["limit"] == {"type": "integer"}
@@ -0,0 +1,139 @@
+"""
+WriteBehindQueue 测试：按 key 保序、事务失败后逐个重试、重试耗尽后丢弃以及关闭时写完
+"""
+
+import asyncio
+
+import pytest
+
+from app.tasks.write_behind import WriteBehindQueue
+
+
+class FakeTransaction:
+    def __init__(self, repository):
+        self._repository = repository
+        self.ops = []
+
+    def create(self, table, data):
+        self.ops.append(("create", table, data))
+
+    def merge(self, table, id, data):
+        self.ops.append(("merge", table, id, data))
+
+    async def execute(self):
+        for op in self.ops:
+            name = op[-1].get("name") if isinstance(op[-1], dict) else None
+            if self._repository.failures.get(name, 0) > 0:
+                self._repository.failures[name] -= 1
+                raise ValueError(f"write failed: {name}")
+        self._repository.written.extend(op[-1]["name"] for op in self.ops)
+        return [None] * len(self.ops)
+
+
+class FakeRepository:
+    """记录写入顺序；failures 为 {写操作名称: 剩余失败次数}"""
+
+    def __init__(self, failures=None):
+        self.failures = dict(failures or {})
+        self.written = []
+
+    def transaction(self):
+        return FakeTransaction(self)
+
+
+def make_queue(repository, **kwargs):
+    kwargs.setdefault("retry_delay", 0.01)
+    return WriteBehindQueue(repository, **kwargs)
+
+
+def op(name):
+    return ("create", "message", {"name": name})
+
+
+def test_writes_keep_submission_order_and_call_back():
+    async def scenario():
+        repository = FakeRepository()
+        queue = make_queue(repository)
+        written = []
+        for name in ("a1", "a2", "a3"):
+            await queue.submit("session:a", [op(name)], on_written=lambda name=name: written.append(name))
+        await queue.submit("session:b", [op("b1"), ("merge", "chat_sessions", "session:b", {"name": "b2"})])
+        await queue.drain(1)
+
+        assert repository.written == ["a1", "a2", "a3", "b1", "b2"]
+        assert written == ["a1", "a2", "a3"]
+        assert queue.stats()["pending"] == 0
+        assert queue.stats()["written"] == 4
+
+    asyncio.run(scenario())
+
+
+def test_failed_key_is_retried_in_order_without_blocking_other_keys():
+    async def scenario():
+        repository = FakeRepository(failures={"a1": 2})
+        queue = make_queue(repository)
+        await queue.submit("session:a", [op("a1")])
+        await queue.submit("session:a", [op("a2")])
+        await queue.submit("session:b", [op("b1")])
+
+        await queue.flush()
+        # 整批事务失败后逐个写入：a1 等待重试，a2 排在它后面，b1 不受影响
+        assert repository.written == ["b1"]
+        stats = queue.stats()
+        assert (stats["batch_failures"], stats["retries"], stats["pending"]) == (1, 1, 2)
+
+        await queue.drain(1)
+        assert repository.written == ["b1", "a1", "a2"]
+
+    asyncio.run(scenario())
+
+
+def test_entry_is_dropped_after_max_retries():
+    async def scenario():
+        repository = FakeRepository(failures={"a1": 10})
+        queue = make_queue(repository, max_retries=2)
+        await queue.submit("session:a", [op("a1")])
+        await queue.submit("session:a", [op("a2")])
+        await queue.drain(1)
+
+        assert repository.written == ["a2"]
+        assert queue.stats()["dropped"] == 1
+        assert queue.stats()["pending"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_submit_waits_when_queue_is_full():
+    async def scenario():
+        repository = FakeRepository()
+        queue = make_queue(repository, max_pending=1)
+        await queue.submit("session:a", [op("a1")])
+        await asyncio.wait_for(queue.submit("session:a", [op("a2")]), timeout=1)
+        await queue.drain(1)
+
+        assert repository.written == ["a1", "a2"]
+        assert queue.stats()["backpressure_waits"] >= 1
+
+    asyncio.run(scenario())
+
+
+def test_stop_writes_remaining_entries():
+    async def scenario():
+        repository = FakeRepository()
+        queue = make_queue(repository, flush_interval=60)
+        queue.start()
+        for i in range(3):
+            await queue.submit("session:a", [op(f"a{i}")])
+        await queue.stop()
+        assert repository.written == ["a0", "a1", "a2"]
+
+    asyncio.run(scenario())
+
+
+def test_unknown_operation_is_rejected():
+    async def scenario():
+        queue = make_queue(FakeRepository())
+        with pytest.raises(ValueError):
+            await queue.submit("session:a", [("delete", "message", {})])
+
+    asyncio.run(scenario())
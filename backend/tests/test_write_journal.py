@@ -0,0 +1,114 @@
+"""
+WriteJournal 测试：追加与按顺序确认、重启后恢复、checkpoint 和段文件删除
+"""
+
+import asyncio
+import os
+
+import pytest
+
+from app.db import SurrealBackend
+from app.db_journal import WriteJournal
+
+
+def segment_files(directory):
+    return sorted(name for name in os.listdir(directory) if name.endswith(".log"))
+
+
+def test_pending_records_survive_reopen(tmp_path):
+    journal = WriteJournal(str(tmp_path))
+    first = journal.append(["create", "users", {"id": "users:1"}])
+    second = journal.append(["merge", "users", "users:1", {"name": "a"}])
+    journal.ack(first)
+    journal.close()
+
+    reopened = WriteJournal(str(tmp_path))
+    reopened.open()
+    assert reopened.pending == 1
+    assert reopened.peek() == (second, ["merge", "users", "users:1", {"name": "a"}])
+    # 新记录的序号接在已有记录之后
+    assert reopened.append(["delete", "users", {"id": "users:1"}]) == second + 1
+
+
+def test_ack_must_follow_append_order(tmp_path):
+    journal = WriteJournal(str(tmp_path))
+    journal.append(["create", "a", {}])
+    second = journal.append(["create", "b", {}])
+    with pytest.raises(ValueError):
+        journal.ack(second)
+
+
+def test_truncated_last_line_is_skipped(tmp_path):
+    journal = WriteJournal(str(tmp_path))
+    journal.append(["create", "users", {"id": "users:1"}])
+    journal.close()
+    with open(os.path.join(str(tmp_path), segment_files(str(tmp_path))[0]), "a", encoding="utf-8") as f:
+        f.write('{"seq": 2, "op": ["crea')
+
+    reopened = WriteJournal(str(tmp_path))
+    reopened.open()
+    assert reopened.pending == 1
+
+
+def test_checkpoint_removes_fully_applied_segments(tmp_path):
+    directory = str(tmp_path)
+    journal = WriteJournal(directory, durability="batch", segment_bytes=80)
+    seqs = [journal.append(["merge", "users", f"users:{i}", {"n": i}]) for i in range(4)]
+    assert len(segment_files(directory)) == 4
+
+    for seq in seqs[:2]:
+        journal.ack(seq)
+    journal.checkpoint()
+    assert len(segment_files(directory)) == 2
+    assert journal.stats()["checkpoint"] == seqs[1]
+
+    for seq in seqs[2:]:
+        journal.ack(seq)
+    journal.checkpoint()
+    assert segment_files(directory) == []
+
+    # 全部删除后继续追加会新建段文件
+    journal.append(["merge", "users", "users:9", {}])
+    assert len(segment_files(directory)) == 1
+
+
+def test_append_async_and_sync_async(tmp_path):
+    async def scenario():
+        durable = WriteJournal(str(tmp_path / "fsync"))
+        assert await durable.append_async(["create", "a", {}]) == 1
+
+        batched = WriteJournal(str(tmp_path / "batch"), durability="batch")
+        await batched.append_async(["create", "a", {}])
+        assert batched._dirty
+        await batched.sync_async()
+        assert not batched._dirty
+
+    asyncio.run(scenario())
+
+
+def test_unknown_durability_is_rejected(tmp_path):
+    with pytest.raises(ValueError):
+        WriteJournal(str(tmp_path), durability="sometimes")
+
+
+def test_replay_turns_creates_into_idempotent_writes():
+    backend = SurrealBackend(pool=None)
+    batch = backend._replay_batch(["create", "users", {"id": "users:1", "name": "a"}])
+    # 按ID整体写入，重复重放不会产生重复记录
+    assert batch.compile() == (
+        "UPDATE type::thing($s0_tb, $s0_id) CONTENT $s0_data;",
+        {"s0_tb": "users", "s0_id": "1", "s0_data": {"id": "users:1", "name": "a"}}
+    )
+
+    batch = backend._replay_batch(["batch", True, [
+        ["create", "message", {"id": "message:1"}],
+        ["delete_record", "chat", "chat:a"],
+    ]])
+    statement, params = batch.compile()
+    assert statement == (
+        "BEGIN TRANSACTION;\n"
+        "UPDATE type::thing($s0_tb, $s0_id) CONTENT $s0_data;\n"
+        "DELETE type::thing($s1_tb, $s1_id);\n"
+        "COMMIT TRANSACTION;"
+    )
+    assert (params["s1_tb"], params["s1_id"]) == ("chat", "a")